@@ -0,0 +1,175 @@
+"""
+The alias_activity table keeps for each alias its number of forwards, blocks and replies
+and its latest email log, so alias listings don't aggregate the email_log table.
+
+It's maintained by the alias_activity_email_log trigger on email_log (migration 2026_101621_5c1e2f8a9b3d),
+for every insert, delete and change of is_reply, blocked or alias_id. Being in the database, it also covers
+bulk deletes and the email logs deleted by cascade, e.g. when a contact is deleted.
+
+The existing email logs are counted by the migration. rebuild_alias_activity() recomputes
+the table from email_log, check_alias_activity() compares it to email_log. To recompute an alias
+without locking email_log, its alias_activity row is locked first: the trigger of a concurrent
+email log waits for the commit and then updates the recomputed row.
+
+A dropped email_log partition doesn't fire the trigger, remove_email_log_partition_activity()
+is called before the drop instead.
+"""
+from typing import List
+
+from sqlalchemy import text, func
+
+from app.db import Session
+from app.log import LOG
+from app.models import Alias
+
+# activity of the aliases whose id is in [:min_id, :max_id), computed from email_log
+_ACTIVITY_QUERY = """
+SELECT alias.id AS alias_id,
+    coalesce(stats.nb_reply, 0) AS nb_reply,
+    coalesce(stats.nb_blocked, 0) AS nb_blocked,
+    coalesce(stats.nb_forward, 0) AS nb_forward,
+    latest.id AS latest_email_log_id,
+    latest.created_at AS latest_activity_at
+FROM alias
+LEFT JOIN (
+    SELECT alias_id,
+        count(*) FILTER (WHERE is_reply) AS nb_reply,
+        count(*) FILTER (WHERE NOT is_reply AND blocked) AS nb_blocked,
+        count(*) FILTER (WHERE NOT is_reply AND NOT blocked) AS nb_forward
+    FROM email_log
+    WHERE alias_id >= :min_id AND alias_id < :max_id
+    GROUP BY alias_id
+) stats ON stats.alias_id = alias.id
+LEFT JOIN LATERAL (
+    SELECT id, created_at FROM email_log
+    WHERE email_log.alias_id = alias.id
+    ORDER BY created_at DESC, id DESC
+    LIMIT 1
+) latest ON true
+WHERE alias.id >= :min_id AND alias.id < :max_id
+"""
+
+_REBUILD_QUERY = f"""
+INSERT INTO alias_activity
+    (created_at, alias_id, nb_reply, nb_blocked, nb_forward, latest_email_log_id, latest_activity_at)
+SELECT now() AT TIME ZONE 'utc', activity.*
+FROM ({_ACTIVITY_QUERY}) activity
+ON CONFLICT (alias_id) DO UPDATE SET
+    nb_reply = EXCLUDED.nb_reply,
+    nb_blocked = EXCLUDED.nb_blocked,
+    nb_forward = EXCLUDED.nb_forward,
+    latest_email_log_id = EXCLUDED.latest_email_log_id,
+    latest_activity_at = EXCLUDED.latest_activity_at,
+    updated_at = now() AT TIME ZONE 'utc'
+"""
+
+# the rows of the aliases whose id is in [:min_id, :max_id) are created if needed, then locked
+_CREATE_ROWS_QUERY = """
+INSERT INTO alias_activity (created_at, alias_id)
+SELECT now() AT TIME ZONE 'utc', id FROM alias
+WHERE id >= :min_id AND id < :max_id
+ORDER BY id
+ON CONFLICT (alias_id) DO NOTHING
+"""
+
+_LOCK_ROWS_QUERY = """
+SELECT alias_id FROM alias_activity
+WHERE alias_id >= :min_id AND alias_id < :max_id
+ORDER BY alias_id
+FOR UPDATE
+"""
+
+_CHECK_QUERY = f"""
+SELECT activity.alias_id
+FROM ({_ACTIVITY_QUERY}) activity
+LEFT JOIN alias_activity ON alias_activity.alias_id = activity.alias_id
+WHERE coalesce(alias_activity.nb_reply, 0) <> activity.nb_reply
+    OR coalesce(alias_activity.nb_blocked, 0) <> activity.nb_blocked
+    OR coalesce(alias_activity.nb_forward, 0) <> activity.nb_forward
+    OR alias_activity.latest_email_log_id IS DISTINCT FROM activity.latest_email_log_id
+"""
+
+# activity of the email logs of a partition, removed from the counters
+_REMOVE_PARTITION_QUERY = """
+UPDATE alias_activity SET
+    nb_reply = alias_activity.nb_reply - partition_activity.nb_reply,
+    nb_blocked = alias_activity.nb_blocked - partition_activity.nb_blocked,
+    nb_forward = alias_activity.nb_forward - partition_activity.nb_forward,
+    updated_at = now() AT TIME ZONE 'utc'
+FROM (
+    SELECT alias_id,
+        count(*) FILTER (WHERE is_reply) AS nb_reply,
+        count(*) FILTER (WHERE NOT is_reply AND blocked) AS nb_blocked,
+        count(*) FILTER (WHERE NOT is_reply AND NOT blocked) AS nb_forward
+    FROM {partition}
+    WHERE alias_id IS NOT NULL
+    GROUP BY alias_id
+) partition_activity
+WHERE alias_activity.alias_id = partition_activity.alias_id
+"""
+
+# the partitions are dropped oldest first: when the latest email log of an alias is in the dropped partition,
+# the alias has no other email log left
+_REMOVE_PARTITION_LATEST_QUERY = """
+UPDATE alias_activity SET latest_email_log_id = NULL, latest_activity_at = NULL
+FROM {partition}
+WHERE alias_activity.latest_email_log_id = {partition}.id
+"""
+
+
+def _alias_id_ranges(batch_size: int):
+    min_id, max_id = Session.query(func.min(Alias.id), func.max(Alias.id)).one()
+    if min_id is None:
+        return
+
+    for start in range(min_id, max_id + 1, batch_size):
+        yield start, start + batch_size
+
+
+def _rebuild_range(min_id: int, max_id: int):
+    """recompute the activity of the aliases whose id is in [min_id, max_id), doesn't commit"""
+    params = {"min_id": min_id, "max_id": max_id}
+    Session.execute(text(_CREATE_ROWS_QUERY), params)
+    # the email logs committed before the lock are read by the rebuild, the later ones update the rows after it
+    Session.execute(text(_LOCK_ROWS_QUERY), params)
+    Session.execute(text(_REBUILD_QUERY), params)
+
+
+def refresh_alias_activity(alias_id: int):
+    """recompute the activity of an alias from email_log, doesn't commit"""
+    _rebuild_range(alias_id, alias_id + 1)
+
+
+def remove_email_log_partition_activity(partition: str):
+    """remove the email logs of an email_log partition about to be dropped from the activity, doesn't commit"""
+    Session.execute(text(_REMOVE_PARTITION_QUERY.format(partition=partition)))
+    Session.execute(text(_REMOVE_PARTITION_LATEST_QUERY.format(partition=partition)))
+
+
+def rebuild_alias_activity(batch_size: int = 1_000):
+    """recompute the activity of all aliases, batch_size aliases (by id) per transaction"""
+    for min_id, max_id in _alias_id_ranges(batch_size):
+        _rebuild_range(min_id, max_id)
+        Session.commit()
+        LOG.d("alias activity rebuilt for alias %s -> %s", min_id, max_id)
+
+
+def check_alias_activity(batch_size: int = 10_000, fix: bool = False) -> List[int]:
+    """return the aliases whose activity doesn't match email_log, recompute them if fix"""
+    inconsistent_alias_ids = []
+    for min_id, max_id in _alias_id_ranges(batch_size):
+        alias_ids = [
+            r[0]
+            for r in Session.execute(
+                text(_CHECK_QUERY), {"min_id": min_id, "max_id": max_id}
+            )
+        ]
+        for alias_id in alias_ids:
+            LOG.w("alias activity of alias %s doesn't match email_log", alias_id)
+            if fix:
+                refresh_alias_activity(alias_id)
+
+        Session.commit()
+        inconsistent_alias_ids.extend(alias_ids)
+
+    return inconsistent_alias_ids
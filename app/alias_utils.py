@@ -11,6 +11,7 @@ from app.config import (
     VERP_PREFIX,
 )
 from app.db import Session
+from app.domain_registry import domain_registry
 from app.email_utils import (
     get_email_domain_part,
     send_cannot_create_directory_alias,
@@ -34,7 +35,7 @@ from app.models import (
     Contact,
     AutoCreateRule,
 )
-from app.regex_utils import regex_match
+from app.regex_utils import first_matching_rule
 
 
 def get_user_if_alias_would_auto_create(
@@ -74,9 +75,14 @@ def check_if_alias_can_be_auto_created_for_custom_domain(
     If there's no rule it's a catchall creation
     """
     alias_domain = get_email_domain_part(address)
-    custom_domain: CustomDomain = CustomDomain.get_by(domain=alias_domain)
+    custom_domain_info = domain_registry.get_custom_domain(alias_domain)
 
+    if not custom_domain_info:
+        return None
+
+    custom_domain: CustomDomain = CustomDomain.get(custom_domain_info.id)
     if not custom_domain:
+        # deleted by another process since it has been cached
         return None
 
     user: User = custom_domain.user
@@ -89,23 +95,34 @@ def check_if_alias_can_be_auto_created_for_custom_domain(
             send_cannot_create_domain_alias(custom_domain.user, address, alias_domain)
         return None
 
-    if not custom_domain.catch_all:
-        if len(custom_domain.auto_create_rules) == 0:
+    if not custom_domain_info.catch_all:
+        if len(custom_domain_info.auto_create_rules) == 0:
             return None
         local = get_email_local_part(address)
 
-        for rule in custom_domain.auto_create_rules:
-            if regex_match(rule.regex, local):
+        rules = custom_domain_info.auto_create_rules
+        while rules:
+            rule = first_matching_rule(rules, local)
+            if not rule:
+                break
+            auto_create_rule = AutoCreateRule.get(rule.id)
+            if auto_create_rule:
                 LOG.d(
                     "%s passes %s on %s",
                     address,
                     rule.regex,
                     custom_domain,
                 )
-                return custom_domain, rule
-        else:  # no rule passes
-            LOG.d("no rule passed to create %s", local)
-            return None
+                return custom_domain, auto_create_rule
+
+            # deleted by another process since it has been cached: try the next rules
+            LOG.d("rule %s doesn't exist anymore", rule.id)
+            domain_registry.invalidate_custom_domain(custom_domain.id)
+            rules = rules[rules.index(rule) + 1 :]
+
+        # no rule passes
+        LOG.d("no rule passed to create %s", local)
+        return None
     LOG.d("Create alias via catchall")
 
     return custom_domain, None
@@ -1,20 +1,30 @@
 from functools import wraps
 
-import arrow
 from flask import Blueprint, request, jsonify, g
 from flask_login import current_user
 
-from app.db import Session
-from app.models import ApiKey
+from app.api_key_utils import api_key_cache, api_key_usage
+from app.models import User
 
 api_bp = Blueprint(name="api", import_name=__name__, url_prefix="/api")
 
 
+@api_bp.teardown_request
+def flush_api_key_usage(exc):
+    # after the request, on its own connection
+    api_key_usage.flush_if_due()
+
+
 def require_api_auth(f):
     @wraps(f)
     def decorated(*args, **kwargs):
         api_code = request.headers.get("Authentication")
-        api_key = ApiKey.get_by(code=api_code)
+        api_key = api_key_cache.get(api_code)
+        user = User.get(api_key.user_id) if api_key else None
+        if api_key and not user:
+            # the api key was deleted with its user
+            api_key_cache.invalidate(api_code)
+            api_key = None
 
         if not api_key:
             # if user is authenticated, the request is authorized
@@ -23,12 +33,10 @@ def require_api_auth(f):
             else:
                 return jsonify(error="Wrong api key"), 401
         else:
-            # Update api key stats
-            api_key.last_used = arrow.now()
-            api_key.times += 1
-            Session.commit()
+            # Update api key stats, written by batch
+            api_key_usage.record(api_key.id)
 
-            g.user = api_key.user
+            g.user = user
 
         if g.user.disabled:
             return jsonify(error="Disabled account"), 403
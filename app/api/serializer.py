@@ -1,8 +1,8 @@
 from dataclasses import dataclass
-from typing import Optional
+from typing import Optional, List
 
 from arrow import Arrow
-from sqlalchemy import or_, func, case, and_
+from sqlalchemy import or_, func, case
 from sqlalchemy.orm import joinedload
 
 from app.config import PAGE_LIMIT
@@ -15,6 +15,13 @@ from app.models import (
     AliasMailbox,
     CustomDomain,
     User,
+    AliasActivity,
+)
+from app.pagination import (
+    SortKey,
+    paginate,
+    order_by_sort_keys,
+    encode_cursor,
 )
 
 
@@ -147,7 +154,12 @@ def get_alias_infos_with_pagination_v3(
     directory_id=None,
     page_limit=PAGE_LIMIT,
     page_size=PAGE_LIMIT,
+    cursor: Optional[str] = None,
 ) -> [AliasInfo]:
+    """
+    Page of aliases, either the page page_id or, if cursor isn't None, the page after the cursor
+    returned by next_alias_cursor(). An empty cursor is the first page. Raise InvalidCursor.
+    """
     q = construct_alias_query(user)
 
     if query:
@@ -181,27 +193,12 @@ def get_alias_infos_with_pagination_v3(
     elif alias_filter == "hibp":
         q = q.filter(Alias.hibp_breaches.any())
 
-    if sort == "old2new":
-        q = q.order_by(Alias.created_at)
-    elif sort == "new2old":
-        q = q.order_by(Alias.created_at.desc())
-    elif sort == "a2z":
-        q = q.order_by(Alias.email)
-    elif sort == "z2a":
-        q = q.order_by(Alias.email.desc())
+    sort_keys = _alias_sort_keys(sort)
+    if cursor is not None:
+        q = list(paginate(q, sort_keys, page_limit, cursor, sort))
     else:
-        # default sorting
-        latest_activity = case(
-            [
-                (Alias.created_at > EmailLog.created_at, Alias.created_at),
-                (Alias.created_at < EmailLog.created_at, EmailLog.created_at),
-            ],
-            else_=Alias.created_at,
-        )
-        q = q.order_by(Alias.pinned.desc())
-        q = q.order_by(latest_activity.desc())
-
-    q = list(q.limit(page_limit).offset(page_id * page_size))
+        q = order_by_sort_keys(q, sort_keys)
+        q = list(q.limit(page_limit).offset(page_id * page_size))
 
     ret = []
     for alias, contact, email_log, nb_reply, nb_blocked, nb_forward in q:
@@ -222,6 +219,56 @@ def get_alias_infos_with_pagination_v3(
     return ret
 
 
+def _alias_sort_keys(sort: Optional[str]) -> List[SortKey]:
+    # the alias id makes the order stable, which is needed by the cursor pagination
+    if sort == "old2new":
+        return [(Alias.created_at, False), (Alias.id, False)]
+    elif sort == "new2old":
+        return [(Alias.created_at, True), (Alias.id, True)]
+    elif sort == "a2z":
+        return [(Alias.email, False), (Alias.id, False)]
+    elif sort == "z2a":
+        return [(Alias.email, True), (Alias.id, True)]
+
+    # default sorting
+    latest_activity = case(
+        [
+            (
+                Alias.created_at > AliasActivity.latest_activity_at,
+                Alias.created_at,
+            ),
+            (
+                Alias.created_at < AliasActivity.latest_activity_at,
+                AliasActivity.latest_activity_at,
+            ),
+        ],
+        else_=Alias.created_at,
+    )
+    return [(Alias.pinned, True), (latest_activity, True), (Alias.id, True)]
+
+
+def next_alias_cursor(alias_infos: [AliasInfo], sort: Optional[str] = None) -> str:
+    """cursor of the page that follows alias_infos"""
+    last = alias_infos[-1]
+    alias = last.alias
+    if sort in ("old2new", "new2old"):
+        values = [alias.created_at, alias.id]
+    elif sort in ("a2z", "z2a"):
+        values = [alias.email, alias.id]
+    else:
+        latest_activity = alias.created_at
+        if last.latest_email_log and last.latest_email_log.created_at > latest_activity:
+            latest_activity = last.latest_email_log.created_at
+        values = [alias.pinned, latest_activity, alias.id]
+
+    return encode_cursor(values, sort)
+
+
+def next_id_cursor(last_id: int) -> str:
+    """cursor of the page that follows the row last_id, for the listings sorted by id"""
+    return encode_cursor([last_id])
+
+
 def get_alias_info(alias: Alias) -> AliasInfo:
     q = (
         Session.query(Contact, EmailLog)
@@ -298,13 +345,18 @@ def get_alias_info_v2(alias: Alias, mailbox=None) -> AliasInfo:
     return alias_info
 
 
-def get_alias_contacts(alias, page_id: int) -> [dict]:
-    q = (
-        Contact.filter_by(alias_id=alias.id)
-        .order_by(Contact.id.desc())
-        .limit(PAGE_LIMIT)
-        .offset(page_id * PAGE_LIMIT)
-    )
+def get_alias_contacts(alias, page_id: int = 0, cursor: Optional[str] = None) -> [dict]:
+    """if cursor isn't None, return the page after the cursor, see next_id_cursor()"""
+    q = Contact.filter_by(alias_id=alias.id)
+    sort_keys = [(Contact.id, True)]
+    if cursor is not None:
+        q = paginate(q, sort_keys, PAGE_LIMIT, cursor)
+    else:
+        q = (
+            order_by_sort_keys(q, sort_keys)
+            .limit(PAGE_LIMIT)
+            .offset(page_id * PAGE_LIMIT)
+        )
 
     res = []
     for fe in q.all():
@@ -333,75 +385,23 @@ def get_alias_info_v3(user: User, alias_id: int) -> AliasInfo:
 
 
 def construct_alias_query(user: User):
-    # subquery on alias annotated with nb_reply, nb_blocked, nb_forward, max_created_at, latest_email_log_created_at
-    alias_activity_subquery = (
-        Session.query(
-            Alias.id,
-            func.sum(case([(EmailLog.is_reply, 1)], else_=0)).label("nb_reply"),
-            func.sum(
-                case(
-                    [(and_(EmailLog.is_reply.is_(False), EmailLog.blocked), 1)],
-                    else_=0,
-                )
-            ).label("nb_blocked"),
-            func.sum(
-                case(
-                    [
-                        (
-                            and_(
-                                EmailLog.is_reply.is_(False),
-                                EmailLog.blocked.is_(False),
-                            ),
-                            1,
-                        )
-                    ],
-                    else_=0,
-                )
-            ).label("nb_forward"),
-            func.max(EmailLog.created_at).label("latest_email_log_created_at"),
-        )
-        .join(EmailLog, Alias.id == EmailLog.alias_id, isouter=True)
-        .filter(Alias.user_id == user.id)
-        .group_by(Alias.id)
-        .subquery()
-    )
-
-    alias_contact_subquery = (
-        Session.query(Alias.id, func.max(Contact.id).label("max_contact_id"))
-        .join(Contact, Alias.id == Contact.alias_id, isouter=True)
-        .filter(Alias.user_id == user.id)
-        .group_by(Alias.id)
-        .subquery()
-    )
-
+    """
+    Alias annotated with its latest contact, latest email log, nb_reply, nb_blocked and nb_forward,
+    read from the alias_activity rollup
+    """
     return (
         Session.query(
             Alias,
             Contact,
             EmailLog,
-            alias_activity_subquery.c.nb_reply,
-            alias_activity_subquery.c.nb_blocked,
-            alias_activity_subquery.c.nb_forward,
+            func.coalesce(AliasActivity.nb_reply, 0),
+            func.coalesce(AliasActivity.nb_blocked, 0),
+            func.coalesce(AliasActivity.nb_forward, 0),
         )
         .options(joinedload(Alias.hibp_breaches))
         .options(joinedload(Alias.custom_domain))
-        .join(Contact, Alias.id == Contact.alias_id, isouter=True)
-        .join(EmailLog, Contact.id == EmailLog.contact_id, isouter=True)
-        .filter(Alias.id == alias_activity_subquery.c.id)
-        .filter(Alias.id == alias_contact_subquery.c.id)
-        .filter(
-            or_(
-                EmailLog.created_at
-                == alias_activity_subquery.c.latest_email_log_created_at,
-                and_(
-                    # no email log yet for this alias
-                    alias_activity_subquery.c.latest_email_log_created_at.is_(None),
-                    # to make sure only 1 contact is returned in this case
-                    or_(
-                        Contact.id == alias_contact_subquery.c.max_contact_id,
-                        alias_contact_subquery.c.max_contact_id.is_(None),
-                    ),
-                ),
-            )
-        )
+        .join(AliasActivity, Alias.id == AliasActivity.alias_id, isouter=True)
+        .join(EmailLog, EmailLog.id == AliasActivity.latest_email_log_id, isouter=True)
+        .join(Contact, Contact.id == EmailLog.contact_id, isouter=True)
+        .filter(Alias.user_id == user.id)
     )
@@ -14,7 +14,10 @@ from app.api.serializer import (
     serialize_alias_info_v2,
     get_alias_info_v2,
     get_alias_infos_with_pagination_v3,
+    next_alias_cursor,
+    next_id_cursor,
 )
+from app.config import PAGE_LIMIT
 from app.dashboard.views.alias_contact_manager import create_contact
 from app.dashboard.views.alias_log import get_alias_log
 from app.db import Session
@@ -25,6 +28,8 @@ from app.errors import (
     ErrAddressInvalid,
 )
 from app.models import Alias, Contact, Mailbox, AliasMailbox
+from app.pagination import InvalidCursor
+from app.read_replica import read_only_view
 
 
 @deprecated
@@ -72,11 +77,13 @@ def get_aliases():
 
 @api_bp.route("/v2/aliases", methods=["GET", "POST"])
 @require_api_auth
+@read_only_view
 def get_aliases_v2():
     """
     Get aliases
     Input:
         page_id: in query
+        cursor: in query, instead of page_id. Empty for the first page then the next_cursor of the previous page
         pinned: in query
         disabled: in query
         enabled: in query
@@ -101,14 +108,18 @@ def get_aliases_v2():
                     - email
                     - name
                     - reverse_alias
-
+        - next_cursor: if cursor is used, null on the last page
 
     """
     user = g.user
-    try:
-        page_id = int(request.args.get("page_id"))
-    except (ValueError, TypeError):
-        return jsonify(error="page_id must be provided in request query"), 400
+    # cursor pagination if "cursor" is in the query, empty for the first page
+    cursor = request.args.get("cursor")
+    page_id = 0
+    if cursor is None:
+        try:
+            page_id = int(request.args.get("page_id"))
+        except (ValueError, TypeError):
+            return jsonify(error="page_id must be provided in request query"), 400
 
     pinned = "pinned" in request.args
     disabled = "disabled" in request.args
@@ -128,16 +139,26 @@ def get_aliases_v2():
     if data:
         query = data.get("query")
 
-    alias_infos: [AliasInfo] = get_alias_infos_with_pagination_v3(
-        user, page_id=page_id, query=query, alias_filter=alias_filter
-    )
-
-    return (
-        jsonify(
-            aliases=[serialize_alias_info_v2(alias_info) for alias_info in alias_infos]
-        ),
-        200,
-    )
+    try:
+        alias_infos: [AliasInfo] = get_alias_infos_with_pagination_v3(
+            user,
+            page_id=page_id,
+            query=query,
+            alias_filter=alias_filter,
+            cursor=cursor,
+        )
+    except InvalidCursor as e:
+        return jsonify(error=e.error_for_user()), 400
+
+    res = {
+        "aliases": [serialize_alias_info_v2(alias_info) for alias_info in alias_infos]
+    }
+    if cursor is not None:
+        res["next_cursor"] = (
+            next_alias_cursor(alias_infos) if len(alias_infos) == PAGE_LIMIT else None
+        )
+
+    return jsonify(**res), 200
 
 
 @api_bp.route("/aliases/<int:alias_id>", methods=["DELETE"])
@@ -189,11 +210,13 @@ def toggle_alias(alias_id):
 
 @api_bp.route("/aliases/<int:alias_id>/activities")
 @require_api_auth
+@read_only_view
 def get_alias_activities(alias_id):
     """
     Get aliases
     Input:
         page_id: in query
+        cursor: in query, instead of page_id. Empty for the first page then the next_cursor of the previous page
     Output:
         - activities: list of activity:
             - from
@@ -201,20 +224,28 @@ def get_alias_activities(alias_id):
             - timestamp
             - action: forward|reply|block|bounced
             - reverse_alias
+        - next_cursor: if cursor is used, null on the last page
 
     """
     user = g.user
-    try:
-        page_id = int(request.args.get("page_id"))
-    except (ValueError, TypeError):
-        return jsonify(error="page_id must be provided in request query"), 400
+    # cursor pagination if "cursor" is in the query, empty for the first page
+    cursor = request.args.get("cursor")
+    page_id = 0
+    if cursor is None:
+        try:
+            page_id = int(request.args.get("page_id"))
+        except (ValueError, TypeError):
+            return jsonify(error="page_id must be provided in request query"), 400
 
     alias: Alias = Alias.get(alias_id)
 
     if not alias or alias.user_id != user.id:
         return jsonify(error="Forbidden"), 403
 
-    alias_logs = get_alias_log(alias, page_id)
+    try:
+        alias_logs = get_alias_log(alias, page_id, cursor)
+    except InvalidCursor as e:
+        return jsonify(error=e.error_for_user()), 400
 
     activities = []
     for alias_log in alias_logs:
@@ -240,7 +271,15 @@ def get_alias_activities(alias_id):
 
         activities.append(activity)
 
-    return jsonify(activities=activities), 200
+    res = {"activities": activities}
+    if cursor is not None:
+        res["next_cursor"] = (
+            next_id_cursor(alias_logs[-1].email_log.id)
+            if len(alias_logs) == PAGE_LIMIT
+            else None
+        )
+
+    return jsonify(**res), 200
 
 
 @api_bp.route("/aliases/<int:alias_id>", methods=["PUT", "PATCH"])
@@ -361,11 +400,13 @@ def get_alias(alias_id):
 
 @api_bp.route("/aliases/<int:alias_id>/contacts")
 @require_api_auth
+@read_only_view
 def get_alias_contacts_route(alias_id):
     """
     Get alias contacts
     Input:
         page_id: in query
+        cursor: in query, instead of page_id. Empty for the first page then the next_cursor of the previous page
     Output:
         - contacts: list of contacts:
             - creation_date
@@ -374,13 +415,18 @@ def get_alias_contacts_route(alias_id):
             - last_email_sent_timestamp
             - contact
             - reverse_alias
+        - next_cursor: if cursor is used, null on the last page
 
     """
     user = g.user
-    try:
-        page_id = int(request.args.get("page_id"))
-    except (ValueError, TypeError):
-        return jsonify(error="page_id must be provided in request query"), 400
+    # cursor pagination if "cursor" is in the query, empty for the first page
+    cursor = request.args.get("cursor")
+    page_id = 0
+    if cursor is None:
+        try:
+            page_id = int(request.args.get("page_id"))
+        except (ValueError, TypeError):
+            return jsonify(error="page_id must be provided in request query"), 400
 
     alias: Alias = Alias.get(alias_id)
 
@@ -390,9 +436,18 @@ def get_alias_contacts_route(alias_id):
     if alias.user_id != user.id:
         return jsonify(error="Forbidden"), 403
 
-    contacts = get_alias_contacts(alias, page_id)
+    try:
+        contacts = get_alias_contacts(alias, page_id, cursor)
+    except InvalidCursor as e:
+        return jsonify(error=e.error_for_user()), 400
+
+    res = {"contacts": contacts}
+    if cursor is not None:
+        res["next_cursor"] = (
+            next_id_cursor(contacts[-1]["id"]) if len(contacts) == PAGE_LIMIT else None
+        )
 
-    return jsonify(contacts=contacts), 200
+    return jsonify(**res), 200
 
 
 @api_bp.route("/aliases/<int:alias_id>/contacts", methods=["POST"])
@@ -4,6 +4,7 @@ from flask import jsonify
 from app.api.base import api_bp, require_api_auth
 from app.db import Session
 from app.models import CustomDomain, DomainDeletedAlias, Mailbox, DomainMailbox
+from app.read_replica import read_only_view
 
 
 def custom_domain_to_dict(custom_domain: CustomDomain):
@@ -25,6 +26,7 @@ def custom_domain_to_dict(custom_domain: CustomDomain):
 
 @api_bp.route("/custom_domains", methods=["GET"])
 @require_api_auth
+@read_only_view
 def get_custom_domains():
     user = g.user
     custom_domains = CustomDomain.filter_by(
@@ -17,6 +17,7 @@ from app.email_utils import (
 )
 from app.log import LOG
 from app.models import Mailbox, Job
+from app.read_replica import read_only_view
 from app.utils import sanitize_email
 
 
@@ -174,6 +175,7 @@ def update_mailbox(mailbox_id):
 
 @api_bp.route("/mailboxes", methods=["GET"])
 @require_api_auth
+@read_only_view
 def get_mailboxes():
     """
     Get verified mailboxes
@@ -190,6 +192,7 @@ def get_mailboxes():
 
 @api_bp.route("/v2/mailboxes", methods=["GET"])
 @require_api_auth
+@read_only_view
 def get_mailboxes_v2():
     """
     Get all mailboxes - including unverified mailboxes
@@ -9,6 +9,7 @@ from app.api.base import api_bp, require_api_auth
 from app.config import SESSION_COOKIE_NAME
 from app.db import Session
 from app.models import ApiKey, File, User
+from app.read_replica import read_only_view
 from app.utils import random_string
 
 
@@ -30,6 +31,7 @@ def user_to_dict(user: User) -> dict:
 
 @api_bp.route("/user_info")
 @require_api_auth
+@read_only_view
 def user_info():
     """
     Return user info given the api-key
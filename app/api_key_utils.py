@@ -0,0 +1,199 @@
+"""
+Authentication of the API requests by api key, without a write per request.
+
+- the api keys are cached by the process during API_KEY_CACHE_TTL seconds, keyed by a hash of their code.
+A deleted (revoked) api key is invalidated as soon as the deletion is flushed in the current process
+and after at most API_KEY_CACHE_TTL seconds in the other processes.
+- the usage statistics (ApiKey.times and ApiKey.last_used) are aggregated in memory and written in one UPDATE
+every API_KEY_USAGE_FLUSH_INTERVAL seconds or API_KEY_USAGE_FLUSH_MAX_REQUESTS requests, and when the process exits.
+The UPDATE is run at the end of the request, on its own connection: it doesn't commit the Session of the request.
+"""
+import atexit
+import hashlib
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+import arrow
+from cachetools import TTLCache
+from sqlalchemy import event, text
+from sqlalchemy.orm import object_session
+
+from app import config
+from app.db import Session, engine
+from app.log import LOG
+from app.models import ApiKey
+
+
+@dataclass(frozen=True)
+class ApiKeyInfo:
+    id: int
+    user_id: int
+
+
+def _hash_code(code: str) -> str:
+    # the codes aren't kept in memory
+    return hashlib.sha256(code.encode()).hexdigest()
+
+
+class ApiKeyCache:
+    def __init__(self, ttl: int, max_size: int = 10_000):
+        """ttl: in seconds, 0 disables the cache"""
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # incremented at each invalidation so a load started before an invalidation isn't kept
+        self.version = 0
+        # hash of the code -> ApiKeyInfo, unknown codes aren't cached
+        self._entries = TTLCache(maxsize=max_size, ttl=max(ttl, 1))
+
+    def get(self, code: Optional[str]) -> Optional[ApiKeyInfo]:
+        if not code:
+            return None
+
+        key = _hash_code(code)
+        if self.ttl:
+            with self._lock:
+                info = self._entries.get(key)
+            if info is not None:
+                return info
+
+        version = self.version
+        api_key: ApiKey = ApiKey.get_by(code=code)
+        if not api_key:
+            return None
+
+        info = ApiKeyInfo(id=api_key.id, user_id=api_key.user_id)
+        if self.ttl:
+            with self._lock:
+                if version == self.version:
+                    self._entries[key] = info
+
+        return info
+
+    def invalidate(self, code: Optional[str] = None):
+        """code: None to invalidate all api keys"""
+        with self._lock:
+            self.version += 1
+            if code is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(_hash_code(code), None)
+
+
+class ApiKeyUsageBuffer:
+    """
+    Aggregate the usage of the api keys, flushed in one UPDATE.
+    With a flush_interval of 0, the usage is written at the end of each request.
+    """
+
+    def __init__(self, flush_interval: float, flush_max_requests: int, bind=None):
+        """bind: the engine or connection the usage is written with, app.db.engine by default"""
+        self.flush_interval = flush_interval
+        self._bind = engine if bind is None else bind
+        self.flush_max_requests = flush_max_requests
+        self._lock = threading.Lock()
+        # api key id -> (nb of requests, last request)
+        self._usages: Dict[int, Tuple[int, datetime]] = {}
+        self._nb_requests = 0
+        self._last_flush = time.time()
+
+    def record(self, api_key_id: int):
+        """record a request made with the api key, written by the next flush"""
+        now = arrow.utcnow().naive
+        with self._lock:
+            nb, _ = self._usages.get(api_key_id, (0, None))
+            self._usages[api_key_id] = (nb + 1, now)
+            self._nb_requests += 1
+
+    def flush_if_due(self):
+        with self._lock:
+            due = self._nb_requests > 0 and (
+                self._nb_requests >= self.flush_max_requests
+                or time.time() - self._last_flush >= self.flush_interval
+            )
+
+        if due:
+            self.flush()
+
+    def flush(self):
+        """write the buffered usage in its own transaction"""
+        with self._lock:
+            usages, self._usages = self._usages, {}
+            self._nb_requests = 0
+            self._last_flush = time.time()
+
+        if not usages:
+            return
+
+        values, params = [], {}
+        for i, (api_key_id, (nb, last_used)) in enumerate(usages.items()):
+            values.append(
+                f"(CAST(:id{i} AS INTEGER), CAST(:nb{i} AS INTEGER), "
+                f"CAST(:last_used{i} AS TIMESTAMP))"
+            )
+            params[f"id{i}"] = api_key_id
+            params[f"nb{i}"] = nb
+            params[f"last_used{i}"] = last_used
+
+        try:
+            with self._bind.connect() as conn, conn.begin():
+                conn.execute(
+                    text(
+                        f"""
+UPDATE api_key SET
+    times = api_key.times + usage.nb,
+    last_used = greatest(api_key.last_used, usage.last_used)
+FROM (VALUES {", ".join(values)}) AS usage (id, nb, last_used)
+WHERE api_key.id = usage.id
+"""
+                    ),
+                    params,
+                )
+        except Exception:
+            LOG.e("cannot write the usage of %s api keys", len(usages), exc_info=True)
+            # kept for the next flush
+            with self._lock:
+                for api_key_id, (nb, last_used) in usages.items():
+                    buffered_nb, buffered_last_used = self._usages.get(
+                        api_key_id, (0, last_used)
+                    )
+                    self._usages[api_key_id] = (
+                        buffered_nb + nb,
+                        max(buffered_last_used, last_used),
+                    )
+                    self._nb_requests += nb
+
+
+api_key_cache = ApiKeyCache(config.API_KEY_CACHE_TTL, config.API_KEY_CACHE_MAX_SIZE)
+api_key_usage = ApiKeyUsageBuffer(
+    config.API_KEY_USAGE_FLUSH_INTERVAL, config.API_KEY_USAGE_FLUSH_MAX_REQUESTS
+)
+atexit.register(api_key_usage.flush)
+
+
+_CHANGED_KEY = "api_key_cache_changed"
+
+
+@event.listens_for(ApiKey, "after_update")
+@event.listens_for(ApiKey, "after_delete")
+def _on_api_key_change(mapper, connection, target: ApiKey):
+    api_key_cache.invalidate(target.code)
+    # entries loaded by other threads between the flush and the commit are stale
+    session = object_session(target)
+    if session is not None:
+        session.info[_CHANGED_KEY] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _on_commit(session):
+    if session.info.pop(_CHANGED_KEY, False):
+        api_key_cache.invalidate()
+
+
+@event.listens_for(Session, "after_bulk_update")
+@event.listens_for(Session, "after_bulk_delete")
+def _on_bulk_change(context):
+    if context.mapper.class_ is ApiKey:
+        api_key_cache.invalidate()
@@ -118,6 +118,27 @@ if "POSTFIX_PORT" in os.environ:
 # Useful when calling Postfix from an external network
 POSTFIX_SUBMISSION_TLS = "POSTFIX_SUBMISSION_TLS" in os.environ
 
+# Keep up to POSTFIX_CONNECTION_POOL_SIZE connections to Postfix open instead of connecting for every email.
+# 0 disables the pool. A connection is recycled after POSTFIX_CONNECTION_MAX_MESSAGES emails
+# or POSTFIX_CONNECTION_MAX_AGE seconds.
+POSTFIX_CONNECTION_POOL_SIZE = int(os.environ.get("POSTFIX_CONNECTION_POOL_SIZE", 0))
+POSTFIX_CONNECTION_MAX_MESSAGES = int(
+    os.environ.get("POSTFIX_CONNECTION_MAX_MESSAGES", 100)
+)
+POSTFIX_CONNECTION_MAX_AGE = int(os.environ.get("POSTFIX_CONNECTION_MAX_AGE", 60))
+
+# Deliver the emails sent with wait=False from a queue with MAIL_SENDER_BACKGROUND_WORKERS threads,
+# 0 disables the queue. The queue is in memory: the forwarded emails don't use it, the email handler
+# only returns 250 once Postfix has accepted them. Emails that can't be delivered are saved to SAVE_UNSENT_DIR.
+MAIL_SENDER_BACKGROUND_WORKERS = int(
+    os.environ.get("MAIL_SENDER_BACKGROUND_WORKERS", 0)
+)
+MAIL_SENDER_QUEUE_SIZE = int(os.environ.get("MAIL_SENDER_QUEUE_SIZE", 1000))
+# nb max of emails delivered at the same time to the same domain
+MAIL_SENDER_MAX_PER_DESTINATION = int(
+    os.environ.get("MAIL_SENDER_MAX_PER_DESTINATION", 5)
+)
+
 # ["domain1.com", "domain2.com"]
 OTHER_ALIAS_DOMAINS = sl_getenv("OTHER_ALIAS_DOMAINS", list)
 OTHER_ALIAS_DOMAINS = [d.lower().strip() for d in OTHER_ALIAS_DOMAINS]
@@ -159,6 +180,30 @@ if "DKIM_PRIVATE_KEY_PATH" in os.environ:
 
 # Database
 DB_URI = os.environ["DB_URI"]
+# connections kept open by each process and extra connections opened when they're all in use.
+# The email handler needs at least EMAIL_HANDLER_WORKERS connections with the thread executor
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_POOL_MAX_OVERFLOW = int(os.environ.get("DB_POOL_MAX_OVERFLOW", 10))
+# seconds to wait for a connection when the pool is exhausted
+DB_POOL_TIMEOUT = int(os.environ.get("DB_POOL_TIMEOUT", 30))
+# seconds after which a connection is reopened, -1 to keep it
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 3600))
+# test the connection before using it, one more round trip per transaction
+DB_POOL_PRE_PING = "DB_POOL_PRE_PING" in os.environ
+# "thread": one Session per thread, "task": one Session per asyncio task (or thread outside of a task)
+DB_SESSION_SCOPE = os.environ.get("DB_SESSION_SCOPE", "thread")
+# read-only endpoints send their queries to one of these replicas, e.g. ["postgresql://..."]
+DB_REPLICA_URIS = sl_getenv("DB_REPLICA_URIS", list)
+# a replica late by more than this nb of seconds isn't used
+DB_REPLICA_MAX_LAG = float(os.environ.get("DB_REPLICA_MAX_LAG", 5))
+# the lag of a replica is checked at most every DB_REPLICA_LAG_CHECK_INTERVAL seconds
+DB_REPLICA_LAG_CHECK_INTERVAL = float(
+    os.environ.get("DB_REPLICA_LAG_CHECK_INTERVAL", 5)
+)
+# the users who have just written are shared by the web processes through this redis, e.g. redis://localhost:6379/0
+# Without it, read-your-writes only holds within a single process: each process only knows the writes
+# it has handled and the next request of the user can be served by another one from a late replica
+DB_REPLICA_REDIS_URL = os.environ.get("DB_REPLICA_REDIS_URL")
 
 # Flask secret
 FLASK_SECRET = os.environ["FLASK_SECRET"]
@@ -272,6 +317,19 @@ PAGE_LIMIT = 20
 LOCAL_FILE_UPLOAD = "LOCAL_FILE_UPLOAD" in os.environ
 UPLOAD_DIR = None
 
+# Email handler execution mode: "process" or "thread" runs the email pipeline on a pool of
+# EMAIL_HANDLER_WORKERS workers, "inline" runs it on the aiosmtpd event loop.
+# Each worker process has its own connections, the threads share the pool with one Session per thread
+EMAIL_HANDLER_EXECUTOR = os.environ.get("EMAIL_HANDLER_EXECUTOR") or "process"
+EMAIL_HANDLER_WORKERS = int(os.environ.get("EMAIL_HANDLER_WORKERS", 10))
+# nb max of emails being handled or waiting for a worker, above this a 4xx is returned
+EMAIL_HANDLER_MAX_PENDING = int(
+    os.environ.get("EMAIL_HANDLER_MAX_PENDING", 2 * EMAIL_HANDLER_WORKERS)
+)
+# Commit the writes of an email for all its recipients (contacts, email logs, spam score...)
+# in one transaction instead of a transaction for each step, the emails are sent after this commit
+FORWARD_SINGLE_TRANSACTION = "FORWARD_SINGLE_TRANSACTION" in os.environ
+
 # Rate Limiting
 # nb max of activity (forward/reply) an alias can have during 1 min
 MAX_ACTIVITY_DURING_MINUTE_PER_ALIAS = 10
@@ -279,6 +337,55 @@ MAX_ACTIVITY_DURING_MINUTE_PER_ALIAS = 10
 # nb max of activity (forward/reply) a mailbox can have during 1 min
 MAX_ACTIVITY_DURING_MINUTE_PER_MAILBOX = 15
 
+# where the rate limiting counters are kept:
+# "none": rate limiting is disabled, "sql": count the email logs in the database,
+# "redis": shared by all processes using RATE_LIMIT_REDIS_URL,
+# "memory": in each email handler process, so the limits apply per process
+RATE_LIMIT_BACKEND = os.environ.get("RATE_LIMIT_BACKEND") or "none"
+# requires the redis package (not installed by default), e.g. redis://localhost:6379/0
+RATE_LIMIT_REDIS_URL = os.environ.get("RATE_LIMIT_REDIS_URL")
+
+# SL domains, custom domains and auto create rules are cached by each process during
+# DOMAIN_REGISTRY_TTL seconds, a change made by another process is seen after at most this delay.
+# 0 disables the cache
+DOMAIN_REGISTRY_TTL = int(os.environ.get("DOMAIN_REGISTRY_TTL", 30))
+# nb max of custom domains kept in the cache
+DOMAIN_REGISTRY_MAX_SIZE = int(os.environ.get("DOMAIN_REGISTRY_MAX_SIZE", 10_000))
+
+# the subscriptions of a user (that make them premium) are cached by each process during
+# ENTITLEMENT_CACHE_TTL seconds, a change made by another process is seen after at most this delay.
+# 0 disables the cache, the subscriptions are then loaded once per request or email
+ENTITLEMENT_CACHE_TTL = int(os.environ.get("ENTITLEMENT_CACHE_TTL", 30))
+# nb max of users kept in the cache
+ENTITLEMENT_CACHE_MAX_SIZE = int(os.environ.get("ENTITLEMENT_CACHE_MAX_SIZE", 10_000))
+# the users without an active subscription are only cached during ENTITLEMENT_CACHE_NO_SUBSCRIPTION_TTL seconds
+# so a user who has just subscribed is premium right away, whichever process handled the webhook
+ENTITLEMENT_CACHE_NO_SUBSCRIPTION_TTL = int(
+    os.environ.get("ENTITLEMENT_CACHE_NO_SUBSCRIPTION_TTL", 1)
+)
+
+# the api keys are cached by each process during API_KEY_CACHE_TTL seconds,
+# a deleted api key can still be used on another process during this delay. 0 disables the cache
+API_KEY_CACHE_TTL = int(os.environ.get("API_KEY_CACHE_TTL", 10))
+API_KEY_CACHE_MAX_SIZE = int(os.environ.get("API_KEY_CACHE_MAX_SIZE", 10_000))
+# the usage of the api keys (nb of requests, last use) is written every API_KEY_USAGE_FLUSH_INTERVAL seconds
+# or every API_KEY_USAGE_FLUSH_MAX_REQUESTS requests. 0 to write it at each request
+API_KEY_USAGE_FLUSH_INTERVAL = int(os.environ.get("API_KEY_USAGE_FLUSH_INTERVAL", 30))
+API_KEY_USAGE_FLUSH_MAX_REQUESTS = int(
+    os.environ.get("API_KEY_USAGE_FLUSH_MAX_REQUESTS", 1000)
+)
+
+# the old logs (email_log, bounce, etc) are deleted by ranges of RETENTION_BATCH_SIZE ids, one transaction per range
+RETENTION_BATCH_SIZE = int(os.environ.get("RETENTION_BATCH_SIZE", 5_000))
+# nb max of rows deleted per second, 0 for no limit
+RETENTION_MAX_ROWS_PER_SECOND = int(os.environ.get("RETENTION_MAX_ROWS_PER_SECOND", 0))
+# pause the deletion while the replicas are late by more than this nb of seconds, 0 to disable
+RETENTION_MAX_REPLICATION_LAG = int(os.environ.get("RETENTION_MAX_REPLICATION_LAG", 10))
+
+# the email handler parses the headers of an incoming email and only parses its body when it's needed
+# (e.g. to add a banner or encrypt it), otherwise the body is forwarded unchanged
+LAZY_EMAIL_PARSING = "LAZY_EMAIL_PARSING" in os.environ
+
 if LOCAL_FILE_UPLOAD:
     print("Upload files to local dir")
     UPLOAD_DIR = os.path.join(ROOT_DIR, "static/upload")
@@ -403,11 +510,20 @@ ENABLE_SPAM_ASSASSIN = "ENABLE_SPAM_ASSASSIN" in os.environ
 
 ALIAS_RANDOM_SUFFIX_LENGTH = int(os.environ.get("ALIAS_RAND_SUFFIX_LENGTH", 5))
 
+# nb of random aliases or reverse aliases generated then checked in one query
+IDENTIFIER_BATCH_SIZE = int(os.environ.get("IDENTIFIER_BATCH_SIZE", 10))
+# nb of free random aliases kept by each process, refilled in the background. 0 to disable
+IDENTIFIER_POOL_SIZE = int(os.environ.get("IDENTIFIER_POOL_SIZE", 0))
+
 try:
     HIBP_SCAN_INTERVAL_DAYS = int(os.environ.get("HIBP_SCAN_INTERVAL_DAYS"))
 except Exception:
     HIBP_SCAN_INTERVAL_DAYS = 7
 HIBP_API_KEYS = sl_getenv("HIBP_API_KEYS", list) or []
+# nb max of requests per minute of an API key, depends on its HIBP plan
+HIBP_RATE_PER_MINUTE = float(os.environ.get("HIBP_RATE_PER_MINUTE", 37.5))
+# nb of concurrent requests per API key, the rate is still enforced
+HIBP_WORKERS_PER_KEY = int(os.environ.get("HIBP_WORKERS_PER_KEY", 2))
 
 POSTMASTER = os.environ.get("POSTMASTER")
 
@@ -476,6 +592,39 @@ def setup_nameservers():
 
 NAMESERVERS = setup_nameservers()
 
+# the DNS answers are cached during their TTL, at most DNS_CACHE_MAX_TTL seconds. 0 to disable
+DNS_CACHE_MAX_TTL = int(os.environ.get("DNS_CACHE_MAX_TTL", 300))
+# how long a name or a record that doesn't exist is cached, in seconds
+DNS_CACHE_NEGATIVE_TTL = int(os.environ.get("DNS_CACHE_NEGATIVE_TTL", 60))
+DNS_CACHE_MAX_SIZE = int(os.environ.get("DNS_CACHE_MAX_SIZE", 10_000))
+# nb max of concurrent DNS lookups, e.g. by the daily check of the custom domains
+DNS_MAX_CONCURRENCY = int(os.environ.get("DNS_MAX_CONCURRENCY", 50))
+
+# the email templates are compiled once per process, TEMPLATES_AUTO_RELOAD reloads a template
+# changed on disk (development)
+TEMPLATES_AUTO_RELOAD = "TEMPLATES_AUTO_RELOAD" in os.environ
+# directory where the compiled templates are saved and shared by the processes
+TEMPLATES_BYTECODE_CACHE_DIR = os.environ.get("TEMPLATES_BYTECODE_CACHE_DIR")
+# compile all the email templates when the email handler starts
+TEMPLATES_PRECOMPILE = "TEMPLATES_PRECOMPILE" in os.environ
+
+# the email handler keeps an in-memory index of the aliases, reverse aliases and trashed aliases
+# to reject the emails to addresses that don't exist without querying the database
+ENABLE_EXISTENCE_INDEX = "ENABLE_EXISTENCE_INDEX" in os.environ
+# probability that a missing address is reported as maybe existing and looked up in the database
+EXISTENCE_INDEX_ERROR_RATE = float(os.environ.get("EXISTENCE_INDEX_ERROR_RATE", 0.01))
+# an address created by another process can be reported as missing during at most this nb of seconds
+EXISTENCE_INDEX_SYNC_INTERVAL = float(
+    os.environ.get("EXISTENCE_INDEX_SYNC_INTERVAL", 1)
+)
+EXISTENCE_INDEX_REBUILD_INTERVAL = int(
+    os.environ.get("EXISTENCE_INDEX_REBUILD_INTERVAL", 24 * 3600)
+)
+# max duration of a transaction that creates an alias or a contact, in seconds
+EXISTENCE_INDEX_MAX_TRANSACTION_DURATION = int(
+    os.environ.get("EXISTENCE_INDEX_MAX_TRANSACTION_DURATION", 60)
+)
+
 DISABLE_CREATE_CONTACTS_FOR_FREE_USERS = False
 PARTNER_API_TOKEN_SECRET = os.environ.get("PARTNER_API_TOKEN_SECRET") or (
     FLASK_SECRET + "partnerapitoken"
@@ -1,3 +1,5 @@
+from typing import Optional
+
 import arrow
 from flask import render_template, flash, redirect, url_for
 from flask_login import login_required, current_user
@@ -6,6 +8,8 @@ from app.config import PAGE_LIMIT
 from app.dashboard.base import dashboard_bp
 from app.db import Session
 from app.models import Alias, EmailLog, Contact
+from app.pagination import paginate, order_by_sort_keys
+from app.read_replica import read_only_view
 
 
 class AliasLog:
@@ -29,6 +33,7 @@ class AliasLog:
 )
 @dashboard_bp.route("/alias_log/<int:alias_id>/<int:page_id>")
 @login_required
+@read_only_view
 def alias_log(alias_id, page_id):
     alias = Alias.get(alias_id)
 
@@ -62,17 +67,24 @@ def alias_log(alias_id, page_id):
     return render_template("dashboard/alias_log.html", **locals())
 
 
-def get_alias_log(alias: Alias, page_id=0) -> [AliasLog]:
+def get_alias_log(alias: Alias, page_id=0, cursor: Optional[str] = None) -> [AliasLog]:
+    """if cursor isn't None, return the page after the cursor, see next_id_cursor()"""
     logs: [AliasLog] = []
 
     q = (
         Session.query(Contact, EmailLog)
         .filter(Contact.id == EmailLog.contact_id)
         .filter(Contact.alias_id == alias.id)
-        .order_by(EmailLog.id.desc())
-        .limit(PAGE_LIMIT)
-        .offset(page_id * PAGE_LIMIT)
     )
+    sort_keys = [(EmailLog.id, True)]
+    if cursor is not None:
+        q = paginate(q, sort_keys, PAGE_LIMIT, cursor)
+    else:
+        q = (
+            order_by_sort_keys(q, sort_keys)
+            .limit(PAGE_LIMIT)
+            .offset(page_id * PAGE_LIMIT)
+        )
 
     for contact, email_log in q:
         al = AliasLog(
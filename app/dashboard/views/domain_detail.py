@@ -27,7 +27,7 @@ from app.models import (
     AutoCreateRuleMailbox,
     Job,
 )
-from app.regex_utils import regex_match
+from app.regex_utils import first_matching_rule
 from app.utils import random_string
 
 
@@ -55,8 +55,9 @@ def domain_detail_dns(custom_domain_id):
     mx_errors = spf_errors = dkim_errors = dmarc_errors = ownership_errors = []
 
     if request.method == "POST":
+        # the records are checked right after being changed, the cache isn't used
         if request.form.get("form-name") == "check-ownership":
-            txt_records = get_txt_record(custom_domain.domain)
+            txt_records = get_txt_record(custom_domain.domain, use_cache=False)
 
             if custom_domain.get_ownership_dns_txt_value() in txt_records:
                 flash(
@@ -78,7 +79,7 @@ def domain_detail_dns(custom_domain_id):
                 ownership_errors = txt_records
 
         elif request.form.get("form-name") == "check-mx":
-            mx_domains = get_mx_domains(custom_domain.domain)
+            mx_domains = get_mx_domains(custom_domain.domain, use_cache=False)
 
             if not is_mx_equivalent(mx_domains, EMAIL_SERVERS_WITH_PRIORITY):
                 flash("The MX record is not correctly set", "warning")
@@ -101,7 +102,7 @@ def domain_detail_dns(custom_domain_id):
                     )
                 )
         elif request.form.get("form-name") == "check-spf":
-            spf_domains = get_spf_domain(custom_domain.domain)
+            spf_domains = get_spf_domain(custom_domain.domain, use_cache=False)
             if EMAIL_DOMAIN in spf_domains:
                 custom_domain.spf_verified = True
                 Session.commit()
@@ -119,10 +120,13 @@ def domain_detail_dns(custom_domain_id):
                     "warning",
                 )
                 spf_ok = False
+                # the TXT records just resolved, from the cache
                 spf_errors = get_txt_record(custom_domain.domain)
 
         elif request.form.get("form-name") == "check-dkim":
-            dkim_record = get_cname_record("dkim._domainkey." + custom_domain.domain)
+            dkim_record = get_cname_record(
+                "dkim._domainkey." + custom_domain.domain, use_cache=False
+            )
             if dkim_record == dkim_cname:
                 flash("DKIM is setup correctly.", "success")
                 custom_domain.dkim_verified = True
@@ -141,7 +145,9 @@ def domain_detail_dns(custom_domain_id):
                 dkim_errors = [dkim_record or "[Empty]"]
 
         elif request.form.get("form-name") == "check-dmarc":
-            txt_records = get_txt_record("_dmarc." + custom_domain.domain)
+            txt_records = get_txt_record(
+                "_dmarc." + custom_domain.domain, use_cache=False
+            )
             if dmarc_record in txt_records:
                 custom_domain.dmarc_verified = True
                 Session.commit()
@@ -502,13 +508,12 @@ def domain_detail_auto_create(custom_domain_id):
                 local = auto_create_test_form.local.data
                 auto_create_test_local = local
 
-                for rule in custom_domain.auto_create_rules:
-                    if regex_match(rule.regex, local):
-                        auto_create_test_result = (
-                            f"{local}@{custom_domain.domain} passes rule #{rule.order}"
-                        )
-                        auto_create_test_passed = True
-                        break
+                rule = first_matching_rule(custom_domain.auto_create_rules, local)
+                if rule:
+                    auto_create_test_result = (
+                        f"{local}@{custom_domain.domain} passes rule #{rule.order}"
+                    )
+                    auto_create_test_passed = True
                 else:  # no rule passes
                     auto_create_test_result = (
                         f"{local}@{custom_domain.domain} doesn't pass any rule"
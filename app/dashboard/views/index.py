@@ -17,6 +17,7 @@ from app.models import (
     EmailLog,
     Contact,
 )
+from app.read_replica import read_only_view
 
 
 @dataclass
@@ -57,6 +58,7 @@ def get_stats(user: User) -> Stats:
     exempt_when=lambda: request.form.get("form-name") != "create-random-email",
 )
 @login_required
+@read_only_view
 def index():
     query = request.args.get("query") or ""
     sort = request.args.get("sort") or ""
@@ -18,6 +18,7 @@ from app.email_utils import (
 )
 from app.log import LOG
 from app.models import Mailbox, Job
+from app.read_replica import read_only_view
 
 
 class NewMailboxForm(FlaskForm):
@@ -28,6 +29,7 @@ class NewMailboxForm(FlaskForm):
 
 @dashboard_bp.route("/mailbox", methods=["GET", "POST"])
 @login_required
+@read_only_view
 def mailbox_route():
     mailboxes = (
         Mailbox.filter_by(user_id=current_user.id)
@@ -1,15 +1,348 @@
+"""
+The engine and its connection pool are created once per process, Session is scoped:
+each thread (or asyncio task with DB_SESSION_SCOPE=task) has its own session, which checks out
+a connection from the pool for each transaction and gives it back at the commit or rollback.
+With DB_SESSION_SCOPE=task, a task must call Session.remove() when it's done.
+
+Read replicas: the queries of a `with read_only():` block go to one of the DB_REPLICA_URIS,
+as long as it's not late by more than DB_REPLICA_MAX_LAG seconds. Everything else, the email
+handler and the cron jobs included, uses the primary. Once a session has written (flush or
+bulk update/delete), all its queries go to the primary so a request reads its own writes.
+The web views opt in with @read_only_view, cf app/read_replica.py.
+Raw SQL writes can't be detected and must be done outside of a read-only block.
+
+Unit of work: in a `with unit_of_work():` block, Session.commit() only releases a savepoint and
+Session.rollback() rolls back to the last one, so the block's writes are committed at its end in
+a single transaction, or all rolled back if it raises.
+"""
+import asyncio
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import List, Optional, Sequence
+
+import newrelic.agent
 import sqlalchemy
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, exc, orm, text
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import scoped_session
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.dml import UpdateBase
+
+from app import config
+from app.log import LOG
+
+
+class PoolStats:
+    """time spent waiting for a connection and nb of checkouts that timed out"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.nb_checkout = 0
+        self.nb_timeout = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record_checkout(self, wait: float):
+        with self._lock:
+            self.nb_checkout += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def record_timeout(self):
+        with self._lock:
+            self.nb_timeout += 1
+
+    def reset(self) -> "PoolStats":
+        """return the stats since the last reset"""
+        stats = PoolStats()
+        with self._lock:
+            stats.nb_checkout, self.nb_checkout = self.nb_checkout, 0
+            stats.nb_timeout, self.nb_timeout = self.nb_timeout, 0
+            stats.total_wait, self.total_wait = self.total_wait, 0.0
+            stats.max_wait, self.max_wait = self.max_wait, 0.0
+        return stats
+
+
+class StatsQueuePool(QueuePool):
+    """QueuePool that records how long the checkouts wait for a connection"""
+
+    def __init__(self, *args, stats: Optional[PoolStats] = None, **kw):
+        super().__init__(*args, **kw)
+        self.stats = stats or PoolStats()
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            conn = super()._do_get()
+        except exc.TimeoutError:
+            self.stats.record_timeout()
+            raise
+        self.stats.record_checkout(time.time() - start)
+        return conn
+
+    def recreate(self):
+        # after engine.dispose(), the new pool keeps the stats
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+    def saturation(self) -> float:
+        """ratio of the connections in use to the max nb of connections"""
+        return self.checkedout() / (self.size() + max(self._max_overflow, 0))
+
+
+def create_pooled_engine(
+    db_uri: str,
+    pool_size: int = config.DB_POOL_SIZE,
+    max_overflow: int = config.DB_POOL_MAX_OVERFLOW,
+    pool_timeout: int = config.DB_POOL_TIMEOUT,
+    pool_recycle: int = config.DB_POOL_RECYCLE,
+    pool_pre_ping: bool = config.DB_POOL_PRE_PING,
+    **kw,
+) -> Engine:
+    new_engine = create_engine(
+        db_uri,
+        poolclass=StatsQueuePool,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=pool_timeout,
+        pool_recycle=pool_recycle,
+        pool_pre_ping=pool_pre_ping,
+        **kw,
+    )
+    _discard_connections_of_parent_process(new_engine)
+    return new_engine
+
+
+def _discard_connections_of_parent_process(new_engine: Engine):
+    """
+    A process forked from the email handler or by a process pool inherits the pooled connections
+    of its parent: they are discarded on checkout instead of being shared
+    """
+
+    @event.listens_for(new_engine, "connect")
+    def _on_connect(dbapi_connection, connection_record):
+        connection_record.info["pid"] = os.getpid()
+
+    @event.listens_for(new_engine, "checkout")
+    def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+        pid = os.getpid()
+        if connection_record.info["pid"] != pid:
+            # not closed: the socket is still used by the parent process
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError(
+                f"Connection of pid {connection_record.info['pid']} "
+                f"checked out in pid {pid}"
+            )
+
+
+# the replication lag in seconds, 0 when the WAL received by the replica is replayed
+_REPLICA_LAG_QUERY = """
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+END
+"""
+
+
+class Replica:
+    def __init__(
+        self,
+        replica_engine: Engine,
+        max_lag: float = config.DB_REPLICA_MAX_LAG,
+        lag_check_interval: float = config.DB_REPLICA_LAG_CHECK_INTERVAL,
+    ):
+        self.engine = replica_engine
+        self.max_lag = max_lag
+        self.lag_check_interval = lag_check_interval
+        self._lock = threading.Lock()
+        # None when the lag can't be read
+        self._lag: Optional[float] = None
+        self._lag_checked_at = 0
+
+    def lag(self) -> Optional[float]:
+        if time.time() - self._lag_checked_at >= self.lag_check_interval:
+            with self._lock:
+                if time.time() - self._lag_checked_at >= self.lag_check_interval:
+                    self._lag = self._read_lag()
+                    self._lag_checked_at = time.time()
+        return self._lag
+
+    def is_usable(self) -> bool:
+        lag = self.lag()
+        return lag is not None and lag <= self.max_lag
+
+    def _read_lag(self) -> Optional[float]:
+        try:
+            with self.engine.connect() as conn:
+                return float(conn.execute(text(_REPLICA_LAG_QUERY)).scalar())
+        except Exception:
+            LOG.w("cannot read the lag of replica %s", self.engine.url, exc_info=True)
+            return None
 
-from app.config import DB_URI
 
-engine = create_engine(DB_URI)
-connection = engine.connect()
+def create_replicas(replica_uris: List[str]) -> List[Replica]:
+    return [
+        Replica(
+            create_pooled_engine(
+                replica_uri,
+                # a write sent by mistake fails even if the replica accepts writes
+                connect_args={"options": "-c default_transaction_read_only=on"},
+            )
+        )
+        for replica_uri in replica_uris
+    ]
 
-Session = scoped_session(sessionmaker(bind=connection))
+
+# Session.info keys
+_READ_ONLY = "read_only"
+_HAS_WRITTEN = "has_written"
+_REPLICA = "replica"
+_UNIT_OF_WORK = "unit_of_work"
+
+
+class RoutingSession(orm.Session):
+    """Send the reads of the read-only blocks to a replica"""
+
+    def __init__(self, replicas: Sequence[Replica] = (), **kw):
+        super().__init__(**kw)
+        self.replicas = replicas
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if isinstance(clause, UpdateBase):
+            self.info[_HAS_WRITTEN] = True
+        elif (
+            self.info.get(_READ_ONLY)
+            and not self.info.get(_HAS_WRITTEN)
+            and not self._flushing
+        ):
+            replica = self._get_replica()
+            if replica is not None:
+                return replica.engine
+
+        return super().get_bind(mapper=mapper, clause=clause, **kw)
+
+    def commit(self):
+        super().commit()
+        if self.info.get(_UNIT_OF_WORK):
+            # the savepoint is released, the next writes go into a new one
+            self.begin_nested()
+
+    def rollback(self):
+        super().rollback()
+        if self.info.get(_UNIT_OF_WORK):
+            # only the writes since the last commit are rolled back
+            self.begin_nested()
+
+    def _get_replica(self) -> Optional[Replica]:
+        # a session keeps the same replica
+        replica = self.info.get(_REPLICA)
+        if replica is None and self.replicas:
+            usable_replicas = [r for r in self.replicas if r.is_usable()]
+            if usable_replicas:
+                replica = self.info[_REPLICA] = random.choice(usable_replicas)
+        return replica
+
+
+@event.listens_for(RoutingSession, "after_flush")
+@event.listens_for(RoutingSession, "after_bulk_update")
+@event.listens_for(RoutingSession, "after_bulk_delete")
+def _on_write(session_or_context, *args):
+    # after_bulk_* receive the query context
+    session = getattr(session_or_context, "session", session_or_context)
+    session.info[_HAS_WRITTEN] = True
+
+
+def _task_or_thread():
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        # no running event loop
+        task = None
+    return task if task is not None else threading.get_ident()
+
+
+def _create_session(
+    bind: Engine,
+    scope: str = config.DB_SESSION_SCOPE,
+    replicas: Sequence[Replica] = (),
+):
+    factory = sessionmaker(bind=bind, class_=RoutingSession, replicas=replicas)
+    if scope == "task":
+        return scoped_session(factory, scopefunc=_task_or_thread)
+    elif scope == "thread":
+        return scoped_session(factory)
+
+    raise ValueError(f"Unknown session scope {scope}")
+
+
+engine = create_pooled_engine(config.DB_URI)
+replicas = create_replicas(config.DB_REPLICA_URIS)
+
+Session = _create_session(engine, replicas=replicas)
 
 # Session is actually a proxy, more info on
 # https://docs.sqlalchemy.org/en/14/orm/contextual.html?highlight=scoped_session#implicit-method-access
 Session: sqlalchemy.orm.Session
+
+
+def record_pool_metrics():
+    """record the checkout wait times since the last call and the pool saturation"""
+    pool: StatsQueuePool = engine.pool
+    stats = pool.stats.reset()
+    if stats.nb_checkout:
+        newrelic.agent.record_custom_metric(
+            "Custom/db_pool_checkout_wait_mean", stats.total_wait / stats.nb_checkout
+        )
+        newrelic.agent.record_custom_metric(
+            "Custom/db_pool_checkout_wait_max", stats.max_wait
+        )
+    if stats.nb_timeout:
+        newrelic.agent.record_custom_metric(
+            "Custom/db_pool_checkout_timeout", stats.nb_timeout
+        )
+    newrelic.agent.record_custom_metric("Custom/db_pool_saturation", pool.saturation())
+
+
+@contextmanager
+def read_only(session=Session):
+    """send the queries of the block to a replica, unless the session has written"""
+    session.info[_READ_ONLY] = session.info.get(_READ_ONLY, 0) + 1
+    try:
+        yield
+    finally:
+        session.info[_READ_ONLY] -= 1
+
+
+@contextmanager
+def unit_of_work(session=Session):
+    """commit the writes of the block in one transaction, its commits are savepoints"""
+    if session.info.get(_UNIT_OF_WORK):
+        # already in a unit of work
+        yield
+        return
+
+    session.begin_nested()
+    session.info[_UNIT_OF_WORK] = True
+    try:
+        yield
+    except BaseException:
+        session.info[_UNIT_OF_WORK] = False
+        # the savepoint, then the transaction
+        session.rollback()
+        session.rollback()
+        raise
+
+    session.info[_UNIT_OF_WORK] = False
+    session.commit()
+    session.commit()
+
+
+def has_written(session=Session) -> bool:
+    """whether the session has written since it was created"""
+    return bool(session.info.get(_HAS_WRITTEN))
@@ -1,50 +1,149 @@
-from app import config
-from typing import Optional, List, Tuple
+"""
+DNS lookups of the custom domains.
+
+- one resolver is shared by the process instead of one per lookup
+- the answers are cached until their TTL expires, capped at DNS_CACHE_MAX_TTL seconds.
+A name or record that doesn't exist is cached DNS_CACHE_NEGATIVE_TTL seconds, a failed lookup
+(timeout, server failure) isn't cached.
+- resolve_many() runs the lookups in a thread pool of at most DNS_MAX_CONCURRENCY threads,
+e.g. to check the MX records of all custom domains at once.
+- the dashboard checks a record with use_cache=False: the user checks it right after changing it.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Tuple, Dict, Iterable
 
 import dns.resolver
+from cachetools import LRUCache
 
+from app import config
+from app.log import LOG
 
-def _get_dns_resolver():
-    my_resolver = dns.resolver.Resolver()
-    my_resolver.nameservers = config.NAMESERVERS
+# (hostname, record type), e.g. ("example.com", "MX")
+DnsQuery = Tuple[str, str]
 
-    return my_resolver
+_resolver: Optional[dns.resolver.Resolver] = None
+_resolver_lock = threading.Lock()
 
 
-def get_ns(hostname) -> [str]:
-    try:
-        answers = _get_dns_resolver().resolve(hostname, "NS", search=True)
-    except Exception:
-        return []
-    return [a.to_text() for a in answers]
+def create_dns_resolver(
+    nameservers: List[str], port: int = 53
+) -> dns.resolver.Resolver:
+    resolver = dns.resolver.Resolver()
+    resolver.nameservers = nameservers
+    resolver.port = port
+    return resolver
 
 
-def get_cname_record(hostname) -> Optional[str]:
-    """Return the CNAME record if exists for a domain, WITHOUT the trailing period at the end"""
+def _get_dns_resolver() -> dns.resolver.Resolver:
+    global _resolver
+    if _resolver is None:
+        with _resolver_lock:
+            if _resolver is None:
+                _resolver = create_dns_resolver(config.NAMESERVERS)
+
+    return _resolver
+
+
+def set_dns_resolver(resolver: Optional[dns.resolver.Resolver]):
+    """Use a specific resolver, None to use the configured one. Clear the cache"""
+    global _resolver
+    _resolver = resolver
+    dns_cache.clear()
+
+
+class DnsCache:
+    def __init__(self, max_ttl: int, negative_ttl: int, max_size: int = 10_000):
+        """max_ttl: in seconds, 0 disables the cache"""
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        # DnsQuery -> (expiration timestamp, records)
+        self._entries = LRUCache(maxsize=max_size)
+
+    def get(self, query: DnsQuery) -> Optional[tuple]:
+        with self._lock:
+            entry = self._entries.get(query)
+        if entry is None or entry[0] <= time.time():
+            return None
+        return entry[1]
+
+    def set(self, query: DnsQuery, records: tuple, ttl: int):
+        ttl = min(ttl, self.max_ttl)
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[query] = (time.time() + ttl, records)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+dns_cache = DnsCache(
+    config.DNS_CACHE_MAX_TTL, config.DNS_CACHE_NEGATIVE_TTL, config.DNS_CACHE_MAX_SIZE
+)
+
+
+def _resolve(hostname: str, rdtype: str, use_cache: bool = True) -> tuple:
+    """
+    the records (dnspython rdata) of hostname, empty if there's none or the lookup fails.
+    With use_cache=False, the answer is looked up again and cached.
+    """
+    query = (hostname.lower(), rdtype)
+    if use_cache:
+        records = dns_cache.get(query)
+        if records is not None:
+            return records
+
     try:
-        answers = _get_dns_resolver().resolve(hostname, "CNAME", search=True)
+        answers = _get_dns_resolver().resolve(hostname, rdtype, search=True)
+    except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+        dns_cache.set(query, (), dns_cache.negative_ttl)
+        return ()
     except Exception:
-        return None
+        LOG.d("cannot resolve %s %s", rdtype, hostname, exc_info=True)
+        return ()
+
+    records = tuple(answers)
+    dns_cache.set(query, records, answers.rrset.ttl)
+    return records
+
 
-    for a in answers:
+def resolve_many(
+    queries: Iterable[DnsQuery], use_cache: bool = True
+) -> Dict[DnsQuery, tuple]:
+    """resolve the queries concurrently, return the records of each query"""
+    queries = list(dict.fromkeys(queries))
+    if len(queries) <= 1:
+        return {query: _resolve(*query, use_cache=use_cache) for query in queries}
+
+    with ThreadPoolExecutor(
+        max_workers=min(config.DNS_MAX_CONCURRENCY, len(queries))
+    ) as executor:
+        results = executor.map(
+            lambda query: _resolve(*query, use_cache=use_cache), queries
+        )
+        return dict(zip(queries, results))
+
+
+def _ns(records) -> [str]:
+    return [a.to_text() for a in records]
+
+
+def _cname(records) -> Optional[str]:
+    for a in records:
         ret = a.to_text()
         return ret[:-1]
 
     return None
 
 
-def get_mx_domains(hostname) -> [(int, str)]:
-    """return list of (priority, domain name).
-    domain name ends with a "." at the end.
-    """
-    try:
-        answers = _get_dns_resolver().resolve(hostname, "MX", search=True)
-    except Exception:
-        return []
-
+def _mx_domains(records) -> [(int, str)]:
     ret = []
 
-    for a in answers:
+    for a in records:
         record = a.to_text()  # for ex '20 alt2.aspmx.l.google.com.'
         parts = record.split(" ")
 
@@ -56,16 +155,10 @@ def get_mx_domains(hostname) -> [(int, str)]:
 _include_spf = "include:"
 
 
-def get_spf_domain(hostname) -> [str]:
-    """return all domains listed in *include:*"""
-    try:
-        answers = _get_dns_resolver().resolve(hostname, "TXT", search=True)
-    except Exception:
-        return []
-
+def _spf_domains(records) -> [str]:
     ret = []
 
-    for a in answers:  # type: dns.rdtypes.ANY.TXT.TXT
+    for a in records:  # type: dns.rdtypes.ANY.TXT.TXT
         for record in a.strings:
             record = record.decode()  # record is bytes
 
@@ -78,15 +171,10 @@ def get_spf_domain(hostname) -> [str]:
     return ret
 
 
-def get_txt_record(hostname) -> [str]:
-    try:
-        answers = _get_dns_resolver().resolve(hostname, "TXT", search=True)
-    except Exception:
-        return []
-
+def _txt_records(records) -> [str]:
     ret = []
 
-    for a in answers:  # type: dns.rdtypes.ANY.TXT.TXT
+    for a in records:  # type: dns.rdtypes.ANY.TXT.TXT
         for record in a.strings:
             record = record.decode()  # record is bytes
 
@@ -95,6 +183,39 @@ def get_txt_record(hostname) -> [str]:
     return ret
 
 
+def get_ns(hostname) -> [str]:
+    return _ns(_resolve(hostname, "NS"))
+
+
+def get_cname_record(hostname, use_cache: bool = True) -> Optional[str]:
+    """Return the CNAME record if exists for a domain, WITHOUT the trailing period at the end"""
+    return _cname(_resolve(hostname, "CNAME", use_cache))
+
+
+def get_mx_domains(hostname, use_cache: bool = True) -> [(int, str)]:
+    """return list of (priority, domain name).
+    domain name ends with a "." at the end.
+    """
+    return _mx_domains(_resolve(hostname, "MX", use_cache))
+
+
+def get_mx_domains_many(hostnames: Iterable[str]) -> Dict[str, List[Tuple[int, str]]]:
+    """get_mx_domains() of the hostnames, resolved concurrently"""
+    answers = resolve_many((hostname, "MX") for hostname in hostnames)
+    return {
+        hostname: _mx_domains(records) for (hostname, _), records in answers.items()
+    }
+
+
+def get_spf_domain(hostname, use_cache: bool = True) -> [str]:
+    """return all domains listed in *include:*"""
+    return _spf_domains(_resolve(hostname, "TXT", use_cache))
+
+
+def get_txt_record(hostname, use_cache: bool = True) -> [str]:
+    return _txt_records(_resolve(hostname, "TXT", use_cache))
+
+
 def is_mx_equivalent(
     mx_domains: List[Tuple[int, str]], ref_mx_domains: List[Tuple[int, str]]
 ) -> bool:
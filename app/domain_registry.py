@@ -0,0 +1,253 @@
+"""
+Process-wide cache of the domain configuration read for every incoming email:
+SL domains, custom domains and their auto create rules.
+
+The entries are plain immutable objects, not Session instances, so they can be shared by all threads.
+They expire after DOMAIN_REGISTRY_TTL seconds, which bounds the staleness when a domain is changed
+by another process (e.g. the web app while the email handler is running).
+In the current process, the entries are invalidated as soon as a SLDomain, CustomDomain
+or AutoCreateRule is created, updated or deleted, whether by the dashboard, the API or the admin.
+"""
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import newrelic.agent
+from cachetools import TTLCache
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+
+from app import config
+from app.db import Session
+from app.log import LOG
+from app.models import SLDomain, CustomDomain, AutoCreateRule
+
+
+@dataclass(frozen=True)
+class SLDomainInfo:
+    id: int
+    domain: str
+    premium_only: bool
+    can_use_subdomain: bool
+
+
+@dataclass(frozen=True)
+class AutoCreateRuleInfo:
+    id: int
+    regex: str
+    order: int
+
+
+@dataclass(frozen=True)
+class CustomDomainInfo:
+    id: int
+    domain: str
+    user_id: int
+    verified: bool
+    dkim_verified: bool
+    catch_all: bool
+    # sorted by order
+    auto_create_rules: Tuple[AutoCreateRuleInfo, ...]
+    loaded_at: float
+
+
+class DomainRegistry:
+    def __init__(self, ttl: int, max_size: int = 10_000):
+        """ttl: in seconds, 0 disables the cache"""
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # incremented at each invalidation so a load started before an invalidation isn't kept
+        self.version = 0
+
+        self._sl_domains: Optional[Dict[str, SLDomainInfo]] = None
+        self._sl_domains_loaded_at = 0
+
+        # domain -> CustomDomainInfo or None if the domain isn't a custom domain
+        self._custom_domains = TTLCache(maxsize=max_size, ttl=max(ttl, 1))
+        self._custom_domain_ids: Dict[int, str] = {}
+
+        self.nb_hit = 0
+        self.nb_miss = 0
+
+    # SL domains
+    def sl_domains(self) -> List[SLDomainInfo]:
+        """all SL domains, ordered by id"""
+        return list(self._get_sl_domains().values())
+
+    def get_sl_domain(self, domain: str) -> Optional[SLDomainInfo]:
+        return self._get_sl_domains().get(domain)
+
+    def is_sl_domain(self, domain: str) -> bool:
+        return self.get_sl_domain(domain) is not None
+
+    def _get_sl_domains(self) -> Dict[str, SLDomainInfo]:
+        sl_domains = self._sl_domains
+        if (
+            self.ttl
+            and sl_domains is not None
+            and time.time() - self._sl_domains_loaded_at < self.ttl
+        ):
+            self.nb_hit += 1
+            return sl_domains
+
+        self.nb_miss += 1
+        version = self.version
+        sl_domains = {
+            sl_domain.domain: SLDomainInfo(
+                id=sl_domain.id,
+                domain=sl_domain.domain,
+                premium_only=sl_domain.premium_only,
+                can_use_subdomain=sl_domain.can_use_subdomain,
+            )
+            for sl_domain in SLDomain.order_by(SLDomain.id).all()
+        }
+
+        with self._lock:
+            if version == self.version:
+                self._sl_domains = sl_domains
+                self._sl_domains_loaded_at = time.time()
+
+        return sl_domains
+
+    # Custom domains
+    def get_custom_domain(self, domain: str) -> Optional[CustomDomainInfo]:
+        if self.ttl:
+            with self._lock:
+                if domain in self._custom_domains:
+                    self.nb_hit += 1
+                    return self._custom_domains[domain]
+
+        self.nb_miss += 1
+        version = self.version
+        custom_domain_info = self._load_custom_domain(domain)
+
+        if self.ttl:
+            with self._lock:
+                if version == self.version:
+                    self._custom_domains[domain] = custom_domain_info
+                    if custom_domain_info:
+                        self._custom_domain_ids[custom_domain_info.id] = domain
+
+        return custom_domain_info
+
+    @staticmethod
+    def _load_custom_domain(domain: str) -> Optional[CustomDomainInfo]:
+        custom_domain: CustomDomain = CustomDomain.get_by(domain=domain)
+        if not custom_domain:
+            return None
+
+        return CustomDomainInfo(
+            id=custom_domain.id,
+            domain=custom_domain.domain,
+            user_id=custom_domain.user_id,
+            verified=custom_domain.verified,
+            dkim_verified=custom_domain.dkim_verified,
+            catch_all=custom_domain.catch_all,
+            auto_create_rules=tuple(
+                AutoCreateRuleInfo(id=rule.id, regex=rule.regex, order=rule.order)
+                for rule in custom_domain.auto_create_rules
+            ),
+            loaded_at=time.time(),
+        )
+
+    # Invalidation
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+            self._sl_domains = None
+            self._custom_domains.clear()
+            self._custom_domain_ids.clear()
+
+    def invalidate_sl_domains(self):
+        with self._lock:
+            self.version += 1
+            self._sl_domains = None
+
+    def invalidate_custom_domain(
+        self, custom_domain_id: int = None, domain: str = None
+    ):
+        with self._lock:
+            self.version += 1
+            if custom_domain_id is not None:
+                domain = self._custom_domain_ids.pop(custom_domain_id, None) or domain
+            if domain is not None:
+                self._custom_domains.pop(domain, None)
+
+    # Metrics
+    def record_metrics(self):
+        """record the hit rate since the last call and the age of the oldest entries"""
+        nb_hit, nb_miss = self.nb_hit, self.nb_miss
+        self.nb_hit = self.nb_miss = 0
+        if nb_hit + nb_miss:
+            newrelic.agent.record_custom_metric(
+                "Custom/domain_registry_hit_rate", nb_hit / (nb_hit + nb_miss)
+            )
+
+        now = time.time()
+        if self._sl_domains is not None:
+            newrelic.agent.record_custom_metric(
+                "Custom/domain_registry_sl_domains_age",
+                now - self._sl_domains_loaded_at,
+            )
+
+        with self._lock:
+            loaded_ats = [
+                info.loaded_at for info in self._custom_domains.values() if info
+            ]
+        if loaded_ats:
+            newrelic.agent.record_custom_metric(
+                "Custom/domain_registry_custom_domain_max_age", now - min(loaded_ats)
+            )
+
+
+_CHANGED_KEY = "domain_registry_changed"
+
+domain_registry = DomainRegistry(
+    config.DOMAIN_REGISTRY_TTL, config.DOMAIN_REGISTRY_MAX_SIZE
+)
+
+
+def _mark_session(target):
+    # entries loaded by other threads between the flush and the commit are stale
+    session = object_session(target)
+    if session is not None:
+        session.info[_CHANGED_KEY] = True
+
+
+@event.listens_for(SLDomain, "after_insert")
+@event.listens_for(SLDomain, "after_update")
+@event.listens_for(SLDomain, "after_delete")
+def _on_sl_domain_change(mapper, connection, target: SLDomain):
+    LOG.d("invalidate SL domains in domain registry")
+    domain_registry.invalidate_sl_domains()
+    _mark_session(target)
+
+
+@event.listens_for(CustomDomain, "after_insert")
+@event.listens_for(CustomDomain, "after_update")
+@event.listens_for(CustomDomain, "after_delete")
+def _on_custom_domain_change(mapper, connection, target: CustomDomain):
+    domain_registry.invalidate_custom_domain(target.id, target.domain)
+    _mark_session(target)
+
+
+@event.listens_for(AutoCreateRule, "after_insert")
+@event.listens_for(AutoCreateRule, "after_update")
+@event.listens_for(AutoCreateRule, "after_delete")
+def _on_auto_create_rule_change(mapper, connection, target: AutoCreateRule):
+    domain_registry.invalidate_custom_domain(target.custom_domain_id)
+    _mark_session(target)
+
+
+@event.listens_for(Session, "after_commit")
+def _on_commit(session):
+    if session.info.pop(_CHANGED_KEY, False):
+        domain_registry.invalidate()
+
+
+@event.listens_for(Session, "after_bulk_update")
+@event.listens_for(Session, "after_bulk_delete")
+def _on_bulk_change(context):
+    if context.mapper.class_ in (SLDomain, CustomDomain, AutoCreateRule):
+        domain_registry.invalidate()
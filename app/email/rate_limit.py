@@ -1,5 +1,11 @@
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, List, Optional, Tuple
+
 import arrow
 
+from app import config
 from app.alias_utils import try_auto_create
 from app.config import (
     MAX_ACTIVITY_DURING_MINUTE_PER_ALIAS,
@@ -7,41 +13,154 @@ from app.config import (
 )
 from app.db import Session
 from app.email_utils import is_reverse_alias
+from app.existence_index import existence_index
 from app.log import LOG
 from app.models import Alias, EmailLog, Contact
 
+# in seconds
+_WINDOW = 60
+
+
+class RateLimitBackend(ABC):
+    """Sliding window counters: the window is approximated by the current fixed window
+    and a weighted share of the previous one, so a hit is O(1) in time and memory"""
+
+    @abstractmethod
+    def hit(self, key: str, window: int = _WINDOW) -> float:
+        """record an activity for key and return the nb of activities during the last window seconds"""
+
+    @staticmethod
+    def _weighted_count(
+        current: int, previous: int, elapsed_in_window: float, window: int
+    ) -> float:
+        return current + previous * (1 - elapsed_in_window / window)
+
+
+class InMemoryRateLimitBackend(RateLimitBackend):
+    """Counters are local to the process"""
+
+    def __init__(
+        self, purge_interval: int = _WINDOW, clock: Callable[[], float] = time.time
+    ):
+        self._clock = clock
+        self._lock = threading.Lock()
+        # (key, window) -> [window index, nb activities in current window, nb activities in previous window]
+        self._counters: Dict[Tuple[str, int], List[int]] = {}
+        self._purge_interval = purge_interval
+        self._last_purge = clock()
+
+    def hit(self, key: str, window: int = _WINDOW) -> float:
+        now = self._clock()
+        window_index, elapsed_in_window = divmod(now, window)
+        window_index = int(window_index)
+
+        with self._lock:
+            counter = self._counters.get((key, window))
+            if counter is None or counter[0] < window_index - 1:
+                counter = [window_index, 0, 0]
+            elif counter[0] == window_index - 1:
+                counter = [window_index, 0, counter[1]]
+
+            counter[1] += 1
+            self._counters[(key, window)] = counter
+
+            if now - self._last_purge > self._purge_interval:
+                self._purge(now)
+
+        return self._weighted_count(counter[1], counter[2], elapsed_in_window, window)
+
+    def _purge(self, now: float):
+        """remove the counters that haven't been hit during their current or previous window"""
+        self._counters = {
+            (key, window): counter
+            for (key, window), counter in self._counters.items()
+            if counter[0] >= int(now // window) - 1
+        }
+        self._last_purge = now
+
+
+class RedisRateLimitBackend(RateLimitBackend):
+    """Counters are shared by all processes. Works with any client implementing the redis-py
+    pipeline API: a hit is a single round-trip"""
+
+    def __init__(
+        self,
+        client,
+        prefix: str = "sl-rate-limit",
+        clock: Callable[[], float] = time.time,
+    ):
+        self._client = client
+        self._clock = clock
+        self._prefix = prefix
+
+    def hit(self, key: str, window: int = _WINDOW) -> float:
+        window_index, elapsed_in_window = divmod(self._clock(), window)
+        window_index = int(window_index)
+        current_key = f"{self._prefix}:{key}:{window_index}"
+
+        pipe = self._client.pipeline()
+        pipe.incr(current_key)
+        # the counter is needed during the next window too
+        pipe.expire(current_key, 2 * window)
+        pipe.get(f"{self._prefix}:{key}:{window_index - 1}")
+        current, _, previous = pipe.execute()
+
+        return self._weighted_count(
+            int(current), int(previous or 0), elapsed_in_window, window
+        )
 
-def rate_limited_for_alias(alias: Alias) -> bool:
+
+_backend: Optional[RateLimitBackend] = None
+
+
+def get_rate_limit_backend() -> RateLimitBackend:
+    global _backend
+    if _backend is None:
+        if config.RATE_LIMIT_BACKEND == "redis":
+            try:
+                import redis
+            except ImportError:
+                raise Exception(
+                    "RATE_LIMIT_BACKEND=redis requires the redis package: pip install redis"
+                )
+
+            _backend = RedisRateLimitBackend(
+                redis.Redis.from_url(config.RATE_LIMIT_REDIS_URL)
+            )
+        else:
+            _backend = InMemoryRateLimitBackend()
+
+    return _backend
+
+
+def set_rate_limit_backend(backend: Optional[RateLimitBackend]):
+    """Use a specific backend, None to use the configured one"""
+    global _backend
+    _backend = backend
+
+
+# an email log has one contact and one alias so the joins don't duplicate it.
+# The created_at bound limits the scan to the latest partition when email_log is partitioned.
+def _nb_activity_for_alias_in_db(alias: Alias) -> int:
     min_time = arrow.now().shift(minutes=-1)
 
     # get the nb of activity on this alias
-    nb_activity = (
+    return (
         Session.query(EmailLog)
         .join(Contact, EmailLog.contact_id == Contact.id)
         .filter(
             Contact.alias_id == alias.id,
             EmailLog.created_at > min_time,
         )
-        .group_by(EmailLog.id)
         .count()
     )
 
-    if nb_activity > MAX_ACTIVITY_DURING_MINUTE_PER_ALIAS:
-        LOG.w(
-            "Too much forward on alias %s. Nb Activity %s",
-            alias,
-            nb_activity,
-        )
-        return True
-
-    return False
-
 
-def rate_limited_for_mailbox(alias: Alias) -> bool:
+def _nb_activity_for_mailbox_in_db(alias: Alias) -> int:
     min_time = arrow.now().shift(minutes=-1)
 
     # get nb of activity on this mailbox
-    nb_activity = (
+    return (
         Session.query(EmailLog)
         .join(Contact, EmailLog.contact_id == Contact.id)
         .join(Alias, Contact.alias_id == Alias.id)
@@ -49,14 +168,37 @@ def rate_limited_for_mailbox(alias: Alias) -> bool:
             Alias.mailbox_id == alias.mailbox_id,
             EmailLog.created_at > min_time,
         )
-        .group_by(EmailLog.id)
         .count()
     )
 
+
+def rate_limited_for_alias(alias: Alias) -> bool:
+    if config.RATE_LIMIT_BACKEND == "sql":
+        nb_activity = _nb_activity_for_alias_in_db(alias)
+    else:
+        nb_activity = get_rate_limit_backend().hit(f"alias:{alias.id}")
+
+    if nb_activity > MAX_ACTIVITY_DURING_MINUTE_PER_ALIAS:
+        LOG.w(
+            "Too much forward on alias %s. Nb Activity %s",
+            alias,
+            nb_activity,
+        )
+        return True
+
+    return False
+
+
+def rate_limited_for_mailbox(alias: Alias) -> bool:
+    if config.RATE_LIMIT_BACKEND == "sql":
+        nb_activity = _nb_activity_for_mailbox_in_db(alias)
+    else:
+        nb_activity = get_rate_limit_backend().hit(f"mailbox:{alias.mailbox_id}")
+
     if nb_activity > MAX_ACTIVITY_DURING_MINUTE_PER_MAILBOX:
         LOG.w(
             "Too much forward on mailbox %s, alias %s. Nb Activity %s",
-            alias.mailbox,
+            alias.mailbox_id,
             alias,
             nb_activity,
         )
@@ -66,7 +208,9 @@ def rate_limited_for_mailbox(alias: Alias) -> bool:
 
 
 def rate_limited_forward_phase(alias_address: str) -> bool:
-    alias = Alias.get_by(email=alias_address)
+    alias = None
+    if existence_index.may_be_alias(alias_address):
+        alias = Alias.get_by(email=alias_address)
 
     if alias:
         return rate_limited_for_alias(alias) or rate_limited_for_mailbox(alias)
@@ -93,8 +237,8 @@ def rate_limited_reply_phase(reply_email: str) -> bool:
 
 
 def rate_limited(mail_from: str, rcpt_tos: [str]) -> bool:
-    # todo: re-enable rate limiting
-    return False
+    if config.RATE_LIMIT_BACKEND == "none":
+        return False
 
     for rcpt_to in rcpt_tos:
         if is_reverse_alias(rcpt_to):
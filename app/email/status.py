@@ -36,6 +36,7 @@ E407 = "421 SL E407 Retry later"
 E408 = "421 SL E408 Retry later"
 E409 = "421 SL E409 Retry later"
 E410 = "421 SL E410 Retry later"
+E411 = "421 SL E411 Too many emails in process - Retry later"
 # endregion
 
 # region 5** errors
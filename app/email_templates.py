@@ -0,0 +1,70 @@
+"""
+Jinja environments to render the emails and the notifications outside of Flask.
+
+An environment is created once per templates directory and process: a template is read and compiled
+the first time it's rendered, then kept in the environment cache.
+- with TEMPLATES_BYTECODE_CACHE_DIR, the compiled templates are also saved on disk,
+the next processes load them instead of compiling them
+- with TEMPLATES_AUTO_RELOAD (development), a template changed on disk is reloaded,
+otherwise the templates are never read again
+- precompile_templates() compiles all the templates ahead of time, at startup with TEMPLATES_PRECOMPILE
+or at build time to fill TEMPLATES_BYTECODE_CACHE_DIR
+"""
+import os
+import threading
+from typing import Dict
+
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+
+from app import config
+from app.log import LOG
+
+TEMPLATES_DIR = os.path.join(config.ROOT_DIR, "templates")
+EMAIL_TEMPLATES_DIR = os.path.join(TEMPLATES_DIR, "emails")
+TEMPLATE_EXTENSIONS = ["html", "txt", "jinja2", "j2"]
+
+# templates dir -> its environment
+_environments: Dict[str, Environment] = {}
+_lock = threading.Lock()
+
+
+def _create_environment(templates_dir: str) -> Environment:
+    bytecode_cache = None
+    if config.TEMPLATES_BYTECODE_CACHE_DIR:
+        os.makedirs(config.TEMPLATES_BYTECODE_CACHE_DIR, exist_ok=True)
+        bytecode_cache = FileSystemBytecodeCache(config.TEMPLATES_BYTECODE_CACHE_DIR)
+
+    return Environment(
+        loader=FileSystemLoader(templates_dir),
+        bytecode_cache=bytecode_cache,
+        auto_reload=config.TEMPLATES_AUTO_RELOAD,
+        # all the templates are kept
+        cache_size=-1,
+    )
+
+
+def get_environment(templates_dir: str = EMAIL_TEMPLATES_DIR) -> Environment:
+    env = _environments.get(templates_dir)
+    if env is None:
+        with _lock:
+            env = _environments.get(templates_dir)
+            if env is None:
+                env = _environments[templates_dir] = _create_environment(templates_dir)
+
+    return env
+
+
+def precompile_templates(templates_dir: str = EMAIL_TEMPLATES_DIR) -> int:
+    """compile all the templates of templates_dir in its environment, return their number"""
+    env = get_environment(templates_dir)
+    template_names = env.list_templates(extensions=TEMPLATE_EXTENSIONS)
+    for template_name in template_names:
+        env.get_template(template_name)
+
+    LOG.d("%s templates of %s compiled", len(template_names), templates_dir)
+    return len(template_names)
+
+
+if __name__ == "__main__":
+    # at build time, with TEMPLATES_BYTECODE_CACHE_DIR set
+    precompile_templates()
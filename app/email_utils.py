@@ -31,11 +31,9 @@ from email_validator import (
 )
 from flanker.addresslib import address
 from flanker.addresslib.address import EmailAddress
-from jinja2 import Environment, FileSystemLoader
 from sqlalchemy import func
 
 from app.config import (
-    ROOT_DIR,
     POSTFIX_SERVER,
     DKIM_SELECTOR,
     DKIM_PRIVATE_KEY,
@@ -60,16 +58,18 @@ from app.config import (
 )
 from app.db import Session
 from app.dns_utils import get_mx_domains
+from app.email_templates import get_environment, EMAIL_TEMPLATES_DIR
+from app.domain_registry import domain_registry
 from app.email import headers
+from app.existence_index import existence_index
+from app.identifier_generator import generate_one_free
 from app.log import LOG
 from app.mail_sender import sl_sendmail
-from app.message_utils import message_to_bytes
+from app.message_utils import message_to_bytes, append_header
 from app.models import (
     Mailbox,
     User,
     SentAlert,
-    CustomDomain,
-    SLDomain,
     Contact,
     Alias,
     EmailLog,
@@ -91,10 +91,7 @@ VERP_HMAC_ALGO = "sha3-224"
 
 
 def render(template_name, **kwargs) -> str:
-    templates_dir = os.path.join(ROOT_DIR, "templates", "emails")
-    env = Environment(loader=FileSystemLoader(templates_dir))
-
-    template = env.get_template(template_name)
+    template = get_environment(EMAIL_TEMPLATES_DIR).get_template(template_name)
 
     return template.render(
         MAX_NB_EMAIL_FREE_PLAN=MAX_NB_EMAIL_FREE_PLAN,
@@ -492,7 +489,8 @@ def add_dkim_signature_with_header(
 
         # remove linebreaks from sig
         sig = sig.replace("\n", " ").replace("\r", "")
-        msg[headers.DKIM_SIGNATURE] = sig[len("DKIM-Signature: ") :]
+        # the signed bytes are kept for the SMTP send
+        append_header(msg, headers.DKIM_SIGNATURE, sig[len("DKIM-Signature: ") :])
 
 
 def add_or_replace_header(msg: Message, header: str, value: str):
@@ -547,10 +545,11 @@ def can_create_directory_for_address(email_address: str) -> bool:
 def is_valid_alias_address_domain(email_address) -> bool:
     """Return whether an address domain might a domain handled by SimpleLogin"""
     domain = get_email_domain_part(email_address)
-    if SLDomain.get_by(domain=domain):
+    if domain_registry.is_sl_domain(domain):
         return True
 
-    if CustomDomain.get_by(domain=domain, verified=True):
+    custom_domain = domain_registry.get_custom_domain(domain)
+    if custom_domain and custom_domain.verified:
         return True
 
     return False
@@ -576,13 +575,12 @@ def email_can_be_used_as_mailbox(email_address: str) -> bool:
         LOG.d("no valid domain associated to %s", email_address)
         return False
 
-    if SLDomain.get_by(domain=domain):
+    if domain_registry.is_sl_domain(domain):
         LOG.d("%s is a SL domain", email_address)
         return False
 
-    from app.models import CustomDomain
-
-    if CustomDomain.get_by(domain=domain, verified=True):
+    custom_domain = domain_registry.get_custom_domain(domain)
+    if custom_domain and custom_domain.verified:
         LOG.d("domain %s is a SimpleLogin custom domain", domain)
         return False
 
@@ -807,8 +805,35 @@ def get_header_unicode(header: Union[str, Header]) -> str:
     return ret
 
 
+def _copy_on_write(msg: Message) -> Message:
+    """
+    Copy the message structure: the headers and the list of parts of each MIME part.
+    The payloads (str or bytes, i.e. the body and the attachments) are immutable and are shared with the original
+    message: they are only replaced, never modified in place, by set_payload().
+    """
+    clone = msg.__class__.__new__(msg.__class__)
+    clone.__dict__.update(msg.__dict__)
+    clone._headers = list(msg._headers)
+    clone.defects = list(msg.defects)
+
+    # not msg._payload: the body of a LazyMessage stays unparsed
+    payload = msg.__dict__.get("_payload")
+    if isinstance(payload, list):
+        clone._payload = [
+            _copy_on_write(part) if isinstance(part, Message) else part
+            for part in payload
+        ]
+
+    return clone
+
+
 def copy(msg: Message) -> Message:
     """return a copy of message"""
+    try:
+        return _copy_on_write(msg)
+    except Exception:
+        LOG.w("copy on write fails, try deepcopy")
+
     try:
         return deepcopy(msg)
     except Exception:
@@ -838,11 +863,11 @@ def to_bytes(msg: Message):
 
 
 def should_add_dkim_signature(domain: str) -> bool:
-    if SLDomain.get_by(domain=domain):
+    if domain_registry.is_sl_domain(domain):
         return True
 
-    custom_domain: CustomDomain = CustomDomain.get_by(domain=domain)
-    if custom_domain.dkim_verified:
+    custom_domain = domain_registry.get_custom_domain(domain)
+    if custom_domain and custom_domain.dkim_verified:
         return True
 
     return False
@@ -1045,6 +1070,15 @@ def generate_reply_email(contact_email: str, user: User) -> str:
     """
     generate a reply_email (aka reverse-alias), make sure it isn't used by any contact
     """
+    # the candidates are checked by batches
+    return generate_one_free(lambda: random_reply_email(contact_email, user))
+
+
+def random_reply_email(contact_email: str, user: User) -> str:
+    """
+    a new random reply_email (aka reverse-alias). It can already be used by a contact:
+    generate_reply_email() checks it, the unique index of contact.reply_email otherwise.
+    """
     # shorten email to avoid exceeding the 64 characters
     # from https://tools.ietf.org/html/rfc5321#section-4.5.3
     # "The maximum total length of a user name or other local-part is 64
@@ -1066,30 +1100,22 @@ def generate_reply_email(contact_email: str, user: User) -> str:
         contact_email = contact_email.replace(".", "_")
         contact_email = convert_to_alphanumeric(contact_email)
 
-    # not use while to avoid infinite loop
-    for _ in range(1000):
-        if include_sender_in_reverse_alias and contact_email:
-            random_length = random.randint(5, 10)
-            reply_email = (
-                # do not use the ra+ anymore
-                # f"ra+{contact_email}+{random_string(random_length)}@{EMAIL_DOMAIN}"
-                f"{contact_email}_{random_string(random_length)}@{EMAIL_DOMAIN}"
-            )
-        else:
-            random_length = random.randint(20, 50)
-            # do not use the ra+ anymore
-            # reply_email = f"ra+{random_string(random_length)}@{EMAIL_DOMAIN}"
-            reply_email = f"{random_string(random_length)}@{EMAIL_DOMAIN}"
+        random_length = random.randint(5, 10)
+        # do not use the ra+ anymore
+        # f"ra+{contact_email}+{random_string(random_length)}@{EMAIL_DOMAIN}"
+        return f"{contact_email}_{random_string(random_length)}@{EMAIL_DOMAIN}"
 
-        if not Contact.get_by(reply_email=reply_email):
-            return reply_email
-
-    raise Exception("Cannot generate reply email")
+    random_length = random.randint(20, 50)
+    # do not use the ra+ anymore
+    # reply_email = f"ra+{random_string(random_length)}@{EMAIL_DOMAIN}"
+    return f"{random_string(random_length)}@{EMAIL_DOMAIN}"
 
 
 def is_reverse_alias(address: str) -> bool:
     # to take into account the new reverse-alias that doesn't start with "ra+"
-    if Contact.get_by(reply_email=address):
+    if existence_index.may_be_reverse_alias(address) and Contact.get_by(
+        reply_email=address
+    ):
         return True
 
     return address.endswith(f"@{EMAIL_DOMAIN}") and (
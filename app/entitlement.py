@@ -0,0 +1,345 @@
+"""
+Entitlement of a user: whether they are premium, through which channel and until when.
+
+The subscriptions of a user (Paddle, Apple, manual, Coinbase and partner) are loaded in one query
+and kept in a plain immutable object:
+- memoised on the User instance, i.e. per request or per email as the Session is removed after each of them
+- cached by the process during ENTITLEMENT_CACHE_TTL seconds, which bounds the staleness when a subscription
+is changed by another process. An entry never outlives the moment a subscription expires.
+A user without an active subscription is only cached ENTITLEMENT_CACHE_NO_SUBSCRIPTION_TTL seconds:
+when they subscribe, the webhook is often handled by another process than their next request.
+
+lifetime and trial_end are read from the User instance, they don't need an invalidation.
+In the current process, the entries of a user are invalidated as soon as one of their subscriptions
+is created, updated or deleted, whether by the Paddle, Apple or Coinbase webhooks, the partner plan sync,
+a coupon or the admin.
+"""
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Optional, Set
+
+import arrow
+import sqlalchemy as sa
+from arrow import Arrow
+from cachetools import TTLCache
+from dateutil import tz
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+
+from app import config
+from app.db import Session
+from app.log import LOG
+from app.models import (
+    User,
+    PlanEnum,
+    Subscription,
+    AppleSubscription,
+    ManualSubscription,
+    CoinbaseSubscription,
+    PartnerSubscription,
+    PartnerUser,
+    PADDLE_SUBSCRIPTION_GRACE_DAYS,
+    _APPLE_GRACE_PERIOD_DAYS,
+    _PARTNER_SUBSCRIPTION_GRACE_DAYS,
+)
+
+SOURCE_LIFETIME = "lifetime"
+SOURCE_PADDLE = "paddle"
+SOURCE_APPLE = "apple"
+SOURCE_MANUAL = "manual"
+SOURCE_COINBASE = "coinbase"
+SOURCE_PARTNER = "partner"
+
+_USER_SUBSCRIPTION_MODELS = (
+    Subscription,
+    AppleSubscription,
+    ManualSubscription,
+    CoinbaseSubscription,
+)
+_SUBSCRIPTION_MODELS = _USER_SUBSCRIPTION_MODELS + (PartnerSubscription, PartnerUser)
+
+
+@dataclass(frozen=True)
+class SubscriptionsInfo:
+    """the active subscriptions of a user at loaded_at"""
+
+    user_id: int
+    # first active subscription, in the order of User.lifetime_or_active_subscription()
+    source: Optional[str]
+    plan: Optional[PlanEnum]
+    # when the subscription from source ends, grace period included
+    expires_at: Optional[Arrow]
+    has_active_subscription: bool
+    # same as has_active_subscription but without the giveaways and the partner subscriptions
+    is_paid: bool
+    # whether the active Paddle subscription is cancelled
+    paddle_cancelled: bool
+    # timestamp when a subscription becomes inactive, i.e. this info becomes stale
+    valid_until: float
+    loaded_at: float
+
+
+@dataclass(frozen=True)
+class Entitlement:
+    user_id: int
+    lifetime: bool
+    trial_end: Optional[Arrow]
+    subscriptions: SubscriptionsInfo
+
+    @property
+    def source(self) -> Optional[str]:
+        return SOURCE_LIFETIME if self.lifetime else self.subscriptions.source
+
+    @property
+    def plan(self) -> Optional[PlanEnum]:
+        return None if self.lifetime else self.subscriptions.plan
+
+    @property
+    def expires_at(self) -> Optional[Arrow]:
+        return None if self.lifetime else self.subscriptions.expires_at
+
+    @property
+    def lifetime_or_active_subscription(self) -> bool:
+        return self.lifetime or self.subscriptions.has_active_subscription
+
+    @property
+    def is_paid(self) -> bool:
+        return self.subscriptions.is_paid
+
+    @property
+    def in_trial(self) -> bool:
+        if self.lifetime_or_active_subscription:
+            return False
+        return bool(self.trial_end and arrow.now() < self.trial_end)
+
+    @property
+    def is_premium(self) -> bool:
+        return self.lifetime_or_active_subscription or self.in_trial
+
+
+def _paddle_end(sub: Subscription) -> Arrow:
+    # the subscription is active until the end of next_bill_date + grace period, in local time
+    # cf User.get_subscription()
+    end_date = sub.next_bill_date + timedelta(days=PADDLE_SUBSCRIPTION_GRACE_DAYS + 1)
+    return Arrow.fromdatetime(
+        datetime.combine(end_date, datetime.min.time()), tzinfo=tz.tzlocal()
+    )
+
+
+def _load_subscriptions(user_id: int) -> SubscriptionsInfo:
+    row = (
+        Session.query(
+            Subscription,
+            AppleSubscription,
+            ManualSubscription,
+            CoinbaseSubscription,
+            PartnerSubscription,
+        )
+        .select_from(User)
+        .outerjoin(Subscription, Subscription.user_id == User.id)
+        .outerjoin(AppleSubscription, AppleSubscription.user_id == User.id)
+        .outerjoin(ManualSubscription, ManualSubscription.user_id == User.id)
+        .outerjoin(CoinbaseSubscription, CoinbaseSubscription.user_id == User.id)
+        .outerjoin(PartnerUser, PartnerUser.user_id == User.id)
+        .outerjoin(
+            PartnerSubscription, PartnerSubscription.partner_user_id == PartnerUser.id
+        )
+        .filter(User.id == user_id)
+        .first()
+    )
+    sub, apple_sub, manual_sub, coinbase_sub, partner_sub = row or (None,) * 5
+
+    # (source, plan, end, is_paid) of each subscription, in the order they are checked
+    candidates = []
+    if sub:
+        candidates.append((SOURCE_PADDLE, sub.plan, _paddle_end(sub), True))
+    if apple_sub:
+        candidates.append(
+            (
+                SOURCE_APPLE,
+                apple_sub.plan,
+                apple_sub.expires_date.shift(days=_APPLE_GRACE_PERIOD_DAYS),
+                True,
+            )
+        )
+    if manual_sub:
+        candidates.append(
+            (SOURCE_MANUAL, None, manual_sub.end_at, not manual_sub.is_giveaway)
+        )
+    if coinbase_sub:
+        candidates.append((SOURCE_COINBASE, None, coinbase_sub.end_at, True))
+    if partner_sub:
+        candidates.append(
+            (
+                SOURCE_PARTNER,
+                None,
+                partner_sub.end_at.shift(days=_PARTNER_SUBSCRIPTION_GRACE_DAYS),
+                False,
+            )
+        )
+
+    now = arrow.now()
+    active = [c for c in candidates if c[2] > now]
+    source, plan, expires_at, _ = active[0] if active else (None, None, None, False)
+
+    return SubscriptionsInfo(
+        user_id=user_id,
+        source=source,
+        plan=plan,
+        expires_at=expires_at,
+        has_active_subscription=bool(active),
+        is_paid=any(c[3] for c in active),
+        paddle_cancelled=bool(sub and sub.cancelled and _paddle_end(sub) > now),
+        valid_until=min([c[2].timestamp() for c in active], default=float("inf")),
+        loaded_at=time.time(),
+    )
+
+
+class EntitlementCache:
+    def __init__(self, ttl: int, max_size: int = 10_000, no_subscription_ttl: int = 0):
+        """
+        ttl: in seconds, 0 disables the process-wide cache
+        no_subscription_ttl: in seconds, for the users without an active subscription
+        """
+        self.ttl = ttl
+        self.no_subscription_ttl = min(no_subscription_ttl, ttl)
+        self._lock = threading.Lock()
+        # incremented at each invalidation so a load started before an invalidation isn't kept
+        # and the memoised entitlements are checked again
+        self.version = 0
+        # user_id -> SubscriptionsInfo
+        self._entries = TTLCache(maxsize=max_size, ttl=max(ttl, 1))
+
+        self.nb_hit = 0
+        self.nb_miss = 0
+
+    def get_subscriptions(self, user_id: int) -> SubscriptionsInfo:
+        if self.ttl:
+            with self._lock:
+                info = self._entries.get(user_id)
+            if info is not None and self._is_fresh(info):
+                self.nb_hit += 1
+                return info
+
+        self.nb_miss += 1
+        version = self.version
+        info = _load_subscriptions(user_id)
+
+        if self.ttl:
+            with self._lock:
+                if version == self.version:
+                    self._entries[user_id] = info
+
+        return info
+
+    def _is_fresh(self, info: SubscriptionsInfo) -> bool:
+        now = time.time()
+        if not info.has_active_subscription:
+            return now < info.loaded_at + self.no_subscription_ttl
+        return now < info.valid_until
+
+    def invalidate(self, user_id: Optional[int] = None):
+        """user_id: None to invalidate all users"""
+        with self._lock:
+            self.version += 1
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+
+entitlement_cache = EntitlementCache(
+    config.ENTITLEMENT_CACHE_TTL,
+    config.ENTITLEMENT_CACHE_MAX_SIZE,
+    config.ENTITLEMENT_CACHE_NO_SUBSCRIPTION_TTL,
+)
+
+
+def _has_pending_subscription_change() -> bool:
+    # a change not flushed yet isn't seen by the cache, the load flushes it
+    return any(
+        isinstance(instance, _SUBSCRIPTION_MODELS)
+        for instances in (Session.new, Session.dirty, Session.deleted)
+        for instance in instances
+    )
+
+
+def get_entitlement(user: User) -> Entitlement:
+    """the entitlement of user, memoised on the instance"""
+    if _has_pending_subscription_change():
+        entitlement_cache.invalidate(user.id)
+
+    memo = user.__dict__.get("_entitlement_memo")
+    if (
+        memo is not None
+        and memo[0] == entitlement_cache.version
+        and time.time() < memo[1].valid_until
+    ):
+        subscriptions = memo[1]
+    else:
+        version = entitlement_cache.version
+        subscriptions = entitlement_cache.get_subscriptions(user.id)
+        user._entitlement_memo = (version, subscriptions)
+
+    return Entitlement(
+        user_id=user.id,
+        lifetime=bool(user.lifetime),
+        trial_end=user.trial_end,
+        subscriptions=subscriptions,
+    )
+
+
+# Invalidation
+_CHANGED_KEY = "entitlement_changed_user_ids"
+
+
+def _invalidate_user(session, user_id: Optional[int]):
+    entitlement_cache.invalidate(user_id)
+    # entries loaded by other threads between the flush and the commit are stale,
+    # those loaded by this thread before a rollback too
+    if session is not None:
+        changed: Set = session.info.setdefault(_CHANGED_KEY, set())
+        changed.add(user_id)
+
+
+def _partner_user_id_to_user_id(connection, partner_user_id) -> Optional[int]:
+    if partner_user_id is None:
+        return None
+    return connection.scalar(
+        sa.select([PartnerUser.user_id]).where(PartnerUser.id == partner_user_id)
+    )
+
+
+def _on_user_subscription_change(mapper, connection, target):
+    _invalidate_user(object_session(target), target.user_id)
+
+
+def _on_partner_subscription_change(mapper, connection, target: PartnerSubscription):
+    user_id = _partner_user_id_to_user_id(connection, target.partner_user_id)
+    # None invalidates all users if the partner user is already deleted
+    _invalidate_user(object_session(target), user_id)
+
+
+for _model in _USER_SUBSCRIPTION_MODELS + (PartnerUser,):
+    for _event_name in ("after_insert", "after_update", "after_delete"):
+        event.listen(_model, _event_name, _on_user_subscription_change)
+
+for _event_name in ("after_insert", "after_update", "after_delete"):
+    event.listen(PartnerSubscription, _event_name, _on_partner_subscription_change)
+
+
+@event.listens_for(Session, "after_commit")
+@event.listens_for(Session, "after_rollback")
+def _on_transaction_end(session):
+    for user_id in session.info.pop(_CHANGED_KEY, ()):
+        LOG.d("invalidate entitlement of user %s", user_id)
+        entitlement_cache.invalidate(user_id)
+
+
+@event.listens_for(Session, "after_bulk_update")
+@event.listens_for(Session, "after_bulk_delete")
+def _on_bulk_change(context):
+    if context.mapper.class_ in _SUBSCRIPTION_MODELS:
+        entitlement_cache.invalidate()
@@ -0,0 +1,358 @@
+"""
+In-memory existence index of the aliases (alias.email) and the reverse aliases (contact.reply_email),
+so an email to an address that doesn't exist, e.g. spam to random addresses, is looked up without
+querying these tables. try_auto_create() still runs on a miss.
+
+Each set is a Bloom filter: "not in the set" is certain, "maybe in the set" is wrong with
+a EXISTENCE_INDEX_ERROR_RATE probability and is then checked in the database as before.
+- the filters are built in a background thread by reading the tables by batches of ids.
+The index isn't used until then, and is rebuilt every EXISTENCE_INDEX_REBUILD_INTERVAL seconds,
+which also drops the deleted rows: an entry can't be removed from a Bloom filter.
+- the rows inserted by this process are added right away. The rows inserted by the other processes
+(web app, API, other email handlers) are read when an address isn't found, by a sync that runs at most
+every EXISTENCE_INDEX_SYNC_INTERVAL seconds: an address committed by another process can be reported
+as missing during this staleness window, e.g. an email to an alias created in the web app a second
+before is rejected, like an email sent before the alias creation. The misses in between don't query
+the database and the concurrent misses share a sync.
+- the new rows are read by id. As a row can be committed after a row with a higher id, the ids missing
+between the rows read are read again by the next syncs during EXISTENCE_INDEX_MAX_TRANSACTION_DURATION
+seconds, assuming a transaction that inserts these rows is committed within this duration.
+
+Memory: a filter needs -ln(error_rate) / ln(2)² bits per entry, i.e. 9.6 bits for 1%.
+100M entries take 114 MiB with 7 hash functions at 1%, 171 MiB with 10 hash functions at 0.1%.
+A filter is sized for the max id of its tables + 25% so its error rate holds until the next rebuild.
+With the process executor, each worker process builds its own index.
+"""
+import hashlib
+import math
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, ContextManager, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import event, text
+from sqlalchemy.engine import Connection
+
+from app import config
+from app.db import engine
+from app.log import LOG
+from app.models import Alias, Contact
+
+ALIAS = "alias"
+REVERSE_ALIAS = "reverse_alias"
+
+# set name -> the (table, column) it's built from
+_SET_COLUMNS = {
+    ALIAS: [("alias", "email")],
+    REVERSE_ALIAS: [("contact", "reply_email")],
+}
+
+_BATCH_SIZE = 50_000
+
+
+def bloom_filter_size(capacity: int, error_rate: float) -> Tuple[int, int]:
+    """(nb of bits, nb of hash functions) of a Bloom filter of capacity entries"""
+    nb_bits = math.ceil(-max(capacity, 1) * math.log(error_rate) / math.log(2) ** 2)
+    nb_hashes = max(1, round(nb_bits / max(capacity, 1) * math.log(2)))
+    return nb_bits, nb_hashes
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.nb_bits, self.nb_hashes = bloom_filter_size(capacity, error_rate)
+        self._bits = bytearray((self.nb_bits + 7) // 8)
+        # setting a bit isn't atomic, the lookups don't need the lock
+        self._lock = threading.Lock()
+        self.nb_entries = 0
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._bits)
+
+    def _positions(self, key: str) -> List[int]:
+        # the nb_hashes positions are derived from 2 hashes (Kirsch-Mitzenmacher)
+        digest = hashlib.blake2b(
+            key.encode("utf-8", "surrogatepass"), digest_size=16
+        ).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.nb_bits for i in range(self.nb_hashes)]
+
+    def add(self, key: str):
+        self.add_many([key])
+
+    def add_many(self, keys: Iterable[str]):
+        bits = self._bits
+        with self._lock:
+            for key in keys:
+                for position in self._positions(key):
+                    bits[position >> 3] |= 1 << (position & 7)
+                self.nb_entries += 1
+
+    def __contains__(self, key: str) -> bool:
+        bits = self._bits
+        for position in self._positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+@dataclass
+class _Source:
+    table: str
+    column: str
+    # the rows up to this id are all committed: the ids missing below it will never be used
+    committed_id: int = 0
+    max_id: int = 0
+    # [first id, last id] of the ids missing after committed_id, with the time they were found missing.
+    # Their rows can still be committed until max_transaction_duration after that time.
+    gaps: List[Tuple[int, int, float]] = field(default_factory=list)
+
+    def read(
+        self, conn: Connection, batch_size: int, max_transaction_duration: float
+    ) -> Iterable[List[str]]:
+        """the values of the rows not read yet: in the gaps and after max_id, by batch"""
+        now = time.time()
+        self.gaps = [g for g in self.gaps if g[2] + max_transaction_duration > now]
+        if self.gaps:
+            yield self._read_gaps(conn)
+
+        last_id = self.max_id
+        while True:
+            rows = conn.execute(
+                text(
+                    f"SELECT id, {self.column} FROM {self.table} "
+                    "WHERE id > :last_id ORDER BY id LIMIT :limit"
+                ),
+                last_id=last_id,
+                limit=batch_size,
+            ).fetchall()
+            if not rows:
+                break
+
+            for row in rows:
+                if row[0] > last_id + 1 and row[0] - 1 > self.committed_id:
+                    self.gaps.append(
+                        (max(last_id, self.committed_id) + 1, row[0] - 1, now)
+                    )
+                last_id = row[0]
+            yield [row[1] for row in rows]
+            self.max_id = last_id
+
+    def _read_gaps(self, conn: Connection) -> List[str]:
+        """the rows committed in the gaps, the gaps are split around them"""
+        conditions = " OR ".join(
+            f"id BETWEEN :first{i} AND :last{i}" for i in range(len(self.gaps))
+        )
+        params = {}
+        for i, (first, last, _) in enumerate(self.gaps):
+            params[f"first{i}"] = first
+            params[f"last{i}"] = last
+        rows = conn.execute(
+            text(f"SELECT id, {self.column} FROM {self.table} WHERE {conditions}"),
+            **params,
+        ).fetchall()
+
+        found_ids = sorted(row[0] for row in rows)
+        gaps = []
+        for first, last, missing_at in self.gaps:
+            for found_id in (i for i in found_ids if first <= i <= last):
+                if found_id > first:
+                    gaps.append((first, found_id - 1, missing_at))
+                first = found_id + 1
+            if first <= last:
+                gaps.append((first, last, missing_at))
+        self.gaps = gaps
+
+        return [row[1] for row in rows]
+
+
+@dataclass
+class _IndexedSet:
+    filter: BloomFilter
+    sources: List[_Source]
+    synced_at: float = 0
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+
+class ExistenceIndex:
+    def __init__(
+        self,
+        error_rate: float = None,
+        sync_interval: float = None,
+        max_transaction_duration: float = None,
+        connect: Callable[[], ContextManager[Connection]] = None,
+        batch_size: int = _BATCH_SIZE,
+    ):
+        """connect: returns the connection to read the tables, a new one from the engine by default"""
+        self.error_rate = error_rate or config.EXISTENCE_INDEX_ERROR_RATE
+        self.sync_interval = (
+            config.EXISTENCE_INDEX_SYNC_INTERVAL
+            if sync_interval is None
+            else sync_interval
+        )
+        self.max_transaction_duration = (
+            config.EXISTENCE_INDEX_MAX_TRANSACTION_DURATION
+            if max_transaction_duration is None
+            else max_transaction_duration
+        )
+        self._connect = connect or engine.connect
+        self.batch_size = batch_size
+
+        # None until the index is built
+        self._sets: Optional[Dict[str, _IndexedSet]] = None
+        self._lock = threading.Lock()
+        # the entries added during a build, added again to the new sets
+        self._pending: Optional[List[Tuple[str, str]]] = None
+        self._thread: Optional[threading.Thread] = None
+
+        self.nb_sync = 0
+
+    @property
+    def ready(self) -> bool:
+        return self._sets is not None
+
+    # Lookups, True when the index isn't ready
+    def may_be_alias(self, email: str) -> bool:
+        return self._may_contain(ALIAS, email)
+
+    def may_be_reverse_alias(self, reply_email: str) -> bool:
+        return self._may_contain(REVERSE_ALIAS, reply_email)
+
+    def _may_contain(self, name: str, key: str) -> bool:
+        sets = self._sets
+        if sets is None:
+            return True
+
+        indexed_set = sets[name]
+        if key in indexed_set.filter:
+            return True
+
+        # the key can have been inserted by another process since the last sync
+        if time.time() - indexed_set.synced_at < self.sync_interval:
+            return False
+
+        self._sync_if_due(indexed_set)
+        return key in indexed_set.filter
+
+    # Updates
+    def add(self, name: str, key: str):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((name, key))
+            sets = self._sets
+
+        if sets is not None:
+            sets[name].filter.add(key)
+
+    def _sync_if_due(self, indexed_set: _IndexedSet):
+        with indexed_set.lock:
+            # the threads that waited for the lock use the sync that just finished
+            if time.time() - indexed_set.synced_at >= self.sync_interval:
+                self._sync(indexed_set)
+
+    def _sync(self, indexed_set: _IndexedSet):
+        synced_at = time.time()
+        with self._connect() as conn:
+            for source in indexed_set.sources:
+                for keys in source.read(
+                    conn, self.batch_size, self.max_transaction_duration
+                ):
+                    indexed_set.filter.add_many(keys)
+
+        indexed_set.synced_at = synced_at
+        self.nb_sync += 1
+
+    def build(self):
+        """read all the tables into new sets, replace the current ones"""
+        start = time.time()
+        with self._lock:
+            self._pending = []
+
+        try:
+            sources = {
+                name: [_Source(table, column) for table, column in columns]
+                for name, columns in _SET_COLUMNS.items()
+            }
+            with self._connect() as conn:
+                for source in (s for ss in sources.values() for s in ss):
+                    source.committed_id = conn.execute(
+                        text(f"SELECT COALESCE(MAX(id), 0) FROM {source.table}")
+                    ).scalar()
+
+            # the rows up to these max ids are committed when the build starts
+            time.sleep(self.max_transaction_duration)
+
+            sets = {}
+            with self._connect() as conn:
+                for name, set_sources in sources.items():
+                    capacity = (
+                        int(sum(s.committed_id for s in set_sources) * 1.25) + 10_000
+                    )
+                    indexed_set = _IndexedSet(
+                        BloomFilter(capacity, self.error_rate), set_sources
+                    )
+                    indexed_set.synced_at = time.time()
+                    for source in set_sources:
+                        for keys in source.read(
+                            conn, self.batch_size, self.max_transaction_duration
+                        ):
+                            indexed_set.filter.add_many(keys)
+                    sets[name] = indexed_set
+
+            with self._lock:
+                for name, key in self._pending:
+                    sets[name].filter.add(key)
+                self._sets = sets
+        finally:
+            with self._lock:
+                self._pending = None
+
+        LOG.i(
+            "existence index built in %.1fs: %s",
+            time.time() - start,
+            ", ".join(
+                f"{name} {s.filter.nb_entries} entries {s.filter.nbytes // 1024} KiB"
+                for name, s in sets.items()
+            ),
+        )
+
+    def start(self, rebuild_interval: int = None):
+        """build the index in a background thread and rebuild it every rebuild_interval seconds"""
+        if self._thread is not None:
+            return
+
+        rebuild_interval = rebuild_interval or config.EXISTENCE_INDEX_REBUILD_INTERVAL
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(rebuild_interval,),
+            name="existence-index",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def _run(self, rebuild_interval: int):
+        while True:
+            try:
+                self.build()
+            except Exception:
+                LOG.e("Cannot build the existence index", exc_info=True)
+                # the current sets stay in use, retry sooner
+                time.sleep(min(rebuild_interval, 60))
+                continue
+
+            time.sleep(rebuild_interval)
+
+
+existence_index = ExistenceIndex()
+
+
+@event.listens_for(Alias, "after_insert")
+def _on_alias_insert(mapper, connection, target: Alias):
+    existence_index.add(ALIAS, target.email)
+
+
+@event.listens_for(Contact, "after_insert")
+def _on_contact_insert(mapper, connection, target: Contact):
+    existence_index.add(REVERSE_ALIAS, target.reply_email)
@@ -0,0 +1,373 @@
+"""
+Check the aliases on the HIBP (Have I Been Pwned) API, as fast as the API keys allow.
+
+- the aliases to check are read by batches instead of being loaded at once, the least recently checked first
+- each API key has a token bucket at the rate of its HIBP plan (HIBP_RATE_PER_MINUTE), shared by
+HIBP_WORKERS_PER_KEY workers so the requests of a key overlap while staying under its rate.
+A 429 pauses the key during its Retry-After and the alias is checked again.
+- the HTTP requests are made in a thread pool, the event loop isn't blocked while they wait
+- the breach names are mapped to their Hibp id by an in-memory cache
+- the results are written by batch: the alias_hibp changes and alias.hibp_last_check in 3 statements
+"""
+import asyncio
+import functools
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import arrow
+import requests
+from arrow import Arrow
+from sqlalchemy import literal, text, tuple_
+
+from app import config
+from app.db import Session
+from app.log import LOG
+from app.models import Alias, Hibp
+
+HIBP_API_URL = "https://haveibeenpwned.com/api/v3"
+
+# when a 429 has no Retry-After, in seconds
+_DEFAULT_RETRY_AFTER = 2
+
+
+class TokenBucket:
+    """Allow rate_per_minute acquisitions per minute, bursts of at most capacity"""
+
+    def __init__(
+        self,
+        rate_per_minute: float,
+        capacity: int = 1,
+        clock=time.monotonic,
+        sleep=asyncio.sleep,
+    ):
+        self.interval = 60 / rate_per_minute
+        self.capacity = capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = capacity
+        self._updated_at = clock()
+        self._paused_until = 0
+        self._lock: Optional[asyncio.Lock] = None
+
+    def pause(self, seconds: float):
+        """no acquisition during the next seconds, e.g. after a 429"""
+        self._paused_until = max(self._paused_until, self._clock() + seconds)
+        # one acquisition is allowed when the pause ends
+        self._tokens = 0
+        self._updated_at = self._paused_until - self.interval
+
+    async def acquire(self):
+        # created in the running loop
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            while True:
+                now = self._clock()
+                if now < self._paused_until:
+                    await self._sleep(self._paused_until - now)
+                    continue
+
+                self._tokens = min(
+                    self.capacity,
+                    self._tokens + (now - self._updated_at) / self.interval,
+                )
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                await self._sleep((1 - self._tokens) * self.interval)
+
+
+class BreachCache:
+    """breach name -> Hibp id"""
+
+    def __init__(self):
+        self._ids: Dict[str, int] = {}
+
+    def load(self):
+        self._ids = {
+            name: hibp_id for hibp_id, name in Session.query(Hibp.id, Hibp.name)
+        }
+
+    def get_id(self, name: str) -> int:
+        hibp_id = self._ids.get(name)
+        if hibp_id is None:
+            # a breach added after the list of breaches was updated
+            hibp = Hibp.get_by(name=name) or Hibp.create(name=name, flush=True)
+            hibp_id = self._ids[name] = hibp.id
+        return hibp_id
+
+
+class HibpResultWriter:
+    """Buffer the breaches found for the aliases, written every batch_size aliases"""
+
+    def __init__(self, batch_size: int):
+        self.batch_size = batch_size
+        # alias id -> its Hibp ids
+        self._results: Dict[int, List[int]] = {}
+
+    def add(self, alias_id: int, hibp_ids: List[int]):
+        self._results[alias_id] = hibp_ids
+        if len(self._results) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        results, self._results = self._results, {}
+        if not results:
+            return
+
+        alias_ids = list(results)
+        pair_alias_ids = [a for a, hibp_ids in results.items() for _ in hibp_ids]
+        pair_hibp_ids = [h for hibp_ids in results.values() for h in hibp_ids]
+        params = {
+            "alias_ids": alias_ids,
+            "pair_alias_ids": pair_alias_ids,
+            "pair_hibp_ids": pair_hibp_ids,
+            "now": arrow.utcnow().naive,
+        }
+
+        # the breaches an alias isn't in anymore
+        Session.execute(
+            text(
+                """
+DELETE FROM alias_hibp
+WHERE alias_id = ANY(CAST(:alias_ids AS INTEGER[]))
+    AND (alias_id, hibp_id) NOT IN (
+        SELECT * FROM unnest(CAST(:pair_alias_ids AS INTEGER[]), CAST(:pair_hibp_ids AS INTEGER[]))
+    )
+"""
+            ),
+            params,
+        )
+        # the new ones, the aliases deleted during the scan are skipped
+        Session.execute(
+            text(
+                """
+INSERT INTO alias_hibp (created_at, alias_id, hibp_id)
+SELECT :now, pair.alias_id, pair.hibp_id
+FROM unnest(CAST(:pair_alias_ids AS INTEGER[]), CAST(:pair_hibp_ids AS INTEGER[]))
+    AS pair (alias_id, hibp_id)
+JOIN alias ON alias.id = pair.alias_id
+ON CONFLICT DO NOTHING
+"""
+            ),
+            params,
+        )
+        Session.execute(
+            text(
+                "UPDATE alias SET hibp_last_check = :now "
+                "WHERE id = ANY(CAST(:alias_ids AS INTEGER[]))"
+            ),
+            params,
+        )
+        Session.commit()
+        LOG.d("Updated breaches info for %s aliases", len(alias_ids))
+
+
+def due_aliases(max_date: Arrow, batch_size: int) -> Iterator[List[Tuple[int, str]]]:
+    """
+    (id, email) of the enabled aliases not checked since max_date, the least recently checked first:
+    the aliases never checked, then by hibp_last_check. Read by batches, each starts where the previous
+    one ends (hibp_last_check, id) so a batch is read from the ix_alias_hibp_last_check index.
+    """
+    # never checked
+    last_id = 0
+    while True:
+        rows = (
+            Session.query(Alias.id, Alias.email)
+            .filter(Alias.hibp_last_check.is_(None), Alias.id > last_id, Alias.enabled)
+            .order_by(Alias.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not rows:
+            break
+
+        yield rows
+        last_id = rows[-1][0]
+
+    # not checked since max_date
+    last_check, last_id = None, 0
+    while True:
+        query = Session.query(Alias.id, Alias.email, Alias.hibp_last_check).filter(
+            Alias.hibp_last_check < max_date, Alias.enabled
+        )
+        if last_check is not None:
+            query = query.filter(
+                tuple_(Alias.hibp_last_check, Alias.id)
+                > tuple_(literal(last_check, Alias.hibp_last_check.type), last_id)
+            )
+        rows = query.order_by(Alias.hibp_last_check, Alias.id).limit(batch_size).all()
+        if not rows:
+            return
+
+        yield [(alias_id, email) for alias_id, email, _ in rows]
+        last_id, _, last_check = rows[-1]
+
+
+@dataclass
+class HibpScanReport:
+    nb_checked: int = 0
+    nb_breached: int = 0
+    nb_rate_limited: int = 0
+    nb_errors: int = 0
+    # in seconds
+    duration: float = 0
+    # index of the api key -> nb of aliases checked with it, the keys aren't logged
+    nb_checked_per_key: Dict[int, int] = field(default_factory=dict)
+
+    def aliases_per_minute_per_key(self) -> float:
+        if not self.duration or not self.nb_checked_per_key:
+            return 0
+        return self.nb_checked / len(self.nb_checked_per_key) / self.duration * 60
+
+    def __str__(self):
+        return (
+            f"{self.nb_checked} aliases checked ({self.nb_breached} breached) "
+            f"in {self.duration:.1f}s, "
+            f"{self.aliases_per_minute_per_key():.1f} aliases/minute per key, "
+            f"{self.nb_rate_limited} rate limited, {self.nb_errors} errors"
+        )
+
+
+def _retry_after(r: requests.Response) -> float:
+    try:
+        return float(r.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return _DEFAULT_RETRY_AFTER
+
+
+class HibpScanner:
+    def __init__(
+        self,
+        api_keys: List[str],
+        rate_per_minute: float = None,
+        workers_per_key: int = None,
+        api_url: str = HIBP_API_URL,
+        batch_size: int = 100,
+        max_retries: int = 3,
+        timeout: float = 10,
+    ):
+        self.api_keys = api_keys
+        self.rate_per_minute = rate_per_minute or config.HIBP_RATE_PER_MINUTE
+        self.workers_per_key = workers_per_key or config.HIBP_WORKERS_PER_KEY
+        self.api_url = api_url
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.timeout = timeout
+
+        self.breach_cache = BreachCache()
+        self.writer = HibpResultWriter(batch_size)
+        self.report = HibpScanReport()
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    async def scan(self, max_date: Arrow) -> HibpScanReport:
+        """check the aliases not checked since max_date"""
+        start = time.time()
+        self.breach_cache.load()
+        self.report = HibpScanReport(
+            nb_checked_per_key={i: 0 for i in range(len(self.api_keys))}
+        )
+
+        nb_workers = len(self.api_keys) * self.workers_per_key
+        queue = asyncio.Queue(maxsize=2 * self.batch_size)
+        self._executor = ThreadPoolExecutor(max_workers=nb_workers)
+        try:
+            workers = []
+            for key_index, api_key in enumerate(self.api_keys):
+                bucket = TokenBucket(self.rate_per_minute)
+                for _ in range(self.workers_per_key):
+                    workers.append(
+                        asyncio.ensure_future(
+                            self._worker(key_index, api_key, bucket, queue)
+                        )
+                    )
+
+            for batch in due_aliases(max_date, self.batch_size):
+                for alias in batch:
+                    await queue.put(alias)
+
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+            self.writer.flush()
+        finally:
+            self._executor.shutdown(wait=False)
+
+        self.report.duration = time.time() - start
+        return self.report
+
+    async def _worker(self, key_index: int, api_key: str, bucket: TokenBucket, queue):
+        # the connection to HIBP is reused by the requests of a worker
+        http = requests.Session()
+        http.headers.update({"user-agent": "SimpleLogin", "hibp-api-key": api_key})
+
+        while True:
+            alias = await queue.get()
+            if alias is None:
+                http.close()
+                return
+
+            try:
+                await self._check(key_index, bucket, http, *alias)
+            except Exception:
+                LOG.e("Cannot check HIBP for alias %s", alias[0], exc_info=True)
+                self.report.nb_errors += 1
+
+    async def _check(
+        self,
+        key_index: int,
+        bucket: TokenBucket,
+        http: requests.Session,
+        alias_id: int,
+        email: str,
+    ):
+        url = f"{self.api_url}/breachedaccount/{urllib.parse.quote(email)}"
+        loop = asyncio.get_event_loop()
+
+        for _ in range(self.max_retries + 1):
+            await bucket.acquire()
+            r = await loop.run_in_executor(
+                self._executor, functools.partial(http.get, url, timeout=self.timeout)
+            )
+            if r.status_code != 429:
+                break
+
+            retry_after = _retry_after(r)
+            LOG.w("HIBP rate limited, pause key %s for %ss", key_index, retry_after)
+            self.report.nb_rate_limited += 1
+            bucket.pause(retry_after)
+        else:
+            LOG.w("HIBP still rate limited, check alias %s in the next run", alias_id)
+            return
+
+        if r.status_code == 200:
+            hibp_ids = [self.breach_cache.get_id(entry["Name"]) for entry in r.json()]
+            if hibp_ids:
+                LOG.w("Alias %s appears in HIBP breaches %s", alias_id, hibp_ids)
+                self.report.nb_breached += 1
+        elif r.status_code == 404:
+            # No breaches found
+            hibp_ids = []
+        elif r.status_code >= 500:
+            LOG.w("HIBP server 5** error %s", r.status_code)
+            self.report.nb_errors += 1
+            return
+        else:
+            LOG.e(
+                "An error occured while checking alias %s: %s - %s",
+                alias_id,
+                r.status_code,
+                r.text,
+            )
+            self.report.nb_errors += 1
+            return
+
+        self.report.nb_checked += 1
+        self.report.nb_checked_per_key[key_index] += 1
+        self.writer.add(alias_id, hibp_ids)
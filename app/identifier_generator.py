@@ -0,0 +1,190 @@
+"""
+Random identifiers that aren't used yet: random alias addresses and reverse aliases.
+
+Instead of looking up one candidate at a time until a free one is found, IDENTIFIER_BATCH_SIZE
+candidates are generated at once and looked up in a single query against alias, deleted_alias
+and contact.
+
+The random aliases of generate_email() don't depend on the user: the free candidates that aren't
+returned are kept in a pool for the next calls. With IDENTIFIER_POOL_SIZE > 0, the pool is also
+refilled up to this size by a background thread, so a call doesn't wait for the database.
+A pooled identifier was free when it was checked: the unique index of alias.email still rejects
+the very unlikely identifier taken in the meantime by another process.
+"""
+import os
+import threading
+from collections import deque
+from typing import Callable, Collection, Deque, Dict, List, Set, Tuple
+
+from sqlalchemy import bindparam, text
+
+from app import config
+from app.db import Session, engine
+from app.log import LOG
+
+_FIND_USED_QUERY = text(
+    """
+SELECT email FROM alias WHERE email IN :candidates
+UNION ALL
+SELECT email FROM deleted_alias WHERE email IN :candidates
+UNION ALL
+SELECT reply_email FROM contact WHERE reply_email IN :candidates
+"""
+).bindparams(bindparam("candidates", expanding=True))
+
+# max nb of batches before giving up, in case the namespace is full
+_MAX_BATCHES = 100
+
+
+class GeneratorStats:
+    """candidates generated, found already used and nb of queries since the last reset"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.nb_generated = 0
+        self.nb_candidates = 0
+        self.nb_collisions = 0
+        self.nb_queries = 0
+
+    def record_batch(self, nb_candidates: int, nb_collisions: int, nb_queries: int):
+        with self._lock:
+            self.nb_candidates += nb_candidates
+            self.nb_collisions += nb_collisions
+            self.nb_queries += nb_queries
+
+    def record_generated(self):
+        with self._lock:
+            self.nb_generated += 1
+
+    def reset(self) -> "GeneratorStats":
+        stats = GeneratorStats()
+        with self._lock:
+            stats.nb_generated, self.nb_generated = self.nb_generated, 0
+            stats.nb_candidates, self.nb_candidates = self.nb_candidates, 0
+            stats.nb_collisions, self.nb_collisions = self.nb_collisions, 0
+            stats.nb_queries, self.nb_queries = self.nb_queries, 0
+        return stats
+
+
+stats = GeneratorStats()
+
+
+def find_used(candidates: Collection[str], conn=None) -> Set[str]:
+    """
+    The candidates used by an alias, a deleted alias or a contact, in one query.
+    conn: the connection to use, the Session by default
+    """
+    rows = (conn or Session).execute(_FIND_USED_QUERY, {"candidates": list(candidates)})
+    used = {row[0] for row in rows}
+    stats.record_batch(len(candidates), len(used), 1)
+    return used
+
+
+def generate_free(
+    generate: Callable[[], str], batch_size: int = None, conn=None
+) -> List[str]:
+    """
+    Free identifiers among batch_size candidates returned by generate,
+    a new batch is generated if they're all used
+    """
+    batch_size = batch_size or config.IDENTIFIER_BATCH_SIZE
+    for _ in range(_MAX_BATCHES):
+        # a set: the same candidate can be generated twice
+        candidates = {generate() for _ in range(batch_size)}
+        used = find_used(candidates, conn)
+        free = [c for c in candidates if c not in used]
+        if free:
+            return free
+
+        LOG.w("all %s candidates are used, e.g. %s", len(candidates), used.pop())
+
+    raise Exception("Cannot generate a free identifier")
+
+
+def generate_one_free(generate: Callable[[], str]) -> str:
+    identifier = generate_free(generate)[0]
+    stats.record_generated()
+    return identifier
+
+
+class IdentifierPool:
+    """Free identifiers returned by generate, generated by batches"""
+
+    def __init__(
+        self,
+        generate: Callable[[], str],
+        pool_size: int = None,
+        batch_size: int = None,
+    ):
+        self._generate = generate
+        self.pool_size = config.IDENTIFIER_POOL_SIZE if pool_size is None else pool_size
+        self.batch_size = batch_size or config.IDENTIFIER_BATCH_SIZE
+        self._pool: Deque[str] = deque()
+        self._lock = threading.Lock()
+        self._refill_needed = threading.Event()
+        # the refill thread isn't inherited by a forked process
+        self._thread_pid = None
+
+    def get(self) -> str:
+        self._start_refill_thread()
+        try:
+            # deque.popleft is thread-safe
+            identifier = self._pool.popleft()
+        except IndexError:
+            free = generate_free(self._generate, self.batch_size)
+            identifier = free.pop()
+            with self._lock:
+                self._pool.extend(free)
+
+        if len(self._pool) < self.pool_size // 2:
+            self._refill_needed.set()
+
+        stats.record_generated()
+        return identifier
+
+    def _start_refill_thread(self):
+        if self.pool_size <= 0 or self._thread_pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._thread_pid == os.getpid():
+                return
+            self._thread_pid = os.getpid()
+            # the identifiers of the parent process can be used by it
+            self._pool.clear()
+            self._refill_needed.set()
+            threading.Thread(
+                target=self._refill_forever, name="identifier-pool", daemon=True
+            ).start()
+
+    def _refill_forever(self):
+        while True:
+            self._refill_needed.wait()
+            self._refill_needed.clear()
+            try:
+                self.refill()
+            except Exception:
+                LOG.e("Cannot refill the identifier pool", exc_info=True)
+
+    def refill(self):
+        """generate identifiers until the pool has pool_size of them"""
+        with engine.connect() as conn:
+            while len(self._pool) < self.pool_size:
+                free = generate_free(self._generate, self.batch_size, conn)
+                with self._lock:
+                    self._pool.extend(free)
+
+
+_pools: Dict[Tuple, IdentifierPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(key: Tuple, generate: Callable[[], str]) -> IdentifierPool:
+    """the pool of the identifiers of key, created with generate on the first call"""
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = IdentifierPool(generate)
+    return pool
@@ -46,19 +46,22 @@ class ExportUserDataJob:
 
     def _get_paginated_model(self, model_class, page_size=50) -> List:
         objects = []
-        page = 0
+        last_id = 0
         db_objects = []
-        while page == 0 or len(db_objects) == page_size:
+        # keyset pagination: each page starts after the last id of the previous one
+        while last_id == 0 or len(db_objects) == page_size:
             db_objects = (
                 Session.query(model_class)
                 .filter(model_class.user_id == self._user.id)
+                .filter(model_class.id > last_id)
                 .order_by(model_class.id)
                 .limit(page_size)
-                .offset(page * page_size)
                 .all()
             )
+            if not db_objects:
+                break
             objects.extend(db_objects)
-            page += 1
+            last_id = db_objects[-1].id
         return objects
 
     def _get_aliases(self) -> List[Alias]:
@@ -1,5 +1,6 @@
 import logging
 import sys
+import threading
 import time
 
 import coloredlogs
@@ -16,13 +17,13 @@ _log_format = (
 _log_formatter = logging.Formatter(_log_format)
 
 # used to keep track of an email lifecycle
-_MESSAGE_ID = ""
+# thread local as several emails can be handled at the same time by the email handler workers
+_MESSAGE_ID = threading.local()
 
 
 def set_message_id(message_id):
-    global _MESSAGE_ID
     LOG.d("set message_id %s", message_id)
-    _MESSAGE_ID = message_id
+    _MESSAGE_ID.value = message_id
 
 
 class EmailHandlerFilter(logging.Filter):
@@ -34,7 +35,7 @@ class EmailHandlerFilter(logging.Filter):
         return True
 
     def get_message_id(self):
-        return _MESSAGE_ID
+        return getattr(_MESSAGE_ID, "value", "")
 
 
 def _get_console_handler():
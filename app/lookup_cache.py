@@ -0,0 +1,114 @@
+"""
+Per message (or per request) cache for the lookups done by unique keys with ModelMixin.get_by,
+e.g. Contact.get_by(reply_email=...) or Alias.get_by(email=...) that are repeated many times
+when an email is handled.
+
+The cache is only active inside `with lookup_cache():` and is local to the thread.
+It keeps the instances of the current Session: entries of a model are invalidated when an instance
+of this model is added or modified. As a deletion can cascade to other tables,
+everything is invalidated on a deletion or a rollback.
+"""
+import threading
+from contextlib import contextmanager
+from typing import Dict, Tuple, Optional, Callable, Any, Iterator
+
+from sqlalchemy import event
+
+from app.db import Session
+from app.log import LOG
+
+_local = threading.local()
+
+
+class LookupCache:
+    def __init__(self):
+        # model -> {lookup key -> instance or None}
+        self._entries: Dict[type, Dict[Tuple, Any]] = {}
+        self.nb_hit = 0
+        self.nb_miss = 0
+
+    def get(self, model: type, kw: dict, load: Callable[[], Any]):
+        entries = self._entries.setdefault(model, {})
+        key = tuple(sorted(kw.items()))
+        if key in entries:
+            self.nb_hit += 1
+            return entries[key]
+
+        self.nb_miss += 1
+        res = load()
+        entries[key] = res
+        return res
+
+    def invalidate(self, model: Optional[type] = None):
+        """model: None to invalidate all models"""
+        if model is None:
+            self._entries.clear()
+        else:
+            for cached_model in list(self._entries):
+                if issubclass(model, cached_model) or issubclass(cached_model, model):
+                    del self._entries[cached_model]
+
+
+def get_lookup_cache() -> Optional[LookupCache]:
+    return getattr(_local, "cache", None)
+
+
+def invalidate_lookup_cache():
+    cache = get_lookup_cache()
+    if cache is not None:
+        cache.invalidate()
+
+
+@contextmanager
+def lookup_cache() -> Iterator[LookupCache]:
+    """Enable the lookup cache, nested calls share the outer cache"""
+    outer = get_lookup_cache()
+    if outer is not None:
+        yield outer
+        return
+
+    cache = LookupCache()
+    _local.cache = cache
+    try:
+        yield cache
+    finally:
+        _local.cache = None
+        LOG.d("lookup cache: %s hits, %s misses", cache.nb_hit, cache.nb_miss)
+
+
+def _invalidate_instance(instance):
+    cache = get_lookup_cache()
+    if cache is not None:
+        cache.invalidate(type(instance))
+
+
+@event.listens_for(Session, "transient_to_pending")
+def _on_add(session, instance):
+    _invalidate_instance(instance)
+
+
+@event.listens_for(Session, "before_flush")
+def _on_flush(session, flush_context, instances):
+    cache = get_lookup_cache()
+    if cache is None:
+        return
+
+    if session.deleted:
+        cache.invalidate()
+        return
+
+    for instance in session.dirty:
+        cache.invalidate(type(instance))
+
+
+@event.listens_for(Session, "after_bulk_update")
+def _on_bulk_update(update_context):
+    cache = get_lookup_cache()
+    if cache is not None:
+        cache.invalidate(update_context.mapper.class_)
+
+
+@event.listens_for(Session, "after_bulk_delete")
+@event.listens_for(Session, "after_soft_rollback")
+def _invalidate_all(*args):
+    invalidate_lookup_cache()
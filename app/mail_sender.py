@@ -1,15 +1,22 @@
 from __future__ import annotations
+import atexit
 import base64
 import email
+import heapq
+import itertools
 import json
 import os
+import queue
+import random
+import ssl
+import threading
 import time
 import uuid
-from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from functools import wraps
 from mailbox import Message
-from smtplib import SMTP, SMTPException
-from typing import Optional, Dict, List, Callable
+from smtplib import SMTP, SMTPException, SMTPServerDisconnected
+from typing import Optional, Dict, List, Callable, Tuple, Iterator
 
 import newrelic.agent
 from attr import dataclass
@@ -65,9 +72,346 @@ class SendRequest:
         )
 
 
+class _ResumableTLSContext(ssl.SSLContext):
+    """Resume the last TLS session on STARTTLS to avoid a full handshake for every new connection.
+    Like smtplib default context, the Postfix certificate isn't verified"""
+
+    def __init__(self, *args, **kwargs):
+        # the protocol is set by SSLContext.__new__
+        self.check_hostname = False
+        self.verify_mode = ssl.CERT_NONE
+        self._session = None
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        kwargs.setdefault("session", self._session)
+        ssl_sock = super().wrap_socket(sock, *args, **kwargs)
+        self._session = ssl_sock.session
+        return ssl_sock
+
+
+def _smtp_target() -> Tuple[str, int, bool]:
+    if config.POSTFIX_SUBMISSION_TLS:
+        return config.POSTFIX_SERVER, 587, True
+    return config.POSTFIX_SERVER, config.POSTFIX_PORT, False
+
+
+def _connect_to_smtp(
+    target: Tuple[str, int, bool], tls_context: Optional[ssl.SSLContext] = None
+) -> SMTP:
+    server, port, use_tls = target
+    smtp = SMTP(server, port)
+    if use_tls:
+        smtp.starttls(context=tls_context)
+    return smtp
+
+
+class _PooledConnection:
+    def __init__(self, smtp: SMTP, target: Tuple[str, int, bool]):
+        self.smtp = smtp
+        self.target = target
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        self.nb_messages = 0
+
+
+class SmtpConnectionPool:
+    """Keep warm SMTP connections to Postfix, shared by all threads of the process.
+
+    An idle connection is checked with NOOP before being reused if it hasn't been used
+    for health_check_interval seconds, and recycled after max_messages emails or max_age seconds.
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        max_messages: int = 100,
+        max_age: int = 60,
+        health_check_interval: int = 5,
+    ):
+        self._idle: queue.LifoQueue[_PooledConnection] = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._max_messages = max_messages
+        self._max_age = max_age
+        self._health_check_interval = health_check_interval
+        self._tls_context = _ResumableTLSContext(ssl.PROTOCOL_TLS_CLIENT)
+        self.nb_connections_created = 0
+
+    @contextmanager
+    def connection(self, fresh: bool = False) -> Iterator[SMTP]:
+        """fresh: don't reuse an idle connection"""
+        target = _smtp_target()
+        with self._slots:
+            conn = None if fresh else self._get_idle_connection(target)
+            if conn is None:
+                conn = _PooledConnection(
+                    _connect_to_smtp(target, self._tls_context), target
+                )
+                self.nb_connections_created += 1
+
+            try:
+                yield conn.smtp
+            except Exception:
+                # the connection state is unknown
+                self._close(conn)
+                raise
+
+            conn.nb_messages += 1
+            conn.last_used = time.time()
+            self._idle.put(conn)
+
+    def _get_idle_connection(
+        self, target: Tuple[str, int, bool]
+    ) -> Optional[_PooledConnection]:
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return None
+
+            now = time.time()
+            if (
+                conn.target != target
+                or conn.nb_messages >= self._max_messages
+                or now - conn.created_at > self._max_age
+            ):
+                self._close(conn)
+                continue
+
+            if now - conn.last_used > self._health_check_interval:
+                try:
+                    code, _ = conn.smtp.noop()
+                except (SMTPException, OSError):
+                    code = None
+                if code != 250:
+                    LOG.d("Pooled smtp connection fails NOOP, status %s", code)
+                    self._close(conn)
+                    continue
+
+            return conn
+
+    def close_all(self):
+        while True:
+            try:
+                self._close(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+    @staticmethod
+    def _close(conn: _PooledConnection):
+        try:
+            conn.smtp.quit()
+        except (SMTPException, OSError):
+            conn.smtp.close()
+
+
+def backoff_delay(attempt: int, base: float, max_delay: float) -> float:
+    """exponential backoff with full jitter, attempt starts at 1"""
+    return random.uniform(0, min(max_delay, base * 2 ** (attempt - 1)))
+
+
+class _QueuedDelivery:
+    def __init__(self, send_request: SendRequest, retries: int):
+        self.send_request = send_request
+        self.retries = retries
+        self.attempt = 0
+
+    @property
+    def destination(self) -> str:
+        return self.send_request.envelope_to.rpartition("@")[2].lower()
+
+
+class DeliveryQueue:
+    """Deliver emails from a bounded in-memory queue with nb_workers threads.
+
+    A failed delivery is retried later with an exponential backoff without blocking a worker,
+    at most max_per_destination emails are delivered at the same time to a destination domain.
+    Emails that can't be queued or delivered are handed to on_failure.
+    """
+
+    _STOP = object()
+
+    def __init__(
+        self,
+        deliver: Callable[[SendRequest], None],
+        on_failure: Callable[[SendRequest, Optional[Exception]], None],
+        nb_workers: int,
+        max_size: int,
+        max_per_destination: int,
+        retry_base_delay: float = 1,
+        retry_max_delay: float = 60,
+    ):
+        self._deliver = deliver
+        self._on_failure = on_failure
+        self._queue: queue.Queue = queue.Queue(maxsize=max_size)
+        self._max_per_destination = max_per_destination
+        self._retry_base_delay = retry_base_delay
+        self._retry_max_delay = retry_max_delay
+
+        self._lock = threading.Condition()
+        # heap of (due time, sequence, delivery) waiting to be retried
+        self._delayed: List[Tuple[float, int, _QueuedDelivery]] = []
+        self._sequence = itertools.count()
+        self._nb_per_destination: Dict[str, int] = {}
+        # nb deliveries queued, delayed or being delivered
+        self._nb_unfinished = 0
+        self._stopped = False
+
+        self._threads = [
+            threading.Thread(target=self._work, name=f"mail-sender-{i}", daemon=True)
+            for i in range(nb_workers)
+        ]
+        self._threads.append(
+            threading.Thread(
+                target=self._schedule_delayed, name="mail-sender-retry", daemon=True
+            )
+        )
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, send_request: SendRequest, retries: int) -> bool:
+        """return False if the email can't be queued, in this case it's handed to on_failure"""
+        with self._lock:
+            if self._stopped:
+                self._on_failure(send_request, None)
+                return False
+            self._nb_unfinished += 1
+
+        if not self._put(_QueuedDelivery(send_request, retries)):
+            LOG.w("Delivery queue full, spill %s", send_request.envelope_to)
+            newrelic.agent.record_custom_metric("Custom/delivery_queue_full", 1)
+            return False
+
+        newrelic.agent.record_custom_metric(
+            "Custom/delivery_queue_size", self._queue.qsize()
+        )
+        return True
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """wait until all submitted emails are delivered or handed to on_failure"""
+        with self._lock:
+            return self._lock.wait_for(lambda: self._nb_unfinished == 0, timeout)
+
+    def shutdown(self, timeout: Optional[float] = None):
+        """stop the workers after the queue is drained, delayed retries are handed to on_failure"""
+        with self._lock:
+            self._stopped = True
+            delayed, self._delayed = self._delayed, []
+            self._lock.notify_all()
+
+        for _, _, delivery in delayed:
+            self._finish(delivery, None)
+
+        for _ in range(len(self._threads) - 1):
+            self._queue.put(self._STOP)
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _put(self, delivery: _QueuedDelivery) -> bool:
+        try:
+            self._queue.put_nowait(delivery)
+            return True
+        except queue.Full:
+            self._finish(delivery, None)
+            return False
+
+    def _finish(self, delivery: _QueuedDelivery, error: Optional[Exception], ok=False):
+        if not ok:
+            self._on_failure(delivery.send_request, error)
+        with self._lock:
+            self._nb_unfinished -= 1
+            self._lock.notify_all()
+
+    def _retry_later(self, delivery: _QueuedDelivery, delay: float):
+        with self._lock:
+            if self._stopped:
+                stopped = True
+            else:
+                stopped = False
+                heapq.heappush(
+                    self._delayed,
+                    (time.time() + delay, next(self._sequence), delivery),
+                )
+                self._lock.notify_all()
+        if stopped:
+            self._finish(delivery, None)
+
+    def _acquire_destination(self, destination: str) -> bool:
+        with self._lock:
+            nb = self._nb_per_destination.get(destination, 0)
+            if nb >= self._max_per_destination:
+                return False
+            self._nb_per_destination[destination] = nb + 1
+            return True
+
+    def _release_destination(self, destination: str):
+        with self._lock:
+            nb = self._nb_per_destination[destination] - 1
+            if nb:
+                self._nb_per_destination[destination] = nb
+            else:
+                del self._nb_per_destination[destination]
+
+    def _work(self):
+        while True:
+            delivery = self._queue.get()
+            if delivery is self._STOP:
+                return
+
+            destination = delivery.destination
+            if not self._acquire_destination(destination):
+                # come back when another email to this destination is delivered
+                self._retry_later(delivery, 0.05)
+                continue
+
+            try:
+                delivery.attempt += 1
+                self._deliver(delivery.send_request)
+            except (SMTPException, ConnectionRefusedError, TimeoutError) as e:
+                if delivery.attempt > delivery.retries:
+                    self._finish(delivery, e)
+                else:
+                    delay = backoff_delay(
+                        delivery.attempt, self._retry_base_delay, self._retry_max_delay
+                    )
+                    LOG.w(
+                        "Delivery to %s fails with %s, retry in %s seconds",
+                        delivery.send_request.envelope_to,
+                        e,
+                        delay,
+                    )
+                    self._retry_later(delivery, delay)
+            except Exception as e:
+                LOG.e("Unexpected error when delivering to %s", destination)
+                self._finish(delivery, e)
+            else:
+                self._finish(delivery, None, ok=True)
+            finally:
+                self._release_destination(destination)
+
+    def _schedule_delayed(self):
+        """move the delayed deliveries that are due to the queue"""
+        while True:
+            with self._lock:
+                while not self._stopped and (
+                    not self._delayed or self._delayed[0][0] > time.time()
+                ):
+                    timeout = (
+                        self._delayed[0][0] - time.time() if self._delayed else None
+                    )
+                    self._lock.wait(timeout)
+                if self._stopped:
+                    return
+                _, _, delivery = heapq.heappop(self._delayed)
+
+            self._put(delivery)
+
+
 class MailSender:
     def __init__(self):
-        self._pool: Optional[ThreadPoolExecutor] = None
+        self._delivery_queue: Optional[DeliveryQueue] = None
+        self._connection_pool: Optional[SmtpConnectionPool] = None
+        if config.POSTFIX_CONNECTION_POOL_SIZE > 0:
+            self.enable_connection_pool(config.POSTFIX_CONNECTION_POOL_SIZE)
         self._store_emails = False
         self._emails_sent: List[SendRequest] = []
 
@@ -92,11 +436,52 @@ class MailSender:
 
         return wrapper
 
-    def enable_background_pool(self, max_workers=10):
-        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+    def enable_background_pool(
+        self,
+        max_workers: int = 10,
+        max_queue_size: int = config.MAIL_SENDER_QUEUE_SIZE,
+        max_per_destination: int = config.MAIL_SENDER_MAX_PER_DESTINATION,
+        retry_base_delay: float = 1,
+    ):
+        """Deliver the emails sent with wait=False from a queue"""
+        self._delivery_queue = DeliveryQueue(
+            self._deliver,
+            self._handle_failed_request,
+            max_workers,
+            max_queue_size,
+            max_per_destination,
+            retry_base_delay,
+        )
+        atexit.register(self.disable_background_pool)
+
+    def disable_background_pool(self):
+        """Deliver the queued emails, those waiting to be retried are saved to SAVE_UNSENT_DIR"""
+        if self._delivery_queue:
+            self._delivery_queue.shutdown()
+        self._delivery_queue = None
+
+    def wait_background_deliveries(self, timeout: Optional[float] = None) -> bool:
+        if not self._delivery_queue:
+            return True
+        return self._delivery_queue.join(timeout)
+
+    def enable_connection_pool(
+        self,
+        max_size: int,
+        max_messages: int = config.POSTFIX_CONNECTION_MAX_MESSAGES,
+        max_age: int = config.POSTFIX_CONNECTION_MAX_AGE,
+    ):
+        self._connection_pool = SmtpConnectionPool(max_size, max_messages, max_age)
 
-    def send(self, send_request: SendRequest, retries: int = 2):
-        """replace smtp.sendmail"""
+    def disable_connection_pool(self):
+        if self._connection_pool:
+            self._connection_pool.close_all()
+        self._connection_pool = None
+
+    def send(self, send_request: SendRequest, retries: int = 2, wait: bool = True):
+        """replace smtp.sendmail
+        wait: if False and the background pool is enabled, return as soon as the email is queued
+        """
         if self._store_emails:
             self._emails_sent.append(send_request)
         if config.NOT_SEND_EMAIL:
@@ -107,75 +492,139 @@ class MailSender:
                 send_request.msg[headers.TO],
             )
             return
-        if not self._pool:
+        if wait or not self._delivery_queue:
             self._send_to_smtp(send_request, retries)
         else:
-            self._pool.submit(self._send_to_smtp, (send_request, retries))
+            self._delivery_queue.submit(send_request, retries)
 
     def _send_to_smtp(self, send_request: SendRequest, retries: int):
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                self._deliver(send_request)
+                return
+            except (
+                SMTPException,
+                ConnectionRefusedError,
+                TimeoutError,
+            ) as e:
+                if attempt > retries:
+                    self._handle_failed_request(send_request, e)
+                    return
+
+                time.sleep(backoff_delay(attempt, 0.3, 2))
+
+    def _deliver(self, send_request: SendRequest):
         try:
-            start = time.time()
-            if config.POSTFIX_SUBMISSION_TLS:
-                smtp_port = 587
-            else:
-                smtp_port = config.POSTFIX_PORT
+            self._sendmail(send_request)
+        except SMTPServerDisconnected:
+            if not self._connection_pool:
+                raise
+            # Postfix may have closed an idle pooled connection
+            LOG.w("Pooled smtp connection disconnected, retry on a new connection")
+            self._sendmail(send_request, new_connection=True)
 
-            with SMTP(config.POSTFIX_SERVER, smtp_port) as smtp:
-                if config.POSTFIX_SUBMISSION_TLS:
-                    smtp.starttls()
+    def _handle_failed_request(
+        self, send_request: SendRequest, error: Optional[Exception]
+    ):
+        if error and send_request.ignore_smtp_errors:
+            LOG.e(f"Ignore smtp error {error}")
+            return
+        server, port, _ = _smtp_target()
+        LOG.e(f"Could not send message to smtp server {server}:{port}, error: {error}")
+        self._save_request_to_unsent_dir(send_request)
 
-                elapsed = time.time() - start
-                LOG.d("getting a smtp connection takes seconds %s", elapsed)
-                newrelic.agent.record_custom_metric(
-                    "Custom/smtp_connection_time", elapsed
-                )
+    @contextmanager
+    def _smtp_connection(self, new_connection: bool = False) -> Iterator[SMTP]:
+        if self._connection_pool:
+            with self._connection_pool.connection(fresh=new_connection) as smtp:
+                yield smtp
+        else:
+            with _connect_to_smtp(_smtp_target()) as smtp:
+                yield smtp
 
-                # smtp.send_message has UnicodeEncodeError
-                # encode message raw directly instead
-                LOG.d(
-                    "Sendmail mail_from:%s, rcpt_to:%s, header_from:%s, header_to:%s, header_cc:%s",
-                    send_request.envelope_from,
-                    send_request.envelope_to,
-                    send_request.msg[headers.FROM],
-                    send_request.msg[headers.TO],
-                    send_request.msg[headers.CC],
-                )
-                smtp.sendmail(
-                    send_request.envelope_from,
-                    send_request.envelope_to,
-                    message_to_bytes(send_request.msg),
-                    send_request.mail_options,
-                    send_request.rcpt_options,
-                )
+    def _sendmail(self, send_request: SendRequest, new_connection: bool = False):
+        start = time.time()
+        with self._smtp_connection(new_connection) as smtp:
+            elapsed = time.time() - start
+            LOG.d("getting a smtp connection takes seconds %s", elapsed)
+            newrelic.agent.record_custom_metric("Custom/smtp_connection_time", elapsed)
 
-                newrelic.agent.record_custom_metric(
-                    "Custom/smtp_sending_time", time.time() - start
-                )
-        except (
-            SMTPException,
-            ConnectionRefusedError,
-            TimeoutError,
-        ) as e:
-            if retries > 0:
-                time.sleep(0.3 * send_request.retries)
-                self._send_to_smtp(send_request, retries - 1)
-            else:
-                if send_request.ignore_smtp_errors:
-                    LOG.e(f"Ignore smtp error {e}")
-                    return
-                LOG.e(
-                    f"Could not send message to smtp server {config.POSTFIX_SERVER}:{smtp_port}"
-                )
-                self._save_request_to_unsent_dir(send_request)
+            # smtp.send_message has UnicodeEncodeError
+            # encode message raw directly instead
+            LOG.d(
+                "Sendmail mail_from:%s, rcpt_to:%s, header_from:%s, header_to:%s, header_cc:%s",
+                send_request.envelope_from,
+                send_request.envelope_to,
+                send_request.msg[headers.FROM],
+                send_request.msg[headers.TO],
+                send_request.msg[headers.CC],
+            )
+            smtp.sendmail(
+                send_request.envelope_from,
+                send_request.envelope_to,
+                message_to_bytes(send_request.msg),
+                send_request.mail_options,
+                send_request.rcpt_options,
+            )
+
+            newrelic.agent.record_custom_metric(
+                "Custom/smtp_sending_time", time.time() - start
+            )
 
     def _save_request_to_unsent_dir(self, send_request: SendRequest):
+        if not config.SAVE_UNSENT_DIR:
+            LOG.e(
+                "SAVE_UNSENT_DIR is not set, email to %s lost", send_request.envelope_to
+            )
+            return
         file_name = f"DeliveryFail-{int(time.time())}-{uuid.uuid4()}.eml"
         file_path = os.path.join(config.SAVE_UNSENT_DIR, file_name)
         file_contents = send_request.to_bytes()
-        with open(file_path, "wb") as fd:
+        # write to a temp file first so a replay never loads a partially written file
+        tmp_file_path = os.path.join(config.SAVE_UNSENT_DIR, f".{file_name}.tmp")
+        with open(tmp_file_path, "wb") as fd:
             fd.write(file_contents)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(tmp_file_path, file_path)
         LOG.i(f"Saved unsent message {file_path}")
 
+    def replay_unsent_emails(self) -> Tuple[int, int]:
+        """Send again the emails saved to SAVE_UNSENT_DIR, return the nb of emails sent and failed.
+        A file is removed once its email is sent"""
+        nb_sent, nb_failed = 0, 0
+        if not config.SAVE_UNSENT_DIR:
+            return nb_sent, nb_failed
+
+        for file_name in sorted(os.listdir(config.SAVE_UNSENT_DIR)):
+            if not file_name.startswith("DeliveryFail-"):
+                continue
+            file_path = os.path.join(config.SAVE_UNSENT_DIR, file_name)
+            try:
+                send_request = SendRequest.load_from_file(file_path)
+            except (ValueError, KeyError):
+                LOG.e("Cannot load unsent message %s", file_path)
+                nb_failed += 1
+                continue
+
+            try:
+                self._deliver(send_request)
+            except (SMTPException, ConnectionRefusedError, TimeoutError) as e:
+                LOG.w("Cannot replay unsent message %s: %s", file_path, e)
+                nb_failed += 1
+            else:
+                os.remove(file_path)
+                LOG.i(
+                    "Replayed unsent message %s to %s",
+                    file_path,
+                    send_request.envelope_to,
+                )
+                nb_sent += 1
+
+        return nb_sent, nb_failed
+
 
 mail_sender = MailSender()
 
@@ -189,6 +638,7 @@ def sl_sendmail(
     is_forward: bool = False,
     retries=2,
     ignore_smtp_error=False,
+    wait: bool = True,
 ):
     send_request = SendRequest(
         envelope_from,
@@ -199,4 +649,4 @@ def sl_sendmail(
         is_forward,
         ignore_smtp_error,
     )
-    mail_sender.send(send_request, retries)
+    mail_sender.send(send_request, retries, wait)
@@ -1,21 +1,208 @@
-from email import policy
+import re
+import threading
+from contextlib import contextmanager
+from email import policy, message_from_bytes
 from email.message import Message
+from email.parser import BytesParser
+from typing import Optional, Iterator, Tuple
 
 from app.log import LOG
 
+# same line endings as email.feedparser
+_NEWLINE = re.compile(rb"\r\n|\r|\n")
 
-def message_to_bytes(msg: Message) -> bytes:
-    """replace Message.as_bytes() method by trying different policies"""
+
+class LazyMessage(Message):
+    """
+    Message whose body is parsed on demand.
+    The header block is parsed upfront, the body is kept as raw bytes and is only parsed into MIME parts
+    on the first access to the payload (get_payload(), set_payload(), walk(), is_multipart(), attach()...).
+    As long as the body isn't parsed, as_bytes() writes the headers followed by the raw body,
+    with the line endings of the policy.
+    """
+
+    @classmethod
+    def from_bytes(cls, raw: bytes) -> "LazyMessage":
+        headers_only = BytesParser().parsebytes(raw, headersonly=True)
+        msg = cls()
+        msg._headers = headers_only._headers
+        msg._unixfrom = headers_only._unixfrom
+        msg.defects = headers_only.defects
+        # the parser decodes bytes as ascii with surrogateescape
+        msg.__dict__["_raw_body"] = (headers_only._payload or "").encode(
+            "ascii", "surrogateescape"
+        )
+        return msg
+
+    @property
+    def _raw_body(self) -> Optional[bytes]:
+        """the raw body, None once it is parsed or replaced"""
+        return self.__dict__.get("_raw_body")
+
+    def is_body_parsed(self) -> bool:
+        return self._raw_body is None
+
+    @property
+    def _payload(self):
+        if self._raw_body is not None:
+            self._parse_body()
+        return self.__dict__.get("_payload")
+
+    @_payload.setter
+    def _payload(self, payload):
+        self.__dict__["_raw_body"] = None
+        self.__dict__["_payload"] = payload
+
+    def _parse_body(self):
+        LOG.d("parse message body")
+        # the body is parsed with the current MIME headers
+        parsed = message_from_bytes(self._headers_to_bytes() + self._raw_body)
+        self.__dict__["_raw_body"] = None
+        self.__dict__["_payload"] = parsed._payload
+        self.preamble = parsed.preamble
+        self.epilogue = parsed.epilogue
+        self.defects.extend(parsed.defects)
+
+    def _headers_to_bytes(self, generator_policy=None) -> bytes:
+        generator_policy = generator_policy or self.policy
+        return (
+            b"".join(
+                generator_policy.fold_binary(name, value)
+                for name, value in self.raw_items()
+            )
+            + generator_policy.linesep.encode()
+        )
+
+    def as_bytes(self, unixfrom=False, policy=None):
+        if self._raw_body is None:
+            return super().as_bytes(unixfrom=unixfrom, policy=policy)
+
+        # like the generator, the lines of the body end with the linesep of the policy
+        linesep = (policy or self.policy).linesep.encode()
+        unixfrom_line = b""
+        if unixfrom and self._unixfrom:
+            unixfrom_line = self._unixfrom.encode("ascii", "surrogateescape") + linesep
+        return (
+            unixfrom_line
+            + self._headers_to_bytes(policy)
+            + _NEWLINE.sub(linesep, self._raw_body)
+        )
+
+
+def parse_message(raw: bytes, lazy: bool = True) -> Message:
+    """parse an email, if lazy, the body is only parsed when it's needed"""
+    if lazy:
+        try:
+            return LazyMessage.from_bytes(raw)
+        except Exception:
+            LOG.w("cannot parse headers only, parse the whole message", exc_info=True)
+
+    return message_from_bytes(raw)
+
+
+class SerializationStats:
+    def __init__(self):
+        self.nb_serialization = 0
+        self.nb_cache_hit = 0
+
+
+_local = threading.local()
+
+
+@contextmanager
+def serialization_stats() -> Iterator[SerializationStats]:
+    """count the messages serialized by message_to_bytes() in the current thread"""
+    previous = getattr(_local, "stats", None)
+    stats = _local.stats = SerializationStats()
+    try:
+        yield stats
+    finally:
+        _local.stats = previous
+
+
+def _snapshot(msg: Message) -> Tuple:
+    """
+    State of a message that determines its serialization: its headers and its payloads, recursively.
+    Payloads are compared by identity first so comparing two snapshots of an unchanged message is cheap.
+    """
+    # not msg._payload: the body of a LazyMessage stays unparsed
+    payload = msg.__dict__.get("_payload")
+    if isinstance(payload, list):
+        payload = tuple(
+            _snapshot(part) if isinstance(part, Message) else part for part in payload
+        )
+    return (
+        tuple(msg._headers),
+        payload,
+        msg.__dict__.get("_raw_body"),
+        msg.preamble,
+        msg.epilogue,
+    )
+
+
+def _serialize(msg: Message) -> Tuple[Optional[policy.Policy], bytes]:
+    """return the policy that was used and the message bytes"""
     for generator_policy in [None, policy.SMTP, policy.SMTPUTF8]:
         try:
-            return msg.as_bytes(policy=generator_policy)
+            return generator_policy, msg.as_bytes(policy=generator_policy)
         except:
             LOG.w("as_bytes() fails with %s policy", policy, exc_info=True)
 
     msg_string = msg.as_string()
     try:
-        return msg_string.encode()
+        return None, msg_string.encode()
     except:
         LOG.w("as_string().encode() fails", exc_info=True)
 
-    return msg_string.encode(errors="replace")
+    return None, msg_string.encode(errors="replace")
+
+
+def message_to_bytes(msg: Message) -> bytes:
+    """replace Message.as_bytes() method by trying different policies.
+    The bytes are cached on the message until its headers or its payloads change"""
+    stats: Optional[SerializationStats] = getattr(_local, "stats", None)
+
+    cached = msg.__dict__.get("_bytes_cache")
+    if cached and cached[0] == _snapshot(msg):
+        if stats:
+            stats.nb_cache_hit += 1
+        return cached[2]
+
+    generator_policy, msg_bytes = _serialize(msg)
+    if stats:
+        stats.nb_serialization += 1
+    # the snapshot is taken after the serialization as it can set a missing multipart boundary
+    msg.__dict__["_bytes_cache"] = (_snapshot(msg), generator_policy, msg_bytes)
+    return msg_bytes
+
+
+def append_header(msg: Message, header: str, value: str):
+    """
+    Same as msg[header] = value but if the message bytes are cached,
+    the header is inserted in the cached bytes instead of serializing the message again
+    """
+    cached = msg.__dict__.get("_bytes_cache")
+    is_cache_valid = cached is not None and cached[0] == _snapshot(msg)
+    msg[header] = value
+    if not is_cache_valid:
+        return
+
+    _, used_policy, msg_bytes = cached
+    generator_policy = used_policy or msg.policy
+    linesep = generator_policy.linesep.encode()
+    # the header is the last one, just before the blank line that separates the headers from the body
+    if msg_bytes.startswith(linesep):
+        headers_end = 0
+    else:
+        headers_end = msg_bytes.find(linesep * 2)
+        if headers_end == -1:
+            return
+        headers_end += len(linesep)
+
+    name, stored_value = msg._headers[-1]
+    header_bytes = generator_policy.fold_binary(name, stored_value)
+    msg.__dict__["_bytes_cache"] = (
+        _snapshot(msg),
+        used_policy,
+        msg_bytes[:headers_end] + header_bytes + msg_bytes[headers_end:],
+    )
@@ -4,7 +4,6 @@ import base64
 import enum
 import hashlib
 import hmac
-import os
 import random
 import uuid
 from email.utils import formataddr
@@ -17,10 +16,9 @@ from email_validator import validate_email
 from flanker.addresslib import address
 from flask import url_for
 from flask_login import UserMixin
-from jinja2 import FileSystemLoader, Environment
 from sqlalchemy import orm
 from sqlalchemy import text, desc, CheckConstraint, Index, Column
-from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.dialects.postgresql import TSVECTOR, insert
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import deferred
 from sqlalchemy.sql import and_
@@ -41,18 +39,20 @@ from app.config import (
     ALIAS_RANDOM_SUFFIX_LENGTH,
     MAX_NB_SUBDOMAIN,
     MAX_NB_DIRECTORY,
-    ROOT_DIR,
     NOREPLY,
     PARTNER_API_TOKEN_SECRET,
 )
 from app.db import Session
+from app.email_templates import get_environment, TEMPLATES_DIR
 from app.errors import (
     AliasInTrashError,
     DirectoryInTrashError,
     SubdomainInTrashError,
     CannotCreateContactForReverseAlias,
 )
+from app.identifier_generator import generate_one_free, get_pool
 from app.log import LOG
+from app.lookup_cache import get_lookup_cache
 from app.oauth_models import Scope
 from app.pw_models import PasswordOracle
 from app.utils import (
@@ -80,6 +80,9 @@ class ModelMixin(object):
 
     _repr_hide = ["created_at", "updated_at"]
 
+    # unique keys whose get_by() lookups are served by the lookup cache when it's enabled
+    _lookup_cache_keys = frozenset()
+
     @classmethod
     def query(cls):
         return Session.query(cls)
@@ -95,6 +98,12 @@ class ModelMixin(object):
 
     @classmethod
     def get_by(cls, **kw):
+        cache = get_lookup_cache()
+        if cache is not None and tuple(sorted(kw)) in cls._lookup_cache_keys:
+            return cache.get(
+                cls, kw, lambda: Session.query(cls).filter_by(**kw).first()
+            )
+
         return Session.query(cls).filter_by(**kw).first()
 
     @classmethod
@@ -582,78 +591,38 @@ class User(Base, ModelMixin, UserMixin, PasswordOracle):
         return user
 
     # region Billing
+    def entitlement(self):
+        """the subscriptions are loaded in one query, memoised for the request and cached by the process"""
+        from app.entitlement import get_entitlement
+
+        return get_entitlement(self)
+
     def lifetime_or_active_subscription(self) -> bool:
         """True if user has lifetime licence or active subscription"""
         if self.lifetime:
             return True
 
-        sub: Subscription = self.get_subscription()
-        if sub:
-            return True
-
-        apple_sub: AppleSubscription = AppleSubscription.get_by(user_id=self.id)
-        if apple_sub and apple_sub.is_valid():
-            return True
-
-        manual_sub: ManualSubscription = ManualSubscription.get_by(user_id=self.id)
-        if manual_sub and manual_sub.is_active():
-            return True
-
-        coinbase_subscription: CoinbaseSubscription = CoinbaseSubscription.get_by(
-            user_id=self.id
-        )
-        if coinbase_subscription and coinbase_subscription.is_active():
-            return True
-
-        partner_sub: PartnerSubscription = PartnerSubscription.find_by_user_id(self.id)
-        if partner_sub and partner_sub.is_active():
-            return True
-
-        return False
+        return self.entitlement().lifetime_or_active_subscription
 
     def is_paid(self) -> bool:
         """same as _lifetime_or_active_subscription but not include free manual subscription"""
-        sub: Subscription = self.get_subscription()
-        if sub:
-            return True
-
-        apple_sub: AppleSubscription = AppleSubscription.get_by(user_id=self.id)
-        if apple_sub and apple_sub.is_valid():
-            return True
-
-        manual_sub: ManualSubscription = ManualSubscription.get_by(user_id=self.id)
-        if manual_sub and not manual_sub.is_giveaway and manual_sub.is_active():
-            return True
-
-        coinbase_subscription: CoinbaseSubscription = CoinbaseSubscription.get_by(
-            user_id=self.id
-        )
-        if coinbase_subscription and coinbase_subscription.is_active():
-            return True
-
-        return False
+        return self.entitlement().is_paid
 
     def in_trial(self):
         """return True if user does not have lifetime licence or an active subscription AND is in trial period"""
-        if self.lifetime_or_active_subscription():
+        if self.lifetime:
             return False
 
-        if self.trial_end and arrow.now() < self.trial_end:
-            return True
-
-        return False
+        return self.entitlement().in_trial
 
     def should_show_upgrade_button(self):
         if self.lifetime:
             return False
 
-        if self.lifetime_or_active_subscription():
+        entitlement = self.entitlement()
+        if entitlement.lifetime_or_active_subscription:
             # user who has canceled can also re-subscribe
-            sub: Subscription = self.get_subscription()
-            if sub and sub.cancelled:
-                return True
-
-            return False
+            return entitlement.subscriptions.paddle_cancelled
 
         return True
 
@@ -664,13 +633,10 @@ class User(Base, ModelMixin, UserMixin, PasswordOracle):
         - in trial period or
         - active subscription
         """
-        if self.lifetime_or_active_subscription():
-            return True
-
-        if self.trial_end and arrow.now() < self.trial_end:
+        if self.lifetime:
             return True
 
-        return False
+        return self.entitlement().is_premium
 
     @property
     def upgrade_channel(self) -> str:
@@ -895,7 +861,14 @@ class User(Base, ModelMixin, UserMixin, PasswordOracle):
         - SimpleLogin public domains, available for all users (ALIAS_DOMAIN)
         - SimpleLogin premium domains, only available for Premium accounts (PREMIUM_ALIAS_DOMAIN)
         """
-        return [sl_domain.domain for sl_domain in self.get_sl_domains()]
+        from app.domain_registry import domain_registry
+
+        is_premium = self.is_premium()
+        return [
+            sl_domain.domain
+            for sl_domain in domain_registry.sl_domains()
+            if is_premium or not sl_domain.premium_only
+        ]
 
     def get_sl_domains(self) -> List["SLDomain"]:
         if self.is_premium():
@@ -1192,28 +1165,24 @@ def generate_email(
     :param scheme: int, value of AliasGeneratorEnum, indicate how the email is generated
     :type in_hex: bool, if the generate scheme is uuid, is hex favorable?
     """
-    if scheme == AliasGeneratorEnum.uuid.value:
-        name = uuid.uuid4().hex if in_hex else uuid.uuid4().__str__()
-        random_email = name + "@" + alias_domain
-    else:
-        random_email = random_words() + "@" + alias_domain
-
-    random_email = random_email.lower().strip()
 
-    # check that the client does not exist yet
-    if not Alias.get_by(email=random_email) and not DeletedAlias.get_by(
-        email=random_email
-    ):
-        LOG.d("generate email %s", random_email)
-        return random_email
+    def generate() -> str:
+        if scheme == AliasGeneratorEnum.uuid.value:
+            name = uuid.uuid4().hex if in_hex else uuid.uuid4().__str__()
+        else:
+            name = random_words()
+        return (name + "@" + alias_domain).lower().strip()
 
-    # Rerun the function
-    LOG.w("email %s already exists, generate a new email", random_email)
-    return generate_email(scheme=scheme, in_hex=in_hex)
+    # the candidates are checked by batches, the free ones are kept for the next calls
+    random_email = get_pool(("alias", scheme, in_hex, alias_domain), generate).get()
+    LOG.d("generate email %s", random_email)
+    return random_email
 
 
 class Alias(Base, ModelMixin):
     __tablename__ = "alias"
+    _lookup_cache_keys = frozenset([("email",)])
+
     user_id = sa.Column(
         sa.ForeignKey(User.id, ondelete="cascade"), nullable=False, index=True
     )
@@ -1309,6 +1278,8 @@ class Alias(Base, ModelMixin):
             postgresql_ops={"note": "gin_trgm_ops"},
             postgresql_using="gin",
         ),
+        # the aliases to check on HIBP, cf hibp_scanner.due_aliases()
+        Index("ix_alias_hibp_last_check", "hibp_last_check", "id"),
     )
 
     user = orm.relationship(User, foreign_keys=[user_id])
@@ -1355,11 +1326,13 @@ class Alias(Base, ModelMixin):
             alias_address, check_deliverability=False, allow_smtputf8=False
         ).domain
 
+        from app.domain_registry import domain_registry
+
         # handle the case a SLDomain is also a CustomDomain
-        if SLDomain.get_by(domain=alias_domain) is None:
-            custom_domain = CustomDomain.get_by(domain=alias_domain)
+        if not domain_registry.is_sl_domain(alias_domain):
+            custom_domain = domain_registry.get_custom_domain(alias_domain)
             if custom_domain:
-                return custom_domain
+                return CustomDomain.get(custom_domain.id)
 
     @classmethod
     def create(cls, **kw):
@@ -1402,13 +1375,10 @@ class Alias(Base, ModelMixin):
         if not prefix:
             raise Exception("alias prefix cannot be empty")
 
-        # find the right suffix - avoid infinite loop by running this at max 1000 times
-        for _ in range(1000):
-            suffix = user.get_random_alias_suffix()
-            email = f"{prefix}.{suffix}@{FIRST_ALIAS_DOMAIN}"
-
-            if not cls.get_by(email=email) and not DeletedAlias.get_by(email=email):
-                break
+        # find the right suffix, the candidates are checked by batches
+        email = generate_one_free(
+            lambda: f"{prefix}.{user.get_random_alias_suffix()}@{FIRST_ALIAS_DOMAIN}"
+        )
 
         return Alias.create(
             user_id=user.id,
@@ -1582,9 +1552,17 @@ class Contact(Base, ModelMixin):
     """
 
     __tablename__ = "contact"
+    _lookup_cache_keys = frozenset([("reply_email",)])
 
     __table_args__ = (
         sa.UniqueConstraint("alias_id", "website_email", name="uq_contact"),
+        # the contacts with an invalid email share the NOREPLY address
+        Index(
+            "uq_contact_reply_email",
+            "reply_email",
+            unique=True,
+            postgresql_where=text("NOT invalid_email"),
+        ),
     )
 
     user_id = sa.Column(
@@ -1650,15 +1628,7 @@ class Contact(Base, ModelMixin):
 
         new_contact = cls(**kw)
 
-        website_email = kw["website_email"]
-        # make sure email is lowercase and doesn't have any whitespace
-        website_email = sanitize_email(website_email)
-
-        # make sure contact.website_email isn't a reverse alias
-        if website_email != NOREPLY:
-            orig_contact = Contact.get_by(reply_email=website_email)
-            if orig_contact:
-                raise CannotCreateContactForReverseAlias(str(orig_contact))
+        cls._check_not_reverse_alias(kw["website_email"])
 
         Session.add(new_contact)
 
@@ -1670,6 +1640,72 @@ class Contact(Base, ModelMixin):
 
         return new_contact
 
+    @classmethod
+    def upsert(
+        cls,
+        alias_id: int,
+        website_email: str,
+        reply_email: str,
+        update_name: bool = True,
+        **kw,
+    ) -> Tuple["Contact", bool]:
+        """
+        Create the contact of website_email for the alias, or update the existing one, in one
+        INSERT ... ON CONFLICT statement: no IntegrityError when it's created concurrently.
+        On an existing contact, the name is updated if update_name and mail_from is set if empty.
+        Raise IntegrityError if reply_email is already used.
+        Return the contact and whether it's been created.
+        """
+        cls._check_not_reverse_alias(website_email)
+
+        table = cls.__table__
+        stmt = insert(table).values(
+            alias_id=alias_id,
+            website_email=website_email,
+            reply_email=reply_email,
+            **kw,
+        )
+        stmt = stmt.on_conflict_do_update(
+            constraint="uq_contact",
+            set_={
+                "name": stmt.excluded.name if update_name else table.c.name,
+                "mail_from": sa.func.coalesce(
+                    sa.func.nullif(table.c.mail_from, ""), stmt.excluded.mail_from
+                ),
+                "updated_at": arrow.utcnow(),
+            },
+        ).returning(table.c.id, text("xmax = 0"))
+        contact_id, created = Session.execute(stmt).fetchone()
+
+        lookup_cache = get_lookup_cache()
+        if lookup_cache is not None:
+            lookup_cache.invalidate(cls)
+
+        # the existing contact can be in the session with the values before the update
+        contact = (
+            Session.query(cls).filter(cls.id == contact_id).populate_existing().one()
+        )
+        if created:
+            from app.existence_index import existence_index, REVERSE_ALIAS
+
+            existence_index.add(REVERSE_ALIAS, reply_email)
+
+        return contact, created
+
+    @classmethod
+    def _check_not_reverse_alias(cls, website_email: str):
+        # make sure email is lowercase and doesn't have any whitespace
+        website_email = sanitize_email(website_email)
+
+        # make sure contact.website_email isn't a reverse alias
+        if website_email != NOREPLY:
+            from app.existence_index import existence_index
+
+            if existence_index.may_be_reverse_alias(website_email):
+                orig_contact = Contact.get_by(reply_email=website_email)
+                if orig_contact:
+                    raise CannotCreateContactForReverseAlias(str(orig_contact))
+
     def website_send_to(self):
         """return the email address with name.
         to use when user wants to send an email from the alias
@@ -1859,6 +1895,31 @@ class EmailLog(Base, ModelMixin):
         return f"<EmailLog {self.id}>"
 
 
+class AliasActivity(Base, ModelMixin):
+    """
+    Number of forwards, blocks and replies of an alias and its latest email log.
+    Maintained by triggers on the email_log table, see app/alias_activity.py.
+    An alias without any email log can have no row.
+    """
+
+    __tablename__ = "alias_activity"
+
+    alias_id = sa.Column(
+        sa.ForeignKey(Alias.id, ondelete="cascade"), nullable=False, unique=True
+    )
+
+    nb_forward = sa.Column(sa.Integer, nullable=False, default=0, server_default="0")
+    nb_blocked = sa.Column(sa.Integer, nullable=False, default=0, server_default="0")
+    nb_reply = sa.Column(sa.Integer, nullable=False, default=0, server_default="0")
+
+    # not a foreign key: the trigger looks for the next latest email log when this one is deleted
+    latest_email_log_id = sa.Column(sa.Integer, nullable=True)
+    latest_activity_at = sa.Column(ArrowType, nullable=True)
+
+    def __repr__(self):
+        return f"<AliasActivity {self.alias_id} {self.nb_forward} {self.nb_blocked} {self.nb_reply}>"
+
+
 class Subscription(Base, ModelMixin):
     """Paddle subscription"""
 
@@ -2059,6 +2120,7 @@ class ApiKey(Base, ModelMixin):
 
 class CustomDomain(Base, ModelMixin):
     __tablename__ = "custom_domain"
+    _lookup_cache_keys = frozenset([("domain",)])
 
     user_id = sa.Column(sa.ForeignKey(User.id, ondelete="cascade"), nullable=False)
     domain = sa.Column(sa.String(128), unique=True, nullable=False)
@@ -2656,10 +2718,7 @@ class Notification(Base, ModelMixin):
 
     @staticmethod
     def render(template_name, **kwargs) -> str:
-        templates_dir = os.path.join(ROOT_DIR, "templates")
-        env = Environment(loader=FileSystemLoader(templates_dir))
-
-        template = env.get_template(template_name)
+        template = get_environment(TEMPLATES_DIR).get_template(template_name)
 
         return template.render(
             URL=URL,
@@ -2673,6 +2732,7 @@ class SLDomain(Base, ModelMixin):
     """SimpleLogin domains"""
 
     __tablename__ = "public_domain"
+    _lookup_cache_keys = frozenset([("domain",)])
 
     domain = sa.Column(sa.String(128), unique=True, nullable=False)
 
@@ -2811,6 +2871,21 @@ class TransactionalEmail(Base, ModelMixin):
     email = sa.Column(sa.String(256), nullable=False, unique=False)
 
 
+class RetentionCheckpoint(Base, ModelMixin):
+    """Progress of a retention policy, cf app/retention.py"""
+
+    __tablename__ = "retention_checkpoint"
+
+    # the retention policy name
+    name = sa.Column(sa.String(128), unique=True, nullable=False)
+
+    # the rows whose id is below next_id have been processed
+    next_id = sa.Column(sa.BigInteger, nullable=False)
+
+    def __repr__(self):
+        return f"<RetentionCheckpoint {self.name} {self.next_id}>"
+
+
 class Payout(Base, ModelMixin):
     """Referral payouts"""
 
@@ -0,0 +1,96 @@
+"""
+Keyset (aka cursor) pagination: a page is made of the rows that come after the last row of the previous page
+in the sort order, instead of skipping page_id * PAGE_LIMIT rows with OFFSET, so the cost of a page
+doesn't depend on its depth. Rows inserted during a scan don't shift the next pages.
+
+The cursor sent to the client is opaque: the sort values of the last row, encoded in base64.
+The sort keys must identify a row, i.e. end with the id.
+"""
+import base64
+import json
+from typing import List, Tuple, Optional, Any
+
+import arrow
+from sqlalchemy import and_, or_
+from sqlalchemy.sql import ColumnElement
+
+from app.errors import SLException
+
+# expression and whether the order is descending
+SortKey = Tuple[ColumnElement, bool]
+
+
+class InvalidCursor(SLException):
+    """raised when a cursor can't be decoded or doesn't match the sort"""
+
+    def error_for_user(self) -> str:
+        return "Invalid cursor"
+
+
+def order_by_sort_keys(q, sort_keys: List[SortKey]):
+    return q.order_by(*[expr.desc() if desc else expr for expr, desc in sort_keys])
+
+
+def after_cursor(q, sort_keys: List[SortKey], values: List[Any]):
+    """filter the rows that come after the row whose sort values are `values`"""
+    clauses = []
+    for i, (expr, desc) in enumerate(sort_keys):
+        same_prefix = [
+            prefix_expr == value
+            for (prefix_expr, _), value in zip(sort_keys[:i], values[:i])
+        ]
+        after = expr < values[i] if desc else expr > values[i]
+        clauses.append(and_(*same_prefix, after))
+
+    return q.filter(or_(*clauses))
+
+
+def _encode_value(value):
+    if isinstance(value, arrow.Arrow):
+        return {"ts": value.isoformat()}
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, dict):
+        return arrow.get(value["ts"])
+    return value
+
+
+def encode_cursor(values: List[Any], sort: Optional[str] = None) -> str:
+    data = {"sort": sort, "values": [_encode_value(value) for value in values]}
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+
+
+def decode_cursor(
+    cursor: str, sort_keys: List[SortKey], sort: Optional[str] = None
+) -> List[Any]:
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        values = [_decode_value(value) for value in data["values"]]
+        cursor_sort = data.get("sort")
+    # binascii.Error, UnicodeDecodeError, json and arrow errors are ValueError
+    except (ValueError, TypeError, KeyError, AttributeError):
+        raise InvalidCursor(cursor)
+
+    if cursor_sort != sort or len(values) != len(sort_keys):
+        raise InvalidCursor(cursor)
+
+    return values
+
+
+def paginate(
+    q,
+    sort_keys: List[SortKey],
+    limit: int,
+    cursor: Optional[str] = None,
+    sort: Optional[str] = None,
+):
+    """
+    Sorted query of the page after cursor. An empty cursor means the first page.
+    Raise InvalidCursor.
+    """
+    q = order_by_sort_keys(q, sort_keys)
+    if cursor:
+        q = after_cursor(q, sort_keys, decode_cursor(cursor, sort_keys, sort))
+    return q.limit(limit)
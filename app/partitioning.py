@@ -0,0 +1,501 @@
+"""
+Optional time partitioning of the log tables: email_log, bounce, transactional_email and sent_alert
+can be range-partitioned by created_at with `python cron.py -j partition_log_tables`, and turned back
+into regular tables with `-j unpartition_log_tables`. This is done outside of the migrations, whose
+schema is the one of the models: the primary key of a partitioned table becomes (id, created_at)
+and the foreign keys to it are dropped, migrations/env.py ignores these differences.
+
+On a partitioned table:
+- a partition covers a day (a month for sent_alert), the partitions of the next days are created in advance
+by the create_partitions cron job. The rows created before the partitioning are in the <table>_legacy partition.
+If the job doesn't run in time, the new rows go into the <table>_default partition instead of being rejected,
+they are moved into their partition when it is created.
+- the retention drops the partitions whose rows are all older than the policy max age, instead of deleting
+their rows. Dropping a table is instant and doesn't leave dead rows to vacuum.
+- the queries bounded by created_at only read the partitions of their time range.
+
+Whether a table is partitioned is read from the database catalog, so the same code runs on both layouts.
+"""
+import re
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+import arrow
+from arrow import Arrow
+from sqlalchemy import text
+
+from app.db import Session
+from app.log import LOG
+
+
+@dataclass(frozen=True)
+class PartitionSpec:
+    table: str
+    # "day" or "month"
+    interval: str
+    # nb of intervals after the current one whose partitions are created in advance
+    nb_future: int
+
+
+PARTITION_SPECS = [
+    PartitionSpec("email_log", "day", 7),
+    PartitionSpec("bounce", "day", 7),
+    PartitionSpec("transactional_email", "day", 7),
+    # the "only once" alerts need all the rows, sent_alert partitions are never dropped
+    PartitionSpec("sent_alert", "month", 2),
+]
+
+
+def get_partition_spec(table: str) -> PartitionSpec:
+    for spec in PARTITION_SPECS:
+        if spec.table == table:
+            return spec
+    raise ValueError(f"{table} can't be partitioned")
+
+
+@dataclass(frozen=True)
+class Partition:
+    name: str
+    # exclusive upper bound of created_at, None for MAXVALUE
+    upper: Optional[datetime]
+
+
+# e.g. FOR VALUES FROM (MINVALUE) TO ('2026-10-17 00:00:00')
+_UPPER_BOUND = re.compile(r"TO \('([^']+)'\)")
+
+
+def is_partitioned(table: str) -> bool:
+    return Session.execute(
+        text(
+            "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:table))"
+        ),
+        {"table": table},
+    ).scalar()
+
+
+def default_partition_name(table: str) -> str:
+    return f"{table}_default"
+
+
+def get_partitions(table: str) -> List[Partition]:
+    """the partitions of table except the default one, ordered by their upper bound"""
+    rows = Session.execute(
+        text(
+            """
+SELECT child.relname, pg_get_expr(child.relpartbound, child.oid)
+FROM pg_inherits
+JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+WHERE pg_inherits.inhparent = to_regclass(:table)
+"""
+        ),
+        {"table": table},
+    ).fetchall()
+
+    partitions = []
+    for name, bound in rows:
+        if bound == "DEFAULT":
+            continue
+        match = _UPPER_BOUND.search(bound)
+        upper = arrow.get(match.group(1)).naive if match else None
+        partitions.append(Partition(name, upper))
+
+    return sorted(partitions, key=lambda p: (p.upper is None, p.upper or datetime.min))
+
+
+def partition_name(spec: PartitionSpec, start: Arrow) -> str:
+    if spec.interval == "month":
+        return f"{spec.table}_p{start.format('YYYYMM')}"
+    return f"{spec.table}_p{start.format('YYYYMMDD')}"
+
+
+def create_future_partitions(spec: PartitionSpec, now: Arrow = None) -> List[str]:
+    """
+    create the partitions up to nb_future intervals after now, return their names.
+    A partition starts where the last one ends so they never overlap.
+    """
+    # created_at is stored in UTC without timezone
+    now = (now or arrow.utcnow()).to("UTC")
+    end = now.floor(spec.interval).shift(**{f"{spec.interval}s": spec.nb_future + 1})
+
+    partitions = get_partitions(spec.table)
+    if partitions and partitions[-1].upper is None:
+        LOG.w("%s has a partition without upper bound", spec.table)
+        return []
+
+    start = arrow.get(partitions[-1].upper) if partitions else now.floor(spec.interval)
+    has_default = has_default_partition(spec.table)
+
+    created = []
+    while start < end:
+        next_start = start.shift(**{f"{spec.interval}s": 1})
+        name = partition_name(spec, start)
+        if has_default and _nb_default_rows(spec.table, start, next_start):
+            _create_partition_from_default(spec.table, name, start, next_start)
+        else:
+            Session.execute(
+                text(
+                    f"CREATE TABLE {name} PARTITION OF {spec.table} FOR VALUES "
+                    f"FROM ('{start.naive.isoformat()}') TO ('{next_start.naive.isoformat()}')"
+                )
+            )
+        Session.commit()
+        LOG.i("partition %s created", name)
+        created.append(name)
+        start = next_start
+
+    return created
+
+
+def has_default_partition(table: str) -> bool:
+    return Session.execute(
+        text(
+            "SELECT EXISTS (SELECT 1 FROM pg_inherits JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE pg_inherits.inhparent = to_regclass(:table) "
+            "AND pg_get_expr(child.relpartbound, child.oid) = 'DEFAULT')"
+        ),
+        {"table": table},
+    ).scalar()
+
+
+def _nb_default_rows(table: str, start: Arrow, end: Arrow) -> int:
+    return Session.execute(
+        text(
+            f"SELECT count(*) FROM {default_partition_name(table)} "
+            "WHERE created_at >= :start AND created_at < :end"
+        ),
+        {"start": start.naive, "end": end.naive},
+    ).scalar()
+
+
+def _create_partition_from_default(table: str, name: str, start: Arrow, end: Arrow):
+    """
+    create the partition name with the rows of the default partition in [start, end).
+    The rows are copied into new tables rather than deleted from the default partition:
+    the triggers of the table don't fire as for new or deleted rows.
+    """
+    default = default_partition_name(table)
+    LOG.e(
+        "%s rows of %s are in %s, the create_partitions job didn't run in time",
+        _nb_default_rows(table, start, end),
+        table,
+        default,
+    )
+    in_range = f"created_at >= '{start.naive.isoformat()}' AND created_at < '{end.naive.isoformat()}'"
+    Session.execute(text(f"SET LOCAL lock_timeout = '{_DROP_LOCK_TIMEOUT}'"))
+    Session.execute(text(f"ALTER TABLE {table} DETACH PARTITION {default}"))
+    Session.execute(text(f"ALTER TABLE {default} RENAME TO {default}_old"))
+    for new_table, where in [(name, in_range), (default, f"NOT ({in_range})")]:
+        Session.execute(
+            text(
+                f"CREATE TABLE {new_table} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"
+            )
+        )
+        Session.execute(
+            text(f"INSERT INTO {new_table} SELECT * FROM {default}_old WHERE {where}")
+        )
+    Session.execute(text(f"DROP TABLE {default}_old"))
+    Session.execute(
+        text(
+            f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES "
+            f"FROM ('{start.naive.isoformat()}') TO ('{end.naive.isoformat()}')"
+        )
+    )
+    Session.execute(text(f"ALTER TABLE {table} ATTACH PARTITION {default} DEFAULT"))
+
+
+def _indexes(table: str) -> List[Tuple[str, str]]:
+    """(name, definition) of the indexes of table except its primary key"""
+    return Session.execute(
+        text(
+            "SELECT indexname, indexdef FROM pg_indexes "
+            "WHERE schemaname = current_schema() AND tablename = :table AND indexname <> :pkey"
+        ),
+        {"table": table, "pkey": f"{table}_pkey"},
+    ).fetchall()
+
+
+def _triggers(table: str) -> List[Tuple[str, str]]:
+    """(name, definition) of the triggers of table"""
+    return Session.execute(
+        text(
+            "SELECT tgname, pg_get_triggerdef(oid) FROM pg_trigger "
+            "WHERE tgrelid = to_regclass(:table) AND NOT tgisinternal"
+        ),
+        {"table": table},
+    ).fetchall()
+
+
+def _foreign_keys(table: str) -> List[Tuple[str, str]]:
+    """(name, definition) of the foreign keys of table"""
+    return Session.execute(
+        text(
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+            "WHERE conrelid = to_regclass(:table) AND contype = 'f' AND conparentid = 0"
+        ),
+        {"table": table},
+    ).fetchall()
+
+
+def partition_table(spec: PartitionSpec, now: Arrow = None):
+    """
+    Partition spec.table by created_at, doesn't commit. The existing table becomes the <table>_legacy
+    partition, attached without copying its rows, its indexes are recreated on the new parent table.
+    A unique constraint of a partitioned table must include created_at: the primary key becomes
+    (id, created_at) and the foreign keys to the table are dropped.
+    """
+    table = spec.table
+    legacy = f"{table}_legacy"
+    now = (now or arrow.utcnow()).to("UTC")
+    boundary = now.floor(spec.interval).shift(**{f"{spec.interval}s": 1})
+    indexes = _indexes(table)
+    triggers = _triggers(table)
+    foreign_keys = _foreign_keys(table)
+
+    referencing_fks = Session.execute(
+        text(
+            "SELECT conrelid::regclass::text, conname FROM pg_constraint "
+            "WHERE confrelid = to_regclass(:table) AND contype = 'f'"
+        ),
+        {"table": table},
+    ).fetchall()
+    for referencing_table, fk_name in referencing_fks:
+        LOG.w("drop foreign key %s of %s", fk_name, referencing_table)
+        Session.execute(
+            text(f"ALTER TABLE {referencing_table} DROP CONSTRAINT {fk_name}")
+        )
+
+    for trigger_name, _ in triggers:
+        Session.execute(text(f"DROP TRIGGER {trigger_name} ON {table}"))
+
+    Session.execute(text(f"ALTER TABLE {table} RENAME TO {legacy}"))
+    Session.execute(
+        text(f"ALTER TABLE {legacy} RENAME CONSTRAINT {table}_pkey TO {legacy}_pkey")
+    )
+    for index_name, _ in indexes:
+        Session.execute(text(f"ALTER INDEX {index_name} RENAME TO {index_name}_legacy"))
+
+    Session.execute(
+        text(
+            f"CREATE TABLE {table} (LIKE {legacy} INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING STORAGE) "
+            "PARTITION BY RANGE (created_at)"
+        )
+    )
+    Session.execute(
+        text(
+            f"ALTER TABLE {table} ADD CONSTRAINT {table}_pkey PRIMARY KEY (id, created_at)"
+        )
+    )
+    Session.execute(text(f"ALTER SEQUENCE {table}_id_seq OWNED BY {table}.id"))
+    # the definitions refer to the table by its name, i.e. now the parent table
+    for _, index_def in indexes:
+        Session.execute(text(index_def))
+    for fk_name, fk_def in foreign_keys:
+        Session.execute(text(f"ALTER TABLE {table} ADD CONSTRAINT {fk_name} {fk_def}"))
+
+    # scans the legacy table once to check the bound, doesn't copy it
+    Session.execute(
+        text(
+            f"ALTER TABLE {table} ATTACH PARTITION {legacy} "
+            f"FOR VALUES FROM (MINVALUE) TO ('{boundary.naive.isoformat()}')"
+        )
+    )
+    for _, trigger_def in triggers:
+        Session.execute(text(trigger_def))
+
+    # not create_future_partitions(), which commits after each partition
+    end = now.floor(spec.interval).shift(**{f"{spec.interval}s": spec.nb_future + 1})
+    start = boundary
+    while start < end:
+        next_start = start.shift(**{f"{spec.interval}s": 1})
+        Session.execute(
+            text(
+                f"CREATE TABLE {partition_name(spec, start)} PARTITION OF {table} FOR VALUES "
+                f"FROM ('{start.naive.isoformat()}') TO ('{next_start.naive.isoformat()}')"
+            )
+        )
+        start = next_start
+
+    # the rows are never rejected if the create_partitions cron job doesn't run in time
+    Session.execute(
+        text(
+            f"CREATE TABLE {default_partition_name(table)} PARTITION OF {table} DEFAULT"
+        )
+    )
+
+
+def unpartition_table(table: str):
+    """copy the rows of a partitioned table back into a regular table, doesn't commit"""
+    plain = f"{table}_plain"
+    indexes = _indexes(table)
+    triggers = _triggers(table)
+    foreign_keys = _foreign_keys(table)
+
+    Session.execute(
+        text(
+            f"CREATE TABLE {plain} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING STORAGE)"
+        )
+    )
+    Session.execute(text(f"INSERT INTO {plain} SELECT * FROM {table}"))
+    Session.execute(text(f"ALTER SEQUENCE {table}_id_seq OWNED BY NONE"))
+    # drops the partitions, their indexes and triggers too
+    Session.execute(text(f"DROP TABLE {table}"))
+    Session.execute(text(f"ALTER TABLE {plain} RENAME TO {table}"))
+    Session.execute(text(f"ALTER SEQUENCE {table}_id_seq OWNED BY {table}.id"))
+    Session.execute(
+        text(f"ALTER TABLE {table} ADD CONSTRAINT {table}_pkey PRIMARY KEY (id)")
+    )
+    for _, index_def in indexes:
+        Session.execute(text(index_def))
+    for fk_name, fk_def in foreign_keys:
+        Session.execute(text(f"ALTER TABLE {table} ADD CONSTRAINT {fk_name} {fk_def}"))
+    for _, trigger_def in triggers:
+        Session.execute(text(trigger_def))
+
+
+# the ON DELETE CASCADE of message_id_matching.email_log_id, whose foreign key is dropped
+_MESSAGE_ID_MATCHING_CASCADE = [
+    "CREATE INDEX ix_message_id_matching_email_log_id ON message_id_matching (email_log_id)",
+    """
+CREATE FUNCTION message_id_matching_email_log_delete() RETURNS trigger AS $$
+BEGIN
+    DELETE FROM message_id_matching WHERE email_log_id = OLD.id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+""",
+    """
+CREATE TRIGGER message_id_matching_email_log_delete
+AFTER DELETE ON email_log
+FOR EACH ROW EXECUTE PROCEDURE message_id_matching_email_log_delete()
+""",
+]
+
+_MESSAGE_ID_MATCHING_FOREIGN_KEY = [
+    "DROP TRIGGER message_id_matching_email_log_delete ON email_log",
+    "DROP FUNCTION message_id_matching_email_log_delete()",
+    "DROP INDEX ix_message_id_matching_email_log_id",
+    # the matchings of the email logs dropped with their partition are deleted by the retention
+    "DELETE FROM message_id_matching WHERE email_log_id NOT IN (SELECT id FROM email_log)",
+    "ALTER TABLE message_id_matching ADD CONSTRAINT message_id_matching_email_log_id_fkey "
+    "FOREIGN KEY (email_log_id) REFERENCES email_log(id) ON DELETE CASCADE",
+]
+
+
+def partition_log_tables() -> List[str]:
+    """partition the log tables that aren't yet, one transaction per table, return their names"""
+    partitioned = []
+    for spec in PARTITION_SPECS:
+        if is_partitioned(spec.table):
+            continue
+
+        partition_table(spec)
+        if spec.table == "email_log":
+            for statement in _MESSAGE_ID_MATCHING_CASCADE:
+                Session.execute(text(statement))
+        Session.commit()
+        LOG.i("%s partitioned", spec.table)
+        partitioned.append(spec.table)
+
+    return partitioned
+
+
+def unpartition_log_tables() -> List[str]:
+    """turn the partitioned log tables back into regular tables, one transaction per table"""
+    unpartitioned = []
+    for spec in PARTITION_SPECS:
+        if not is_partitioned(spec.table):
+            continue
+
+        unpartition_table(spec.table)
+        if spec.table == "email_log":
+            for statement in _MESSAGE_ID_MATCHING_FOREIGN_KEY:
+                Session.execute(text(statement))
+        Session.commit()
+        LOG.i("%s unpartitioned", spec.table)
+        unpartitioned.append(spec.table)
+
+    return unpartitioned
+
+
+def create_partitions(now: Arrow = None) -> List[str]:
+    """create the future partitions of the partitioned tables, and their default partition if it's missing"""
+    created = []
+    for spec in PARTITION_SPECS:
+        if is_partitioned(spec.table):
+            if not has_default_partition(spec.table):
+                default = default_partition_name(spec.table)
+                Session.execute(
+                    text(f"CREATE TABLE {default} PARTITION OF {spec.table} DEFAULT")
+                )
+                Session.commit()
+                created.append(default)
+            created.extend(create_future_partitions(spec, now))
+    Session.commit()
+    return created
+
+
+def estimated_nb_rows(partition: str) -> int:
+    # exact enough for a report, a count(*) would read the whole partition
+    # reltuples is negative or 0 for a table never analyzed
+    reltuples = Session.execute(
+        text("SELECT reltuples FROM pg_class WHERE oid = to_regclass(:name)"),
+        {"name": partition},
+    ).scalar()
+    return max(int(reltuples or 0), 0)
+
+
+def _before_email_log_partition_drop(partition: str):
+    from app.alias_activity import remove_email_log_partition_activity
+
+    remove_email_log_partition_activity(partition)
+    # message_id_matching.email_log_id can't reference a partitioned table, its cascade is done by a trigger
+    # on email_log that doesn't fire for a dropped partition
+    Session.execute(
+        text(
+            f"DELETE FROM message_id_matching USING {partition} "
+            f"WHERE message_id_matching.email_log_id = {partition}.id"
+        )
+    )
+
+
+# table -> what to do before one of its partitions is dropped, in the same transaction
+_BEFORE_DROP: Dict[str, Callable[[str], None]] = {
+    "email_log": _before_email_log_partition_drop
+}
+
+# the drop locks the parent table: rather give up until the next run than queue the inserts behind the lock
+_DROP_LOCK_TIMEOUT = "5s"
+
+
+def drop_partitions_before(
+    table: str,
+    cutoff: datetime,
+    before_drop: Optional[Callable[[str], None]] = None,
+) -> List[Tuple[Partition, int]]:
+    """
+    drop the partitions whose rows are all older than cutoff, oldest first, one transaction per partition.
+    Return the dropped partitions with their estimated nb of rows.
+    """
+    before_drop = before_drop or _BEFORE_DROP.get(table)
+    dropped = []
+    for partition in get_partitions(table):
+        if partition.upper is None or partition.upper > cutoff:
+            break
+
+        nb_rows = estimated_nb_rows(partition.name)
+        try:
+            if before_drop:
+                before_drop(partition.name)
+            Session.execute(text(f"SET LOCAL lock_timeout = '{_DROP_LOCK_TIMEOUT}'"))
+            Session.execute(text(f"DROP TABLE {partition.name}"))
+            Session.commit()
+        except Exception:
+            LOG.w("cannot drop partition %s", partition.name, exc_info=True)
+            Session.rollback()
+            break
+
+        LOG.i("partition %s dropped", partition.name)
+        dropped.append((partition, nb_rows))
+
+    return dropped
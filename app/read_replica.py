@@ -0,0 +1,117 @@
+"""
+The web layer of the read replicas, cf app/db.py: the GET requests of a view decorated by
+@read_only_view send their queries to a replica. The requests of a user who has just written,
+from the dashboard or with an API key, use the primary during DB_REPLICA_MAX_LAG seconds,
+e.g. the page shown after a form is submitted.
+
+The users who have written are kept in the redis of DB_REPLICA_REDIS_URL, shared by all the
+processes. Without it, each process only knows the writes it has handled: a request served by
+another web process can read a replica that doesn't have the write yet.
+"""
+import threading
+import time
+from functools import wraps
+from typing import Callable, Dict, Optional
+
+from flask import g, request
+from flask_login import current_user
+
+from app import config
+from app.db import has_written, read_only, replicas
+
+
+class RecentWrites:
+    """The users who have written during the last ttl seconds, kept by this process"""
+
+    def __init__(self, ttl: float, clock: Callable[[], float] = time.time):
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        # user id -> time of the last write
+        self._written_at: Dict[int, float] = {}
+        self._last_purge = clock()
+
+    def add(self, user_id: int):
+        now = self._clock()
+        with self._lock:
+            self._written_at[user_id] = now
+            if now - self._last_purge > self.ttl:
+                self._written_at = {
+                    u: t for u, t in self._written_at.items() if now - t < self.ttl
+                }
+                self._last_purge = now
+
+    def __contains__(self, user_id: int) -> bool:
+        written_at = self._written_at.get(user_id)
+        return written_at is not None and self._clock() - written_at < self.ttl
+
+
+class RedisRecentWrites(RecentWrites):
+    """Shared by all processes, the keys expire after ttl"""
+
+    def __init__(self, client, ttl: float, prefix: str = "sl-db-write"):
+        super().__init__(ttl)
+        self._client = client
+        self._prefix = prefix
+
+    def add(self, user_id: int):
+        self._client.set(f"{self._prefix}:{user_id}", 1, px=int(self.ttl * 1000))
+
+    def __contains__(self, user_id: int) -> bool:
+        return bool(self._client.exists(f"{self._prefix}:{user_id}"))
+
+
+def create_recent_writes() -> RecentWrites:
+    if config.DB_REPLICA_REDIS_URL:
+        try:
+            import redis
+        except ImportError:
+            raise Exception(
+                "DB_REPLICA_REDIS_URL requires the redis package: pip install redis"
+            )
+
+        return RedisRecentWrites(
+            redis.Redis.from_url(config.DB_REPLICA_REDIS_URL), config.DB_REPLICA_MAX_LAG
+        )
+    return RecentWrites(config.DB_REPLICA_MAX_LAG)
+
+
+recent_writes = create_recent_writes()
+
+
+def _current_user_id() -> Optional[int]:
+    """the user of the API key or of the browser session"""
+    user = g.get("user")
+    if user is None and current_user.is_authenticated:
+        user = current_user
+    return user.id if user is not None else None
+
+
+def remember_write():
+    """
+    Called at the end of a web request: when it has written, the next requests of the user
+    don't use the replicas until they have replicated the write
+    """
+    if replicas and has_written():
+        user_id = _current_user_id()
+        if user_id is not None:
+            recent_writes.add(user_id)
+
+
+def _has_written_recently() -> bool:
+    user_id = _current_user_id()
+    return user_id is not None and user_id in recent_writes
+
+
+def read_only_view(f):
+    """send the queries of the GET requests of this view to a replica"""
+
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if request.method not in ("GET", "HEAD") or _has_written_recently():
+            return f(*args, **kwargs)
+
+        with read_only():
+            return f(*args, **kwargs)
+
+    return decorated
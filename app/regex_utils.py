@@ -1,18 +1,121 @@
 import re
+import threading
+from typing import Callable, Optional, Sequence, TypeVar
 
 import re2
+from cachetools import LRUCache
 
 from app.log import LOG
 
+# compiled patterns, keyed by (rule id, regex)
+_PATTERN_CACHE_SIZE = 10_000
+# combined matchers, keyed by the (rule id, regex) of all the rules of a domain
+_MATCHER_CACHE_SIZE = 1_000
+# below this number of rules, the rules are tried one by one
+COMBINED_MATCHER_MIN_RULES = 4
+# a numbered backreference: the groups are numbered differently in the combined regex
+_BACKREFERENCE = re.compile(r"\\[1-9]")
 
-def regex_match(rule_regex: str, local):
-    regex = re2.compile(rule_regex)
+_lock = threading.Lock()
+_patterns = LRUCache(maxsize=_PATTERN_CACHE_SIZE)
+_matchers = LRUCache(maxsize=_MATCHER_CACHE_SIZE)
+
+Rule = TypeVar("Rule")  # an AutoCreateRule or anything with "id" and "regex"
+
+
+def _compile(regex: str) -> Callable:
+    """return the fullmatch function of the regex, compiled with re2 or with re if re2 can't handle it"""
+    pattern = re2.compile(regex)
     try:
-        if re2.fullmatch(regex, local):
-            return True
+        re2.fullmatch(pattern, "")
     except TypeError:  # re2 bug "Argument 'pattern' has incorrect type (expected bytes, got PythonRePattern)"
-        LOG.w("use re instead of re2 for %s %s", rule_regex, local)
-        regex = re.compile(rule_regex)
-        if re.fullmatch(regex, local):
-            return True
-    return False
+        LOG.w("use re instead of re2 for %s", regex)
+        return re.compile(regex).fullmatch
+
+    return lambda s: re2.fullmatch(pattern, s)
+
+
+def _get_fullmatch(rule_regex: str, rule_id: Optional[int] = None) -> Callable:
+    key = (rule_id, rule_regex)
+    with _lock:
+        fullmatch = _patterns.get(key)
+    if fullmatch is None:
+        fullmatch = _compile(rule_regex)
+        with _lock:
+            _patterns[key] = fullmatch
+    return fullmatch
+
+
+def regex_match(rule_regex: str, local, rule_id: Optional[int] = None):
+    return _get_fullmatch(rule_regex, rule_id)(local) is not None
+
+
+class _CombinedMatcher:
+    """
+    Match all the rules in one pass: the rules are combined into one alternation where each rule is
+    a named group. The alternation is tried in order so the group that matches is the first rule that matches.
+    """
+
+    def __init__(self, regexes: Sequence[str]):
+        self.nb_rules = len(regexes)
+        self._fullmatch = _compile(
+            "|".join(f"(?P<_rule{i}>{regex})" for i, regex in enumerate(regexes))
+        )
+
+    def first_match(self, local: str) -> Optional[int]:
+        """return the index of the first matching rule"""
+        m = self._fullmatch(local)
+        if m is None:
+            return None
+        for i in range(self.nb_rules):
+            if m.group(f"_rule{i}") is not None:
+                return i
+        return None
+
+
+def _get_matcher(rules: Sequence) -> Optional[_CombinedMatcher]:
+    """
+    return None if the rules can't be combined, e.g. if they use the same group name
+    or a numbered backreference
+    """
+    key = tuple((rule.id, rule.regex) for rule in rules)
+    with _lock:
+        if key in _matchers:
+            return _matchers[key]
+
+    if any(_BACKREFERENCE.search(rule.regex) for rule in rules):
+        LOG.d("cannot combine %s rules with a numbered backreference", len(rules))
+        matcher = None
+    else:
+        try:
+            matcher = _CombinedMatcher([rule.regex for rule in rules])
+        except Exception:
+            LOG.d("cannot combine %s rules, try them one by one", len(rules))
+            matcher = None
+
+    with _lock:
+        _matchers[key] = matcher
+    return matcher
+
+
+def first_matching_rule(rules: Sequence[Rule], local: str) -> Optional[Rule]:
+    """
+    Return the first rule whose regex matches local, rules must be sorted by order.
+    With many rules, all the rules are matched in one pass.
+    """
+    if len(rules) >= COMBINED_MATCHER_MIN_RULES:
+        matcher = _get_matcher(rules)
+        if matcher:
+            index = matcher.first_match(local)
+            return rules[index] if index is not None else None
+
+    for rule in rules:
+        if regex_match(rule.regex, local, rule.id):
+            return rule
+    return None
+
+
+def clear_regex_cache():
+    with _lock:
+        _patterns.clear()
+        _matchers.clear()
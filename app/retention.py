@@ -0,0 +1,244 @@
+"""
+Retention of the logs: email_log, bounce, transactional_email and monitoring rows are deleted after a while.
+
+A policy deletes the old rows of its table by ranges of ids, one short transaction per range,
+instead of one DELETE of the whole table that locks and bloats it. As the ids follow the creation time,
+the deletion stops at the first range that has a row younger than the policy max age.
+
+The progress is saved in retention_checkpoint in the same transaction as the range deletion,
+so an interrupted run is resumed where it stopped and a run doesn't scan the already deleted ranges.
+
+The deletion is throttled by a rows per second cap and paused while the replicas are late.
+
+When the table is partitioned by created_at (cf app/partitioning.py), the partitions older than the max age
+are dropped instead. A row is then kept until all the rows of its partition are older than the max age,
+i.e. at most a day more.
+"""
+import time
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import List, Optional
+
+import arrow
+from sqlalchemy import text
+
+from app import config
+from app.db import Session
+from app.log import LOG
+from app.partitioning import is_partitioned, drop_partitions_before
+from app.models import (
+    EmailLog,
+    Bounce,
+    TransactionalEmail,
+    Monitoring,
+    RetentionCheckpoint,
+)
+
+
+@dataclass(frozen=True)
+class RetentionPolicy:
+    name: str
+    # a model with an "id" and a "created_at" column
+    model: type
+    max_age: timedelta
+
+
+RETENTION_POLICIES = [
+    RetentionPolicy("transactional_email", TransactionalEmail, timedelta(days=7)),
+    RetentionPolicy("bounce", Bounce, timedelta(days=7)),
+    RetentionPolicy("email_log", EmailLog, timedelta(weeks=2)),
+    RetentionPolicy("monitoring", Monitoring, timedelta(days=30)),
+]
+
+
+def get_retention_policy(name: str) -> RetentionPolicy:
+    for policy in RETENTION_POLICIES:
+        if policy.name == name:
+            return policy
+    raise ValueError(f"unknown retention policy {name}")
+
+
+@dataclass
+class RetentionReport:
+    policy: str
+    nb_deleted: int = 0
+    nb_batches: int = 0
+    # in seconds
+    duration: float = 0
+    # the longest batch transaction
+    max_batch_duration: float = 0
+    # time spent waiting for the throttle
+    throttled: float = 0
+    # on a partitioned table, nb_deleted is estimated from the dropped partitions
+    nb_dropped_partitions: int = 0
+
+    def __str__(self):
+        if self.nb_dropped_partitions:
+            return (
+                f"{self.policy}: {self.nb_dropped_partitions} partitions dropped, "
+                f"~{self.nb_deleted} rows, {self.duration:.1f}s"
+            )
+        return (
+            f"{self.policy}: {self.nb_deleted} rows deleted in {self.nb_batches} batches, "
+            f"{self.duration:.1f}s (longest batch {self.max_batch_duration:.2f}s, "
+            f"throttled {self.throttled:.1f}s)"
+        )
+
+
+class Throttle:
+    def __init__(
+        self,
+        max_rows_per_second: int = 0,
+        max_replication_lag: int = 0,
+        sleep=time.sleep,
+    ):
+        """0 disables the corresponding limit"""
+        self.max_rows_per_second = max_rows_per_second
+        self.max_replication_lag = max_replication_lag
+        self._sleep = sleep
+
+    def replication_lag(self) -> float:
+        """the replay lag of the most late replica in seconds, 0 without replica"""
+        try:
+            lag = Session.execute(
+                text(
+                    "SELECT extract(epoch FROM max(replay_lag)) FROM pg_stat_replication"
+                )
+            ).scalar()
+        except Exception:
+            LOG.w("cannot get the replication lag, stop checking it", exc_info=True)
+            Session.rollback()
+            self.max_replication_lag = 0
+            return 0
+
+        return float(lag or 0)
+
+    def wait(self, nb_rows: int, elapsed: float) -> float:
+        """wait after a batch of nb_rows that took elapsed seconds, return the time waited"""
+        waited = 0
+        if self.max_rows_per_second and nb_rows:
+            delay = nb_rows / self.max_rows_per_second - elapsed
+            if delay > 0:
+                self._sleep(delay)
+                waited += delay
+
+        if self.max_replication_lag:
+            lag = self.replication_lag()
+            while self.max_replication_lag and lag > self.max_replication_lag:
+                LOG.d("replication lag %ss, pause the deletion", lag)
+                self._sleep(lag)
+                waited += lag
+                lag = self.replication_lag()
+
+        return waited
+
+
+def default_throttle() -> Throttle:
+    return Throttle(
+        config.RETENTION_MAX_ROWS_PER_SECOND, config.RETENTION_MAX_REPLICATION_LAG
+    )
+
+
+def _start_id(policy: RetentionPolicy) -> Optional[int]:
+    checkpoint: RetentionCheckpoint = RetentionCheckpoint.get_by(name=policy.name)
+    if checkpoint:
+        return checkpoint.next_id
+
+    return Session.execute(
+        text(f"SELECT min(id) FROM {policy.model.__tablename__}")
+    ).scalar()
+
+
+def _save_checkpoint(policy: RetentionPolicy, next_id: int):
+    checkpoint: RetentionCheckpoint = RetentionCheckpoint.get_by(name=policy.name)
+    if checkpoint:
+        checkpoint.next_id = next_id
+    else:
+        RetentionCheckpoint.create(name=policy.name, next_id=next_id)
+
+
+def apply_retention_policy(
+    policy: RetentionPolicy,
+    batch_size: int = None,
+    throttle: Optional[Throttle] = None,
+) -> RetentionReport:
+    """delete the rows of the policy table older than its max age"""
+    batch_size = batch_size or config.RETENTION_BATCH_SIZE
+    throttle = throttle or default_throttle()
+    table = policy.model.__tablename__
+    # created_at is stored in UTC without timezone
+    cutoff = arrow.utcnow().shift(seconds=-policy.max_age.total_seconds()).naive
+
+    report = RetentionReport(policy.name)
+    start_time = time.time()
+
+    if is_partitioned(table):
+        for _, nb_rows in drop_partitions_before(table, cutoff):
+            report.nb_dropped_partitions += 1
+            report.nb_deleted += nb_rows
+
+        report.duration = time.time() - start_time
+        LOG.i("retention %s", report)
+        return report
+
+    start = _start_id(policy)
+    max_id = Session.execute(text(f"SELECT max(id) FROM {table}")).scalar()
+    Session.commit()
+
+    while start is not None and max_id is not None and start <= max_id:
+        end = start + batch_size
+        batch_start_time = time.time()
+
+        # the EXISTS sees the rows as before the deletion, only the young ones are counted
+        nb_deleted, has_young_rows = Session.execute(
+            text(
+                f"""
+WITH deleted AS (
+    DELETE FROM {table}
+    WHERE id >= :start AND id < :end AND created_at < :cutoff
+    RETURNING id
+)
+SELECT
+    (SELECT count(*) FROM deleted),
+    EXISTS (
+        SELECT 1 FROM {table}
+        WHERE id >= :start AND id < :end AND created_at >= :cutoff
+    )
+"""
+            ),
+            {"start": start, "end": end, "cutoff": cutoff},
+        ).fetchone()
+
+        # the next run starts from the range that still has rows,
+        # or after the last row as the ranges above max_id receive the new rows
+        _save_checkpoint(policy, start if has_young_rows else min(end, max_id + 1))
+        Session.commit()
+
+        batch_duration = time.time() - batch_start_time
+        report.nb_deleted += nb_deleted
+        report.nb_batches += 1
+        report.max_batch_duration = max(report.max_batch_duration, batch_duration)
+
+        if has_young_rows:
+            break
+
+        start = end
+        report.throttled += throttle.wait(nb_deleted, batch_duration)
+
+    report.duration = time.time() - start_time
+    LOG.i("retention %s", report)
+    return report
+
+
+def apply_retention_policies(
+    names: Optional[List[str]] = None,
+    batch_size: int = None,
+    throttle: Optional[Throttle] = None,
+) -> List[RetentionReport]:
+    """names: None for all the policies"""
+    policies = (
+        [get_retention_policy(name) for name in names]
+        if names is not None
+        else RETENTION_POLICIES
+    )
+    return [apply_retention_policy(policy, batch_size, throttle) for policy in policies]
@@ -0,0 +1,109 @@
+"""
+Compare the alias listing of get_alias_infos_with_pagination_v3(), which reads the alias_activity rollup,
+with the former aggregation of email_log, for a user with 1k, 10k and 100k aliases.
+Needs a database as configured by CONFIG: test objects are created then rolled back.
+
+    CONFIG=tests/test.env python -m benchmarks.alias_activity --nb-email-logs-per-alias 5
+"""
+import argparse
+
+from sqlalchemy import text
+
+from app.api.serializer import get_alias_infos_with_pagination_v3
+from app.db import Session
+from app.log import LOG
+from app.models import User, Alias, Contact, EmailLog
+from benchmarks.utils import timed
+
+# the aggregation done by construct_alias_query() before the alias_activity rollup
+_LEGACY_QUERY = """
+SELECT alias.id,
+    sum(CASE WHEN email_log.is_reply THEN 1 ELSE 0 END) AS nb_reply,
+    sum(CASE WHEN NOT email_log.is_reply AND email_log.blocked THEN 1 ELSE 0 END) AS nb_blocked,
+    sum(CASE WHEN NOT email_log.is_reply AND NOT email_log.blocked THEN 1 ELSE 0 END) AS nb_forward,
+    max(email_log.created_at) AS latest_email_log_created_at
+FROM alias
+LEFT JOIN email_log ON alias.id = email_log.alias_id
+WHERE alias.user_id = :user_id
+GROUP BY alias.id
+ORDER BY latest_email_log_created_at DESC NULLS LAST
+LIMIT 20
+"""
+
+
+def create_aliases(user: User, nb_aliases: int, nb_email_logs_per_alias: int):
+    Session.bulk_insert_mappings(
+        Alias,
+        [
+            {
+                "user_id": user.id,
+                "email": f"alias-activity-{user.id}-{i}@sl.test",
+                "mailbox_id": user.default_mailbox_id,
+            }
+            for i in range(nb_aliases)
+        ],
+    )
+    Session.flush()
+    alias_ids = [r[0] for r in Session.query(Alias.id).filter(Alias.user_id == user.id)]
+
+    Session.bulk_insert_mappings(
+        Contact,
+        [
+            {
+                "user_id": user.id,
+                "alias_id": alias_id,
+                "website_email": f"contact-{alias_id}@example.com",
+                "reply_email": f"ra-{alias_id}@sl.test",
+            }
+            for alias_id in alias_ids
+        ],
+    )
+    Session.flush()
+
+    contacts = Session.query(Contact.id, Contact.alias_id).filter(
+        Contact.user_id == user.id
+    )
+    Session.bulk_insert_mappings(
+        EmailLog,
+        [
+            {
+                "user_id": user.id,
+                "contact_id": contact_id,
+                "alias_id": alias_id,
+                "is_reply": i % 3 == 0,
+            }
+            for contact_id, alias_id in contacts
+            for i in range(nb_email_logs_per_alias)
+        ],
+    )
+    Session.flush()
+
+
+def run(nb_email_logs_per_alias: int, nb_queries: int):
+    for nb_aliases in [1_000, 10_000, 100_000]:
+        user = User.create(
+            email=f"alias-activity-benchmark-{nb_aliases}@mailbox.test",
+            name="benchmark",
+        )
+        Session.flush()
+        create_aliases(user, nb_aliases, nb_email_logs_per_alias)
+
+        with timed(f"{nb_aliases:>6} aliases, email_log aggregation", nb_queries):
+            for _ in range(nb_queries):
+                Session.execute(text(_LEGACY_QUERY), {"user_id": user.id}).fetchall()
+
+        with timed(f"{nb_aliases:>6} aliases, alias_activity", nb_queries):
+            for _ in range(nb_queries):
+                get_alias_infos_with_pagination_v3(user)
+
+        Session.rollback()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nb-email-logs-per-alias", type=int, default=5)
+    parser.add_argument("--nb-queries", type=int, default=10)
+    args = parser.parse_args()
+    LOG.setLevel("WARNING")
+
+    run(args.nb_email_logs_per_alias, args.nb_queries)
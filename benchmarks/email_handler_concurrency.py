@@ -0,0 +1,118 @@
+"""
+Push N concurrent SMTP sessions through the aiosmtpd Controller and report throughput and latency
+for each email handler executor.
+
+The email pipeline is replaced by a simulated workload: --io-ms of blocking IO (DB, SpamAssassin, Postfix)
+and --cpu-ms of CPU per email, so no database is needed.
+
+    python -m benchmarks.email_handler_concurrency --sessions 50 --emails 10
+"""
+import argparse
+import smtplib
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.message import EmailMessage
+
+from aiosmtpd.controller import Controller
+
+import email_handler
+from app.email import status
+from app.log import LOG
+from benchmarks.utils import print_latencies
+
+IO_SECONDS = 0.05
+CPU_SECONDS = 0.002
+
+
+def simulated_handle(envelope, msg) -> str:
+    time.sleep(IO_SECONDS)
+    end = time.process_time() + CPU_SECONDS
+    while time.process_time() < end:
+        pass
+    return status.E200
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def send_emails(port: int, nb_emails: int) -> ([float], int):
+    latencies, nb_rejected = [], 0
+    msg = EmailMessage()
+    msg["From"] = "sender@benchmark.test"
+    msg["To"] = "alias@benchmark.test"
+    msg["Subject"] = "benchmark"
+    msg.set_content("hello\n" * 1000)
+
+    with smtplib.SMTP("localhost", port) as smtp:
+        for _ in range(nb_emails):
+            start = time.time()
+            try:
+                smtp.send_message(msg)
+                latencies.append(time.time() - start)
+            except smtplib.SMTPDataError:
+                nb_rejected += 1
+
+    return latencies, nb_rejected
+
+
+def run(
+    executor_type: str, nb_sessions: int, nb_emails: int, workers: int, max_pending
+):
+    executor = email_handler.create_executor(executor_type, workers)
+    port = free_port()
+    controller = Controller(
+        email_handler.MailHandler(executor, max_pending),
+        hostname="localhost",
+        port=port,
+    )
+    controller.start()
+
+    latencies, nb_rejected = [], 0
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=nb_sessions) as clients:
+        for res in clients.map(
+            send_emails, [port] * nb_sessions, [nb_emails] * nb_sessions
+        ):
+            latencies += res[0]
+            nb_rejected += res[1]
+    elapsed = time.time() - start
+
+    controller.stop()
+    if executor:
+        executor.shutdown()
+
+    print_latencies(f"{executor_type:>7}", latencies, elapsed)
+    print(f"{'':>7}  {nb_rejected} emails rejected with 4xx")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--emails", type=int, default=10, help="emails per session")
+    parser.add_argument("--workers", type=int, default=10)
+    parser.add_argument("--max-pending", type=int, default=0)
+    parser.add_argument("--io-ms", type=float, default=50)
+    parser.add_argument("--cpu-ms", type=float, default=2)
+    parser.add_argument(
+        "--executors", default="inline,thread,process", help="comma separated"
+    )
+    args = parser.parse_args()
+    LOG.setLevel("WARNING")
+
+    IO_SECONDS = args.io_ms / 1000
+    CPU_SECONDS = args.cpu_ms / 1000
+    # patch before creating the process pool so the forked workers inherit it
+    email_handler.MailHandler._handle = staticmethod(simulated_handle)
+
+    for executor_type in args.executors.split(","):
+        run(
+            executor_type,
+            args.sessions,
+            args.emails,
+            args.workers,
+            args.max_pending,
+        )
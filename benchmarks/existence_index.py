@@ -0,0 +1,83 @@
+"""
+Latency to reject an email to an address that doesn't exist: the reverse alias and alias lookups
+in the database vs the existence index, then the Bloom filter throughput and memory for --nb-entries.
+The index is built from the database configured by CONFIG.
+
+    CONFIG=tests/test.env python -m benchmarks.existence_index --nb-lookups 2000
+"""
+import argparse
+import time
+
+from app.db import Session
+from app.existence_index import ExistenceIndex, BloomFilter, bloom_filter_size
+from app.log import LOG
+from app.models import Alias, Contact
+from benchmarks.utils import print_latencies, timed
+from tests.utils import random_token
+
+
+def db_lookup(address: str) -> bool:
+    return bool(Contact.get_by(reply_email=address) or Alias.get_by(email=address))
+
+
+def index_lookup(index: ExistenceIndex, address: str) -> bool:
+    return bool(
+        (index.may_be_reverse_alias(address) and Contact.get_by(reply_email=address))
+        or (index.may_be_alias(address) and Alias.get_by(email=address))
+    )
+
+
+def measure(name: str, lookup, addresses):
+    latencies = []
+    start = time.time()
+    for address in addresses:
+        lookup_start = time.time()
+        assert not lookup(address)
+        latencies.append(time.time() - lookup_start)
+    print_latencies(name, latencies, time.time() - start)
+
+
+def run(nb_lookups: int, nb_entries: int):
+    addresses = [f"{random_token(20)}@unknown.test" for _ in range(nb_lookups)]
+
+    measure("database lookups", db_lookup, addresses)
+    Session.rollback()
+
+    index = ExistenceIndex(max_transaction_duration=0)
+    build_start = time.time()
+    index.build()
+    print(f"index built in {time.time() - build_start:.2f}s")
+    # a miss reads the rows inserted since the last sync when it's due
+    for sync_interval in [0, 1]:
+        index.sync_interval = sync_interval
+        measure(
+            f"existence index, sync interval {sync_interval}s",
+            lambda a: index_lookup(index, a),
+            addresses,
+        )
+
+    for capacity in [1_000_000, 10_000_000, 100_000_000]:
+        for error_rate in [0.01, 0.001]:
+            nb_bits, nb_hashes = bloom_filter_size(capacity, error_rate)
+            print(
+                f"{capacity:>11} entries at {error_rate}: "
+                f"{nb_bits / 8 / 1024 / 1024:.1f} MiB, {nb_hashes} hash functions"
+            )
+
+    bloom_filter = BloomFilter(nb_entries, 0.01)
+    keys = [f"{random_token(20)}@sl.test" for _ in range(nb_entries)]
+    with timed(f"add {nb_entries} entries", nb_entries):
+        bloom_filter.add_many(keys)
+    with timed("lookup of missing entries", nb_lookups):
+        nb_false_positives = sum(address in bloom_filter for address in addresses)
+    print(f"{nb_false_positives / nb_lookups:.2%} false positives")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nb-lookups", type=int, default=2000)
+    parser.add_argument("--nb-entries", type=int, default=1_000_000)
+    args = parser.parse_args()
+    LOG.setLevel("WARNING")
+
+    run(args.nb_lookups, args.nb_entries)
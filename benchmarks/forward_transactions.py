@@ -0,0 +1,107 @@
+"""
+Replay a corpus of emails through the forward phase, with a transaction for each step and with
+FORWARD_SINGLE_TRANSACTION, and report the transactions per email and the throughput.
+The emails are .eml files with an {{ alias_email }} To: header, like tests/example_emls.
+Needs a database as configured by CONFIG, with NOT_SEND_EMAIL.
+The test user is deleted at the end.
+
+    CONFIG=tests/test.env python -m benchmarks.forward_transactions --repeat 50
+"""
+import argparse
+import os
+import time
+
+from aiosmtpd.smtp import Envelope
+from sqlalchemy import event
+
+import email_handler
+from app import config
+from app.db import Session, engine
+from app.log import LOG
+from app.models import Alias, User
+from benchmarks.utils import print_latencies
+from tests.utils import create_new_user, load_eml_file
+
+
+class TransactionCounter:
+    def __init__(self):
+        self.nb_commits = 0
+        self.nb_savepoints = 0
+
+    def __enter__(self):
+        event.listen(engine, "commit", self._on_commit)
+        event.listen(engine, "savepoint", self._on_savepoint)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(engine, "commit", self._on_commit)
+        event.remove(engine, "savepoint", self._on_savepoint)
+
+    def _on_commit(self, conn):
+        self.nb_commits += 1
+
+    def _on_savepoint(self, conn, name):
+        self.nb_savepoints += 1
+
+
+def load_corpus(corpus_dir: str) -> [str]:
+    """paths of the emails of the corpus that are sent to {{ alias_email }}"""
+    paths = []
+    for filename in sorted(os.listdir(corpus_dir)):
+        path = os.path.join(corpus_dir, filename)
+        if filename.endswith(".eml"):
+            with open(path) as f:
+                if "alias_email" in f.read():
+                    paths.append(path)
+    return paths
+
+
+def replay(corpus: [str], repeat: int, single_transaction: bool):
+    config.FORWARD_SINGLE_TRANSACTION = single_transaction
+    user = create_new_user()
+    # each email of the corpus goes to a new alias
+    aliases = [Alias.create_new_random(user) for _ in range(repeat)]
+    Session.commit()
+
+    latencies = []
+    with TransactionCounter() as counter:
+        start = time.time()
+        for alias in aliases:
+            for path in corpus:
+                msg = load_eml_file(path, {"alias_email": alias.email})
+                envelope = Envelope()
+                envelope.mail_from = msg["from"]
+                envelope.rcpt_tos = [alias.email]
+                email_start = time.time()
+                email_handler.handle(envelope, msg)
+                latencies.append(time.time() - email_start)
+        elapsed = time.time() - start
+
+    mode = "single transaction" if single_transaction else "commit per step"
+    print_latencies(mode, latencies, elapsed)
+    print(
+        f"{'':>18}  {counter.nb_commits / len(latencies):.1f} commits/email, "
+        f"{counter.nb_savepoints / len(latencies):.1f} savepoints/email"
+    )
+
+    User.delete(user.id)
+    Session.commit()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--corpus",
+        default=os.path.join(
+            os.path.dirname(os.path.dirname(__file__)), "tests", "example_emls"
+        ),
+    )
+    parser.add_argument("--repeat", type=int, default=20, help="replays of the corpus")
+    args = parser.parse_args()
+    LOG.setLevel("WARNING")
+    # all the aliases forward to the same mailbox
+    config.RATE_LIMIT_BACKEND = "none"
+
+    corpus = load_corpus(args.corpus)
+    for single_transaction in [False, True]:
+        replay(corpus, args.repeat, single_transaction)
@@ -0,0 +1,75 @@
+"""
+Throughput of the HIBP scan against a local fake HIBP API that answers in --latency seconds.
+Reports the aliases checked per minute and per API key, to compare with --rate-per-minute.
+Needs a database as configured by CONFIG. The seeded aliases are committed and deleted at the end.
+
+    CONFIG=tests/test.env python -m benchmarks.hibp_scanner --nb-aliases 500 --nb-keys 2
+"""
+import argparse
+import asyncio
+from typing import List
+
+import arrow
+
+from app.db import Session
+from app.hibp_scanner import HibpScanner
+from app.log import LOG
+from app.models import User, Alias
+from tests.utils import FakeHibpServer
+
+
+def seed(nb_aliases: int) -> (User, List[str]):
+    user = User.create(
+        email="hibp-benchmark@mailbox.test", name="benchmark", flush=True
+    )
+    emails = [Alias.create_new_random(user).email for _ in range(nb_aliases)]
+    Session.commit()
+    return user, emails
+
+
+def run(
+    nb_aliases: int,
+    nb_keys: int,
+    rate_per_minute: float,
+    workers_per_key: int,
+    latency: float,
+):
+    user, emails = seed(nb_aliases)
+    # every 10th alias is breached
+    breaches = {email: ["Benchmark breach"] for email in emails[::10]}
+
+    try:
+        with FakeHibpServer(breaches, latency=latency) as server:
+            scanner = HibpScanner(
+                [f"key{i}" for i in range(nb_keys)],
+                rate_per_minute=rate_per_minute,
+                workers_per_key=workers_per_key,
+                api_url=server.url,
+            )
+            report = asyncio.run(scanner.scan(arrow.now().shift(days=-7)))
+        print(
+            f"{nb_keys} keys at {rate_per_minute} requests/minute, "
+            f"{workers_per_key} workers per key, latency {latency}s: {report}"
+        )
+    finally:
+        User.filter_by(id=user.id).delete()
+        Session.commit()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nb-aliases", type=int, default=500)
+    parser.add_argument("--nb-keys", type=int, default=2)
+    parser.add_argument("--rate-per-minute", type=float, default=600)
+    parser.add_argument("--workers-per-key", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=0.2)
+    args = parser.parse_args()
+    LOG.setLevel("WARNING")
+
+    run(
+        args.nb_aliases,
+        args.nb_keys,
+        args.rate_per_minute,
+        args.workers_per_key,
+        args.latency,
+    )
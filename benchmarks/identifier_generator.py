@@ -0,0 +1,90 @@
+"""
+Collision rate and queries per generated alias when --fill of a namespace of --namespace-size
+addresses is already used, for the lookup of one candidate at a time (the former generate_email)
+and for the batches of identifier_generator with several batch sizes.
+Needs a database as configured by CONFIG: the aliases are created then rolled back.
+
+    CONFIG=tests/test.env python -m benchmarks.identifier_generator --fill 0.9
+"""
+import argparse
+import random
+
+from app import identifier_generator
+from app.db import Session
+from app.log import LOG
+from app.models import Alias, DeletedAlias, User
+from benchmarks.utils import timed
+from tests.utils import QueryCounter
+
+
+def legacy_generate(generate) -> (str, int):
+    """(free identifier, nb of collisions) by looking up one candidate at a time"""
+    nb_collisions = 0
+    while True:
+        email = generate()
+        if not Alias.get_by(email=email) and not DeletedAlias.get_by(email=email):
+            return email, nb_collisions
+        nb_collisions += 1
+
+
+def run(namespace_size: int, fill: float, nb_aliases: int):
+    user = User.create(email="identifier-benchmark@mailbox.test", name="benchmark")
+    Session.flush()
+    used = random.sample(range(namespace_size), int(namespace_size * fill))
+    Session.bulk_insert_mappings(
+        Alias,
+        [
+            {
+                "user_id": user.id,
+                "email": f"{i}@identifier.test",
+                "mailbox_id": user.default_mailbox_id,
+            }
+            for i in used
+        ],
+    )
+    Session.flush()
+
+    def generate() -> str:
+        return f"{random.randrange(namespace_size)}@identifier.test"
+
+    print(f"{len(used)} of {namespace_size} addresses used")
+    nb_collisions = 0
+    with QueryCounter() as counter, timed("one candidate at a time", nb_aliases):
+        for _ in range(nb_aliases):
+            nb_collisions += legacy_generate(generate)[1]
+    print(
+        f"  {nb_collisions / nb_aliases:.2f} collisions/alias, "
+        f"{counter.nb_queries / nb_aliases:.2f} queries/alias"
+    )
+
+    for batch_size in [5, 10, 50]:
+        identifier_generator.stats.reset()
+        with QueryCounter() as counter, timed(f"batches of {batch_size}", nb_aliases):
+            for _ in range(nb_aliases):
+                identifier_generator.generate_free(generate, batch_size)
+                identifier_generator.stats.record_generated()
+        stats = identifier_generator.stats.reset()
+        print(
+            f"  {stats.nb_collisions / stats.nb_candidates:.1%} of candidates used, "
+            f"{counter.nb_queries / nb_aliases:.2f} queries/alias"
+        )
+
+    # the free candidates of a batch are kept for the next calls
+    pool = identifier_generator.IdentifierPool(generate, pool_size=0, batch_size=50)
+    with QueryCounter() as counter, timed("pool, batches of 50", nb_aliases):
+        for _ in range(nb_aliases):
+            pool.get()
+    print(f"  {counter.nb_queries / nb_aliases:.2f} queries/alias")
+
+    Session.rollback()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--namespace-size", type=int, default=10_000)
+    parser.add_argument("--fill", type=float, default=0.9)
+    parser.add_argument("--nb-aliases", type=int, default=200)
+    args = parser.parse_args()
+    LOG.setLevel("WARNING")
+
+    run(args.namespace_size, args.fill, args.nb_aliases)
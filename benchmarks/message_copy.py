@@ -0,0 +1,66 @@
+"""
+Compare the cost of copying a message with large attachments for a fan-out to several mailboxes,
+with deepcopy and with the copy-on-write copy of email_utils.copy().
+
+    python -m benchmarks.message_copy --attachment-size 5000000 --nb-mailboxes 5
+"""
+import argparse
+import os
+import tracemalloc
+from copy import deepcopy
+from email import message_from_bytes
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from app.email_utils import copy, add_or_replace_header
+from app.log import LOG
+from app.message_utils import message_to_bytes
+from benchmarks.utils import timed
+
+
+def build_message(attachment_size: int, nb_attachments: int):
+    msg = MIMEMultipart()
+    msg["From"] = "sender@example.com"
+    msg["To"] = "alias@sl.test"
+    msg["Subject"] = "benchmark"
+    msg.attach(MIMEText("hello"))
+    for i in range(nb_attachments):
+        attachment = MIMEApplication(os.urandom(attachment_size))
+        attachment.add_header(
+            "Content-Disposition", "attachment", filename=f"attachment-{i}.bin"
+        )
+        msg.attach(attachment)
+    # like in the email handler, the message is parsed from bytes
+    return message_from_bytes(message_to_bytes(msg))
+
+
+def run(attachment_size: int, nb_attachments: int, nb_mailboxes: int, nb_runs: int):
+    msg = build_message(attachment_size, nb_attachments)
+
+    for name, copy_fn in [("deepcopy", deepcopy), ("copy on write", copy)]:
+        tracemalloc.start()
+        with timed(f"{name:>13}, {nb_mailboxes} mailboxes", nb_runs):
+            for _ in range(nb_runs):
+                copies = []
+                for mailbox_index in range(nb_mailboxes):
+                    copy_msg = copy_fn(msg)
+                    add_or_replace_header(
+                        copy_msg, "To", f"mailbox{mailbox_index}@test"
+                    )
+                    copies.append(copy_msg)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{name:>13}: peak memory {peak / 1024 / 1024:.2f}MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--attachment-size", type=int, default=5_000_000)
+    parser.add_argument("--nb-attachments", type=int, default=3)
+    parser.add_argument("--nb-mailboxes", type=int, default=5)
+    parser.add_argument("--nb-runs", type=int, default=20)
+    args = parser.parse_args()
+    LOG.setLevel("WARNING")
+
+    run(args.attachment_size, args.nb_attachments, args.nb_mailboxes, args.nb_runs)
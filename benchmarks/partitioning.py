@@ -0,0 +1,147 @@
+"""
+Compare a regular email_log table with one partitioned by day: insert throughput,
+deletion of the logs older than 2 weeks (DELETE vs drop of the partitions) and a count of the last 24h.
+Runs on 2 scratch tables shaped like email_log, without its foreign keys and triggers,
+dropped at the end. Needs a database as configured by CONFIG.
+
+    CONFIG=tests/test.env python -m benchmarks.partitioning --nb-email-logs 2000000
+"""
+import argparse
+import time
+
+import arrow
+from sqlalchemy import text
+
+from app.db import Session
+from app.log import LOG
+from app.partitioning import (
+    PartitionSpec,
+    create_future_partitions,
+    drop_partitions_before,
+)
+
+_PLAIN = "benchmark_email_log_plain"
+_PARTITIONED = "benchmark_email_log_partitioned"
+_NB_DAYS = 30
+
+# the email logs are spread over the last 30 days, inserted by batches of 1000 rows
+_INSERT_QUERY = """
+INSERT INTO {table} (created_at, user_id, contact_id, alias_id, is_reply, blocked, bounced,
+    auto_replied, is_spam)
+SELECT now() AT TIME ZONE 'utc' - (i % :nb_days) * interval '1 day', 1, 1, 1, false, false, false, false, false
+FROM generate_series(:start, :start + 999) AS i
+"""
+
+
+def create_tables():
+    Session.execute(
+        text(
+            f"CREATE TABLE {_PLAIN} (LIKE email_log INCLUDING DEFAULTS INCLUDING INDEXES)"
+        )
+    )
+    Session.execute(text(f"ALTER TABLE {_PLAIN} ALTER COLUMN id DROP DEFAULT"))
+    Session.execute(
+        text(
+            f"CREATE TABLE {_PARTITIONED} (LIKE email_log INCLUDING DEFAULTS) "
+            f"PARTITION BY RANGE (created_at)"
+        )
+    )
+    Session.execute(text(f"ALTER TABLE {_PARTITIONED} ALTER COLUMN id DROP DEFAULT"))
+    Session.execute(
+        text(f"ALTER TABLE {_PARTITIONED} ADD PRIMARY KEY (id, created_at)")
+    )
+    # same secondary indexes as email_log
+    for (index_def,) in Session.execute(
+        text(
+            "SELECT indexdef FROM pg_indexes WHERE tablename = 'email_log' "
+            "AND indexname <> 'email_log_pkey'"
+        )
+    ):
+        Session.execute(
+            text(
+                index_def.replace(" ON public.email_log ", f" ON {_PARTITIONED} ")
+                .replace(" ON email_log ", f" ON {_PARTITIONED} ")
+                .replace("INDEX ", f"INDEX {_PARTITIONED}_", 1)
+            )
+        )
+    for table in (_PLAIN, _PARTITIONED):
+        Session.execute(text(f"CREATE SEQUENCE {table}_id_seq OWNED BY {table}.id"))
+        Session.execute(
+            text(
+                f"ALTER TABLE {table} ALTER COLUMN id SET DEFAULT nextval('{table}_id_seq')"
+            )
+        )
+    Session.commit()
+
+    create_future_partitions(
+        PartitionSpec(_PARTITIONED, "day", 1), arrow.utcnow().shift(days=-_NB_DAYS)
+    )
+    create_future_partitions(PartitionSpec(_PARTITIONED, "day", 1))
+
+
+def drop_tables():
+    Session.rollback()
+    for table in (_PLAIN, _PARTITIONED):
+        Session.execute(text(f"DROP TABLE IF EXISTS {table}"))
+    Session.commit()
+
+
+def insert(table: str, nb_email_logs: int) -> float:
+    start = time.time()
+    for i in range(0, nb_email_logs, 1000):
+        Session.execute(
+            text(_INSERT_QUERY.format(table=table)), {"start": i, "nb_days": _NB_DAYS}
+        )
+        Session.commit()
+    return time.time() - start
+
+
+def run(nb_email_logs: int):
+    create_tables()
+    cutoff = arrow.utcnow().shift(weeks=-2).naive
+
+    try:
+        for table in (_PLAIN, _PARTITIONED):
+            elapsed = insert(table, nb_email_logs)
+            print(
+                f"{table}: {nb_email_logs} inserts in {elapsed:.1f}s, "
+                f"{nb_email_logs / elapsed:.0f} rows/s"
+            )
+            Session.execute(text(f"ANALYZE {table}"))
+            Session.commit()
+
+        for table in (_PLAIN, _PARTITIONED):
+            start = time.time()
+            nb = Session.execute(
+                text(f"SELECT count(*) FROM {table} WHERE created_at > :since"),
+                {"since": arrow.utcnow().shift(days=-1).naive},
+            ).scalar()
+            print(
+                f"{table}: count of the last 24h ({nb}) in {time.time() - start:.2f}s"
+            )
+
+        start = time.time()
+        nb_deleted = Session.execute(
+            text(f"DELETE FROM {_PLAIN} WHERE created_at < :cutoff"),
+            {"cutoff": cutoff},
+        ).rowcount
+        Session.commit()
+        print(f"{_PLAIN}: DELETE of {nb_deleted} rows in {time.time() - start:.1f}s")
+
+        start = time.time()
+        dropped = drop_partitions_before(_PARTITIONED, cutoff)
+        print(
+            f"{_PARTITIONED}: drop of {len(dropped)} partitions, "
+            f"~{sum(nb for _, nb in dropped)} rows in {time.time() - start:.1f}s"
+        )
+    finally:
+        drop_tables()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nb-email-logs", type=int, default=2_000_000)
+    args = parser.parse_args()
+    LOG.setLevel("WARNING")
+
+    run(args.nb_email_logs)
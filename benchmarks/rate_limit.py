@@ -0,0 +1,61 @@
+"""
+Compare the cost of a rate limit check with the in-memory counters and with the EmailLog COUNT queries.
+Needs a database as configured by CONFIG: test objects are created then rolled back.
+
+    CONFIG=tests/test.env python -m benchmarks.rate_limit --nb-email-logs 10000
+"""
+import argparse
+
+from app import config
+from app.db import Session
+from app.email.rate_limit import (
+    rate_limited_for_alias,
+    rate_limited_for_mailbox,
+    set_rate_limit_backend,
+    InMemoryRateLimitBackend,
+)
+from app.models import User, Alias, Contact, EmailLog
+from app.log import LOG
+from benchmarks.utils import timed
+
+
+def run(nb_email_logs: int, nb_checks: int):
+    user = User.create(email="rate-limit-benchmark@mailbox.test", name="benchmark")
+    Session.flush()
+    alias = Alias.create_new_random(user)
+    Session.flush()
+    contact = Contact.create(
+        user_id=user.id,
+        alias_id=alias.id,
+        website_email="contact@benchmark.test",
+        reply_email="rate-limit-benchmark@sl.test",
+        flush=True,
+    )
+    Session.bulk_insert_mappings(
+        EmailLog,
+        [
+            {"user_id": user.id, "contact_id": contact.id, "alias_id": alias.id}
+            for _ in range(nb_email_logs)
+        ],
+    )
+    Session.flush()
+
+    for backend in ["sql", "memory"]:
+        config.RATE_LIMIT_BACKEND = backend
+        set_rate_limit_backend(InMemoryRateLimitBackend())
+        with timed(f"{backend:>6} with {nb_email_logs} email logs", nb_checks):
+            for _ in range(nb_checks):
+                rate_limited_for_alias(alias)
+                rate_limited_for_mailbox(alias)
+
+    Session.rollback()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nb-email-logs", type=int, default=10_000)
+    parser.add_argument("--nb-checks", type=int, default=1000)
+    args = parser.parse_args()
+    LOG.setLevel("WARNING")
+
+    run(args.nb_email_logs, args.nb_checks)
@@ -0,0 +1,63 @@
+"""
+Compare the auto create rules matching with a regex compiled at each call, with the compiled-pattern cache
+and with the combined matcher, for domains with 1, 10 and 100 rules.
+
+    python -m benchmarks.regex_match --nb-checks 10000
+"""
+import argparse
+import random
+import string
+
+import re2
+
+from app import regex_utils
+from app.log import LOG
+from benchmarks.utils import timed
+
+
+class _Rule:
+    def __init__(self, id, regex):
+        self.id = id
+        self.regex = regex
+
+
+def uncached_first_matching_rule(rules, local):
+    for rule in rules:
+        if re2.fullmatch(re2.compile(rule.regex), local):
+            return rule
+    return None
+
+
+def run(nb_checks: int):
+    for nb_rules in [1, 10, 100]:
+        rules = [_Rule(i, f"prefix{i}(\\.|-)?[a-z0-9]{{4,6}}") for i in range(nb_rules)]
+        # like spam to a catch-all domain: most locals don't match any rule
+        locals_ = [
+            "".join(random.choices(string.ascii_lowercase, k=12))
+            for _ in range(nb_checks)
+        ]
+
+        with timed(f"{nb_rules:>3} rules, uncached", nb_checks):
+            for local in locals_:
+                uncached_first_matching_rule(rules, local)
+
+        regex_utils.clear_regex_cache()
+        regex_utils.COMBINED_MATCHER_MIN_RULES = nb_rules + 1
+        with timed(f"{nb_rules:>3} rules, cached", nb_checks):
+            for local in locals_:
+                regex_utils.first_matching_rule(rules, local)
+
+        regex_utils.clear_regex_cache()
+        regex_utils.COMBINED_MATCHER_MIN_RULES = 1
+        with timed(f"{nb_rules:>3} rules, combined", nb_checks):
+            for local in locals_:
+                regex_utils.first_matching_rule(rules, local)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nb-checks", type=int, default=10_000)
+    args = parser.parse_args()
+    LOG.setLevel("WARNING")
+
+    run(args.nb_checks)
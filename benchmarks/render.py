@@ -0,0 +1,97 @@
+"""
+Compare render() of the email templates with an environment created at each call (the templates are
+read and compiled every time) and with the cached environment. Also compares the cold start of a process:
+all the templates compiled from source vs loaded from the bytecode cache.
+
+    CONFIG=tests/test.env python -m benchmarks.render --nb-renders 2000
+"""
+import argparse
+import os
+import tempfile
+
+import arrow
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+
+from app import config
+from app.email_templates import (
+    EMAIL_TEMPLATES_DIR,
+    TEMPLATE_EXTENSIONS,
+    get_environment,
+)
+from app.email_utils import render
+from app.log import LOG
+from benchmarks.utils import timed
+
+# a text template and an html one that extends base.html
+_TEMPLATES = [
+    ("transactional/noreply.text.jinja2", {}),
+    (
+        "transactional/activation.html",
+        {"email": "user@example.com", "activation_link": "https://example.com/a"},
+    ),
+]
+
+
+def uncached_render(template_name, **kwargs) -> str:
+    env = Environment(loader=FileSystemLoader(EMAIL_TEMPLATES_DIR))
+    template = env.get_template(template_name)
+    return template.render(
+        MAX_NB_EMAIL_FREE_PLAN=config.MAX_NB_EMAIL_FREE_PLAN,
+        URL=config.URL,
+        LANDING_PAGE_URL=config.LANDING_PAGE_URL,
+        YEAR=arrow.now().year,
+        **kwargs,
+    )
+
+
+def compile_all(env: Environment) -> int:
+    template_names = env.list_templates(extensions=TEMPLATE_EXTENSIONS)
+    for template_name in template_names:
+        env.get_template(template_name)
+    return len(template_names)
+
+
+def run(nb_renders: int):
+    for template_name, kwargs in _TEMPLATES:
+        with timed(f"{template_name}, environment per call", nb_renders):
+            for _ in range(nb_renders):
+                uncached_render(template_name, **kwargs)
+
+        get_environment().get_template(template_name)
+        with timed(f"{template_name}, cached environment", nb_renders):
+            for _ in range(nb_renders):
+                render(template_name, **kwargs)
+
+    nb_templates = len(
+        Environment(loader=FileSystemLoader(EMAIL_TEMPLATES_DIR)).list_templates(
+            extensions=TEMPLATE_EXTENSIONS
+        )
+    )
+    with tempfile.TemporaryDirectory() as cache_dir:
+        with timed("cold start, compiled from source", nb_templates):
+            compile_all(Environment(loader=FileSystemLoader(EMAIL_TEMPLATES_DIR)))
+
+        # fill the bytecode cache, like a previous process would
+        compile_all(
+            Environment(
+                loader=FileSystemLoader(EMAIL_TEMPLATES_DIR),
+                bytecode_cache=FileSystemBytecodeCache(cache_dir),
+            )
+        )
+        print(f"{len(os.listdir(cache_dir))} templates in the bytecode cache")
+        with timed("cold start, loaded from the bytecode cache", nb_templates):
+            compile_all(
+                Environment(
+                    loader=FileSystemLoader(EMAIL_TEMPLATES_DIR),
+                    bytecode_cache=FileSystemBytecodeCache(cache_dir),
+                )
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nb-renders", type=int, default=2000)
+    args = parser.parse_args()
+    LOG.setLevel("WARNING")
+
+    run(args.nb_renders)
@@ -0,0 +1,98 @@
+"""
+Compare the deletion of old email logs in one DELETE, as cron.delete_logs used to do,
+with the retention policy that deletes them by id ranges, on a table seeded with millions of email logs.
+Needs a database as configured by CONFIG. The seeded rows are committed and deleted at the end.
+
+    CONFIG=tests/test.env python -m benchmarks.retention --nb-email-logs 2000000
+"""
+import argparse
+import time
+
+from sqlalchemy import text
+
+from app.db import Session
+from app.log import LOG
+from app.models import User, Alias, Contact, RetentionCheckpoint
+from app.retention import apply_retention_policy, get_retention_policy, Throttle
+
+# 90% of the email logs are older than the retention of 2 weeks
+_SEED_QUERY = """
+INSERT INTO email_log (created_at, user_id, contact_id, alias_id, is_reply, blocked, bounced,
+    auto_replied, is_spam)
+SELECT now() AT TIME ZONE 'utc' - (CASE WHEN i <= :nb_old THEN interval '30 days' ELSE interval '1 day' END)
+        + i * interval '1 millisecond',
+    :user_id, :contact_id, :alias_id, false, false, false, false, false
+FROM generate_series(1, :nb) AS i
+"""
+
+
+def seed(nb_email_logs: int) -> User:
+    user = User.create(email="retention-benchmark@mailbox.test", name="benchmark")
+    Session.flush()
+    alias = Alias.create_new_random(user)
+    Session.flush()
+    contact = Contact.create(
+        user_id=user.id,
+        alias_id=alias.id,
+        website_email="contact@example.com",
+        reply_email="retention-benchmark@sl.test",
+        flush=True,
+    )
+    Session.execute(
+        text(_SEED_QUERY),
+        {
+            "nb": nb_email_logs,
+            "nb_old": nb_email_logs * 9 // 10,
+            "user_id": user.id,
+            "contact_id": contact.id,
+            "alias_id": alias.id,
+        },
+    )
+    Session.commit()
+    return user
+
+
+def run(nb_email_logs: int, batch_size: int, max_rows_per_second: int):
+    start = time.time()
+    user = seed(nb_email_logs)
+    print(f"seeded {nb_email_logs} email logs in {time.time() - start:.1f}s")
+
+    # the single DELETE is rolled back to keep the rows for the retention policy
+    start = time.time()
+    nb_deleted = Session.execute(
+        text(
+            "DELETE FROM email_log WHERE created_at < now() AT TIME ZONE 'utc' - interval '14 days'"
+        )
+    ).rowcount
+    elapsed = time.time() - start
+    Session.rollback()
+    print(
+        f"single DELETE: {nb_deleted} rows in one transaction of {elapsed:.1f}s, "
+        f"{nb_deleted / elapsed if elapsed else 0:.0f} rows/s"
+    )
+
+    RetentionCheckpoint.filter_by(name="email_log").delete()
+    Session.commit()
+    report = apply_retention_policy(
+        get_retention_policy("email_log"),
+        batch_size=batch_size,
+        throttle=Throttle(max_rows_per_second=max_rows_per_second),
+    )
+    print(
+        f"retention policy: {report}, "
+        f"{report.nb_deleted / report.duration if report.duration else 0:.0f} rows/s"
+    )
+
+    User.filter_by(id=user.id).delete()
+    Session.commit()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nb-email-logs", type=int, default=2_000_000)
+    parser.add_argument("--batch-size", type=int, default=5_000)
+    parser.add_argument("--max-rows-per-second", type=int, default=0)
+    args = parser.parse_args()
+    LOG.setLevel("WARNING")
+
+    run(args.nb_email_logs, args.batch_size, args.max_rows_per_second)
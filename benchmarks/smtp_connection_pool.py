@@ -0,0 +1,82 @@
+"""
+Send emails to a local aiosmtpd sink with and without the Postfix connection pool and report messages/sec.
+
+    python -m benchmarks.smtp_connection_pool --nb-emails 1000 --threads 4
+"""
+import argparse
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.message import Message
+
+from aiosmtpd.controller import Controller
+
+from app import config
+from app.mail_sender import MailSender, SendRequest
+from app.log import LOG
+from benchmarks.utils import print_latencies
+
+
+class SinkHandler:
+    async def handle_DATA(self, server, session, envelope) -> str:
+        return "250 Message accepted for delivery"
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def send(sender: MailSender, nb_emails: int) -> [float]:
+    latencies = []
+    for i in range(nb_emails):
+        msg = Message()
+        msg["From"] = "from@benchmark.test"
+        msg["To"] = "to@benchmark.test"
+        msg["Subject"] = f"benchmark {i}"
+        msg.set_payload("hello world " * 50)
+
+        start = time.time()
+        sender.send(SendRequest("from@benchmark.test", "to@benchmark.test", msg), 0)
+        latencies.append(time.time() - start)
+    return latencies
+
+
+def run(pool_size: int, nb_emails: int, nb_threads: int):
+    sender = MailSender()
+    if pool_size:
+        sender.enable_connection_pool(pool_size)
+
+    latencies = []
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=nb_threads) as executor:
+        for res in executor.map(
+            send, [sender] * nb_threads, [nb_emails // nb_threads] * nb_threads
+        ):
+            latencies += res
+    elapsed = time.time() - start
+
+    sender.disable_connection_pool()
+    print_latencies(f"pool size {pool_size}", latencies, elapsed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nb-emails", type=int, default=1000)
+    parser.add_argument("--threads", type=int, default=4)
+    args = parser.parse_args()
+    LOG.setLevel("WARNING")
+
+    controller = Controller(SinkHandler(), hostname="localhost", port=free_port())
+    controller.start()
+
+    config.NOT_SEND_EMAIL = False
+    config.POSTFIX_SERVER = "localhost"
+    config.POSTFIX_PORT = controller.port
+    config.POSTFIX_SUBMISSION_TLS = False
+
+    for size in [0, args.threads]:
+        run(size, args.nb_emails, args.threads)
+
+    controller.stop()
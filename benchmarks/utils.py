@@ -0,0 +1,36 @@
+import statistics
+import time
+from contextlib import contextmanager
+from typing import List
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def print_latencies(name: str, latencies: List[float], elapsed: float):
+    """latencies and elapsed are in seconds"""
+    print(
+        f"{name}: {len(latencies)} ops in {elapsed:.2f}s, "
+        f"{len(latencies) / elapsed if elapsed else 0:.1f} ops/s, "
+        f"mean {statistics.mean(latencies) * 1000 if latencies else 0:.2f}ms, "
+        f"p50 {percentile(latencies, 50) * 1000:.2f}ms, "
+        f"p95 {percentile(latencies, 95) * 1000:.2f}ms, "
+        f"p99 {percentile(latencies, 99) * 1000:.2f}ms"
+    )
+
+
+@contextmanager
+def timed(name: str, nb_ops: int):
+    start = time.time()
+    yield
+    elapsed = time.time() - start
+    print(
+        f"{name}: {nb_ops} ops in {elapsed:.3f}s, "
+        f"{nb_ops / elapsed if elapsed else 0:.1f} ops/s, "
+        f"{elapsed / nb_ops * 1_000_000 if nb_ops else 0:.1f}us/op"
+    )
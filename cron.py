@@ -1,17 +1,23 @@
 import argparse
 import asyncio
-import urllib.parse
 from typing import List, Tuple
 
 import arrow
 import requests
-from sqlalchemy import func, desc, or_
+from sqlalchemy import func, desc
 from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.orm import joinedload
 from sqlalchemy.orm.exc import ObjectDeletedError
 from sqlalchemy.sql import Insert
 
 from app import s3
+from app.alias_activity import rebuild_alias_activity, check_alias_activity
+from app.hibp_scanner import HibpScanner, HIBP_API_URL
+from app.partitioning import (
+    create_partitions,
+    partition_log_tables,
+    unpartition_log_tables,
+)
 from app.alias_utils import nb_email_log_for_mailbox
 from app.api.views.apple import verify_receipt
 from app.config import (
@@ -26,7 +32,7 @@ from app.config import (
     MONITORING_EMAIL,
 )
 from app.db import Session
-from app.dns_utils import get_mx_domains, is_mx_equivalent
+from app.dns_utils import get_mx_domains, get_mx_domains_many, is_mx_equivalent
 from app.email_utils import (
     send_email,
     send_trial_end_soon_email,
@@ -38,6 +44,7 @@ from app.email_utils import (
     get_email_domain_part,
 )
 from app.log import LOG
+from app.mail_sender import mail_sender
 from app.models import (
     Subscription,
     User,
@@ -49,10 +56,8 @@ from app.models import (
     RefusedEmail,
     AppleSubscription,
     Mailbox,
-    Monitoring,
     Contact,
     CoinbaseSubscription,
-    TransactionalEmail,
     Bounce,
     Metric2,
     SLDomain,
@@ -64,6 +69,11 @@ from app.models import (
     DeletedDirectory,
     DeletedSubdomain,
 )
+from app.retention import (
+    apply_retention_policies,
+    apply_retention_policy,
+    get_retention_policy,
+)
 from app.utils import sanitize_email
 from server import create_light_app
 
@@ -86,25 +96,10 @@ def notify_trial_end():
 def delete_logs():
     """delete everything that are considered logs"""
     delete_refused_emails()
-    delete_old_monitoring()
-
-    for t in TransactionalEmail.filter(
-        TransactionalEmail.created_at < arrow.now().shift(days=-7)
-    ):
-        TransactionalEmail.delete(t.id)
-
-    for b in Bounce.filter(Bounce.created_at < arrow.now().shift(days=-7)):
-        Bounce.delete(b.id)
-
-    Session.commit()
-
-    LOG.d("Delete EmailLog older than 2 weeks")
-
-    max_dt = arrow.now().shift(weeks=-2)
-    nb_deleted = EmailLog.filter(EmailLog.created_at < max_dt).delete()
-    Session.commit()
 
-    LOG.i("Delete %s email logs", nb_deleted)
+    # monitoring, transactional_email, bounce and email_log, by batch
+    for report in apply_retention_policies():
+        LOG.i("Retention %s", report)
 
 
 def delete_refused_emails():
@@ -270,6 +265,32 @@ def compute_metric2() -> Metric2:
         if user.is_paid():
             nb_referred_user_paid += 1
 
+    # one scan of the email logs of the last 24h,
+    # i.e. of the last 2 partitions when email_log is partitioned
+    email_log_stats = (
+        Session.query(
+            func.count(EmailLog.id)
+            .filter(
+                EmailLog.bounced.is_(False),
+                EmailLog.is_spam.is_(False),
+                EmailLog.is_reply.is_(False),
+                EmailLog.blocked.is_(False),
+            )
+            .label("nb_forward"),
+            func.count(EmailLog.id)
+            .filter(EmailLog.bounced.is_(True))
+            .label("nb_bounced"),
+            func.count(EmailLog.id)
+            .filter(EmailLog.is_reply.is_(True))
+            .label("nb_reply"),
+            func.count(EmailLog.id)
+            .filter(EmailLog.blocked.is_(True))
+            .label("nb_block"),
+        )
+        .filter(EmailLog.created_at > _24h_ago)
+        .one()
+    )
+
     return Metric2.create(
         date=now,
         # user stats
@@ -294,19 +315,11 @@ def compute_metric2() -> Metric2:
         nb_referred_user_paid=nb_referred_user_paid,
         nb_alias=Alias.count(),
         # email log stats
-        nb_forward_last_24h=EmailLog.filter(EmailLog.created_at > _24h_ago)
-        .filter_by(bounced=False, is_spam=False, is_reply=False, blocked=False)
-        .count(),
-        nb_bounced_last_24h=EmailLog.filter(EmailLog.created_at > _24h_ago)
-        .filter_by(bounced=True)
-        .count(),
+        nb_forward_last_24h=email_log_stats.nb_forward,
+        nb_bounced_last_24h=email_log_stats.nb_bounced,
         nb_total_bounced_last_24h=Bounce.filter(Bounce.created_at > _24h_ago).count(),
-        nb_reply_last_24h=EmailLog.filter(EmailLog.created_at > _24h_ago)
-        .filter_by(is_reply=True)
-        .count(),
-        nb_block_last_24h=EmailLog.filter(EmailLog.created_at > _24h_ago)
-        .filter_by(blocked=True)
-        .count(),
+        nb_reply_last_24h=email_log_stats.nb_reply,
+        nb_block_last_24h=email_log_stats.nb_block,
         # other stats
         nb_verified_custom_domain=CustomDomain.filter_by(verified=True).count(),
         nb_subdomain=CustomDomain.filter_by(is_sl_subdomain=True).count(),
@@ -788,15 +801,23 @@ def check_mailbox_valid_domain():
 def check_custom_domain():
     LOG.d("Check verified domain for DNS issues")
 
-    for custom_domain in CustomDomain.filter_by(verified=True):  # type: CustomDomain
+    custom_domains = CustomDomain.filter_by(verified=True).all()
+    # the MX records of all domains are resolved concurrently
+    mx_domains_by_domain = get_mx_domains_many(cd.domain for cd in custom_domains)
+
+    for custom_domain in custom_domains:  # type: CustomDomain
         try:
-            check_single_custom_domain(custom_domain)
+            check_single_custom_domain(
+                custom_domain, mx_domains_by_domain[custom_domain.domain]
+            )
         except ObjectDeletedError:
             LOG.i("custom domain has been deleted")
 
 
-def check_single_custom_domain(custom_domain):
-    mx_domains = get_mx_domains(custom_domain.domain)
+def check_single_custom_domain(custom_domain, mx_domains=None):
+    """mx_domains: the MX records of the domain if they are already resolved"""
+    if mx_domains is None:
+        mx_domains = get_mx_domains(custom_domain.domain)
     if not is_mx_equivalent(mx_domains, EMAIL_SERVERS_WITH_PRIORITY):
         user = custom_domain.user
         LOG.w(
@@ -834,78 +855,35 @@ def check_single_custom_domain(custom_domain):
     Session.commit()
 
 
-def delete_old_monitoring():
-    """
-    Delete old monitoring records
-    """
-    max_time = arrow.now().shift(days=-30)
-    nb_row = Monitoring.filter(Monitoring.created_at < max_time).delete()
-    Session.commit()
-    LOG.d("delete monitoring records older than %s, nb row %s", max_time, nb_row)
+def replay_unsent_emails():
+    nb_sent, nb_failed = mail_sender.replay_unsent_emails()
+    LOG.i("Replay unsent emails: %s sent, %s failed", nb_sent, nb_failed)
 
 
-async def _hibp_check(api_key, queue):
-    """
-    Uses a single API key to check the queue as fast as possible.
+def create_log_partitions():
+    """create the partitions of the next days of the partitioned log tables"""
+    created = create_partitions()
+    LOG.i("%s partitions created: %s", len(created), created)
 
-    This function to be ran simultaneously (multiple _hibp_check functions with different keys on the same queue) to make maximum use of multiple API keys.
-    """
-    while True:
-        try:
-            alias_id = queue.get_nowait()
-        except asyncio.QueueEmpty:
-            return
-
-        alias = Alias.get(alias_id)
-        # an alias can be deleted in the meantime
-        if not alias:
-            return
-
-        LOG.d("Checking HIBP for %s", alias)
-
-        request_headers = {
-            "user-agent": "SimpleLogin",
-            "hibp-api-key": api_key,
-        }
-        r = requests.get(
-            f"https://haveibeenpwned.com/api/v3/breachedaccount/{urllib.parse.quote(alias.email)}",
-            headers=request_headers,
-        )
 
-        if r.status_code == 200:
-            # Breaches found
-            alias.hibp_breaches = [
-                Hibp.get_by(name=entry["Name"]) for entry in r.json()
-            ]
-            if len(alias.hibp_breaches) > 0:
-                LOG.w("%s appears in HIBP breaches %s", alias, alias.hibp_breaches)
-        elif r.status_code == 404:
-            # No breaches found
-            alias.hibp_breaches = []
-        elif r.status_code == 429:
-            # rate limited
-            LOG.w("HIBP rate limited, check alias %s in the next run", alias)
-            await asyncio.sleep(1.6)
-            return
-        elif r.status_code > 500:
-            LOG.w("HIBP server 5** error %s", r.status_code)
-            return
-        else:
-            LOG.error(
-                "An error occured while checking alias %s: %s - %s",
-                alias,
-                r.status_code,
-                r.text,
-            )
-            return
+def partition_tables():
+    """partition the log tables, a one-off opt-in job not scheduled in crontab.yml"""
+    partitioned = partition_log_tables()
+    LOG.i("%s tables partitioned: %s", len(partitioned), partitioned)
 
-        alias.hibp_last_check = arrow.utcnow()
-        Session.add(alias)
-        Session.commit()
 
-        LOG.d("Updated breaches info for %s", alias)
+def unpartition_tables():
+    """turn the partitioned log tables back into regular tables"""
+    unpartitioned = unpartition_log_tables()
+    LOG.i("%s tables unpartitioned: %s", len(unpartitioned), unpartitioned)
+
 
-        await asyncio.sleep(1.6)
+def delete_old_monitoring():
+    """
+    Delete old monitoring records
+    """
+    report = apply_retention_policy(get_retention_policy("monitoring"))
+    LOG.d("delete monitoring records older than 30 days: %s", report)
 
 
 async def check_hibp():
@@ -919,7 +897,7 @@ async def check_hibp():
         return
 
     LOG.d("Updating list of known breaches")
-    r = requests.get("https://haveibeenpwned.com/api/v3/breaches")
+    r = requests.get(f"{HIBP_API_URL}/breaches")
     for entry in r.json():
         hibp_entry = Hibp.get_or_create(name=entry["Name"])
         hibp_entry.date = arrow.get(entry["BreachDate"])
@@ -928,39 +906,10 @@ async def check_hibp():
     Session.commit()
     LOG.d("Updated list of known breaches")
 
-    LOG.d("Preparing list of aliases to check")
-    queue = asyncio.Queue()
     max_date = arrow.now().shift(days=-HIBP_SCAN_INTERVAL_DAYS)
-    for alias in (
-        Alias.filter(
-            or_(Alias.hibp_last_check.is_(None), Alias.hibp_last_check < max_date)
-        )
-        .filter(Alias.enabled)
-        .order_by(Alias.hibp_last_check.asc())
-        .all()
-    ):
-        await queue.put(alias.id)
-
-    LOG.d("Need to check about %s aliases", queue.qsize())
-
-    # Start one checking process per API key
-    # Each checking process will take one alias from the queue, get the info
-    # and then sleep for 1.5 seconds (due to HIBP API request limits)
-    checkers = []
-    for i in range(len(HIBP_API_KEYS)):
-        checker = asyncio.create_task(
-            _hibp_check(
-                HIBP_API_KEYS[i],
-                queue,
-            )
-        )
-        checkers.append(checker)
-
-    # Wait until all checking processes are done
-    for checker in checkers:
-        await checker
+    report = await HibpScanner(HIBP_API_KEYS).scan(max_date)
 
-    LOG.d("Done checking HIBP API for aliases in breaches")
+    LOG.d("Done checking HIBP API for aliases in breaches: %s", report)
 
 
 def notify_hibp():
@@ -1035,6 +984,12 @@ if __name__ == "__main__":
             "check_custom_domain",
             "check_hibp",
             "notify_hibp",
+            "replay_unsent_emails",
+            "rebuild_alias_activity",
+            "check_alias_activity",
+            "create_partitions",
+            "partition_log_tables",
+            "unpartition_log_tables",
         ],
     )
     args = parser.parse_args()
@@ -1073,3 +1028,21 @@ if __name__ == "__main__":
         elif args.job == "notify_hibp":
             LOG.d("Notify users about HIBP breaches")
             notify_hibp()
+        elif args.job == "replay_unsent_emails":
+            LOG.d("Replay emails saved to SAVE_UNSENT_DIR")
+            replay_unsent_emails()
+        elif args.job == "rebuild_alias_activity":
+            LOG.d("Rebuild alias activity from email logs")
+            rebuild_alias_activity()
+        elif args.job == "check_alias_activity":
+            LOG.d("Check alias activity against email logs")
+            check_alias_activity(fix=True)
+        elif args.job == "create_partitions":
+            LOG.d("Create the future partitions of the log tables")
+            create_log_partitions()
+        elif args.job == "partition_log_tables":
+            LOG.d("Partition the log tables")
+            partition_tables()
+        elif args.job == "unpartition_log_tables":
+            LOG.d("Unpartition the log tables")
+            unpartition_tables()
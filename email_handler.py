@@ -31,9 +31,11 @@ It should contain the following info:
 
 """
 import argparse
-import email
+import asyncio
 import time
 import uuid
+from contextvars import ContextVar
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
 from email import encoders
 from email.encoders import encode_noop
 from email.message import Message
@@ -42,7 +44,7 @@ from email.mime.multipart import MIMEMultipart
 from email.utils import formataddr, make_msgid, formatdate, getaddresses
 from io import BytesIO
 from smtplib import SMTPRecipientsRefused, SMTPServerDisconnected
-from typing import List, Tuple, Optional
+from typing import Callable, List, Tuple, Optional
 
 import newrelic.agent
 from aiosmtpd.controller import Controller
@@ -83,10 +85,11 @@ from app.config import (
     ALERT_FROM_ADDRESS_IS_REVERSE_ALIAS,
     ALERT_TO_NOREPLY,
 )
-from app.db import Session
+from app.db import Session, record_pool_metrics, unit_of_work
 from app.email import status, headers
 from app.email.rate_limit import rate_limited
 from app.email.spam import get_spam_score
+from app.email_templates import precompile_templates
 from app.email_utils import (
     send_email,
     add_dkim_signature,
@@ -105,7 +108,7 @@ from app.email_utils import (
     should_add_dkim_signature,
     add_header,
     get_header_unicode,
-    generate_reply_email,
+    random_reply_email,
     is_reverse_alias,
     normalize_reply_email,
     is_valid_email,
@@ -123,6 +126,7 @@ from app.email_utils import (
     get_verp_info_from_email,
     generate_verp_email,
 )
+from app.existence_index import existence_index
 from app.errors import (
     NonReverseAliasInReplyPhase,
     VERPTransactional,
@@ -143,8 +147,14 @@ from app.handler.provider_complaint import (
     handle_yahoo_complaint,
 )
 from app.log import LOG, set_message_id
-from app.mail_sender import sl_sendmail
-from app.message_utils import message_to_bytes
+from app.domain_registry import domain_registry
+from app.lookup_cache import lookup_cache, invalidate_lookup_cache
+from app.mail_sender import sl_sendmail, mail_sender
+from app.message_utils import (
+    message_to_bytes,
+    parse_message,
+    serialization_stats,
+)
 from app.models import (
     Alias,
     Contact,
@@ -165,6 +175,9 @@ from app.utils import sanitize_email
 from init_app import load_pgp_public_keys
 from server import create_light_app
 
+# a random reverse alias is very unlikely to be already used
+_MAX_REPLY_EMAIL_ATTEMPTS = 5
+
 
 def get_or_create_contact(
     from_header: str, mail_from: str, alias: Alias, msg: Message
@@ -205,57 +218,32 @@ def get_or_create_contact(
 
     contact = Contact.get_by(alias_id=alias.id, website_email=contact_email)
     if contact:
-        if contact.name != contact_name:
-            LOG.d(
-                "Update contact %s name %s to %s",
-                contact,
-                contact.name,
-                contact_name,
-            )
-            contact.name = contact_name
-            Session.commit()
-
         # contact created in the past does not have mail_from and from_header field
-        if not contact.mail_from and mail_from:
-            LOG.d(
-                "Set contact mail_from %s: %s to %s",
-                contact,
-                contact.mail_from,
-                mail_from,
-            )
-            contact.mail_from = mail_from
-            Session.commit()
-    else:
-
-        try:
-            contact = Contact.create(
-                user_id=alias.user_id,
-                alias_id=alias.id,
-                website_email=contact_email,
-                name=contact_name,
-                mail_from=mail_from,
-                reply_email=generate_reply_email(contact_email, alias.user)
-                if is_valid_email(contact_email)
-                else NOREPLY,
-                automatic_created=True,
-            )
-            if not contact_email:
-                LOG.d("Create a contact with invalid email for %s", alias)
-                contact.invalid_email = True
+        if contact.name == contact_name and (contact.mail_from or not mail_from):
+            return contact
 
-            LOG.d(
-                "create contact %s for %s, reverse alias:%s",
-                contact_email,
-                alias,
-                contact.reply_email,
-            )
-
-            Session.commit()
-        except IntegrityError:
-            LOG.w("Contact %s %s already exist", alias, contact_email)
-            Session.rollback()
-            contact = Contact.get_by(alias_id=alias.id, website_email=contact_email)
+        LOG.d(
+            "Update contact %s name %s to %s, mail_from %s to %s",
+            contact,
+            contact.name,
+            contact_name,
+            contact.mail_from,
+            mail_from,
+        )
+    else:
+        LOG.d("create contact %s for %s", contact_email, alias)
+        if not contact_email:
+            LOG.d("Create a contact with invalid email for %s", alias)
 
+    # also updates the contact when it's created in the meantime
+    contact = upsert_contact(
+        alias,
+        contact_email,
+        invalid_email=not is_valid_email(contact_email),
+        name=contact_name,
+        mail_from=mail_from,
+    )
+    LOG.d("contact %s reverse alias:%s", contact, contact.reply_email)
     return contact
 
 
@@ -281,30 +269,59 @@ def get_or_create_reply_to_contact(
     contact = Contact.get_by(alias_id=alias.id, website_email=contact_address)
     if contact:
         return contact
-    else:
-        LOG.d(
-            "create contact %s for alias %s via reply-to header %s",
-            contact_address,
-            alias,
-            reply_to_header,
+
+    LOG.d(
+        "create contact %s for alias %s via reply-to header %s",
+        contact_address,
+        alias,
+        reply_to_header,
+    )
+    # the contact created in the meantime is returned unchanged
+    return upsert_contact(alias, contact_address, update_name=False, name=contact_name)
+
+
+def upsert_contact(
+    alias: Alias,
+    website_email: str,
+    update_name: bool = True,
+    invalid_email: bool = False,
+    **kw,
+) -> Contact:
+    """
+    Create the contact automatically or update the existing one, cf Contact.upsert().
+    The new reverse alias isn't looked up beforehand, another one is tried if it's already used.
+    """
+    for _ in range(_MAX_REPLY_EMAIL_ATTEMPTS):
+        # a contact with an invalid email can't be replied to
+        reply_email = (
+            NOREPLY if invalid_email else random_reply_email(website_email, alias.user)
         )
 
         try:
-            contact = Contact.create(
-                user_id=alias.user_id,
+            contact, _ = Contact.upsert(
                 alias_id=alias.id,
-                website_email=contact_address,
-                name=contact_name,
-                reply_email=generate_reply_email(contact_address, alias.user),
+                website_email=website_email,
+                reply_email=reply_email,
+                update_name=update_name,
+                user_id=alias.user_id,
+                invalid_email=invalid_email,
                 automatic_created=True,
+                **kw,
             )
-            Session.commit()
-        except IntegrityError:
-            LOG.w("Contact %s %s already exist", alias, contact_address)
+        except IntegrityError as e:
             Session.rollback()
-            contact = Contact.get_by(alias_id=alias.id, website_email=contact_address)
+            constraint_name = getattr(e.orig.diag, "constraint_name", None)
+            if constraint_name == "uq_contact_reply_email":
+                LOG.w("Reverse alias %s already used, try another one", reply_email)
+                continue
 
-    return contact
+            LOG.w("Cannot create contact %s %s", alias, website_email, exc_info=True)
+            return Contact.get_by(alias_id=alias.id, website_email=website_email)
+
+        Session.commit()
+        return contact
+
+    raise Exception("Cannot generate reply email")
 
 
 def replace_header_when_forward(msg: Message, alias: Alias, header: str):
@@ -338,40 +355,20 @@ def replace_header_when_forward(msg: Message, alias: Alias, header: str):
             continue
 
         contact = Contact.get_by(alias_id=alias.id, website_email=contact_email)
-        if contact:
-            # update the contact name if needed
-            if contact.name != full_address.display_name:
-                LOG.d(
-                    "Update contact %s name %s to %s",
-                    contact,
-                    contact.name,
-                    full_address.display_name,
-                )
-                contact.name = full_address.display_name
-                Session.commit()
-        else:
+        # update the contact name if needed
+        if not contact or contact.name != full_address.display_name:
             LOG.d(
-                "create contact for alias %s and email %s, header %s",
+                "create or update contact for alias %s and email %s, header %s",
                 alias,
                 contact_email,
                 header,
             )
-
-            try:
-                contact = Contact.create(
-                    user_id=alias.user_id,
-                    alias_id=alias.id,
-                    website_email=contact_email,
-                    name=full_address.display_name,
-                    reply_email=generate_reply_email(contact_email, alias.user),
-                    is_cc=header.lower() == "cc",
-                    automatic_created=True,
-                )
-                Session.commit()
-            except IntegrityError:
-                LOG.w("Contact %s %s already exist", alias, contact_email)
-                Session.rollback()
-                contact = Contact.get_by(alias_id=alias.id, website_email=contact_email)
+            contact = upsert_contact(
+                alias,
+                contact_email,
+                name=full_address.display_name,
+                is_cc=header.lower() == "cc",
+            )
 
         new_addrs.append(contact.new_addr())
 
@@ -582,6 +579,51 @@ def handle_email_sent_to_ourself(alias, from_addr: str, msg: Message, user):
     )
 
 
+# With FORWARD_SINGLE_TRANSACTION, the emails to send for the email being handled.
+# They are sent once its writes are committed
+_sends_after_commit: ContextVar[
+    Optional[List[Callable[[], Tuple[bool, str]]]]
+] = ContextVar("sends_after_commit", default=None)
+# the status of an email that is sent after the commit
+_SEND_AFTER_COMMIT = "send after commit"
+
+
+def send_after_commit(send: Callable[[], Tuple[bool, str]]) -> Tuple[bool, str]:
+    """call send, or once the writes of the email are committed in a single transaction"""
+    sends = _sends_after_commit.get()
+    if sends is None:
+        return send()
+
+    sends.append(send)
+    return True, _SEND_AFTER_COMMIT
+
+
+def in_single_transaction(
+    handle_rcpts: Callable[[], List[Tuple[bool, str]]]
+) -> List[Tuple[bool, str]]:
+    """
+    With FORWARD_SINGLE_TRANSACTION, the writes of handle_rcpts for all the recipients are committed
+    in one transaction, its commits become savepoints. The emails are sent after this commit,
+    so a rollback never leaves a sent email without its email log.
+    """
+    if not config.FORWARD_SINGLE_TRANSACTION:
+        return handle_rcpts()
+
+    sends = []
+    token = _sends_after_commit.set(sends)
+    try:
+        with unit_of_work():
+            res = handle_rcpts()
+    finally:
+        _sends_after_commit.reset(token)
+
+    sent = iter([send() for send in sends])
+    return [
+        next(sent) if smtp_status == _SEND_AFTER_COMMIT else (is_success, smtp_status)
+        for is_success, smtp_status in res
+    ]
+
+
 def handle_forward(envelope, msg: Message, rcpt_to: str) -> List[Tuple[bool, str]]:
     """return an array of SMTP status (is_success, smtp_status)
     is_success indicates whether an email has been delivered and
@@ -589,7 +631,9 @@ def handle_forward(envelope, msg: Message, rcpt_to: str) -> List[Tuple[bool, str
     """
     alias_address = rcpt_to  # alias@SL
 
-    alias = Alias.get_by(email=alias_address)
+    alias = None
+    if existence_index.may_be_alias(alias_address):
+        alias = Alias.get_by(email=alias_address)
     if not alias:
         LOG.d(
             "alias %s not exist. Try to see if it can be created on the fly",
@@ -627,6 +671,7 @@ def handle_forward(envelope, msg: Message, rcpt_to: str) -> List[Tuple[bool, str
         contact = get_or_create_contact(from_header, envelope.mail_from, alias, msg)
     except ObjectDeletedError:
         LOG.d("maybe alias was deleted in the meantime")
+        invalidate_lookup_cache()
         alias = Alias.get_by(email=alias_address)
         if not alias:
             LOG.i("Alias %s was deleted in the meantime", alias_address)
@@ -913,34 +958,39 @@ def forward_email_to_mailbox(
         envelope.rcpt_options,
     )
 
-    try:
-        sl_sendmail(
-            # use a different envelope sender for each forward (aka VERP)
-            generate_verp_email(VerpType.bounce_forward, email_log.id),
-            mailbox.email,
-            msg,
-            envelope.mail_options,
-            envelope.rcpt_options,
-            is_forward=True,
-        )
-    except (SMTPServerDisconnected, SMTPRecipientsRefused, TimeoutError):
-        LOG.w(
-            "Postfix error during forward phase %s -> %s -> %s",
-            contact,
-            alias,
-            mailbox,
-            exc_info=True,
-        )
-        if should_ignore_bounce(envelope.mail_from):
-            return True, status.E207
-        else:
-            EmailLog.delete(email_log.id, commit=True)
-            # so Postfix can retry
-            return False, status.E407
-    else:
-        Session.commit()
+    email_log_id = email_log.id
+    Session.commit()
+
+    def send() -> Tuple[bool, str]:
+        try:
+            sl_sendmail(
+                # use a different envelope sender for each forward (aka VERP)
+                generate_verp_email(VerpType.bounce_forward, email_log_id),
+                mailbox.email,
+                msg,
+                envelope.mail_options,
+                envelope.rcpt_options,
+                is_forward=True,
+            )
+        except (SMTPServerDisconnected, SMTPRecipientsRefused, TimeoutError):
+            LOG.w(
+                "Postfix error during forward phase %s -> %s -> %s",
+                contact,
+                alias,
+                mailbox,
+                exc_info=True,
+            )
+            if should_ignore_bounce(envelope.mail_from):
+                return True, status.E207
+            else:
+                EmailLog.delete(email_log_id, commit=True)
+                # so Postfix can retry
+                return False, status.E407
+
         return True, status.E200
 
+    return send_after_commit(send)
+
 
 def replace_sl_message_id_by_original_message_id(msg):
     # Replace SL Message-ID by original one in In-Reply-To header
@@ -1207,39 +1257,44 @@ def handle_reply(envelope, msg: Message, rcpt_to: str) -> (bool, str):
     if should_add_dkim_signature(alias_domain):
         add_dkim_signature(msg, alias_domain)
 
-    try:
-        sl_sendmail(
-            generate_verp_email(VerpType.bounce_reply, email_log.id, alias_domain),
-            contact.website_email,
-            msg,
-            envelope.mail_options,
-            envelope.rcpt_options,
-            is_forward=False,
-        )
-    except Exception:
-        LOG.w("Cannot send email from %s to %s", alias, contact)
-        EmailLog.delete(email_log.id, commit=True)
-        send_email(
-            mailbox.email,
-            f"Email cannot be sent to {contact.email} from {alias.email}",
-            render(
-                "transactional/reply-error.txt.jinja2",
-                user=user,
-                alias=alias,
-                contact=contact,
-                contact_domain=get_email_domain_part(contact.email),
-            ),
-            render(
-                "transactional/reply-error.html",
-                user=user,
-                alias=alias,
-                contact=contact,
-                contact_domain=get_email_domain_part(contact.email),
-            ),
-        )
+    email_log_id = email_log.id
 
-    # return 250 even if error as user is already informed of the incident and can retry sending the email
-    return True, status.E200
+    def send() -> Tuple[bool, str]:
+        try:
+            sl_sendmail(
+                generate_verp_email(VerpType.bounce_reply, email_log_id, alias_domain),
+                contact.website_email,
+                msg,
+                envelope.mail_options,
+                envelope.rcpt_options,
+                is_forward=False,
+            )
+        except Exception:
+            LOG.w("Cannot send email from %s to %s", alias, contact)
+            EmailLog.delete(email_log_id, commit=True)
+            send_email(
+                mailbox.email,
+                f"Email cannot be sent to {contact.email} from {alias.email}",
+                render(
+                    "transactional/reply-error.txt.jinja2",
+                    user=user,
+                    alias=alias,
+                    contact=contact,
+                    contact_domain=get_email_domain_part(contact.email),
+                ),
+                render(
+                    "transactional/reply-error.html",
+                    user=user,
+                    alias=alias,
+                    contact=contact,
+                    contact_domain=get_email_domain_part(contact.email),
+                ),
+            )
+
+        # return 250 even if error as user is already informed of the incident and can retry sending the email
+        return True, status.E200
+
+    return send_after_commit(send)
 
 
 def replace_original_message_id(alias: Alias, email_log: EmailLog, msg: Message):
@@ -1938,8 +1993,9 @@ def handle_bounce(envelope, email_log: EmailLog, msg: Message) -> str:
             # each element is a couple of whether the delivery is successful and the smtp status
             res: [(bool, str)] = []
 
-            for is_delivered, smtp_status in handle_forward(envelope, msg, alias.email):
-                res.append((is_delivered, smtp_status))
+            res = in_single_transaction(
+                lambda: handle_forward(envelope, msg, alias.email)
+            )
 
             for (is_success, smtp_status) in res:
                 # Consider all deliveries successful if 1 delivery is successful
@@ -1981,6 +2037,48 @@ def send_no_reply_response(mail_from: str, msg: Message):
     )
 
 
+def handle_rcpt_tos(
+    envelope: Envelope, msg: Message, mail_from: str, rcpt_tos: List[str]
+) -> List[Tuple[bool, str]]:
+    """the delivery results of all the recipients, couples of (is_success, smtp_status)"""
+    res: [(bool, str)] = []
+
+    nb_rcpt_tos = len(rcpt_tos)
+    for rcpt_index, rcpt_to in enumerate(rcpt_tos):
+        if rcpt_to in config.NOREPLIES:
+            LOG.i("email sent to {} address from {}".format(NOREPLY, mail_from))
+            send_no_reply_response(mail_from, msg)
+            return [(True, status.E200)]
+
+        # create a copy of msg for each recipient except the last one
+        if rcpt_index < nb_rcpt_tos - 1:
+            LOG.d("copy message for rcpt %s", rcpt_to)
+            copy_msg = copy(msg)
+        else:
+            copy_msg = msg
+
+        # Reply case: the recipient is a reverse alias. Used to start with "reply+" or "ra+"
+        if is_reverse_alias(rcpt_to):
+            LOG.d(
+                "Reply phase %s(%s) -> %s", mail_from, copy_msg[headers.FROM], rcpt_to
+            )
+            is_delivered, smtp_status = handle_reply(envelope, copy_msg, rcpt_to)
+            res.append((is_delivered, smtp_status))
+        else:  # Forward case
+            LOG.d(
+                "Forward phase %s(%s) -> %s",
+                mail_from,
+                copy_msg[headers.FROM],
+                rcpt_to,
+            )
+            for is_delivered, smtp_status in handle_forward(
+                envelope, copy_msg, rcpt_to
+            ):
+                res.append((is_delivered, smtp_status))
+
+    return res
+
+
 def handle(envelope: Envelope, msg: Message) -> str:
     """Return SMTP status"""
 
@@ -2033,7 +2131,9 @@ def handle(envelope: Envelope, msg: Message) -> str:
 
     # region mail_from or from_header is a reverse alias which should never happen
     email_sent_from_reverse_alias = False
-    contact = Contact.get_by(reply_email=mail_from)
+    contact = None
+    if existence_index.may_be_reverse_alias(mail_from):
+        contact = Contact.get_by(reply_email=mail_from)
     if contact:
         email_sent_from_reverse_alias = True
 
@@ -2044,9 +2144,10 @@ def handle(envelope: Envelope, msg: Message) -> str:
         except ValueError:
             LOG.w("cannot parse the From header %s", from_header)
         else:
-            contact = Contact.get_by(reply_email=from_header_address)
-            if contact:
-                email_sent_from_reverse_alias = True
+            if existence_index.may_be_reverse_alias(from_header_address):
+                contact = Contact.get_by(reply_email=from_header_address)
+                if contact:
+                    email_sent_from_reverse_alias = True
 
     if email_sent_from_reverse_alias:
         LOG.w(f"email sent from reverse alias {contact} {contact.alias} {contact.user}")
@@ -2182,18 +2283,6 @@ def handle(envelope: Envelope, msg: Message) -> str:
     if rate_limited(mail_from, rcpt_tos):
         LOG.w("Rate Limiting applied for mail_from:%s rcpt_tos:%s", mail_from, rcpt_tos)
 
-        # add more logging info. TODO: remove
-        if len(rcpt_tos) == 1:
-            alias = Alias.get_by(email=rcpt_tos[0])
-            if alias:
-                LOG.w(
-                    "total number email log on %s, %s is %s, %s",
-                    alias,
-                    alias.user,
-                    EmailLog.filter(EmailLog.alias_id == alias.id).count(),
-                    EmailLog.filter(EmailLog.user_id == alias.user_id).count(),
-                )
-
         if should_ignore_bounce(envelope.mail_from):
             return status.E207
         else:
@@ -2211,41 +2300,9 @@ def handle(envelope: Envelope, msg: Message) -> str:
 
     # result of all deliveries
     # each element is a couple of whether the delivery is successful and the smtp status
-    res: [(bool, str)] = []
-
-    nb_rcpt_tos = len(rcpt_tos)
-    for rcpt_index, rcpt_to in enumerate(rcpt_tos):
-        if rcpt_to in config.NOREPLIES:
-            LOG.i("email sent to {} address from {}".format(NOREPLY, mail_from))
-            send_no_reply_response(mail_from, msg)
-            return status.E200
-
-        # create a copy of msg for each recipient except the last one
-        # as copy() is a slow function
-        if rcpt_index < nb_rcpt_tos - 1:
-            LOG.d("copy message for rcpt %s", rcpt_to)
-            copy_msg = copy(msg)
-        else:
-            copy_msg = msg
-
-        # Reply case: the recipient is a reverse alias. Used to start with "reply+" or "ra+"
-        if is_reverse_alias(rcpt_to):
-            LOG.d(
-                "Reply phase %s(%s) -> %s", mail_from, copy_msg[headers.FROM], rcpt_to
-            )
-            is_delivered, smtp_status = handle_reply(envelope, copy_msg, rcpt_to)
-            res.append((is_delivered, smtp_status))
-        else:  # Forward case
-            LOG.d(
-                "Forward phase %s(%s) -> %s",
-                mail_from,
-                copy_msg[headers.FROM],
-                rcpt_to,
-            )
-            for is_delivered, smtp_status in handle_forward(
-                envelope, copy_msg, rcpt_to
-            ):
-                res.append((is_delivered, smtp_status))
+    res: [(bool, str)] = in_single_transaction(
+        lambda: handle_rcpt_tos(envelope, msg, mail_from, rcpt_tos)
+    )
 
     # to know whether both successful and unsuccessful deliveries can happen at the same time
     nb_success = len([is_success for (is_success, smtp_status) in res if is_success])
@@ -2323,53 +2380,44 @@ def handle_out_of_office_forward_phase(email_log, envelope, msg, rcpt_tos):
 
 
 class MailHandler:
+    def __init__(self, executor: Optional[Executor] = None, max_pending: int = 0):
+        """
+        executor: if set, the email pipeline runs on this pool instead of the aiosmtpd event loop
+        max_pending: nb max of emails handled or waiting for the executor, 0 means no limit.
+        Above this limit, a 4xx is returned so the sender retries later.
+        """
+        self._executor = executor
+        self._max_pending = max_pending
+        # only updated from the event loop, no need for a lock
+        self._nb_pending = 0
+
     async def handle_DATA(self, server, session, envelope: Envelope):
-        msg = email.message_from_bytes(envelope.original_content)
-        try:
-            ret = self._handle(envelope, msg)
-            return ret
+        if not self._executor:
+            return handle_envelope(envelope)
 
-        # happen if reverse-alias is used during the forward phase
-        # as in this case, a new reverse-alias needs to be created for this reverse-alias -> chaos
-        except CannotCreateContactForReverseAlias as e:
-            LOG.w(
-                "Probably due to reverse-alias used in the forward phase, "
-                "error:%s mail_from:%s, rcpt_tos:%s, header_from:%s, header_to:%s",
-                e,
-                envelope.mail_from,
-                envelope.rcpt_tos,
-                msg[headers.FROM],
-                msg[headers.TO],
-            )
-            return status.E524
-        except (VERPReply, VERPForward, VERPTransactional) as e:
+        if self._max_pending and self._nb_pending >= self._max_pending:
             LOG.w(
-                "email handling fail with error:%s "
-                "mail_from:%s, rcpt_tos:%s, header_from:%s, header_to:%s",
-                e,
-                envelope.mail_from,
-                envelope.rcpt_tos,
-                msg[headers.FROM],
-                msg[headers.TO],
-            )
-            return status.E213
-        except Exception as e:
-            LOG.e(
-                "email handling fail with error:%s "
-                "mail_from:%s, rcpt_tos:%s, header_from:%s, header_to:%s, saved to %s",
-                e,
+                "Email handler saturated with %s pending emails, mail_from:%s, rcpt_tos:%s",
+                self._nb_pending,
                 envelope.mail_from,
                 envelope.rcpt_tos,
-                msg[headers.FROM],
-                msg[headers.TO],
-                save_envelope_for_debugging(
-                    envelope, file_name_prefix=e.__class__.__name__
-                ),  # todo: remove
             )
-            return status.E404
+            newrelic.agent.record_custom_metric("Custom/email_handler_saturated", 1)
+            return status.E411
+
+        self._nb_pending += 1
+        newrelic.agent.record_custom_metric(
+            "Custom/email_handler_pending", self._nb_pending
+        )
+        try:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(self._executor, handle_envelope, envelope)
+        finally:
+            self._nb_pending -= 1
 
+    @staticmethod
     @newrelic.agent.background_task()
-    def _handle(self, envelope: Envelope, msg: Message):
+    def _handle(envelope: Envelope, msg: Message):
         start = time.time()
 
         # generate a different message_id to keep track of an email lifecycle
@@ -2386,8 +2434,23 @@ class MailHandler:
             "Custom/nb_rcpt_tos", len(envelope.rcpt_tos)
         )
 
+        # the light app context removes the scoped Session at teardown
+        # so each email, whatever the worker, uses its own session
         with create_light_app().app_context():
-            return_status = handle(envelope, msg)
+            with lookup_cache() as cache, serialization_stats() as stats:
+                return_status = handle(envelope, msg)
+            newrelic.agent.record_custom_metric("Custom/lookup_cache_hit", cache.nb_hit)
+            newrelic.agent.record_custom_metric(
+                "Custom/lookup_cache_miss", cache.nb_miss
+            )
+            newrelic.agent.record_custom_metric(
+                "Custom/nb_message_serialization", stats.nb_serialization
+            )
+            newrelic.agent.record_custom_metric(
+                "Custom/message_serialization_cache_hit", stats.nb_cache_hit
+            )
+            domain_registry.record_metrics()
+            record_pool_metrics()
             elapsed = time.time() - start
             # Only bounce messages if the return-path passes the spf check. Otherwise black-hole it.
             spamd_result = SpamdResult.extract_from_headers(msg)
@@ -2415,9 +2478,107 @@ class MailHandler:
             return return_status
 
 
+def handle_envelope(envelope: Envelope) -> str:
+    """Parse and handle an email, return the SMTP status.
+    Module level function so it can be sent to a thread or process pool"""
+    msg = parse_message(envelope.original_content, lazy=config.LAZY_EMAIL_PARSING)
+    try:
+        ret = MailHandler._handle(envelope, msg)
+        return ret
+
+    # happen if reverse-alias is used during the forward phase
+    # as in this case, a new reverse-alias needs to be created for this reverse-alias -> chaos
+    except CannotCreateContactForReverseAlias as e:
+        LOG.w(
+            "Probably due to reverse-alias used in the forward phase, "
+            "error:%s mail_from:%s, rcpt_tos:%s, header_from:%s, header_to:%s",
+            e,
+            envelope.mail_from,
+            envelope.rcpt_tos,
+            msg[headers.FROM],
+            msg[headers.TO],
+        )
+        return status.E524
+    except (VERPReply, VERPForward, VERPTransactional) as e:
+        LOG.w(
+            "email handling fail with error:%s "
+            "mail_from:%s, rcpt_tos:%s, header_from:%s, header_to:%s",
+            e,
+            envelope.mail_from,
+            envelope.rcpt_tos,
+            msg[headers.FROM],
+            msg[headers.TO],
+        )
+        return status.E213
+    except Exception as e:
+        LOG.e(
+            "email handling fail with error:%s "
+            "mail_from:%s, rcpt_tos:%s, header_from:%s, header_to:%s, saved to %s",
+            e,
+            envelope.mail_from,
+            envelope.rcpt_tos,
+            msg[headers.FROM],
+            msg[headers.TO],
+            save_envelope_for_debugging(
+                envelope, file_name_prefix=e.__class__.__name__
+            ),  # todo: remove
+        )
+        return status.E404
+
+
+def _enable_background_delivery():
+    if config.MAIL_SENDER_BACKGROUND_WORKERS > 0:
+        mail_sender.enable_background_pool(config.MAIL_SENDER_BACKGROUND_WORKERS)
+
+
+def _start_existence_index():
+    if config.ENABLE_EXISTENCE_INDEX:
+        existence_index.start()
+
+
+def _init_worker_process():
+    """Each worker process needs its own DB connections, the ones inherited from the parent can't be shared"""
+    # without closing it, that would roll back the transaction of the parent on the shared socket
+    Session.registry.clear()
+    # threads aren't inherited from the parent process
+    _enable_background_delivery()
+    _start_existence_index()
+
+
+def create_executor(
+    executor_type: str = config.EMAIL_HANDLER_EXECUTOR,
+    max_workers: int = config.EMAIL_HANDLER_WORKERS,
+) -> Optional[Executor]:
+    if executor_type == "thread":
+        return ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="email-handler"
+        )
+    elif executor_type == "process":
+        return ProcessPoolExecutor(
+            max_workers=max_workers, initializer=_init_worker_process
+        )
+    elif executor_type == "inline":
+        return None
+
+    raise ValueError(f"Unknown email handler executor {executor_type}")
+
+
 def main(port: int):
     """Use aiosmtpd Controller"""
-    controller = Controller(MailHandler(), hostname="0.0.0.0", port=port)
+    if config.TEMPLATES_PRECOMPILE:
+        # before the worker processes are forked, they inherit the compiled templates
+        precompile_templates()
+    if config.EMAIL_HANDLER_EXECUTOR != "process":
+        # each worker process enables its own background delivery and existence index
+        _enable_background_delivery()
+        _start_existence_index()
+    executor = create_executor()
+    LOG.i("Use %s email handler executor", config.EMAIL_HANDLER_EXECUTOR)
+    controller = Controller(
+        MailHandler(executor, config.EMAIL_HANDLER_MAX_PENDING),
+        hostname="0.0.0.0",
+        port=port,
+    )
 
     controller.start()
     LOG.d("Start mail controller %s %s", controller.hostname, controller.port)
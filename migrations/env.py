@@ -17,6 +17,7 @@ fileConfig(config.config_file_name)
 # for 'autogenerate' support
 # from myapp import mymodel
 # target_metadata = mymodel.Base.metadata
+import re
 import sys
 
 # hack to be able to import Base
@@ -25,8 +26,37 @@ sys.path = ['', '..'] + sys.path[1:]
 
 from app.models import Base
 from app.config import DB_URI
+from app.partitioning import PARTITION_SPECS
 target_metadata = Base.metadata
 
+PARTITIONED_TABLES = {spec.table for spec in PARTITION_SPECS}
+# e.g. email_log_p20261017, sent_alert_p202610, email_log_legacy, email_log_default
+PARTITION_NAME = re.compile(r"^(%s)_(p\d{6}|p\d{8}|legacy|default)$" % "|".join(PARTITIONED_TABLES))
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    """
+    ignore the differences with the models made by `python cron.py -j partition_log_tables`:
+    the partitions, the foreign keys to the partitioned tables and the index replacing one of them
+    """
+    if type_ == "table" and reflected and PARTITION_NAME.match(name):
+        return False
+    if (
+        type_ == "foreign_key_constraint"
+        and compare_to is None
+        and not reflected
+        and object.referred_table.name in PARTITIONED_TABLES
+    ):
+        return False
+    if (
+        type_ == "index"
+        and reflected
+        and compare_to is None
+        and name == "ix_message_id_matching_email_log_id"
+    ):
+        return False
+    return True
+
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
@@ -52,6 +82,7 @@ def run_migrations_offline():
         url=url,
         target_metadata=target_metadata,
         literal_binds=True,
+        include_object=include_object,
         dialect_opts={"paramstyle": "named"},
     )
 
@@ -74,7 +105,7 @@ def run_migrations_online():
 
     with connectable.connect() as connection:
         context.configure(
-            connection=connection, target_metadata=target_metadata
+            connection=connection, target_metadata=target_metadata, include_object=include_object
         )
 
         with context.begin_transaction():
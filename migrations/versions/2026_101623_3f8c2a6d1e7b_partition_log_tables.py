@@ -0,0 +1,26 @@
+"""Partition the log tables, now done by `python cron.py -j partition_log_tables` outside of the migrations
+
+Revision ID: 3f8c2a6d1e7b
+Revises: 9d3b7e1c4a2f
+Create Date: 2026-10-16 23:02:51.604288
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f8c2a6d1e7b'
+down_revision = '9d3b7e1c4a2f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # kept so the databases already at this revision can still upgrade,
+    # the partitioned tables are left as they are: cf app/partitioning.py
+    pass
+
+
+def downgrade():
+    pass
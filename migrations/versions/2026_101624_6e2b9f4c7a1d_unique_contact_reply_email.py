@@ -0,0 +1,72 @@
+"""Unique index on contact.reply_email, except for the contacts with an invalid email that share the NOREPLY address
+
+Revision ID: 6e2b9f4c7a1d
+Revises: 3f8c2a6d1e7b
+Create Date: 2026-10-16 23:41:09.281734
+
+The NOREPLY addresses, i.e. the NOREPLIES of the config, are passed as an argument:
+    alembic -x noreplies=noreply@example.com,noreply@other.example.com upgrade head
+"""
+from alembic import context, op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6e2b9f4c7a1d'
+down_revision = '3f8c2a6d1e7b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    conn = op.get_bind()
+    noreplies = [
+        email.strip()
+        for email in context.get_x_argument(as_dictionary=True).get('noreplies', '').split(',')
+        if email.strip()
+    ]
+    # invalid_email now means "not is_valid_email": the contacts created before with the NOREPLY
+    # reverse alias and a valid email are excluded from the index too
+    if noreplies:
+        conn.execute(
+            sa.text("""
+UPDATE contact SET invalid_email = true
+WHERE reply_email IN :noreplies AND NOT invalid_email
+""").bindparams(sa.bindparam("noreplies", expanding=True)),
+            noreplies=noreplies,
+        )
+
+    nb_duplicates = conn.execute(sa.text("""
+SELECT count(*) FROM (
+    SELECT reply_email FROM contact
+    WHERE NOT invalid_email
+    GROUP BY reply_email
+    HAVING count(*) > 1
+) AS duplicate
+""")).scalar()
+    if nb_duplicates:
+        raise Exception(
+            f"{nb_duplicates} reverse aliases are used by several contacts, "
+            "they must be changed before the unique index is created. "
+            "When they are NOREPLY addresses, pass them with -x noreplies=<email>,<email>"
+        )
+
+    # built without locking the contact table for writes
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'uq_contact_reply_email',
+            'contact',
+            ['reply_email'],
+            unique=True,
+            postgresql_where=sa.text('NOT invalid_email'),
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            'uq_contact_reply_email',
+            table_name='contact',
+            postgresql_concurrently=True,
+        )
@@ -0,0 +1,36 @@
+"""Index on alias (hibp_last_check, id) for the HIBP scan
+
+Revision ID: 8a4d2c9e5f17
+Revises: 6e2b9f4c7a1d
+Create Date: 2026-10-16 23:58:37.104925
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '8a4d2c9e5f17'
+down_revision = '6e2b9f4c7a1d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # built without locking the alias table for writes
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_alias_hibp_last_check',
+            'alias',
+            ['hibp_last_check', 'id'],
+            unique=False,
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            'ix_alias_hibp_last_check',
+            table_name='alias',
+            postgresql_concurrently=True,
+        )
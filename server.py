@@ -71,7 +71,7 @@ from app.config import (
     ZENDESK_ENABLED,
 )
 from app.dashboard.base import dashboard_bp
-from app.db import Session
+from app.db import Session, record_pool_metrics
 from app.developer.base import developer_bp
 from app.discover.base import discover_bp
 from app.email_utils import send_email, render
@@ -98,6 +98,7 @@ from app.monitor.base import monitor_bp
 from app.oauth.base import oauth_bp
 from app.onboarding.base import onboarding_bp
 from app.phone.base import phone_bp
+from app.read_replica import remember_write
 from app.utils import random_string
 
 if SENTRY_DSN:
@@ -193,9 +194,15 @@ def create_app() -> Flask:
         session.permanent = True
         app.permanent_session_lifetime = timedelta(days=7)
 
+    @app.after_request
+    def remember_db_write(response):
+        remember_write()
+        return response
+
     @app.teardown_appcontext
     def cleanup(resp_or_exc):
         Session.remove()
+        record_pool_metrics()
 
     return app
 
@@ -318,6 +318,55 @@ def test_alias_activities(flask_client):
     assert len(r.json["activities"]) < 3
 
 
+def test_alias_activities_cursor(flask_client):
+    user, api_key = get_new_user_and_api_key()
+
+    alias = Alias.create_new_random(user)
+    Session.commit()
+
+    contact = Contact.create(
+        website_email="marketing@example.com",
+        reply_email="reply@a.b",
+        alias_id=alias.id,
+        user_id=alias.user_id,
+        commit=True,
+    )
+
+    for _ in range(config.PAGE_LIMIT + 2):
+        EmailLog.create(
+            contact_id=contact.id,
+            user_id=contact.user_id,
+            alias_id=contact.alias_id,
+        )
+    Session.commit()
+
+    r = flask_client.get(
+        url_for("api.get_alias_activities", alias_id=alias.id, cursor=""),
+        headers={"Authentication": api_key.code},
+    )
+    assert r.status_code == 200
+    assert len(r.json["activities"]) == config.PAGE_LIMIT
+    assert r.json["next_cursor"]
+
+    r = flask_client.get(
+        url_for(
+            "api.get_alias_activities",
+            alias_id=alias.id,
+            cursor=r.json["next_cursor"],
+        ),
+        headers={"Authentication": api_key.code},
+    )
+    assert r.status_code == 200
+    assert len(r.json["activities"]) == 2
+    assert r.json["next_cursor"] is None
+
+    r = flask_client.get(
+        url_for("api.get_alias_activities", alias_id=alias.id, cursor="invalid"),
+        headers={"Authentication": api_key.code},
+    )
+    assert r.status_code == 400
+
+
 def test_update_alias(flask_client):
     user, api_key = get_new_user_and_api_key()
 
@@ -490,6 +539,50 @@ def test_alias_contacts(flask_client):
     assert len(r.json["contacts"]) == 1
 
 
+def test_alias_contacts_cursor(flask_client):
+    user = login(flask_client)
+
+    alias = Alias.create_new_random(user)
+    Session.commit()
+
+    contact_ids = set()
+    for i in range(config.PAGE_LIMIT + 1):
+        contact = Contact.create(
+            website_email=f"marketing-{i}@example.com",
+            reply_email=f"reply-{i}@a.b",
+            alias_id=alias.id,
+            user_id=alias.user_id,
+            commit=True,
+        )
+        contact_ids.add(contact.id)
+
+    r = flask_client.get(f"/api/aliases/{alias.id}/contacts?cursor=")
+    assert r.status_code == 200
+    assert len(r.json["contacts"]) == config.PAGE_LIMIT
+    assert r.json["next_cursor"]
+    scanned_ids = [c["id"] for c in r.json["contacts"]]
+
+    # a contact created in between doesn't shift the next page
+    Contact.create(
+        website_email="new@example.com",
+        reply_email="reply-new@a.b",
+        alias_id=alias.id,
+        user_id=alias.user_id,
+        commit=True,
+    )
+
+    r = flask_client.get(
+        f"/api/aliases/{alias.id}/contacts?cursor={r.json['next_cursor']}"
+    )
+    assert len(r.json["contacts"]) == 1
+    assert r.json["next_cursor"] is None
+    scanned_ids += [c["id"] for c in r.json["contacts"]]
+    assert sorted(scanned_ids) == sorted(contact_ids)
+
+    r = flask_client.get(f"/api/aliases/{alias.id}/contacts?cursor=invalid")
+    assert r.status_code == 400
+
+
 def test_create_contact_route(flask_client):
     user = User.create(
         email="a@b.c", password="password", name="Test User", activated=True
@@ -1,7 +1,10 @@
-from app.api.serializer import get_alias_infos_with_pagination_v3
+import pytest
+
+from app.api.serializer import get_alias_infos_with_pagination_v3, next_alias_cursor
 from app.config import PAGE_LIMIT
 from app.db import Session
 from app.models import Alias, Mailbox, Contact
+from app.pagination import InvalidCursor
 from tests.utils import create_new_user
 
 
@@ -155,3 +158,71 @@ def test_get_alias_infos_pinned_alias(flask_client):
     # pinned alias isn't included in the search
     alias_infos = get_alias_infos_with_pagination_v3(user, query="no match")
     assert len(alias_infos) == 0
+
+
+def _scan_aliases(user, sort=None, on_page=None) -> [int]:
+    """alias ids of all the pages, following the cursors"""
+    alias_ids = []
+    cursor = ""
+    while cursor is not None:
+        alias_infos = get_alias_infos_with_pagination_v3(
+            user, sort=sort, page_limit=3, cursor=cursor
+        )
+        alias_ids.extend(alias_info.alias.id for alias_info in alias_infos)
+        cursor = next_alias_cursor(alias_infos, sort) if len(alias_infos) == 3 else None
+        if on_page:
+            on_page()
+
+    return alias_ids
+
+
+def test_get_alias_infos_with_pagination_v3_cursor(flask_client):
+    user = create_new_user()
+    for _ in range(9):
+        Alias.create_new_random(user)
+    Session.commit()
+    alias_ids = [alias.id for alias in Alias.filter_by(user_id=user.id)]
+
+    for sort in [None, "old2new", "new2old", "a2z", "z2a"]:
+        scanned_ids = _scan_aliases(user, sort)
+        assert len(scanned_ids) == len(set(scanned_ids))
+        assert set(scanned_ids) == set(alias_ids)
+
+        # same order as the page_id pagination
+        alias_infos = get_alias_infos_with_pagination_v3(
+            user, sort=sort, page_limit=100
+        )
+        assert scanned_ids == [alias_info.alias.id for alias_info in alias_infos]
+
+
+def test_get_alias_infos_with_pagination_v3_cursor_insert_during_scan(flask_client):
+    """aliases created during a scan don't make it skip or repeat the other aliases"""
+    user = create_new_user()
+    for _ in range(9):
+        Alias.create_new_random(user)
+    Session.commit()
+    alias_ids = {alias.id for alias in Alias.filter_by(user_id=user.id)}
+
+    def create_alias():
+        Alias.create_new_random(user)
+        Session.commit()
+
+    for sort in [None, "old2new", "new2old"]:
+        scanned_ids = _scan_aliases(user, sort, on_page=create_alias)
+        assert len(scanned_ids) == len(set(scanned_ids))
+        assert alias_ids.issubset(scanned_ids)
+        alias_ids = {alias.id for alias in Alias.filter_by(user_id=user.id)}
+
+
+def test_get_alias_infos_with_pagination_v3_invalid_cursor(flask_client):
+    user = create_new_user()
+
+    with pytest.raises(InvalidCursor):
+        get_alias_infos_with_pagination_v3(user, cursor="not a cursor")
+
+    # a cursor of another sort
+    alias_infos = get_alias_infos_with_pagination_v3(user, sort="a2z")
+    with pytest.raises(InvalidCursor):
+        get_alias_infos_with_pagination_v3(
+            user, sort="old2new", cursor=next_alias_cursor(alias_infos, "a2z")
+        )
@@ -8,7 +8,10 @@ os.environ["CONFIG"] = os.path.abspath(
 )
 import sqlalchemy
 
-from app.db import Session, engine, connection
+from app.api_key_utils import api_key_cache
+from app.db import Session, engine
+from app.domain_registry import domain_registry
+from app.entitlement import entitlement_cache
 
 from psycopg2 import errors
 from psycopg2.errorcodes import DEPENDENT_OBJECTS_STILL_EXIST
@@ -18,6 +21,10 @@ import pytest
 from server import create_app
 from init_app import add_sl_domains, add_proton_partner
 
+# the tests run in a transaction of this connection, rolled back at the end of each test
+connection = engine.connect()
+Session.configure(bind=connection)
+
 app = create_app()
 app.config["TESTING"] = True
 app.config["WTF_CSRF_ENABLED"] = False
@@ -55,3 +62,7 @@ def flask_client():
             transaction.rollback()
             Session.rollback()
             Session.close()
+            # the registry may keep domains created during the test
+            domain_registry.invalidate()
+            entitlement_cache.invalidate()
+            api_key_cache.invalidate()
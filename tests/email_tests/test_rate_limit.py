@@ -1,3 +1,8 @@
+from typing import Dict
+
+import pytest
+
+from app import config
 from app.config import (
     MAX_ACTIVITY_DURING_MINUTE_PER_ALIAS,
     MAX_ACTIVITY_DURING_MINUTE_PER_MAILBOX,
@@ -8,12 +13,56 @@ from app.email.rate_limit import (
     rate_limited_for_alias,
     rate_limited_for_mailbox,
     rate_limited_reply_phase,
+    InMemoryRateLimitBackend,
+    RedisRateLimitBackend,
+    set_rate_limit_backend,
 )
 from app.models import Alias, EmailLog, Contact
 from tests.utils import create_new_user
 
 
-def test_rate_limited_forward_phase_for_alias(flask_client):
+class FakeRedisPipeline:
+    def __init__(self, store: Dict[str, int]):
+        self._store = store
+        self._commands = []
+
+    def incr(self, key):
+        self._commands.append(("incr", key))
+
+    def expire(self, key, seconds):
+        self._commands.append(("expire", key))
+
+    def get(self, key):
+        self._commands.append(("get", key))
+
+    def execute(self):
+        res = []
+        for command, key in self._commands:
+            if command == "incr":
+                self._store[key] = self._store.get(key, 0) + 1
+                res.append(self._store[key])
+            elif command == "expire":
+                res.append(True)
+            else:
+                value = self._store.get(key)
+                res.append(str(value).encode() if value is not None else None)
+        return res
+
+
+class FakeRedis:
+    def __init__(self):
+        self.store: Dict[str, int] = {}
+
+    def pipeline(self):
+        return FakeRedisPipeline(self.store)
+
+
+@pytest.fixture
+def sql_rate_limit(monkeypatch):
+    monkeypatch.setattr(config, "RATE_LIMIT_BACKEND", "sql")
+
+
+def test_rate_limited_forward_phase_for_alias(flask_client, sql_rate_limit):
     user = create_new_user()
 
     # no rate limiting for a new alias
@@ -40,7 +89,7 @@ def test_rate_limited_forward_phase_for_alias(flask_client):
     assert rate_limited_for_alias(alias)
 
 
-def test_rate_limited_forward_phase_for_mailbox(flask_client):
+def test_rate_limited_forward_phase_for_mailbox(flask_client, sql_rate_limit):
     user = create_new_user()
 
     alias = Alias.create_new_random(user)
@@ -79,7 +128,7 @@ def test_rate_limited_forward_phase(flask_client):
     assert not rate_limited_forward_phase("not-exist@alias.com")
 
 
-def test_rate_limited_reply_phase(flask_client):
+def test_rate_limited_reply_phase(flask_client, sql_rate_limit):
     # no rate limiting when reply_email does not exist
     assert not rate_limited_reply_phase("not-exist-reply@alias.com")
 
@@ -104,3 +153,75 @@ def test_rate_limited_reply_phase(flask_client):
         Session.commit()
 
     assert rate_limited_reply_phase("rep@sl.local")
+
+
+@pytest.mark.parametrize(
+    "backend",
+    [InMemoryRateLimitBackend(), RedisRateLimitBackend(FakeRedis())],
+)
+def test_rate_limit_backend(backend):
+    for i in range(1, MAX_ACTIVITY_DURING_MINUTE_PER_ALIAS + 1):
+        # the count can't be above the nb of hits
+        assert backend.hit("key") <= i
+
+    # counters are per key
+    assert backend.hit("other-key") == 1
+
+
+@pytest.mark.parametrize(
+    "backend",
+    [
+        # freeze the time in the middle of a window
+        InMemoryRateLimitBackend(clock=lambda: 30),
+        RedisRateLimitBackend(FakeRedis(), clock=lambda: 30),
+    ],
+)
+def test_rate_limited_with_backend(flask_client, backend, monkeypatch):
+    monkeypatch.setattr(config, "RATE_LIMIT_BACKEND", "memory")
+    set_rate_limit_backend(backend)
+    user = create_new_user()
+    alias = Alias.create_new_random(user)
+    Session.commit()
+
+    try:
+        for _ in range(MAX_ACTIVITY_DURING_MINUTE_PER_ALIAS):
+            assert not rate_limited_for_alias(alias)
+
+        assert rate_limited_for_alias(alias)
+
+        for _ in range(MAX_ACTIVITY_DURING_MINUTE_PER_MAILBOX):
+            assert not rate_limited_for_mailbox(alias)
+
+        # another alias on the same mailbox
+        alias2 = Alias.create_new_random(user)
+        Session.commit()
+        assert rate_limited_for_mailbox(alias2)
+    finally:
+        set_rate_limit_backend(None)
+
+
+def test_rate_limit_sliding_window():
+    now = 0
+    backend = InMemoryRateLimitBackend(clock=lambda: now)
+    for _ in range(10):
+        backend.hit("key")
+
+    # half of the previous window is taken into account
+    now = 90
+    assert backend.hit("key") == 1 + 10 * 0.5
+
+    # previous activities are forgotten after 2 windows
+    now = 200
+    assert backend.hit("key") == 1
+
+
+def test_rate_limit_purge_keeps_longer_windows():
+    now = 0
+    backend = InMemoryRateLimitBackend(purge_interval=60, clock=lambda: now)
+    for _ in range(10):
+        backend.hit("key", window=3600)
+
+    # a purge after a minute keeps the counter of the 1 hour window
+    now = 120
+    backend.hit("other-key")
+    assert backend.hit("key", window=3600) == 11
@@ -0,0 +1,102 @@
+from app.alias_activity import (
+    check_alias_activity,
+    rebuild_alias_activity,
+    refresh_alias_activity,
+)
+from app.api.serializer import get_alias_info_v3
+from app.db import Session
+from app.models import Alias, Contact, EmailLog, AliasActivity
+from tests.utils import create_new_user, random_email
+
+
+def _create_contact(user, alias) -> Contact:
+    return Contact.create(
+        user_id=user.id,
+        alias_id=alias.id,
+        website_email=random_email(),
+        reply_email=random_email(),
+        flush=True,
+    )
+
+
+def _create_email_log(contact, **kw) -> EmailLog:
+    return EmailLog.create(
+        user_id=contact.user_id,
+        contact_id=contact.id,
+        alias_id=contact.alias_id,
+        flush=True,
+        **kw,
+    )
+
+
+def test_alias_activity_maintained_by_trigger(flask_client):
+    user = create_new_user()
+    alias = Alias.create_new_random(user)
+    Session.flush()
+    contact = _create_contact(user, alias)
+
+    _create_email_log(contact)
+    _create_email_log(contact, blocked=True)
+    reply = _create_email_log(contact, is_reply=True)
+
+    alias_info = get_alias_info_v3(user, alias.id)
+    assert alias_info.nb_forward == 1
+    assert alias_info.nb_blocked == 1
+    assert alias_info.nb_reply == 1
+    assert alias_info.latest_email_log == reply
+    assert alias_info.latest_contact == contact
+
+    # block a forward
+    forward = _create_email_log(contact)
+    forward.blocked = True
+    Session.flush()
+    alias_info = get_alias_info_v3(user, alias.id)
+    assert alias_info.nb_forward == 1
+    assert alias_info.nb_blocked == 2
+    assert alias_info.latest_email_log == forward
+
+    # delete the latest email log
+    EmailLog.delete(forward.id)
+    Session.flush()
+    Session.expire_all()
+    alias_info = get_alias_info_v3(user, alias.id)
+    assert alias_info.nb_blocked == 1
+    assert alias_info.latest_email_log == reply
+
+    # email logs deleted by cascade
+    Contact.delete(contact.id)
+    Session.flush()
+    Session.expire_all()
+    alias_info = get_alias_info_v3(user, alias.id)
+    assert alias_info.nb_forward == 0
+    assert alias_info.nb_blocked == 0
+    assert alias_info.nb_reply == 0
+    assert alias_info.latest_email_log is None
+
+    assert check_alias_activity() == []
+
+
+def test_check_and_rebuild_alias_activity(flask_client):
+    user = create_new_user()
+    alias = Alias.create_new_random(user)
+    Session.flush()
+    contact = _create_contact(user, alias)
+    email_log = _create_email_log(contact)
+
+    alias_activity = AliasActivity.get_by(alias_id=alias.id)
+    alias_activity.nb_forward = 10
+    alias_activity.latest_email_log_id = None
+    Session.flush()
+
+    assert alias.id in check_alias_activity()
+    assert alias.id in check_alias_activity(fix=True)
+    assert check_alias_activity() == []
+
+    refresh_alias_activity(alias.id)
+    Session.expire_all()
+    alias_activity = AliasActivity.get_by(alias_id=alias.id)
+    assert alias_activity.nb_forward == 1
+    assert alias_activity.latest_email_log_id == email_log.id
+
+    rebuild_alias_activity(batch_size=100)
+    assert check_alias_activity() == []
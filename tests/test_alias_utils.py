@@ -1,8 +1,11 @@
 from typing import List
 
+from sqlalchemy import text
+
 from app.alias_utils import (
     delete_alias,
     check_alias_prefix,
+    check_if_alias_can_be_auto_created_for_custom_domain,
     get_user_if_alias_would_auto_create,
     try_auto_create,
 )
@@ -124,3 +127,38 @@ def test_auto_create_alias(flask_client):
             assert result, f"Case {test_id} - Failed address {address}"
         else:
             assert result is None, f"Case {test_id} - Failed address {address}"
+
+
+def test_auto_create_rule_deleted_by_another_process(flask_client):
+    user = create_new_user()
+    user.lifetime = True
+    custom_domain = CustomDomain.create(
+        user_id=user.id,
+        catch_all=False,
+        domain=random_domain(),
+        verified=True,
+        flush=True,
+    )
+    deleted_rule = AutoCreateRule.create(
+        custom_domain_id=custom_domain.id, order=0, regex="ok-.*", flush=True
+    )
+    rule = AutoCreateRule.create(
+        custom_domain_id=custom_domain.id, order=1, regex=".*", flush=True
+    )
+    Session.commit()
+    address = f"ok-nonexistant@{custom_domain.domain}"
+    assert check_if_alias_can_be_auto_created_for_custom_domain(address) == (
+        custom_domain,
+        deleted_rule,
+    )
+
+    # without the ORM events, the cached rules still have the deleted rule
+    Session.execute(
+        text("DELETE FROM auto_create_rule WHERE id = :id"),
+        {"id": deleted_rule.id},
+    )
+    Session.expire_all()
+    assert check_if_alias_can_be_auto_created_for_custom_domain(address) == (
+        custom_domain,
+        rule,
+    )
@@ -0,0 +1,110 @@
+from flask import url_for
+
+import app.api.base
+
+from app.api_key_utils import api_key_cache, ApiKeyUsageBuffer
+from app.db import Session
+from app.models import ApiKey
+from tests.api.utils import get_new_user_and_api_key
+from tests.utils import QueryCounter
+
+
+def test_api_key_usage_buffer(flask_client):
+    _, api_key = get_new_user_and_api_key()
+    _, other_api_key = get_new_user_and_api_key()
+    # the connection of the test, its transaction is rolled back after the test
+    buffer = ApiKeyUsageBuffer(
+        flush_interval=3600, flush_max_requests=3, bind=Session.get_bind()
+    )
+
+    buffer.record(api_key.id)
+    buffer.record(other_api_key.id)
+    buffer.flush_if_due()
+    Session.refresh(api_key)
+    assert api_key.times == 0
+    assert api_key.last_used is None
+
+    # the 3rd request makes the flush due
+    buffer.record(api_key.id)
+    Session.refresh(api_key)
+    assert api_key.times == 0
+    buffer.flush_if_due()
+    Session.refresh(api_key)
+    Session.refresh(other_api_key)
+    assert api_key.times == 2
+    assert api_key.last_used is not None
+    assert other_api_key.times == 1
+
+    buffer.record(api_key.id)
+    buffer.flush()
+    Session.refresh(api_key)
+    assert api_key.times == 3
+
+
+def test_api_key_usage_buffer_without_interval(flask_client):
+    _, api_key = get_new_user_and_api_key()
+    buffer = ApiKeyUsageBuffer(
+        flush_interval=0, flush_max_requests=1000, bind=Session.get_bind()
+    )
+
+    with QueryCounter() as counter:
+        buffer.record(api_key.id)
+    assert counter.nb_queries == 0
+
+    with QueryCounter() as counter:
+        buffer.flush_if_due()
+        # nothing to write
+        buffer.flush_if_due()
+    assert counter.nb_queries == 1
+
+    Session.refresh(api_key)
+    assert api_key.times == 1
+
+
+def test_api_key_usage_flushed_after_request(flask_client, monkeypatch):
+    _, api_key = get_new_user_and_api_key()
+    buffer = ApiKeyUsageBuffer(
+        flush_interval=0, flush_max_requests=1000, bind=Session.get_bind()
+    )
+    monkeypatch.setattr(app.api.base, "api_key_usage", buffer)
+
+    r = flask_client.get(
+        url_for("api.user_info"), headers={"Authentication": api_key.code}
+    )
+    assert r.status_code == 200
+    Session.refresh(api_key)
+    assert api_key.times == 1
+
+
+def test_api_key_cache(flask_client):
+    _, api_key = get_new_user_and_api_key()
+
+    api_key_info = api_key_cache.get(api_key.code)
+    assert api_key_info.id == api_key.id
+    assert api_key_info.user_id == api_key.user_id
+    assert api_key_cache.get("unknown") is None
+    assert api_key_cache.get(None) is None
+
+    with QueryCounter() as counter:
+        assert api_key_cache.get(api_key.code) == api_key_info
+    assert counter.nb_queries == 0
+
+    # revoked
+    code = api_key.code
+    ApiKey.delete(api_key.id)
+    Session.commit()
+    assert api_key_cache.get(code) is None
+
+
+def test_require_api_auth_revoked_api_key(flask_client):
+    _, api_key = get_new_user_and_api_key()
+    code = api_key.code
+
+    r = flask_client.get(url_for("api.user_info"), headers={"Authentication": code})
+    assert r.status_code == 200
+
+    ApiKey.delete_all(api_key.user_id)
+    Session.commit()
+
+    r = flask_client.get(url_for("api.user_info"), headers={"Authentication": code})
+    assert r.status_code == 401
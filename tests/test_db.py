@@ -0,0 +1,159 @@
+import threading
+import time
+
+import pytest
+from sqlalchemy import event, exc, text
+
+from app import config
+from app.db import (
+    create_pooled_engine,
+    _create_session,
+    PoolStats,
+    Replica,
+    read_only,
+    Session,
+    unit_of_work,
+)
+from app.models import User, Alias
+from tests.utils import create_new_user
+
+
+def test_pool_stats():
+    stats = PoolStats()
+    stats.record_checkout(0.1)
+    stats.record_checkout(0.3)
+    stats.record_timeout()
+
+    previous = stats.reset()
+    assert previous.nb_checkout == 2
+    assert previous.nb_timeout == 1
+    assert previous.max_wait == 0.3
+    assert stats.nb_checkout == stats.nb_timeout == 0
+
+
+def test_threads_query_in_parallel():
+    nb_threads = 5
+    engine = create_pooled_engine(config.DB_URI, pool_size=nb_threads, max_overflow=0)
+    session = _create_session(engine, "thread")
+    connection_pids = set()
+
+    def query():
+        connection_pids.add(session.execute("SELECT pg_backend_pid()").scalar())
+        session.execute("SELECT pg_sleep(0.5)")
+        session.remove()
+
+    threads = [threading.Thread(target=query) for _ in range(nb_threads)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # on a single connection, the queries would take 2.5s
+    assert time.time() - start < 2
+    assert len(connection_pids) == nb_threads
+    stats = engine.pool.stats.reset()
+    assert stats.nb_checkout == nb_threads
+    assert engine.pool.saturation() == 0
+    engine.dispose()
+
+
+def test_pool_timeout():
+    engine = create_pooled_engine(
+        config.DB_URI, pool_size=1, max_overflow=0, pool_timeout=1
+    )
+    with engine.connect():
+        assert engine.pool.saturation() == 1
+        with pytest.raises(exc.TimeoutError):
+            engine.connect()
+
+    assert engine.pool.stats.nb_timeout == 1
+    engine.dispose()
+
+
+def create_replica_role() -> str:
+    # a role of the test database stands in for the replica:
+    # current_user tells where a query runs
+    role = "sl_replica_test"
+    engine = create_pooled_engine(config.DB_URI)
+    with engine.connect() as conn:
+        conn.execution_options(autocommit=True).execute(
+            text(
+                f"""
+DO $$ BEGIN
+    IF NOT EXISTS (SELECT FROM pg_roles WHERE rolname = '{role}') THEN
+        CREATE ROLE {role} NOLOGIN;
+    END IF;
+END $$
+"""
+            )
+        )
+    engine.dispose()
+    return role
+
+
+def test_read_replica_routing():
+    role = create_replica_role()
+    primary_engine = create_pooled_engine(config.DB_URI)
+    replica_engine = create_pooled_engine(config.DB_URI)
+
+    @event.listens_for(replica_engine, "connect")
+    def set_role(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"SET ROLE {role}")
+        cursor.close()
+
+    replica = Replica(replica_engine, max_lag=5, lag_check_interval=0)
+    session = _create_session(primary_engine, "thread", replicas=[replica])
+
+    def current_user() -> str:
+        return session.execute("SELECT current_user").scalar()
+
+    primary_role = current_user()
+    assert primary_role != role
+    with read_only(session):
+        assert current_user() == role
+    assert current_user() == primary_role
+
+    # read your writes
+    with read_only(session):
+        session.query(User).filter(User.id == -1).update({"name": "replica test"})
+        assert current_user() == primary_role
+    session.remove()
+
+    # a late replica isn't used
+    replica.max_lag = -1
+    with read_only(session):
+        assert current_user() == primary_role
+    session.remove()
+
+    primary_engine.dispose()
+    replica_engine.dispose()
+
+
+def test_unit_of_work(flask_client):
+    user = create_new_user()
+    Session.commit()
+
+    with unit_of_work():
+        alias = Alias.create_new_random(user)
+        Session.commit()
+        alias_id = alias.id
+
+        # a rollback only discards the writes since the last commit
+        user.name = "unit of work"
+        Session.rollback()
+        assert user.name == "Test User"
+        assert Alias.get(alias_id)
+
+    assert Alias.get(alias_id)
+
+    # an error rolls back all the writes of the block, its commits included
+    with pytest.raises(ValueError):
+        with unit_of_work():
+            alias = Alias.create_new_random(user)
+            Session.commit()
+            alias_id = alias.id
+            raise ValueError()
+
+    assert Alias.get(alias_id) is None
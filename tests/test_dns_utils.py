@@ -1,8 +1,22 @@
+import socket
+import threading
+from typing import Dict, Tuple, List
+
+import dns.message
+import dns.rcode
+import dns.rdatatype
+import dns.rrset
+import pytest
+
 from app.dns_utils import (
     get_mx_domains,
     get_spf_domain,
     get_txt_record,
     is_mx_equivalent,
+    get_cname_record,
+    get_mx_domains_many,
+    set_dns_resolver,
+    create_dns_resolver,
 )
 
 # use our own domain for test
@@ -46,3 +60,125 @@ def test_is_mx_equivalent():
         [(5, "domain1"), (10, "domain2")],
         [(10, "domain1"), (20, "domain2"), (20, "domain3")],
     )
+
+
+class StubDnsServer:
+    """
+    DNS server on localhost (UDP) answering from records: (name, type) -> records as text.
+    The other types of a known name have no answer, an unknown name doesn't exist.
+    """
+
+    def __init__(self, records: Dict[Tuple[str, str], List[str]], ttl: int = 300):
+        self.records = records
+        self.ttl = ttl
+        # (name, type) of the queries received
+        self.queries = []
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind(("127.0.0.1", 0))
+        self._sock.settimeout(0.1)
+        self.port = self._sock.getsockname()[1]
+        self._stopped = threading.Event()
+
+    def _serve(self):
+        while not self._stopped.is_set():
+            try:
+                data, addr = self._sock.recvfrom(4096)
+            except socket.timeout:
+                continue
+
+            query = dns.message.from_wire(data)
+            question = query.question[0]
+            name = question.name.to_text(omit_final_dot=True)
+            rdtype = dns.rdatatype.to_text(question.rdtype)
+            self.queries.append((name, rdtype))
+
+            response = dns.message.make_response(query)
+            records = self.records.get((name, rdtype))
+            if records:
+                response.answer.append(
+                    dns.rrset.from_text_list(
+                        question.name, self.ttl, "IN", rdtype, records
+                    )
+                )
+            elif all(known_name != name for known_name, _ in self.records):
+                response.set_rcode(dns.rcode.NXDOMAIN)
+
+            self._sock.sendto(response.to_wire(), addr)
+
+    def __enter__(self):
+        threading.Thread(target=self._serve, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self._stopped.set()
+        self._sock.close()
+
+
+_STUB_RECORDS = {
+    ("stub.test", "MX"): ["10 mx1.sl.test.", "20 mx2.sl.test."],
+    ("stub.test", "TXT"): ['"v=spf1 include:sl.test ~all"', '"sl-verification=abcd"'],
+    ("dkim._domainkey.stub.test", "CNAME"): ["dkim._domainkey.sl.test."],
+    ("_dmarc.stub.test", "TXT"): ['"v=DMARC1; p=quarantine"'],
+}
+
+
+@pytest.fixture
+def stub_dns():
+    records = dict(_STUB_RECORDS)
+    for i in range(20):
+        records[(f"stub{i}.test", "MX")] = [f"10 mx{i}.sl.test."]
+
+    with StubDnsServer(records) as server:
+        set_dns_resolver(create_dns_resolver(["127.0.0.1"], port=server.port))
+        try:
+            yield server
+        finally:
+            set_dns_resolver(None)
+
+
+def test_lookups_with_stub_dns(stub_dns):
+    assert get_mx_domains("stub.test") == [(10, "mx1.sl.test."), (20, "mx2.sl.test.")]
+    assert get_spf_domain("stub.test") == ["sl.test"]
+    assert "sl-verification=abcd" in get_txt_record("stub.test")
+    assert get_cname_record("dkim._domainkey.stub.test") == "dkim._domainkey.sl.test"
+
+    # no record of this type, unknown name
+    assert get_cname_record("stub.test") is None
+    assert get_mx_domains("unknown.test") == []
+
+
+def test_dns_cache(stub_dns):
+    get_mx_domains("stub.test")
+    get_mx_domains("stub.test")
+    get_spf_domain("stub.test")
+    get_txt_record("stub.test")
+    assert stub_dns.queries == [("stub.test", "MX"), ("stub.test", "TXT")]
+
+    # negative answers are cached too
+    get_mx_domains("unknown.test")
+    get_mx_domains("unknown.test")
+    assert stub_dns.queries.count(("unknown.test", "MX")) == 1
+
+
+def test_get_mx_domains_many(stub_dns):
+    hostnames = [f"stub{i}.test" for i in range(20)]
+
+    mx_domains = get_mx_domains_many(hostnames + ["unknown.test"])
+
+    for i, hostname in enumerate(hostnames):
+        assert mx_domains[hostname] == [(10, f"mx{i}.sl.test.")]
+    assert mx_domains["unknown.test"] == []
+
+
+def test_dns_without_cache(stub_dns):
+    get_mx_domains("stub.test")
+    assert get_mx_domains("stub.test", use_cache=False) == [
+        (10, "mx1.sl.test."),
+        (20, "mx2.sl.test."),
+    ]
+    assert stub_dns.queries.count(("stub.test", "MX")) == 2
+
+    # the fresh answer is cached
+    get_spf_domain("stub.test", use_cache=False)
+    assert "sl-verification=abcd" in get_txt_record("stub.test")
+    assert stub_dns.queries.count(("stub.test", "TXT")) == 1
@@ -0,0 +1,66 @@
+from app.db import Session
+from app.domain_registry import domain_registry, DomainRegistry
+from app.models import CustomDomain, AutoCreateRule, SLDomain
+from tests.utils import create_new_user, random_domain, QueryCounter
+
+
+def test_sl_domains(flask_client):
+    assert domain_registry.is_sl_domain("d1.test")
+    assert not domain_registry.is_sl_domain("not-sl.test")
+
+    with QueryCounter() as counter:
+        assert domain_registry.is_sl_domain("d1.test")
+    assert counter.nb_queries == 0
+
+    domain = random_domain()
+    SLDomain.create(domain=domain, premium_only=True, commit=True)
+    sl_domain = domain_registry.get_sl_domain(domain)
+    assert sl_domain.premium_only
+
+
+def test_custom_domain(flask_client):
+    user = create_new_user()
+    domain = random_domain()
+    assert domain_registry.get_custom_domain(domain) is None
+
+    custom_domain = CustomDomain.create(
+        user_id=user.id, domain=domain, verified=True, commit=True
+    )
+    custom_domain_info = domain_registry.get_custom_domain(domain)
+    assert custom_domain_info.id == custom_domain.id
+    assert not custom_domain_info.catch_all
+    assert custom_domain_info.auto_create_rules == ()
+
+    with QueryCounter() as counter:
+        assert domain_registry.get_custom_domain(domain) == custom_domain_info
+    assert counter.nb_queries == 0
+
+    # invalidated when the domain or its rules are changed
+    custom_domain.catch_all = True
+    Session.commit()
+    assert domain_registry.get_custom_domain(domain).catch_all
+
+    AutoCreateRule.create(
+        custom_domain_id=custom_domain.id, order=1, regex="b-.*", commit=True
+    )
+    AutoCreateRule.create(
+        custom_domain_id=custom_domain.id, order=0, regex="a-.*", commit=True
+    )
+    Session.refresh(custom_domain)
+    rules = domain_registry.get_custom_domain(domain).auto_create_rules
+    assert [rule.regex for rule in rules] == ["a-.*", "b-.*"]
+
+    CustomDomain.delete(custom_domain.id)
+    Session.commit()
+    assert domain_registry.get_custom_domain(domain) is None
+
+
+def test_domain_registry_disabled(flask_client):
+    registry = DomainRegistry(ttl=0)
+    assert registry.is_sl_domain("d1.test")
+
+    with QueryCounter() as counter:
+        assert registry.is_sl_domain("d1.test")
+        assert registry.get_custom_domain(random_domain()) is None
+    assert counter.nb_queries == 2
+    assert registry.nb_hit == 0
@@ -1,14 +1,18 @@
+import asyncio
 import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from email.message import EmailMessage
 from typing import List
 
 import pytest
 from aiosmtpd.smtp import Envelope
+from sqlalchemy import event
 
 import email_handler
 from app import config
 from app.config import EMAIL_DOMAIN, ALERT_DMARC_FAILED_REPLY_PHASE
-from app.db import Session
+from app.db import Session, engine
 from app.email import headers, status
 from app.email_utils import generate_verp_email
 from app.models import (
@@ -20,6 +24,7 @@ from app.models import (
     VerpType,
     Contact,
     SentAlert,
+    User,
 )
 from email_handler import (
     get_mailbox_from_mail_from,
@@ -155,6 +160,181 @@ def test_preserve_5xx_with_no_header(flask_client):
     assert status.E512 == result
 
 
+def test_forward_single_transaction(flask_client, monkeypatch):
+    monkeypatch.setattr(config, "FORWARD_SINGLE_TRANSACTION", True)
+    user = create_new_user()
+    alias = Alias.create_new_random(user)
+    other_alias = Alias.create_new_random(user)
+    Session.commit()
+    msg = load_eml_file("dmarc_allow.eml", {"alias_email": alias.email})
+    envelope = Envelope()
+    envelope.mail_from = msg["from"]
+    envelope.rcpt_tos = [alias.email, other_alias.email]
+
+    nb_commits = 0
+
+    @event.listens_for(Session, "after_commit")
+    def count_commit(session):
+        nonlocal nb_commits
+        # the savepoints are nested transactions
+        if not session.transaction.nested:
+            nb_commits += 1
+
+    # the emails are sent once the writes of both recipients are committed
+    nb_commits_at_send = []
+    monkeypatch.setattr(
+        email_handler,
+        "sl_sendmail",
+        lambda *args, **kwargs: nb_commits_at_send.append(nb_commits),
+    )
+
+    try:
+        result = email_handler.handle(envelope, msg)
+    finally:
+        event.remove(Session, "after_commit", count_commit)
+
+    assert result == status.E200
+    assert nb_commits_at_send == [1, 1]
+    assert nb_commits == 1
+    for a in [alias, other_alias]:
+        assert EmailLog.filter_by(alias_id=a.id, blocked=False).count() == 1
+        assert Contact.filter_by(alias_id=a.id).count() == 1
+
+
+def test_get_or_create_contact(flask_client):
+    user = create_new_user()
+    alias = Alias.create_new_random(user)
+    Session.commit()
+
+    contact = email_handler.get_or_create_contact(
+        "First <contact@example.com>", "bounce@example.com", alias, EmailMessage()
+    )
+    assert contact.name == "First"
+    assert contact.mail_from == "bounce@example.com"
+    assert contact.reply_email.endswith(f"@{EMAIL_DOMAIN}")
+    assert contact.automatic_created
+
+    # the existing contact is updated
+    same_contact = email_handler.get_or_create_contact(
+        "Second <contact@example.com>", "other@example.com", alias, EmailMessage()
+    )
+    assert same_contact.id == contact.id
+    assert same_contact.name == "Second"
+    assert same_contact.mail_from == "bounce@example.com"
+    assert same_contact.reply_email == contact.reply_email
+
+    # but not by the Reply-To header
+    assert (
+        email_handler.get_or_create_reply_to_contact(
+            "Third <contact@example.com>", alias, EmailMessage()
+        ).name
+        == "Second"
+    )
+
+    invalid_contact = email_handler.get_or_create_contact(
+        "invalid", "<>", alias, EmailMessage()
+    )
+    assert invalid_contact.invalid_email
+    assert invalid_contact.reply_email == config.NOREPLY
+
+
+def test_get_or_create_contact_concurrently(flask_client, monkeypatch):
+    # the threads use their own session on the engine: their commits are real
+    monkeypatch.setattr(
+        Session.registry,
+        "createfunc",
+        lambda: Session.session_factory(bind=engine),
+    )
+    nb_threads = 10
+
+    def in_session(f):
+        def run(*args):
+            try:
+                return f(*args)
+            finally:
+                Session.remove()
+
+        return run
+
+    @in_session
+    def create_alias() -> (int, int):
+        user = create_new_user()
+        alias = Alias.create_new_random(user)
+        Session.commit()
+        return user.id, alias.id
+
+    barrier = threading.Barrier(nb_threads)
+
+    @in_session
+    def get_or_create_contact(alias_id: int) -> (int, str):
+        alias = Alias.get(alias_id)
+        barrier.wait()
+        contact = email_handler.get_or_create_contact(
+            "Contact <contact@example.com>", "contact@example.com", alias, None
+        )
+        return contact.id, contact.reply_email
+
+    @in_session
+    def delete_user(user_id: int):
+        User.delete(user_id)
+        Session.commit()
+
+    with ThreadPoolExecutor(max_workers=nb_threads) as executor:
+        user_id, alias_id = executor.submit(create_alias).result()
+        try:
+            contacts = set(executor.map(get_or_create_contact, [alias_id] * nb_threads))
+        finally:
+            executor.submit(delete_user, user_id).result()
+
+    # all the threads get the same contact
+    assert len(contacts) == 1
+
+
+def test_mail_handler_with_executor(flask_client):
+    msg = EmailMessage()
+    msg[headers.FROM] = "from@domain.test"
+    envelope = Envelope()
+    envelope.mail_from = "from@domain.test"
+    envelope.rcpt_tos = [config.NOREPLY]
+    envelope.original_content = msg.as_bytes()
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        handler = email_handler.MailHandler(executor, max_pending=1)
+        result = asyncio.run(handler.handle_DATA(None, None, envelope))
+
+    assert result == status.E200
+    assert handler._nb_pending == 0
+
+
+def test_mail_handler_saturated(monkeypatch):
+    release = threading.Event()
+
+    def blocked_handle_envelope(envelope):
+        release.wait(5)
+        return status.E200
+
+    monkeypatch.setattr(email_handler, "handle_envelope", blocked_handle_envelope)
+    envelope = Envelope()
+    envelope.mail_from = "from@domain.test"
+    envelope.rcpt_tos = [config.NOREPLY]
+
+    async def send_two_emails(handler):
+        first = asyncio.ensure_future(handler.handle_DATA(None, None, envelope))
+        # the first email blocks the only worker
+        while handler._nb_pending == 0:
+            await asyncio.sleep(0.01)
+        second = await handler.handle_DATA(None, None, envelope)
+        release.set()
+        return await first, second
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        handler = email_handler.MailHandler(executor, max_pending=1)
+        results = asyncio.run(send_two_emails(handler))
+
+    assert results == (status.E200, status.E411)
+    assert handler._nb_pending == 0
+
+
 def generate_dmarc_result() -> List:
     return ["DMARC_POLICY_QUARANTINE", "DMARC_POLICY_REJECT", "DMARC_POLICY_SOFTFAIL"]
 
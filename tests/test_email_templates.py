@@ -0,0 +1,59 @@
+import os
+
+from app import config
+from app.email_templates import (
+    get_environment,
+    precompile_templates,
+    EMAIL_TEMPLATES_DIR,
+)
+from app.email_utils import render
+
+
+def write_template(templates_dir, content, mtime):
+    path = os.path.join(templates_dir, "test.txt.jinja2")
+    with open(path, "w") as f:
+        f.write(content)
+    os.utime(path, (mtime, mtime))
+
+
+def test_get_environment():
+    env = get_environment()
+    assert get_environment(EMAIL_TEMPLATES_DIR) is env
+
+    render("transactional/noreply.text.jinja2")
+    assert any(
+        name == "transactional/noreply.text.jinja2" for _, name in env.cache.keys()
+    )
+
+
+def test_precompile_templates():
+    nb_templates = precompile_templates()
+
+    assert nb_templates > 0
+    assert len(get_environment().cache) >= nb_templates
+
+
+def test_auto_reload(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "TEMPLATES_AUTO_RELOAD", False)
+    write_template(tmp_path, "v1", 1_000_000)
+    env = get_environment(str(tmp_path))
+    assert env.get_template("test.txt.jinja2").render() == "v1"
+
+    write_template(tmp_path, "v2", 2_000_000)
+    assert env.get_template("test.txt.jinja2").render() == "v1"
+
+    env.auto_reload = True
+    assert env.get_template("test.txt.jinja2").render() == "v2"
+
+
+def test_bytecode_cache(tmp_path, monkeypatch):
+    cache_dir = tmp_path / "cache"
+    templates_dir = tmp_path / "templates"
+    templates_dir.mkdir()
+    monkeypatch.setattr(config, "TEMPLATES_BYTECODE_CACHE_DIR", str(cache_dir))
+    write_template(templates_dir, "Hello {{ name }}", 1_000_000)
+
+    env = get_environment(str(templates_dir))
+    assert precompile_templates(str(templates_dir)) == 1
+    assert env.get_template("test.txt.jinja2").render(name="you") == "Hello you"
+    assert len(os.listdir(cache_dir)) == 1
@@ -7,6 +7,7 @@ import pytest
 
 from app.config import MAX_ALERT_24H, EMAIL_DOMAIN, ROOT_DIR
 from app.db import Session
+from app.email import headers
 from app.email_utils import (
     get_email_domain_part,
     can_create_directory_for_address,
@@ -38,6 +39,7 @@ from app.email_utils import (
     generate_verp_email,
     get_verp_info_from_email,
 )
+from app.message_utils import message_to_bytes
 from app.models import (
     CustomDomain,
     Alias,
@@ -777,3 +779,23 @@ def test_add_header_multipart_with_invalid_part():
             assert part.get_payload().index("INJECT") > -1
         else:
             assert part == "invalid"
+
+
+def test_copy():
+    msg = load_eml_file("multipart_alternative.eml")
+    orig_bytes = message_to_bytes(msg)
+
+    clone_msg = copy(msg)
+    assert message_to_bytes(clone_msg) == orig_bytes
+    # the payloads are shared
+    assert (
+        clone_msg.get_payload()[0].get_payload() is msg.get_payload()[0].get_payload()
+    )
+
+    # modifying the copy doesn't change the original message
+    add_or_replace_header(clone_msg, headers.SUBJECT, "new subject")
+    clone_msg.get_payload()[0].set_payload("new payload")
+    delete_header(clone_msg.get_payload()[1], headers.CONTENT_TYPE)
+    clone_msg.get_payload().append("new part")
+
+    assert message_to_bytes(msg) == orig_bytes
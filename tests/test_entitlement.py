@@ -0,0 +1,166 @@
+import re
+
+import arrow
+from flask import url_for
+
+from app.db import Session
+from app.entitlement import (
+    entitlement_cache,
+    EntitlementCache,
+    SOURCE_LIFETIME,
+    SOURCE_MANUAL,
+    SOURCE_PADDLE,
+)
+from app.models import ManualSubscription, Subscription, PlanEnum, User
+from tests.api.utils import get_new_user_and_api_key
+from tests.utils import create_new_user, QueryCounter
+
+
+def _nb_subscription_queries(counter: QueryCounter) -> int:
+    return len(
+        [s for s in counter.statements if re.search(r"(FROM|JOIN) \w*subscription", s)]
+    )
+
+
+def test_entitlement_free_user(flask_client):
+    user = create_new_user()
+    user.trial_end = None
+    Session.commit()
+
+    entitlement = user.entitlement()
+    assert entitlement.source is None
+    assert entitlement.expires_at is None
+    assert not entitlement.lifetime_or_active_subscription
+    assert not entitlement.is_paid
+    assert not entitlement.in_trial
+    assert not entitlement.is_premium
+
+    user.trial_end = arrow.now().shift(days=1)
+    assert user.entitlement().in_trial
+    assert user.is_premium()
+
+    user.lifetime = True
+    assert user.entitlement().source == SOURCE_LIFETIME
+    assert not user.in_trial()
+    assert user.is_premium()
+
+
+def test_entitlement_sources(flask_client):
+    user = create_new_user()
+    end_at = arrow.now().shift(days=10)
+    ManualSubscription.create(
+        user_id=user.id, end_at=end_at, is_giveaway=True, commit=True
+    )
+
+    entitlement = user.entitlement()
+    assert entitlement.source == SOURCE_MANUAL
+    assert entitlement.expires_at == end_at
+    assert entitlement.is_premium
+    assert not entitlement.is_paid
+    # the entry expires with the subscription
+    assert entitlement.subscriptions.valid_until == end_at.timestamp()
+
+    Subscription.create(
+        user_id=user.id,
+        cancel_url="https://checkout.paddle.com/subscription/cancel",
+        update_url="https://checkout.paddle.com/subscription/update",
+        subscription_id="123",
+        event_time=arrow.now(),
+        next_bill_date=arrow.now().shift(days=10).date(),
+        plan=PlanEnum.monthly,
+        cancelled=True,
+        commit=True,
+    )
+    entitlement = user.entitlement()
+    assert entitlement.source == SOURCE_PADDLE
+    assert entitlement.plan == PlanEnum.monthly
+    assert entitlement.is_paid
+    assert user.should_show_upgrade_button()
+
+
+def test_entitlement_one_query(flask_client):
+    user = create_new_user()
+
+    with QueryCounter() as counter:
+        user.lifetime_or_active_subscription()
+        user.is_premium()
+        user.in_trial()
+        user.is_paid()
+        user.should_show_upgrade_button()
+    # used to be 5 queries for each call except is_paid, 4 queries
+    assert _nb_subscription_queries(counter) == 1
+
+    # cached by the process, for another instance of the same user
+    Session.expunge(user)
+    user = User.get(user.id)
+    with QueryCounter() as counter:
+        user.is_premium()
+    assert _nb_subscription_queries(counter) == 0
+
+
+def test_entitlement_invalidation(flask_client):
+    user = create_new_user()
+    user.trial_end = None
+    Session.commit()
+    assert not user.is_premium()
+
+    manual_sub = ManualSubscription.create(
+        user_id=user.id, end_at=arrow.now().shift(days=10), commit=True
+    )
+    assert user.is_premium()
+
+    # a change that isn't flushed yet
+    manual_sub.end_at = arrow.now().shift(days=-1)
+    assert not user.is_premium()
+    Session.commit()
+    assert not user.is_premium()
+
+    # a change by another process is seen after ENTITLEMENT_CACHE_TTL
+    Session.execute(
+        "UPDATE manual_subscription SET end_at = now() + interval '1 day' WHERE id = :id",
+        {"id": manual_sub.id},
+    )
+    assert not User.get(user.id).is_premium()
+    entitlement_cache.invalidate()
+    Session.expire_all()
+    assert User.get(user.id).is_premium()
+
+
+def test_entitlement_cache_no_subscription(flask_client):
+    user = create_new_user()
+    user.trial_end = None
+    Session.commit()
+    cache = EntitlementCache(ttl=30, no_subscription_ttl=0)
+    assert not cache.get_subscriptions(user.id).has_active_subscription
+
+    # subscribed through another process: the user without subscription isn't kept
+    Session.execute(
+        "INSERT INTO manual_subscription (created_at, user_id, end_at, is_giveaway) "
+        "VALUES (now(), :user_id, now() + interval '1 day', false)",
+        {"user_id": user.id},
+    )
+    assert cache.get_subscriptions(user.id).has_active_subscription
+
+    # the user with a subscription is kept
+    with QueryCounter() as counter:
+        assert cache.get_subscriptions(user.id).has_active_subscription
+    assert _nb_subscription_queries(counter) == 0
+
+
+def test_user_info_queries(flask_client):
+    user, api_key = get_new_user_and_api_key()
+
+    with QueryCounter() as counter:
+        r = flask_client.get(
+            url_for("api.user_info"), headers={"Authentication": api_key.code}
+        )
+    assert r.status_code == 200
+    assert r.json["is_premium"]
+    # is_premium() and in_trial() used to issue 5 queries each
+    assert _nb_subscription_queries(counter) == 1
+
+    with QueryCounter() as counter:
+        flask_client.get(
+            url_for("api.user_info"), headers={"Authentication": api_key.code}
+        )
+    assert _nb_subscription_queries(counter) == 0
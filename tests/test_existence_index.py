@@ -0,0 +1,138 @@
+from contextlib import nullcontext
+
+from app.db import Session
+from app.email_utils import is_reverse_alias
+from app.existence_index import (
+    BloomFilter,
+    bloom_filter_size,
+    ExistenceIndex,
+    existence_index,
+    ALIAS,
+)
+from app.models import Alias, Contact
+from tests.utils import create_new_user, random_token, random_email, QueryCounter
+
+
+def test_bloom_filter_size():
+    nb_bits, nb_hashes = bloom_filter_size(100_000_000, 0.01)
+    assert nb_hashes == 7
+    # ~114 MiB
+    assert 119_000_000 < nb_bits / 8 < 120_000_000
+
+
+def test_bloom_filter():
+    bloom_filter = BloomFilter(10_000, 0.01)
+    keys = [random_email() for _ in range(10_000)]
+    bloom_filter.add_many(keys)
+
+    assert all(key in bloom_filter for key in keys)
+    nb_false_positives = sum(random_email() in bloom_filter for _ in range(10_000))
+    assert nb_false_positives < 300
+
+
+def create_index(**kw) -> ExistenceIndex:
+    # the test data is only visible on the connection of the test transaction
+    return ExistenceIndex(
+        error_rate=1e-6,
+        sync_interval=0,
+        max_transaction_duration=0,
+        connect=lambda: nullcontext(Session.connection()),
+        **kw,
+    )
+
+
+def test_existence_index(flask_client):
+    user = create_new_user()
+    alias = Alias.create_new_random(user)
+    Session.flush()
+    contact = Contact.create(
+        user_id=user.id,
+        alias_id=alias.id,
+        website_email=random_email(),
+        reply_email=f"{random_token(20)}@sl.local",
+        commit=True,
+    )
+    unknown = f"{random_token(20)}@sl.local"
+
+    index = create_index()
+    # not used before it's built
+    assert index.may_be_alias(unknown)
+
+    index.build()
+    assert index.may_be_alias(alias.email)
+    assert index.may_be_reverse_alias(contact.reply_email)
+    assert not index.may_be_alias(unknown)
+    assert not index.may_be_reverse_alias(unknown)
+
+    index.add(ALIAS, unknown)
+    assert index.may_be_alias(unknown)
+
+    # the rows inserted by other processes are read on a miss once the sync is due
+    # the index isn't the global one updated by the inserts of this process
+    other_email = Alias.create_new_random(user).email
+    Session.commit()
+    index.sync_interval = 3600
+    with QueryCounter() as counter:
+        assert not index.may_be_alias(other_email)
+    assert counter.nb_queries == 0
+
+    index.sync_interval = 0
+    assert index.may_be_alias(other_email)
+
+
+def test_existence_index_id_gap(flask_client):
+    user = create_new_user()
+    alias = Alias.create_new_random(user)
+    Session.flush()
+    index = create_index()
+    index.build()
+    index.max_transaction_duration = 60
+
+    # the row with the id in between is committed after the next one is read
+    late_email = f"{random_token(20)}@sl.local"
+    Alias.create(
+        id=alias.id + 2,
+        user_id=user.id,
+        email=f"{random_token(20)}@sl.local",
+        mailbox_id=user.default_mailbox_id,
+        commit=True,
+    )
+    assert not index.may_be_alias(late_email)
+
+    Alias.create(
+        id=alias.id + 1,
+        user_id=user.id,
+        email=late_email,
+        mailbox_id=user.default_mailbox_id,
+        commit=True,
+    )
+    assert index.may_be_alias(late_email)
+
+
+def test_is_reverse_alias(flask_client, monkeypatch):
+    monkeypatch.setattr(existence_index, "_sets", None)
+    monkeypatch.setattr(existence_index, "error_rate", 1e-6)
+    monkeypatch.setattr(existence_index, "sync_interval", 3600)
+    monkeypatch.setattr(existence_index, "max_transaction_duration", 0)
+    monkeypatch.setattr(
+        existence_index, "_connect", lambda: nullcontext(Session.connection())
+    )
+    existence_index.build()
+
+    # no sync before the interval
+    with QueryCounter() as counter:
+        assert not is_reverse_alias(f"{random_token(20)}@sl.local")
+    assert counter.nb_queries == 0
+
+    # added by the process that creates the contact
+    user = create_new_user()
+    alias = Alias.create_new_random(user)
+    Session.flush()
+    contact = Contact.create(
+        user_id=user.id,
+        alias_id=alias.id,
+        website_email=random_email(),
+        reply_email=f"{random_token(20)}@sl.local",
+        commit=True,
+    )
+    assert is_reverse_alias(contact.reply_email)
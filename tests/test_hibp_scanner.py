@@ -0,0 +1,140 @@
+import asyncio
+
+import arrow
+
+from app.db import Session
+from app.hibp_scanner import TokenBucket, HibpScanner, BreachCache, due_aliases
+from app.models import Alias, Hibp, AliasHibp
+from tests.utils import create_new_user, FakeHibpServer
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def test_token_bucket():
+    clock = FakeClock()
+    bucket = TokenBucket(60, clock=clock, sleep=clock.sleep)
+
+    async def run():
+        for _ in range(3):
+            await bucket.acquire()
+        # 1 request per second
+        assert clock.now == 2
+
+        bucket.pause(10)
+        await bucket.acquire()
+        assert clock.now == 12
+
+    asyncio.run(run())
+
+
+def test_breach_cache(flask_client):
+    hibp = Hibp.create(name="Breach cache test", flush=True)
+    cache = BreachCache()
+    cache.load()
+
+    assert cache.get_id("Breach cache test") == hibp.id
+    # unknown breaches are created
+    new_id = cache.get_id("New breach cache test")
+    assert Hibp.get_by(name="New breach cache test").id == new_id
+
+
+def test_due_aliases(flask_client):
+    user = create_new_user()
+    now = arrow.utcnow()
+    checked_long_ago = Alias.create_new_random(user)
+    checked_long_ago.hibp_last_check = now.shift(days=-30)
+    checked_before = Alias.create_new_random(user)
+    checked_before.hibp_last_check = now.shift(days=-10)
+    never_checked = Alias.create_new_random(user)
+    # same hibp_last_check, ordered by id
+    checked_long_ago2 = Alias.create_new_random(user)
+    checked_long_ago2.hibp_last_check = checked_long_ago.hibp_last_check
+    checked_recently = Alias.create_new_random(user)
+    checked_recently.hibp_last_check = now
+    Session.commit()
+
+    aliases = [checked_long_ago, checked_before, never_checked, checked_long_ago2]
+    alias_ids = {alias.id for alias in aliases}
+    due_ids = [
+        alias_id
+        for batch in due_aliases(now.shift(days=-7), batch_size=1)
+        for alias_id, _ in batch
+        if alias_id in alias_ids | {checked_recently.id}
+    ]
+    assert due_ids == [
+        never_checked.id,
+        checked_long_ago.id,
+        checked_long_ago2.id,
+        checked_before.id,
+    ]
+
+
+def test_hibp_scanner(flask_client):
+    user = create_new_user()
+    breached = Alias.create_new_random(user)
+    breached2 = Alias.create_new_random(user)
+    not_breached = Alias.create_new_random(user)
+    # not breached anymore
+    was_breached = Alias.create_new_random(user)
+    checked_recently = Alias.create_new_random(user)
+    checked_recently.hibp_last_check = arrow.utcnow()
+    disabled = Alias.create_new_random(user)
+    disabled.enabled = False
+    breach1 = Hibp.create(name="Scanner test 1")
+    breach2 = Hibp.create(name="Scanner test 2")
+    Session.flush()
+    AliasHibp.create(alias_id=was_breached.id, hibp_id=breach1.id)
+    Session.commit()
+
+    breaches = {
+        breached.email: ["Scanner test 1", "Scanner test 2"],
+        breached2.email: ["Scanner test 2"],
+    }
+    with FakeHibpServer(breaches, nb_rate_limited=1) as server:
+        scanner = HibpScanner(
+            ["key1", "key2"],
+            rate_per_minute=6000,
+            workers_per_key=2,
+            api_url=server.url,
+            batch_size=2,
+        )
+        report = asyncio.run(scanner.scan(arrow.now().shift(days=-7)))
+
+    checked_emails = {email for email, _ in server.requests}
+    assert {
+        breached.email,
+        breached2.email,
+        not_breached.email,
+        was_breached.email,
+    } <= checked_emails
+    assert checked_recently.email not in checked_emails
+    assert disabled.email not in checked_emails
+    assert {api_key for _, api_key in server.requests} <= {"key1", "key2"}
+
+    assert report.nb_rate_limited == 1
+    assert report.nb_errors == 0
+    assert report.nb_breached >= 2
+    assert sum(report.nb_checked_per_key.values()) == report.nb_checked
+    assert report.aliases_per_minute_per_key() > 0
+
+    Session.expire_all()
+    assert {h.id for h in Alias.get(breached.id).hibp_breaches} == {
+        breach1.id,
+        breach2.id,
+    }
+    assert [h.id for h in Alias.get(breached2.id).hibp_breaches] == [breach2.id]
+    assert Alias.get(not_breached.id).hibp_breaches == []
+    assert Alias.get(was_breached.id).hibp_breaches == []
+    for alias_id in (breached.id, not_breached.id, was_breached.id):
+        assert Alias.get(alias_id).hibp_last_check is not None
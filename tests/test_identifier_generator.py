@@ -0,0 +1,48 @@
+from app.db import Session
+from app.identifier_generator import (
+    find_used,
+    generate_free,
+    IdentifierPool,
+    generate_one_free,
+)
+from app.models import Alias, Contact
+from tests.utils import create_new_user, random_email, random_token, QueryCounter
+
+
+def test_find_used(flask_client):
+    user = create_new_user()
+    alias = Alias.create_new_random(user)
+    Session.flush()
+    contact = Contact.create(
+        user_id=user.id,
+        alias_id=alias.id,
+        website_email=random_email(),
+        reply_email=f"{random_token(20)}@sl.local",
+        flush=True,
+    )
+    free = random_email()
+
+    with QueryCounter() as counter:
+        used = find_used([alias.email, contact.reply_email, free])
+    assert used == {alias.email, contact.reply_email}
+    assert counter.nb_queries == 1
+
+
+def test_generate_free(flask_client):
+    user = create_new_user()
+    alias = Alias.create_new_random(user)
+    Session.flush()
+    candidates = iter([alias.email, alias.email, "free@sl.local", alias.email])
+
+    assert generate_free(lambda: next(candidates), batch_size=2) == ["free@sl.local"]
+    assert generate_one_free(random_email)
+
+
+def test_identifier_pool(flask_client):
+    pool = IdentifierPool(random_email, pool_size=0, batch_size=5)
+
+    with QueryCounter() as counter:
+        identifiers = {pool.get() for _ in range(5)}
+    assert len(identifiers) == 5
+    # the other free candidates of the first batch are used next
+    assert counter.nb_queries == 1
@@ -0,0 +1,79 @@
+from app.db import Session
+from app.lookup_cache import lookup_cache
+from app.models import Alias, Contact
+from tests.utils import create_new_user, random_email, QueryCounter
+
+
+def test_lookup_cache(flask_client):
+    user = create_new_user()
+    alias = Alias.create_new_random(user)
+    Session.commit()
+
+    with lookup_cache() as cache:
+        with QueryCounter() as counter:
+            for _ in range(3):
+                assert Alias.get_by(email=alias.email) == alias
+                assert Contact.get_by(reply_email="not-exist@sl.test") is None
+
+        assert counter.nb_queries == 2
+        assert cache.nb_miss == 2
+        assert cache.nb_hit == 4
+
+    # no cache outside of lookup_cache()
+    with QueryCounter() as counter:
+        Alias.get_by(email=alias.email)
+        Alias.get_by(email=alias.email)
+    assert counter.nb_queries == 2
+
+
+def test_lookup_cache_only_for_unique_keys(flask_client):
+    user = create_new_user()
+    alias = Alias.create_new_random(user)
+    Session.commit()
+
+    with lookup_cache() as cache:
+        Alias.get_by(email=alias.email, user_id=user.id)
+        Alias.get_by(email=alias.email, user_id=user.id)
+        assert cache.nb_hit == 0
+        assert cache.nb_miss == 0
+
+
+def test_lookup_cache_invalidated_on_create(flask_client):
+    user = create_new_user()
+    alias = Alias.create_new_random(user)
+    Session.commit()
+    reply_email = random_email()
+
+    with lookup_cache():
+        assert Contact.get_by(reply_email=reply_email) is None
+
+        contact = Contact.create(
+            user_id=user.id,
+            alias_id=alias.id,
+            website_email="contact@example.com",
+            reply_email=reply_email,
+        )
+        assert Contact.get_by(reply_email=reply_email) == contact
+
+        Session.commit()
+        assert Contact.get_by(reply_email=reply_email) == contact
+
+
+def test_lookup_cache_invalidated_on_rollback(flask_client):
+    user = create_new_user()
+    alias = Alias.create_new_random(user)
+    Session.commit()
+    reply_email = random_email()
+
+    with lookup_cache():
+        Contact.create(
+            user_id=user.id,
+            alias_id=alias.id,
+            website_email="contact@example.com",
+            reply_email=reply_email,
+            flush=True,
+        )
+        assert Contact.get_by(reply_email=reply_email)
+
+        Session.rollback()
+        assert Contact.get_by(reply_email=reply_email) is None
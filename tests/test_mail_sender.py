@@ -91,14 +91,13 @@ def smtp_response_server(smtp_response: str) -> Callable[[], int]:
         smtp_response_server("500 error"),
     ],
 )
-def test_mail_sender_save_unsent_to_disk(server_fn):
-    original_postfix_server = config.POSTFIX_SERVER
-    config.POSTFIX_SERVER = "localhost"
-    config.NOT_SEND_EMAIL = False
-    config.POSTFIX_SUBMISSION_TLS = False
-    config.POSTFIX_PORT = server_fn()
+def test_mail_sender_save_unsent_to_disk(server_fn, monkeypatch):
+    monkeypatch.setattr(config, "POSTFIX_SERVER", "localhost")
+    monkeypatch.setattr(config, "NOT_SEND_EMAIL", False)
+    monkeypatch.setattr(config, "POSTFIX_SUBMISSION_TLS", False)
+    monkeypatch.setattr(config, "POSTFIX_PORT", server_fn())
     with tempfile.TemporaryDirectory() as temp_dir:
-        config.SAVE_UNSENT_DIR = temp_dir
+        monkeypatch.setattr(config, "SAVE_UNSENT_DIR", temp_dir)
         send_request = create_dummy_send_request()
         mail_sender.send(send_request, 0)
         found_files = os.listdir(temp_dir)
@@ -112,5 +111,108 @@ def test_mail_sender_save_unsent_to_disk(server_fn):
         assert send_request.envelope_from == loaded_send_request.envelope_from
         assert send_request.msg[headers.TO] == loaded_send_request.msg[headers.TO]
         assert send_request.msg[headers.FROM] == loaded_send_request.msg[headers.FROM]
-    config.POSTFIX_SERVER = original_postfix_server
-    config.NOT_SEND_EMAIL = True
+
+
+class SinkHandler:
+    def __init__(self):
+        self.envelopes = []
+
+    async def handle_DATA(self, server, session, envelope) -> str:
+        self.envelopes.append(envelope)
+        return "250 Message accepted for delivery"
+
+
+@pytest.mark.parametrize(
+    "max_messages,nb_connections",
+    [
+        (100, 1),
+        # connection recycled after 2 emails
+        (2, 3),
+    ],
+)
+def test_mail_sender_connection_pool(max_messages, nb_connections, monkeypatch):
+    handler = SinkHandler()
+    controller = Controller(handler, hostname="localhost", port=closed_dummy_server())
+    controller.start()
+
+    monkeypatch.setattr(config, "POSTFIX_SERVER", "localhost")
+    monkeypatch.setattr(config, "NOT_SEND_EMAIL", False)
+    monkeypatch.setattr(config, "POSTFIX_SUBMISSION_TLS", False)
+    monkeypatch.setattr(config, "POSTFIX_PORT", controller.port)
+    mail_sender.enable_connection_pool(2, max_messages=max_messages)
+    try:
+        for _ in range(5):
+            mail_sender.send(create_dummy_send_request(), 0)
+
+        assert len(handler.envelopes) == 5
+        assert mail_sender._connection_pool.nb_connections_created == nb_connections
+    finally:
+        mail_sender.disable_connection_pool()
+        controller.stop()
+
+
+def test_mail_sender_background_pool(monkeypatch):
+    handler = SinkHandler()
+    controller = Controller(handler, hostname="localhost", port=closed_dummy_server())
+    controller.start()
+
+    monkeypatch.setattr(config, "POSTFIX_SERVER", "localhost")
+    monkeypatch.setattr(config, "NOT_SEND_EMAIL", False)
+    monkeypatch.setattr(config, "POSTFIX_SUBMISSION_TLS", False)
+    monkeypatch.setattr(config, "POSTFIX_PORT", controller.port)
+    mail_sender.enable_background_pool(2, max_per_destination=1)
+    try:
+        for _ in range(5):
+            mail_sender.send(create_dummy_send_request(), 0, wait=False)
+
+        assert mail_sender.wait_background_deliveries(timeout=10)
+        assert len(handler.envelopes) == 5
+    finally:
+        mail_sender.disable_background_pool()
+        controller.stop()
+
+
+def test_mail_sender_background_pool_save_unsent_to_disk(monkeypatch):
+    monkeypatch.setattr(config, "POSTFIX_SERVER", "localhost")
+    monkeypatch.setattr(config, "NOT_SEND_EMAIL", False)
+    monkeypatch.setattr(config, "POSTFIX_SUBMISSION_TLS", False)
+    monkeypatch.setattr(config, "POSTFIX_PORT", closed_dummy_server())
+    mail_sender.enable_background_pool(1, retry_base_delay=0.01)
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            monkeypatch.setattr(config, "SAVE_UNSENT_DIR", temp_dir)
+            send_request = create_dummy_send_request()
+            mail_sender.send(send_request, 2, wait=False)
+
+            assert mail_sender.wait_background_deliveries(timeout=10)
+            found_files = os.listdir(temp_dir)
+            assert len(found_files) == 1
+    finally:
+        mail_sender.disable_background_pool()
+
+
+def test_mail_sender_replay_unsent_emails(monkeypatch):
+    handler = SinkHandler()
+    controller = Controller(handler, hostname="localhost", port=closed_dummy_server())
+    controller.start()
+
+    monkeypatch.setattr(config, "POSTFIX_SERVER", "localhost")
+    monkeypatch.setattr(config, "NOT_SEND_EMAIL", False)
+    monkeypatch.setattr(config, "POSTFIX_SUBMISSION_TLS", False)
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            monkeypatch.setattr(config, "SAVE_UNSENT_DIR", temp_dir)
+            # Postfix is down
+            monkeypatch.setattr(config, "POSTFIX_PORT", closed_dummy_server())
+            send_request = create_dummy_send_request()
+            mail_sender.send(send_request, 0)
+            assert len(os.listdir(temp_dir)) == 1
+
+            # Postfix is back
+            monkeypatch.setattr(config, "POSTFIX_PORT", controller.port)
+            assert mail_sender.replay_unsent_emails() == (1, 0)
+            assert os.listdir(temp_dir) == []
+            assert len(handler.envelopes) == 1
+            assert handler.envelopes[0].rcpt_tos == [send_request.envelope_to]
+    finally:
+        controller.stop()
@@ -1,8 +1,20 @@
 import email
+import email.policy
+import os
+
+import pytest
+
 from app.email_utils import (
     copy,
 )
-from app.message_utils import message_to_bytes
+from app.message_utils import (
+    message_to_bytes,
+    parse_message,
+    LazyMessage,
+    serialization_stats,
+    append_header,
+)
+from tests.utils import load_eml_file
 
 
 def test_copy():
@@ -33,3 +45,109 @@ def test_to_bytes():
 
     msg = email.message_from_string("éèà€")
     assert message_to_bytes(msg).decode() == "\néèà€"
+
+
+def test_parse_message_lazy():
+    raw = message_to_bytes(load_eml_file("multipart_alternative.eml"))
+    msg = parse_message(raw)
+    assert isinstance(msg, LazyMessage)
+    assert not msg.is_body_parsed()
+    assert msg.get_content_type() == "multipart/alternative"
+
+    # header changes don't need the body
+    msg.replace_header("Subject", "new subject")
+    msg_bytes = message_to_bytes(msg)
+    assert not msg.is_body_parsed()
+    assert b"Subject: new subject" in msg_bytes
+
+    # the copy shares the unparsed body
+    msg2 = copy(msg)
+    assert not msg2.is_body_parsed()
+
+    # the body is parsed on demand, with the same result
+    parts = msg.get_payload()
+    assert msg.is_body_parsed()
+    assert len(parts) == 2
+    assert message_to_bytes(msg) == msg_bytes
+
+    assert not msg2.is_body_parsed()
+    assert message_to_bytes(msg2) == msg_bytes
+
+
+def test_parse_message_lazy_set_payload():
+    msg = parse_message(b"Subject: subject\n\nbody")
+    msg.set_payload("new body")
+    assert message_to_bytes(msg) == b"Subject: subject\n\nnew body"
+
+
+def test_parse_message_lazy_linesep():
+    raw = b"Subject: subject\r\nContent-Type: text/plain\r\n\r\nline 1\r\nline 2\r\n"
+    for generator_policy in [None, email.policy.SMTP]:
+        msg = parse_message(raw)
+        lazy_bytes = msg.as_bytes(policy=generator_policy)
+        msg.get_payload()
+        assert msg.is_body_parsed()
+        assert lazy_bytes == msg.as_bytes(policy=generator_policy)
+
+
+EXAMPLE_EMLS_DIR = os.path.join(os.path.dirname(__file__), "example_emls")
+
+
+@pytest.mark.parametrize(
+    "filename",
+    [
+        pytest.param(
+            filename,
+            marks=pytest.mark.xfail(
+                reason="the eager parsing re-folds the headers of the attached report, "
+                "the lazy parsing forwards them as received"
+            ),
+        )
+        if filename == "yahoo_complaint.eml"
+        else filename
+        for filename in sorted(os.listdir(EXAMPLE_EMLS_DIR))
+    ],
+)
+def test_parse_message_lazy_same_bytes(filename):
+    with open(os.path.join(EXAMPLE_EMLS_DIR, filename), "rb") as f:
+        raw = f.read()
+
+    lazy_msg = parse_message(raw, lazy=True)
+    assert isinstance(lazy_msg, LazyMessage)
+    assert message_to_bytes(lazy_msg) == message_to_bytes(
+        parse_message(raw, lazy=False)
+    )
+
+
+def test_message_to_bytes_cache():
+    msg = load_eml_file("multipart_alternative.eml")
+    with serialization_stats() as stats:
+        msg_bytes = message_to_bytes(msg)
+        assert message_to_bytes(msg) is msg_bytes
+        assert stats.nb_serialization == 1
+        assert stats.nb_cache_hit == 1
+
+        # a copy has the same bytes
+        assert message_to_bytes(copy(msg)) is msg_bytes
+        assert stats.nb_serialization == 1
+
+        # header change
+        msg.replace_header("Subject", "new subject")
+        assert b"Subject: new subject" in message_to_bytes(msg)
+        assert stats.nb_serialization == 2
+
+        # change in a part
+        msg.get_payload()[0].set_payload("new payload")
+        assert b"new payload" in message_to_bytes(msg)
+        assert stats.nb_serialization == 3
+
+
+def test_append_header():
+    msg = load_eml_file("multipart_alternative.eml")
+    with serialization_stats() as stats:
+        message_to_bytes(msg)
+        append_header(msg, "DKIM-Signature", "v=1; a=rsa-sha256; " + "b" * 200)
+        msg_bytes = message_to_bytes(msg)
+        assert stats.nb_serialization == 1
+
+    assert msg_bytes == msg.as_bytes()
@@ -0,0 +1,220 @@
+import arrow
+from sqlalchemy import text
+
+from app.alias_activity import remove_email_log_partition_activity
+from app.db import Session
+from app.models import Alias, Contact, EmailLog, AliasActivity
+from app.partitioning import (
+    PartitionSpec,
+    is_partitioned,
+    get_partitions,
+    create_future_partitions,
+    drop_partitions_before,
+    has_default_partition,
+    partition_table,
+    unpartition_table,
+)
+from tests.utils import create_new_user
+
+_SPEC = PartitionSpec("partitioning_test", "day", 2)
+
+
+def _create_partitioned_table():
+    Session.execute(
+        text(
+            "CREATE TABLE partitioning_test (id serial, created_at timestamp NOT NULL) "
+            "PARTITION BY RANGE (created_at)"
+        )
+    )
+
+
+def test_is_partitioned(flask_client):
+    _create_partitioned_table()
+
+    assert is_partitioned("partitioning_test")
+    assert not is_partitioned("users")
+    assert not is_partitioned("unknown_table")
+
+
+def test_partition_table(flask_client):
+    Session.execute(
+        text(
+            "CREATE TABLE partitioning_test (id serial PRIMARY KEY, created_at timestamp NOT NULL)"
+        )
+    )
+    Session.execute(
+        text(
+            "CREATE INDEX ix_partitioning_test_created_at ON partitioning_test (created_at)"
+        )
+    )
+    Session.execute(
+        text(
+            "CREATE TABLE partitioning_test_ref (id serial PRIMARY KEY, "
+            "test_id int REFERENCES partitioning_test (id))"
+        )
+    )
+    Session.execute(
+        text("INSERT INTO partitioning_test (created_at) VALUES ('2026-10-15 10:00')")
+    )
+
+    partition_table(_SPEC, arrow.get("2026-10-16T15:00:00"))
+    assert is_partitioned("partitioning_test")
+    assert [p.name for p in get_partitions("partitioning_test")] == [
+        "partitioning_test_legacy",
+        "partitioning_test_p20261017",
+        "partitioning_test_p20261018",
+    ]
+    assert has_default_partition("partitioning_test")
+    # the existing rows are kept in the legacy partition, the foreign keys to the table dropped
+    assert (
+        Session.execute(text("SELECT count(*) FROM partitioning_test_legacy")).scalar()
+        == 1
+    )
+    assert not Session.execute(
+        text(
+            "SELECT EXISTS (SELECT 1 FROM pg_constraint "
+            "WHERE conrelid = 'partitioning_test_ref'::regclass AND contype = 'f')"
+        )
+    ).scalar()
+
+    Session.execute(
+        text("INSERT INTO partitioning_test (created_at) VALUES ('2026-10-17 10:00')")
+    )
+    unpartition_table("partitioning_test")
+    assert not is_partitioned("partitioning_test")
+    assert Session.execute(text("SELECT count(*) FROM partitioning_test")).scalar() == 2
+    assert Session.execute(
+        text(
+            "SELECT EXISTS (SELECT 1 FROM pg_indexes "
+            "WHERE indexname = 'ix_partitioning_test_created_at')"
+        )
+    ).scalar()
+
+
+def test_create_future_partitions(flask_client):
+    _create_partitioned_table()
+    now = arrow.get("2026-10-16T15:00:00")
+
+    created = create_future_partitions(_SPEC, now)
+    assert created == [
+        "partitioning_test_p20261016",
+        "partitioning_test_p20261017",
+        "partitioning_test_p20261018",
+    ]
+    assert [p.upper for p in get_partitions("partitioning_test")] == [
+        arrow.get("2026-10-17").naive,
+        arrow.get("2026-10-18").naive,
+        arrow.get("2026-10-19").naive,
+    ]
+
+    # idempotent, continues after the last partition
+    assert create_future_partitions(_SPEC, now) == []
+    assert create_future_partitions(_SPEC, now.shift(days=1)) == [
+        "partitioning_test_p20261019"
+    ]
+
+    # the rows go into their partition
+    Session.execute(
+        text("INSERT INTO partitioning_test (created_at) VALUES ('2026-10-17 10:00')")
+    )
+    assert (
+        Session.execute(
+            text("SELECT count(*) FROM partitioning_test_p20261017")
+        ).scalar()
+        == 1
+    )
+
+
+def test_create_future_partitions_default_partition(flask_client):
+    _create_partitioned_table()
+    now = arrow.get("2026-10-16T15:00:00")
+    create_future_partitions(_SPEC, now)
+    assert not has_default_partition("partitioning_test")
+    Session.execute(
+        text(
+            "CREATE TABLE partitioning_test_default PARTITION OF partitioning_test DEFAULT"
+        )
+    )
+    assert has_default_partition("partitioning_test")
+    # not returned with the range partitions
+    assert len(get_partitions("partitioning_test")) == 3
+
+    # the partition of the 19th wasn't created in time
+    Session.execute(
+        text("INSERT INTO partitioning_test (created_at) VALUES ('2026-10-19 10:00')")
+    )
+    assert create_future_partitions(_SPEC, now.shift(days=1)) == [
+        "partitioning_test_p20261019"
+    ]
+
+    def count(table: str) -> int:
+        return Session.execute(text(f"SELECT count(*) FROM {table}")).scalar()
+
+    assert count("partitioning_test_p20261019") == 1
+    assert count("partitioning_test_default") == 0
+    assert has_default_partition("partitioning_test")
+
+
+def test_drop_partitions_before(flask_client):
+    _create_partitioned_table()
+    create_future_partitions(_SPEC, arrow.get("2026-10-16T15:00:00"))
+    dropped_names = []
+
+    dropped = drop_partitions_before(
+        "partitioning_test",
+        arrow.get("2026-10-18T12:00:00").naive,
+        before_drop=dropped_names.append,
+    )
+
+    # the partition of the 18th has rows younger than the cutoff
+    assert [p.name for p, _ in dropped] == [
+        "partitioning_test_p20261016",
+        "partitioning_test_p20261017",
+    ]
+    assert dropped_names == [p.name for p, _ in dropped]
+    assert [p.name for p in get_partitions("partitioning_test")] == [
+        "partitioning_test_p20261018"
+    ]
+
+
+def test_remove_email_log_partition_activity(flask_client):
+    user = create_new_user()
+    alias = Alias.create_new_random(user)
+    Session.flush()
+    contact = Contact.create(
+        user_id=user.id,
+        alias_id=alias.id,
+        website_email="contact@example.com",
+        reply_email="rep@sl.local",
+        flush=True,
+    )
+
+    def create(created_at, **kwargs) -> EmailLog:
+        return EmailLog.create(
+            user_id=user.id,
+            alias_id=alias.id,
+            contact_id=contact.id,
+            created_at=created_at,
+            flush=True,
+            **kwargs,
+        )
+
+    old_forward = create(arrow.now().shift(days=-20))
+    old_reply = create(arrow.now().shift(days=-20), is_reply=True)
+    create(arrow.now(), blocked=True)
+
+    # a copy of the old email logs stands for their partition
+    Session.execute(
+        text(
+            "CREATE TABLE email_log_partition_test AS "
+            "SELECT * FROM email_log WHERE id IN (:id1, :id2)"
+        ),
+        {"id1": old_forward.id, "id2": old_reply.id},
+    )
+    remove_email_log_partition_activity("email_log_partition_test")
+    Session.expire_all()
+
+    activity = AliasActivity.get_by(alias_id=alias.id)
+    assert (activity.nb_forward, activity.nb_reply, activity.nb_blocked) == (0, 0, 1)
+    # the latest email log isn't in the partition
+    assert activity.latest_email_log_id is not None
@@ -0,0 +1,18 @@
+from app.read_replica import RecentWrites
+
+
+def test_recent_writes():
+    now = 1000
+    recent_writes = RecentWrites(5, clock=lambda: now)
+    recent_writes.add(1)
+    assert 1 in recent_writes
+    assert 2 not in recent_writes
+
+    now += 5
+    assert 1 not in recent_writes
+
+    # the expired writes are purged
+    recent_writes.add(2)
+    now += 1
+    recent_writes.add(3)
+    assert list(recent_writes._written_at) == [2, 3]
@@ -1,4 +1,9 @@
-from app.regex_utils import regex_match
+from app.regex_utils import (
+    regex_match,
+    first_matching_rule,
+    clear_regex_cache,
+    COMBINED_MATCHER_MIN_RULES,
+)
 
 
 def test_regex_match(flask_client):
@@ -7,3 +12,56 @@ def test_regex_match(flask_client):
     # this generates re2 error "Argument 'pattern' has incorrect type (expected bytes, got PythonRePattern)"
     # fallback to re
     assert not regex_match("(?!abcd)s(\\.|-)?([a-z0-9]{4,6})", "abcd")
+
+
+class _Rule:
+    def __init__(self, id, regex):
+        self.id = id
+        self.regex = regex
+
+
+def test_regex_match_is_cached(flask_client):
+    clear_regex_cache()
+    assert regex_match("prefix.*", "prefix-abcd", rule_id=1)
+    assert not regex_match("prefix.*", "abcd", rule_id=1)
+    # same rule id, different regex
+    assert regex_match("abcd", "abcd", rule_id=1)
+
+
+def test_first_matching_rule(flask_client):
+    rules = [_Rule(1, "a.*"), _Rule(2, "ab.*"), _Rule(3, "b.*")]
+    assert first_matching_rule(rules, "abcd").id == 1
+    assert first_matching_rule(rules, "bcd").id == 3
+    assert first_matching_rule(rules, "cd") is None
+    assert first_matching_rule([], "cd") is None
+
+
+def test_first_matching_rule_combined(flask_client):
+    rules = [_Rule(i, f"prefix{i}(\\.|-)?[a-z]+") for i in range(10)]
+    rules.append(_Rule(100, ".*"))
+    assert len(rules) >= COMBINED_MATCHER_MIN_RULES
+
+    assert first_matching_rule(rules, "prefix3-abcd").id == 3
+    # the catch-all rule is the last one
+    assert first_matching_rule(rules, "prefix3").id == 100
+    assert first_matching_rule(rules[:-1], "prefix3") is None
+
+
+def test_first_matching_rule_combined_fallback(flask_client):
+    # same group name in several rules and a rule not supported by re2
+    rules = [
+        _Rule(1, "(?P<name>a)"),
+        _Rule(2, "(?P<name>b)"),
+        _Rule(3, "(?!abcd)s(\\.|-)?([a-z0-9]{4,6})"),
+        _Rule(4, "c"),
+    ]
+    assert first_matching_rule(rules, "b").id == 2
+    assert first_matching_rule(rules, "s-efgh").id == 3
+    assert first_matching_rule(rules, "abcd") is None
+
+
+def test_first_matching_rule_combined_backreference(flask_client):
+    # in the combined regex, \1 would be the group of the first rule
+    rules = [_Rule(1, "x"), _Rule(2, "y"), _Rule(3, "z"), _Rule(4, r"(a)\1")]
+    assert first_matching_rule(rules, "aa").id == 4
+    assert first_matching_rule(rules, "ab") is None
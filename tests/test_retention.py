@@ -0,0 +1,118 @@
+import arrow
+import pytest
+
+from app.db import Session
+from app.models import EmailLog, Contact, Alias, RetentionCheckpoint, Bounce
+from app.retention import (
+    apply_retention_policy,
+    get_retention_policy,
+    Throttle,
+)
+from tests.utils import create_new_user
+
+
+def _create_email_logs(nb_old: int, nb_new: int) -> ([int], [int]):
+    user = create_new_user()
+    alias = Alias.create_new_random(user)
+    Session.flush()
+    contact = Contact.create(
+        user_id=user.id,
+        alias_id=alias.id,
+        website_email="contact@example.com",
+        reply_email="rep@sl.local",
+        flush=True,
+    )
+
+    def create(created_at) -> int:
+        return EmailLog.create(
+            user_id=user.id,
+            alias_id=alias.id,
+            contact_id=contact.id,
+            created_at=created_at,
+            flush=True,
+        ).id
+
+    old_ids = [create(arrow.now().shift(weeks=-3)) for _ in range(nb_old)]
+    new_ids = [create(arrow.now()) for _ in range(nb_new)]
+    Session.commit()
+    return old_ids, new_ids
+
+
+def test_apply_retention_policy(flask_client):
+    old_ids, new_ids = _create_email_logs(5, 2)
+
+    report = apply_retention_policy(
+        get_retention_policy("email_log"), batch_size=2, throttle=Throttle()
+    )
+
+    assert report.nb_deleted >= 5
+    assert report.nb_batches >= 3
+    assert EmailLog.filter(EmailLog.id.in_(old_ids)).count() == 0
+    assert EmailLog.filter(EmailLog.id.in_(new_ids)).count() == 2
+
+    # the next run starts from the range of the new email logs
+    checkpoint = RetentionCheckpoint.get_by(name="email_log")
+    assert checkpoint.next_id <= min(new_ids)
+
+    report = apply_retention_policy(
+        get_retention_policy("email_log"), batch_size=2, throttle=Throttle()
+    )
+    assert report.nb_deleted == 0
+    assert report.nb_batches == 1
+
+
+def test_apply_retention_policy_resume(flask_client):
+    old_ids, new_ids = _create_email_logs(6, 1)
+
+    class Interrupted(Exception):
+        pass
+
+    def interrupt(delay):
+        raise Interrupted()
+
+    # interrupted after the first batch
+    with pytest.raises(Interrupted):
+        apply_retention_policy(
+            get_retention_policy("email_log"),
+            batch_size=2,
+            throttle=Throttle(max_rows_per_second=1, sleep=interrupt),
+        )
+    assert 0 < EmailLog.filter(EmailLog.id.in_(old_ids)).count() < 6
+
+    apply_retention_policy(
+        get_retention_policy("email_log"), batch_size=2, throttle=Throttle()
+    )
+    assert EmailLog.filter(EmailLog.id.in_(old_ids)).count() == 0
+    assert EmailLog.filter(EmailLog.id.in_(new_ids)).count() == 1
+
+
+def test_apply_retention_policy_empty_table(flask_client):
+    Bounce.filter().delete()
+    report = apply_retention_policy(get_retention_policy("bounce"), throttle=Throttle())
+    assert report.nb_deleted == 0
+    assert report.nb_batches == 0
+
+
+def test_throttle_rows_per_second():
+    delays = []
+    throttle = Throttle(max_rows_per_second=100, sleep=delays.append)
+
+    assert throttle.wait(500, 1) == 4
+    assert delays == [4]
+
+    # the batch was slow enough
+    assert throttle.wait(50, 1) == 0
+    assert delays == [4]
+
+
+def test_throttle_replication_lag():
+    delays = []
+    lags = [20, 12, 3]
+
+    class FakeThrottle(Throttle):
+        def replication_lag(self) -> float:
+            return lags.pop(0)
+
+    throttle = FakeThrottle(max_replication_lag=10, sleep=delays.append)
+    assert throttle.wait(100, 1) == 32
+    assert delays == [20, 12]
@@ -3,12 +3,18 @@ import json
 import os
 import random
 import string
+import threading
+import time
+import urllib.parse
 from email.message import EmailMessage
-from typing import Optional, Dict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Optional, Dict, List
 
 import jinja2
 from flask import url_for
+from sqlalchemy import event
 
+from app.db import engine
 from app.models import User
 from app.utils import random_string
 
@@ -71,3 +77,83 @@ def load_eml_file(
 
 def random_email() -> str:
     return "{rand}@{rand}.com".format(rand=random_string(20))
+
+
+class QueryCounter:
+    """count the SQL queries sent to the database"""
+
+    def __init__(self):
+        self.nb_queries = 0
+        self.statements = []
+
+    def __enter__(self):
+        event.listen(engine, "before_cursor_execute", self._count)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(engine, "before_cursor_execute", self._count)
+
+    def _count(self, conn, cursor, statement, *args):
+        self.nb_queries += 1
+        self.statements.append(statement)
+
+
+class FakeHibpServer:
+    """
+    HIBP API on localhost: breaches maps an email to its breach names, the other emails aren't breached.
+    The first nb_rate_limited requests are answered with a 429, each request takes latency seconds.
+    """
+
+    def __init__(
+        self,
+        breaches: Dict[str, List[str]],
+        nb_rate_limited: int = 0,
+        latency: float = 0,
+    ):
+        self.breaches = breaches
+        self.nb_rate_limited = nb_rate_limited
+        self.latency = latency
+        # (email, api key) of the requests
+        self.requests = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.url = f"http://127.0.0.1:{self._server.server_port}/api/v3"
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                email = urllib.parse.unquote(self.path.rsplit("/", 1)[-1])
+                time.sleep(fake.latency)
+                with fake._lock:
+                    fake.requests.append((email, self.headers.get("hibp-api-key")))
+                    rate_limited = fake.nb_rate_limited > 0
+                    fake.nb_rate_limited -= 1
+
+                if rate_limited:
+                    self.send_response(429)
+                    self.send_header("Retry-After", "0")
+                    self.end_headers()
+                elif fake.breaches.get(email):
+                    body = json.dumps([{"Name": name} for name in fake.breaches[email]])
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json")
+                    self.end_headers()
+                    self.wfile.write(body.encode())
+                else:
+                    self.send_response(404)
+                    self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()